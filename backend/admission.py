@@ -0,0 +1,283 @@
+"""
+LLM 生成请求的准入控制：全局并发上限、每用户并发上限、每分钟 token 预算
+
+超过限制的请求进入有界的公平队列（按用户轮转，避免单个用户占满队列头部），
+队列已满或等待超时则拒绝（调用方返回 429 + Retry-After），
+使发给 LLM 服务的并发和 token 速率始终保持在限额附近而不会整体失败。
+
+所有状态只在事件循环线程中访问，不需要加锁。
+
+环境变量：
+    LLM_MAX_CONCURRENCY           全局并发上限，默认 8
+    LLM_MAX_CONCURRENCY_PER_USER  每用户并发上限，默认 2
+    LLM_TOKENS_PER_MINUTE         每分钟 token 预算，0 表示不限制，默认 0
+    LLM_QUEUE_MAX                 最大排队请求数，默认 100
+    LLM_QUEUE_TIMEOUT_SECONDS     最长排队时间（秒），默认 30
+"""
+import asyncio
+import math
+import os
+import time
+from collections import OrderedDict, defaultdict, deque
+from typing import Hashable, Optional
+
+
+class AdmissionRejected(Exception):
+    """请求被拒绝（队列已满或排队超时）"""
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.retry_after = retry_after
+
+
+def estimate_tokens(prompt: str, expected_output_tokens: int = 500) -> int:
+    """粗略估计一次调用的 token 数（输入约 4 个字符 1 个 token）"""
+    return len(prompt) // 4 + expected_output_tokens
+
+
+class _Waiter:
+    __slots__ = ("user_key", "tokens", "future")
+
+    def __init__(self, user_key: Hashable, tokens: int, future: asyncio.Future):
+        self.user_key = user_key
+        self.tokens = tokens
+        self.future = future
+
+
+class Ticket:
+    """已获准执行的请求，退出时释放并发名额"""
+
+    def __init__(self, controller: "AdmissionController", user_key: Hashable, tokens: int):
+        self.controller = controller
+        self.user_key = user_key
+        self.tokens = tokens
+        self.started_at = time.monotonic()
+
+    def record_usage(self, total_tokens: Optional[int]):
+        """用实际 token 用量修正预算（多退少补）"""
+        if total_tokens is None:
+            return
+        self.controller._adjust_tokens(self.tokens - total_tokens)
+        self.tokens = total_tokens
+
+
+class AdmissionController:
+    def __init__(
+        self,
+        max_concurrency: int = 8,
+        max_per_user: int = 2,
+        tokens_per_minute: int = 0,
+        max_queue: int = 100,
+        queue_timeout: float = 30.0,
+    ):
+        self.max_concurrency = max_concurrency
+        self.max_per_user = max_per_user
+        self.tokens_per_minute = tokens_per_minute
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+
+        self._active = 0
+        self._active_per_user = defaultdict(int)
+        # 用户 -> 等待队列；OrderedDict 的顺序即轮转顺序
+        self._queues: "OrderedDict[Hashable, deque]" = OrderedDict()
+        self._queued = 0
+        self._tokens = float(tokens_per_minute)
+        self._last_refill = time.monotonic()
+        self._wakeup = None
+        self._token_blocked = False
+        # 平均服务时间（EWMA），用于估计 Retry-After
+        self._avg_service = 5.0
+        self.stats = {"admitted": 0, "enqueued": 0, "rejected": 0, "timed_out": 0}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", "8")),
+            max_per_user=int(os.getenv("LLM_MAX_CONCURRENCY_PER_USER", "2")),
+            tokens_per_minute=int(os.getenv("LLM_TOKENS_PER_MINUTE", "0")),
+            max_queue=int(os.getenv("LLM_QUEUE_MAX", "100")),
+            queue_timeout=float(os.getenv("LLM_QUEUE_TIMEOUT_SECONDS", "30")),
+        )
+
+    # ------------------------------------------------------------------
+    # token 预算（令牌桶：容量为每分钟预算，按秒匀速补充）
+    # ------------------------------------------------------------------
+
+    def _refill(self):
+        if self.tokens_per_minute <= 0:
+            return
+        now = time.monotonic()
+        self._tokens = min(
+            float(self.tokens_per_minute),
+            self._tokens + (now - self._last_refill) * self.tokens_per_minute / 60.0
+        )
+        self._last_refill = now
+
+    def _adjust_tokens(self, delta: float):
+        if self.tokens_per_minute <= 0:
+            return
+        self._refill()
+        self._tokens = min(float(self.tokens_per_minute), self._tokens + delta)
+        if delta > 0:
+            self._dispatch()
+
+    def _tokens_ok(self, tokens: int) -> bool:
+        if self.tokens_per_minute <= 0:
+            return True
+        # 单个请求超过整桶容量时只要求桶满，避免永远等不到
+        return self._tokens >= min(tokens, self.tokens_per_minute)
+
+    def _seconds_until_tokens(self, tokens: int) -> float:
+        missing = min(tokens, self.tokens_per_minute) - self._tokens
+        return max(0.0, missing * 60.0 / self.tokens_per_minute)
+
+    # ------------------------------------------------------------------
+    # 准入与调度
+    # ------------------------------------------------------------------
+
+    def _slot_free(self, user_key: Hashable) -> bool:
+        return self._active < self.max_concurrency and self._active_per_user[user_key] < self.max_per_user
+
+    def _admit(self, user_key: Hashable, tokens: int) -> Ticket:
+        self._active += 1
+        self._active_per_user[user_key] += 1
+        if self.tokens_per_minute > 0:
+            self._tokens -= tokens
+        self.stats["admitted"] += 1
+        return Ticket(self, user_key, tokens)
+
+    def _dispatch(self):
+        """按用户轮转，把能执行的排队请求放行"""
+        self._refill()
+        token_wait = None
+        progressed = True
+        while progressed and self._queued and self._active < self.max_concurrency:
+            progressed = False
+            for user_key in list(self._queues.keys()):
+                queue = self._queues[user_key]
+                while queue and queue[0].future.done():
+                    # 已超时/取消的等待者
+                    queue.popleft()
+                    self._queued -= 1
+                if not queue:
+                    del self._queues[user_key]
+                    continue
+                waiter = queue[0]
+                if not self._slot_free(user_key):
+                    continue
+                if not self._tokens_ok(waiter.tokens):
+                    wait = self._seconds_until_tokens(waiter.tokens)
+                    token_wait = wait if token_wait is None else min(token_wait, wait)
+                    continue
+                queue.popleft()
+                self._queued -= 1
+                waiter.future.set_result(self._admit(user_key, waiter.tokens))
+                # 放到轮转队尾
+                self._queues.move_to_end(user_key)
+                if not queue:
+                    del self._queues[user_key]
+                progressed = True
+                if self._active >= self.max_concurrency:
+                    break
+
+        self._token_blocked = token_wait is not None
+        if token_wait is not None and self._wakeup is None:
+            loop = asyncio.get_running_loop()
+            self._wakeup = loop.call_later(max(0.01, token_wait), self._on_wakeup)
+
+    def _on_wakeup(self):
+        self._wakeup = None
+        self._dispatch()
+
+    def retry_after(self) -> float:
+        """估计队列排空所需的时间"""
+        return max(1.0, math.ceil(self._avg_service * (self._queued + 1) / max(1, self.max_concurrency)))
+
+    async def acquire(self, user_key: Hashable, tokens: int = 0) -> Ticket:
+        # 先放行能执行的排队请求；之后仍在排队的都被各自的限制卡住，
+        # 新请求只要自己的用户没有在排队、也没有请求在等 token，就可以直接执行
+        self._dispatch()
+        if (
+            user_key not in self._queues
+            and not self._token_blocked
+            and self._slot_free(user_key)
+            and self._tokens_ok(tokens)
+        ):
+            return self._admit(user_key, tokens)
+
+        if self._queued >= self.max_queue:
+            self.stats["rejected"] += 1
+            raise AdmissionRejected("LLM request queue is full", self.retry_after())
+
+        future = asyncio.get_running_loop().create_future()
+        waiter = _Waiter(user_key, tokens, future)
+        self._queues.setdefault(user_key, deque()).append(waiter)
+        self._queued += 1
+        self.stats["enqueued"] += 1
+        self._dispatch()
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout=self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # 刚好在超时的同时被放行，归还名额
+                self.release(future.result())
+            else:
+                future.cancel()
+                self._remove(waiter)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            self.stats["timed_out"] += 1
+            raise AdmissionRejected("Timed out waiting for an LLM slot", self.retry_after())
+
+    def _remove(self, waiter: _Waiter):
+        queue = self._queues.get(waiter.user_key)
+        if queue is None:
+            return
+        try:
+            queue.remove(waiter)
+            self._queued -= 1
+        except ValueError:
+            pass
+        if not queue:
+            del self._queues[waiter.user_key]
+
+    def release(self, ticket: Ticket):
+        self._active -= 1
+        self._active_per_user[ticket.user_key] -= 1
+        if self._active_per_user[ticket.user_key] <= 0:
+            del self._active_per_user[ticket.user_key]
+        elapsed = time.monotonic() - ticket.started_at
+        self._avg_service = 0.8 * self._avg_service + 0.2 * elapsed
+        self._dispatch()
+
+    def slot(self, user_key: Hashable, tokens: int = 0) -> "_Slot":
+        """async with controller.slot(user, tokens) as ticket: ..."""
+        return _Slot(self, user_key, tokens)
+
+    def snapshot(self) -> dict:
+        self._refill()
+        return {
+            "active": self._active,
+            "queued": self._queued,
+            "tokens_available": None if self.tokens_per_minute <= 0 else int(self._tokens),
+            **self.stats,
+        }
+
+
+class _Slot:
+    def __init__(self, controller: AdmissionController, user_key: Hashable, tokens: int):
+        self.controller = controller
+        self.user_key = user_key
+        self.tokens = tokens
+        self.ticket: Optional[Ticket] = None
+
+    async def __aenter__(self) -> Ticket:
+        self.ticket = await self.controller.acquire(self.user_key, self.tokens)
+        return self.ticket
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self.ticket is not None:
+            self.controller.release(self.ticket)
+            self.ticket = None
+        return False
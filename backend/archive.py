@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+每日任务项归档
+
+把已完成且日期早于保留期限（ARCHIVE_RETENTION_DAYS，默认 90 天）的计划项从 daily_task_items
+移到 daily_task_items_archive（冗余任务名、子任务名、重要性，读取时无需 JOIN），热表只保留近期和未完成的数据。
+每批在一个事务中完成插入归档、删除原行、从 user_daily_loads 索引中扣除、写入增量同步墓碑；
+每次执行后清理过期的墓碑（SYNC_TOMBSTONE_RETENTION_DAYS）。
+
+用法（例如每天由 cron 执行一次）：
+    python archive.py --retention-days 90
+也可以设置 ARCHIVE_INTERVAL_HOURS，由后端进程定期执行（见 main.py）。
+"""
+import argparse
+import os
+import time
+from collections import defaultdict
+from datetime import date, timedelta
+
+from sqlalchemy.orm import Session
+
+from models import DailyTaskItem, DailyTaskItemArchive, Subtask, Task
+from load_index import adjust_user_loads
+from change_tracking import prune_tombstones, record_tombstones, touch_users
+
+ARCHIVE_RETENTION_DAYS = int(os.getenv("ARCHIVE_RETENTION_DAYS", "90"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "5000"))
+
+
+def archive_completed_items(db: Session, before: date, batch_size: int = ARCHIVE_BATCH_SIZE) -> int:
+    """归档 before 之前已完成的计划项，返回归档的行数"""
+    total = 0
+    while True:
+        rows = db.query(
+            DailyTaskItem.id,
+            DailyTaskItem.date,
+            DailyTaskItem.task_id,
+            DailyTaskItem.subtask_id,
+            DailyTaskItem.allocated_hours,
+            DailyTaskItem.created_at,
+            Task.user_id,
+            Task.task_name,
+            Task.importance,
+            Subtask.subtask_name,
+        ).join(
+            Task, DailyTaskItem.task_id == Task.id
+        ).outerjoin(
+            Subtask, DailyTaskItem.subtask_id == Subtask.id
+        ).filter(
+            DailyTaskItem.is_completed == True,
+            DailyTaskItem.date < before
+        ).order_by(DailyTaskItem.id).limit(batch_size).all()
+        if not rows:
+            break
+
+        db.bulk_insert_mappings(DailyTaskItemArchive, [
+            {
+                "id": row.id,
+                "date": row.date,
+                "user_id": row.user_id,
+                "task_id": row.task_id,
+                "subtask_id": row.subtask_id,
+                "allocated_hours": row.allocated_hours,
+                "task_name": row.task_name,
+                "subtask_name": row.subtask_name,
+                "importance": row.importance,
+                "created_at": row.created_at,
+            }
+            for row in rows
+        ])
+        db.query(DailyTaskItem).filter(
+            DailyTaskItem.id.in_([row.id for row in rows])
+        ).delete(synchronize_session=False)
+
+        # 批量删除绕过了 ORM，从每日负载索引中扣除
+        user_deltas = defaultdict(float)
+        for row in rows:
+            user_deltas[(row.user_id, row.date)] -= row.allocated_hours or 0.0
+        adjust_user_loads(db, user_deltas)
+        touch_users(db, {row.user_id for row in rows})
+        # 归档的行从热表中消失，对增量同步的客户端来说等同于删除
+        user_items = defaultdict(list)
+        for row in rows:
+            user_items[row.user_id].append(row.id)
+        for user_id, item_ids in user_items.items():
+            record_tombstones(db, user_id, "item", item_ids)
+
+        db.commit()
+        total += len(rows)
+        if len(rows) < batch_size:
+            break
+    return total
+
+
+def run_archival(retention_days: int = ARCHIVE_RETENTION_DAYS) -> int:
+    """执行一次归档（使用独立的主库会话），并确保未来月份的分区存在"""
+    from database import SessionLocal, engine
+    from partitioning import ensure_partitions
+
+    before = date.today() - timedelta(days=retention_days)
+    started = time.perf_counter()
+    db = SessionLocal()
+    try:
+        archived = archive_completed_items(db, before)
+        pruned = prune_tombstones(db)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+    ensure_partitions(engine)
+    print(f"✅ 已归档 {archived} 个早于 {before.isoformat()} 的已完成计划项，清理 {pruned} 条过期墓碑，用时 {time.perf_counter() - started:.2f}s")
+    return archived
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Archive completed daily task items")
+    parser.add_argument("--retention-days", type=int, default=ARCHIVE_RETENTION_DAYS)
+    args = parser.parse_args()
+    run_archival(args.retention_days)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""
+会话令牌：签名、带过期时间，内嵌内部用户 ID
+
+- POST /users 和 GET /users/by-nickname/{nickname} 在响应中返回 token 和 token_expires_at
+- 客户端之后用 Authorization: Bearer <token> 携带令牌；EventSource、日历订阅等无法设置请求头的场景用 ?access_token=
+- 验证只做一次 HMAC-SHA256 计算，不查询数据库：令牌中直接带有 users.id（用于过滤和归属检查）和公开的 user_id
+- 格式：base64url(JSON {"uid", "sub", "exp"}) + "." + base64url(签名)
+
+环境变量：
+    SESSION_SECRET            签名密钥，多 worker / 多实例部署必须配置同一个值；
+                              逗号分隔多个时用第一个签名、全部用于验证（轮换密钥时把新密钥放在前面）。
+                              未配置时每个进程随机生成，重启后已签发的令牌失效（前端收到 401 后按昵称重新获取令牌）
+    SESSION_SECRET_REQUIRED   是否必须配置 SESSION_SECRET（缺少时启动失败），
+                              在 Railway 上（存在 RAILWAY_ENVIRONMENT）和 entrypoint.sh 启动时默认 1，其他情况默认 0
+    SESSION_TOKEN_TTL_HOURS   令牌有效期（小时），默认 720（30 天）
+    AUTH_ALLOW_USER_ID_PARAM  没有令牌时是否仍接受 user_id 参数识别用户（兼容旧客户端，需要查询一次 users 表），默认 1
+    ADMIN_TOKEN               管理接口（/admin/...，例如性能剖析）的令牌，通过 X-Admin-Token 请求头传递；
+                              未配置时管理接口全部关闭（返回 404）
+"""
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import time
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from fastapi import Depends, Header, HTTPException
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+
+SESSION_TOKEN_TTL_HOURS = float(os.getenv("SESSION_TOKEN_TTL_HOURS", "720"))
+AUTH_ALLOW_USER_ID_PARAM = os.getenv("AUTH_ALLOW_USER_ID_PARAM", "1").lower() in ("1", "true", "yes", "on")
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+SESSION_SECRET_REQUIRED = os.getenv(
+    "SESSION_SECRET_REQUIRED", "1" if os.getenv("RAILWAY_ENVIRONMENT") else "0"
+).lower() in ("1", "true", "yes", "on")
+
+
+def _load_secrets() -> List[bytes]:
+    keys = [key.strip() for key in os.getenv("SESSION_SECRET", "").split(",") if key.strip()]
+    if not keys and SESSION_SECRET_REQUIRED:
+        raise RuntimeError(
+            "SESSION_SECRET is not set. Configure it in the production environment variables "
+            "(a random per-process key would invalidate every session token on restart), "
+            "or set SESSION_SECRET_REQUIRED=0 to allow it"
+        )
+    if not keys:
+        print("⚠️  未配置 SESSION_SECRET，使用进程内随机密钥（重启后或多 worker 部署时令牌会失效）")
+        keys = [secrets.token_urlsafe(32)]
+    return [key.encode("utf-8") for key in keys]
+
+
+SESSION_SECRETS = _load_secrets()
+
+
+class InvalidToken(Exception):
+    """令牌格式错误、签名不匹配或已过期"""
+
+
+class SessionUser:
+    """令牌中携带的用户身份"""
+
+    __slots__ = ("id", "user_id")
+
+    def __init__(self, id: int, user_id: str):
+        self.id = id  # users.id
+        self.user_id = user_id  # 公开的用户 ID
+
+    def __repr__(self):
+        return f"SessionUser(id={self.id}, user_id={self.user_id!r})"
+
+
+def _b64encode(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(value: str) -> bytes:
+    return base64.urlsafe_b64decode(value + "=" * (-len(value) % 4))
+
+
+def _sign(payload: str, key: bytes) -> str:
+    return _b64encode(hmac.new(key, payload.encode("ascii"), hashlib.sha256).digest())
+
+
+def issue_token(user_pk: int, user_id: str, ttl_hours: Optional[float] = None) -> Tuple[str, datetime]:
+    """签发令牌，返回 (token, 过期时间 UTC)"""
+    expires = int(time.time() + (SESSION_TOKEN_TTL_HOURS if ttl_hours is None else ttl_hours) * 3600)
+    payload = _b64encode(json.dumps({"uid": user_pk, "sub": user_id, "exp": expires}, separators=(",", ":")).encode("utf-8"))
+    return f"{payload}.{_sign(payload, SESSION_SECRETS[0])}", datetime.utcfromtimestamp(expires)
+
+
+def verify_token(token: str) -> SessionUser:
+    """验证签名和过期时间（纯计算，不查询数据库）"""
+    payload, _, signature = token.partition(".")
+    if not payload or not signature:
+        raise InvalidToken("malformed token")
+    try:
+        if not any(hmac.compare_digest(_sign(payload, key), signature) for key in SESSION_SECRETS):
+            raise InvalidToken("bad signature")
+        claims = json.loads(_b64decode(payload))
+        user = SessionUser(int(claims["uid"]), str(claims["sub"]))
+        expires = float(claims["exp"])
+    except InvalidToken:
+        raise
+    except (ValueError, KeyError, TypeError) as e:
+        raise InvalidToken(f"malformed token: {str(e)}")
+    if expires < time.time():
+        raise InvalidToken("token expired")
+    return user
+
+
+def token_user_id(token: Optional[str]) -> Optional[str]:
+    """令牌有效时返回其中的公开 user_id，否则返回 None（供中间件识别用户，不抛出异常）"""
+    if not token:
+        return None
+    try:
+        return verify_token(token).user_id
+    except InvalidToken:
+        return None
+
+
+_bearer = HTTPBearer(auto_error=False)
+
+
+def session_user(
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(_bearer),
+    access_token: Optional[str] = None
+) -> Optional[SessionUser]:
+    """FastAPI 依赖：验证请求携带的令牌；没有令牌时返回 None，令牌无效或过期时返回 401"""
+    token = credentials.credentials if credentials is not None else access_token
+    if not token:
+        return None
+    try:
+        return verify_token(token)
+    except InvalidToken as e:
+        raise HTTPException(
+            status_code=401,
+            detail=f"Invalid session token ({str(e)}), please sign in again",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+
+
+def admin_token_valid(token: Optional[str]) -> bool:
+    """是否为有效的管理员令牌（未配置 ADMIN_TOKEN 时总是 False）"""
+    return bool(ADMIN_TOKEN) and bool(token) and hmac.compare_digest(token.encode("utf-8"), ADMIN_TOKEN.encode("utf-8"))
+
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    """FastAPI 依赖：管理接口；未配置 ADMIN_TOKEN 时返回 404（不暴露接口存在），令牌错误时返回 403"""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not found")
+    if not admin_token_valid(x_admin_token):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
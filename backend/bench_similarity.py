@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+相似任务索引（similarity_index.MinHashLSH）的查询开销基准
+
+生成 N 个合成任务放入索引，然后测量：
+- 近似重复查询（改空格、标点、日期、大小写，偶尔增删一个词后的已有任务）的延迟和召回率
+- 无关查询（全新任务）的延迟和误报率
+
+用法：
+    python bench_similarity.py --tasks 1000000 --queries 2000
+"""
+import argparse
+import random
+import resource
+import statistics
+import time
+
+from similarity_index import MinHashLSH
+
+WORDS = (
+    "review lecture notes slides homework midterm final exam practice quiz chapter read write essay "
+    "thesis paper project report presentation lab assignment leetcode algorithm data structure "
+    "database network operating system compiler machine learning react vue python java rust "
+    "复习 完成 准备 整理 笔记 作业 考试 练习 阅读 论文 项目 报告 实验 刷题 背单词 写作 口语 听力"
+).split()
+
+
+def random_task(rng: random.Random) -> str:
+    name = " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 4)))
+    description = " ".join(rng.choice(WORDS) for _ in range(rng.randint(8, 20)))
+    deadline = f"2025-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+    return f"{name} {description} by {deadline}"
+
+
+def perturb(text: str, rng: random.Random) -> str:
+    """模拟用户改写：改日期、大小写、空格、标点，偶尔增删一个词"""
+    words = text.split()
+    if rng.random() < 0.3 and len(words) > 6:
+        words.pop(rng.randrange(1, len(words) - 1))
+    if rng.random() < 0.3:
+        words.insert(rng.randrange(1, len(words)), rng.choice(WORDS))
+    out = []
+    for word in words:
+        if word.startswith("2025-"):
+            word = f"2026-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+        if rng.random() < 0.2:
+            word = word.upper()
+        out.append(word)
+        if rng.random() < 0.15:
+            out.append(rng.choice([",", ";", "!", "  ", "、"]))
+    return " ".join(out)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the near-duplicate task index")
+    parser.add_argument("--tasks", type=int, default=1_000_000)
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--threshold", type=float, default=0.85)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    index = MinHashLSH()
+    samples = []
+    sample_every = max(1, args.tasks // args.queries)
+
+    started = time.perf_counter()
+    for task_id in range(args.tasks):
+        text = random_task(rng)
+        index.add(task_id, text, owner=task_id % 1000)
+        if task_id % sample_every == 0 and len(samples) < args.queries:
+            samples.append((task_id, text))
+        if task_id and task_id % 100_000 == 0:
+            print(f"  indexed {task_id} tasks ({time.perf_counter() - started:.1f}s)")
+    build_seconds = time.perf_counter() - started
+
+    dup_latencies, hits = [], 0
+    for task_id, text in samples:
+        query = perturb(text, rng)
+        t0 = time.perf_counter()
+        matches = index.query(query, threshold=args.threshold, limit=1)
+        dup_latencies.append((time.perf_counter() - t0) * 1000)
+        hits += bool(matches and matches[0][0] == task_id)
+
+    new_latencies, false_hits = [], 0
+    for _ in range(len(samples)):
+        query = random_task(rng)
+        t0 = time.perf_counter()
+        matches = index.query(query, threshold=args.threshold, limit=1)
+        new_latencies.append((time.perf_counter() - t0) * 1000)
+        false_hits += bool(matches)
+
+    rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"tasks indexed:     {len(index)}")
+    print(f"build time:        {build_seconds:.1f}s ({len(index) / build_seconds:.0f} tasks/s)")
+    print(f"peak RSS:          {rss_mb:.0f} MB")
+    for label, latencies in (("near-duplicate", dup_latencies), ("unrelated", new_latencies)):
+        print(
+            f"{label:<15} lookup ms: mean {statistics.mean(latencies):.3f}  "
+            f"p50 {percentile(latencies, 0.5):.3f}  p95 {percentile(latencies, 0.95):.3f}  "
+            f"p99 {percentile(latencies, 0.99):.3f}"
+        )
+    print(f"near-duplicate recall:  {hits / len(samples):.3f}")
+    print(f"unrelated match rate:   {false_hits / len(samples):.3f}")
+
+
+if __name__ == "__main__":
+    main()
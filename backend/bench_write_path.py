@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""
+计划项写接口（勾选完成、修改时间、删除）的 SQL 语句数和延迟基准
+
+在临时 SQLite 数据库中生成数据，对同一批计划项分别执行：
+- before：旧的写法（按 ID 查计划项、查用户、查任务，提交后 refresh，再查任务和子任务构造响应）
+- after：main.py 当前的写法（一次 JOIN 查询加载计划项、任务、子任务并检查归属，提交前构造响应），
+  调用方按会话令牌识别（与前端一致，不再按 user_id 查询用户）
+两者都经过同样的 flush 事件（每日负载、统计、进度、墓碑、变更事件），统计每次请求执行的 SQL 语句数和耗时。
+两种写法都在同一个事件循环中执行，避免把 asyncio.run() 创建事件循环的开销算进 after。
+
+用法：
+    python bench_write_path.py --tasks 200 --requests 500
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+DB_PATH = os.path.join(tempfile.mkdtemp(prefix="bench_write_path_"), "bench.db")
+os.environ["DATABASE_URL"] = f"sqlite:///{DB_PATH}"
+os.environ.setdefault("LLM_PROVIDER", "offline")
+
+from sqlalchemy import event  # noqa: E402
+
+from auth import SessionUser  # noqa: E402
+from database import SessionLocal, engine  # noqa: E402
+from main import AllocatedHoursUpdate, DailyItemResponse, delete_daily_item, toggle_item_complete, update_daily_item  # noqa: E402
+from models import DailyTaskItem, Subtask, Task, User  # noqa: E402
+
+statement_count = [0]
+
+
+@event.listens_for(engine, "before_cursor_execute")
+def _count_statement(conn, cursor, statement, parameters, context, executemany):
+    statement_count[0] += 1
+
+
+# ============================================================================
+# 旧写法（改动前 main.py 中的实现）
+# ============================================================================
+
+def _legacy_response(db, item):
+    task = db.query(Task).filter(Task.id == item.task_id).first()
+    if item.subtask_id is None:
+        subtask_name = task.task_name if task else ""
+    else:
+        subtask = db.query(Subtask).filter(Subtask.id == item.subtask_id).first()
+        subtask_name = subtask.subtask_name if subtask else ""
+    return DailyItemResponse(
+        id=item.id,
+        date=item.date.isoformat(),
+        task_id=item.task_id,
+        task_name=task.task_name if task else "",
+        subtask_id=item.subtask_id if item.subtask_id is not None else 0,
+        subtask_name=subtask_name,
+        allocated_hours=item.allocated_hours,
+        is_completed=item.is_completed,
+        importance=task.importance if task else "medium"
+    )
+
+
+def _legacy_check(db, item, user_id):
+    user = db.query(User).filter(User.user_id == user_id).first()
+    task = db.query(Task).filter(Task.id == item.task_id).first()
+    if not user or not task or task.user_id != user.id:
+        raise RuntimeError("forbidden")
+
+
+def legacy_toggle(db, item_id, user_id):
+    item = db.query(DailyTaskItem).filter(DailyTaskItem.id == item_id).first()
+    _legacy_check(db, item, user_id)
+    item.is_completed = not item.is_completed
+    db.commit()
+    db.refresh(item)
+    return _legacy_response(db, item)
+
+
+def legacy_update(db, item_id, user_id, hours):
+    item = db.query(DailyTaskItem).filter(DailyTaskItem.id == item_id).first()
+    item.allocated_hours = hours
+    db.commit()
+    db.refresh(item)
+    return _legacy_response(db, item)
+
+
+def legacy_delete(db, item_id, user_id):
+    item = db.query(DailyTaskItem).filter(DailyTaskItem.id == item_id).first()
+    _legacy_check(db, item, user_id)
+    db.delete(item)
+    db.commit()
+
+
+# ============================================================================
+# 数据和测量
+# ============================================================================
+
+def seed(tasks: int, subtasks_per_task: int, items_per_subtask: int, rng: random.Random) -> tuple:
+    db = SessionLocal()
+    try:
+        user = User(user_id="bench001", nickname="bench")
+        db.add(user)
+        db.commit()
+        start = date.today()
+        for t in range(tasks):
+            task = Task(user_id=user.id, task_name=f"任务 {t}", description="bench", importance="medium")
+            db.add(task)
+            db.flush()
+            for s in range(subtasks_per_task):
+                subtask = Subtask(task_id=task.id, subtask_name=f"子任务 {t}-{s}", estimated_hours=2.0)
+                db.add(subtask)
+                db.flush()
+                for i in range(items_per_subtask):
+                    db.add(DailyTaskItem(
+                        task_id=task.id, subtask_id=subtask.id,
+                        date=start + timedelta(days=rng.randrange(60)), allocated_hours=1.0
+                    ))
+            db.commit()
+        item_ids = [item_id for (item_id,) in db.query(DailyTaskItem.id)]
+        return SessionUser(user.id, user.user_id), item_ids
+    finally:
+        db.close()
+
+
+def measure(loop, label: str, fn, item_ids: list) -> dict:
+    """fn(db, item_id) 返回协程，在同一个事件循环中依次执行"""
+    counts, latencies = [], []
+    for item_id in item_ids:
+        db = SessionLocal()
+        try:
+            statement_count[0] = 0
+            started = time.perf_counter()
+            loop.run_until_complete(fn(db, item_id))
+            latencies.append((time.perf_counter() - started) * 1000)
+            counts.append(statement_count[0])
+        finally:
+            db.close()
+    latencies.sort()
+    return {
+        "label": label,
+        "statements": statistics.mean(counts),
+        "p50_ms": latencies[len(latencies) // 2],
+        "p99_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Benchmark daily item write endpoints")
+    parser.add_argument("--tasks", type=int, default=200)
+    parser.add_argument("--subtasks", type=int, default=5)
+    parser.add_argument("--items", type=int, default=6)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    caller, item_ids = seed(args.tasks, args.subtasks, args.items, rng)
+    print(f"🔹 {len(item_ids)} 个计划项，每种操作 {args.requests} 次请求（SQLite: {DB_PATH}）")
+    sample = rng.sample(item_ids, min(len(item_ids), args.requests * 3))
+    toggle_ids = sample[:args.requests]
+    update_ids = sample[args.requests:2 * args.requests]
+    delete_ids = sample[2 * args.requests:]
+    half = len(delete_ids) // 2
+
+    user_id = caller.user_id
+
+    async def legacy(fn, *args):
+        return fn(*args)
+
+    loop = asyncio.new_event_loop()
+    try:
+        results = [
+            measure(loop, "toggle  before", lambda db, i: legacy(legacy_toggle, db, i, user_id), toggle_ids),
+            measure(loop, "toggle  after ", lambda db, i: toggle_item_complete(i, None, caller=caller, db=db), toggle_ids),
+            measure(loop, "update  before", lambda db, i: legacy(legacy_update, db, i, user_id, 1.5), update_ids),
+            measure(loop, "update  after ", lambda db, i: update_daily_item(i, AllocatedHoursUpdate(allocated_hours=2.0), None, caller=caller, db=db), update_ids),
+            measure(loop, "delete  before", lambda db, i: legacy(legacy_delete, db, i, user_id), delete_ids[:half]),
+            measure(loop, "delete  after ", lambda db, i: delete_daily_item(i, None, False, caller=caller, db=db), delete_ids[half:]),
+        ]
+    finally:
+        loop.close()
+    print(f"{'operation':<16}{'SQL/request':>12}{'p50 ms':>10}{'p99 ms':>10}")
+    for result in results:
+        print(f"{result['label']:<16}{result['statements']:>12.1f}{result['p50_ms']:>10.2f}{result['p99_ms']:>10.2f}")
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
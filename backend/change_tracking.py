@@ -0,0 +1,229 @@
+"""
+用户日历的变更跟踪
+
+users.calendar_updated_at 记录用户的任务、子任务、计划项最近一次变化的时间，
+由 before_flush 事件在同一个事务中更新；iCalendar 订阅等接口用它生成 ETag/Last-Modified，
+客户端轮询时只读 users 表即可返回 304，不需要查询计划项。
+
+同一个事件还为被删除的任务、子任务、计划项（包括级联删除的子行）写入 sync_tombstones，
+供 /sync 增量同步告诉客户端哪些行已删除；墓碑保留 SYNC_TOMBSTONE_RETENTION_DAYS 天（默认 30）。
+
+事务中变化的行还会整理成行级变更事件（{"type": "item.updated", "id": ..., "data": {...}}），
+提交后交给 add_change_listener() 注册的监听器（events.py 的推送通道），回滚时丢弃。
+
+绕过 ORM 的批量操作（query.delete() 等）需要调用 touch_users()，删除行时还要调用 record_tombstones()。
+"""
+import os
+from datetime import datetime, timedelta
+from typing import Callable, Iterable, List
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from models import DailyTaskItem, Subtask, SyncTombstone, Task, User
+from load_index import loaded_tasks
+
+TRACKED_MODELS = (Task, Subtask, DailyTaskItem)
+TOMBSTONE_ENTITIES = {Task: "task", Subtask: "subtask", DailyTaskItem: "item"}
+SYNC_TOMBSTONE_RETENTION_DAYS = int(os.getenv("SYNC_TOMBSTONE_RETENTION_DAYS", "30"))
+
+_STAGED_KEY = "change_tracking_staged"  # 本次 flush 变化的对象，after_flush 时序列化
+_EVENTS_KEY = "change_tracking_events"  # 已 flush、等待提交的事件 [(user_id, event)]
+_change_listeners: List[Callable[[int, List[dict]], None]] = []
+
+
+def add_change_listener(listener: Callable[[int, List[dict]], None]):
+    """注册提交后的变更监听器：listener(user_id, events)，user_id 为 users.id"""
+    _change_listeners.append(listener)
+
+
+def _stage_event(db: Session, user_id: int, event_type: str, entity_id: int, data: dict = None):
+    event_data = {"type": event_type, "id": entity_id}
+    if data is not None:
+        event_data["data"] = data
+    db.info.setdefault(_EVENTS_KEY, []).append((user_id, event_data))
+
+
+def touch_users(db: Session, user_ids: Iterable[int], when: datetime = None):
+    """把用户的日历标记为已变化（不提交事务）"""
+    user_ids = {user_id for user_id in user_ids if user_id is not None}
+    if not user_ids:
+        return
+    db.query(User).filter(User.id.in_(user_ids)).update(
+        {User.calendar_updated_at: when or datetime.utcnow()},
+        synchronize_session=False
+    )
+
+
+def record_tombstones(db: Session, user_id: int, entity: str, entity_ids: Iterable[int], when: datetime = None):
+    """为批量删除的行写入墓碑（不提交事务）"""
+    when = when or datetime.utcnow()
+    rows = [
+        {"user_id": user_id, "entity": entity, "entity_id": entity_id, "deleted_at": when}
+        for entity_id in entity_ids
+    ]
+    if rows and user_id is not None:
+        db.bulk_insert_mappings(SyncTombstone, rows)
+        for row in rows:
+            _stage_event(db, user_id, f"{entity}.deleted", row["entity_id"])
+
+
+def prune_tombstones(db: Session, retention_days: int = SYNC_TOMBSTONE_RETENTION_DAYS) -> int:
+    """删除超过保留期的墓碑（不提交事务），返回删除的行数"""
+    return db.query(SyncTombstone).filter(
+        SyncTombstone.deleted_at < tombstone_horizon(retention_days)
+    ).delete(synchronize_session=False)
+
+
+def tombstone_horizon(retention_days: int = SYNC_TOMBSTONE_RETENTION_DAYS) -> datetime:
+    """早于这个时间的墓碑可能已被清理，更早的同步游标需要全量同步"""
+    return datetime.utcnow() - timedelta(days=retention_days)
+
+
+def _task_owners(session: Session, task_ids: set) -> dict:
+    found, missing = loaded_tasks(session, task_ids)
+    owners = {task_id: task.user_id for task_id, task in found.items()}
+    if missing:
+        with session.no_autoflush:
+            owners.update(session.query(Task.id, Task.user_id).filter(Task.id.in_(missing)))
+    return owners
+
+
+def _object_task_id(obj):
+    if isinstance(obj, Task):
+        return obj.id
+    return obj.task_id if obj.task_id is not None else getattr(obj.task, "id", None)
+
+
+def _deleted_objects(session: Session) -> list:
+    """本次 flush 删除的对象，包括随任务、子任务级联删除的子行"""
+    deleted = []
+    seen = set()
+
+    def add(obj):
+        if id(obj) not in seen:
+            seen.add(id(obj))
+            deleted.append(obj)
+
+    with session.no_autoflush:
+        for obj in list(session.deleted):
+            if not isinstance(obj, TRACKED_MODELS):
+                continue
+            add(obj)
+            if isinstance(obj, Task):
+                for child in list(obj.subtasks) + list(obj.daily_items):
+                    add(child)
+            elif isinstance(obj, Subtask):
+                for child in obj.daily_items:
+                    add(child)
+    return deleted
+
+
+def _changed_objects(session: Session) -> list:
+    changed = []
+    for obj in list(session.new) + list(session.dirty):
+        if not isinstance(obj, TRACKED_MODELS):
+            continue
+        if obj in session.dirty and not session.is_modified(obj, include_collections=False):
+            continue
+        changed.append(obj)
+    return changed
+
+
+@event.listens_for(Session, "before_flush")
+def _track_calendar_changes(session, flush_context, instances):
+    changed = _changed_objects(session)
+    deleted = _deleted_objects(session)
+    if not changed and not deleted:
+        return
+
+    objects = changed + deleted
+    owners = _task_owners(session, {
+        _object_task_id(obj) for obj in objects if not isinstance(obj, Task)
+    })
+    now = datetime.utcnow()
+
+    def owner_of(obj):
+        if isinstance(obj, Task):
+            return obj.user_id
+        return owners.get(_object_task_id(obj))
+
+    user_ids = {owner_of(obj) for obj in objects}
+    touch_users(session, user_ids, now)
+
+    staged = session.info.setdefault(_STAGED_KEY, [])
+    for obj in changed:
+        user_id = owner_of(obj)
+        if user_id is not None:
+            staged.append((user_id, "created" if obj in session.new else "updated", obj))
+
+    for obj in deleted:
+        user_id = owner_of(obj)
+        if obj.id is None or user_id is None:
+            continue
+        session.add(SyncTombstone(
+            user_id=user_id,
+            entity=TOMBSTONE_ENTITIES[type(obj)],
+            entity_id=obj.id,
+            deleted_at=now,
+        ))
+        staged.append((user_id, "deleted", obj))
+
+
+def _event_data(obj) -> dict:
+    """变更事件中的行数据（字段与 /sync 的响应一致）"""
+    if isinstance(obj, Task):
+        return {
+            "task_name": obj.task_name,
+            "description": obj.description,
+            "importance": obj.importance,
+            "is_long_term": obj.is_long_term,
+            "start_date": obj.start_date.isoformat() if obj.start_date else None,
+            "deadline": obj.deadline.isoformat() if obj.deadline else None,
+        }
+    if isinstance(obj, Subtask):
+        return {
+            "task_id": obj.task_id,
+            "subtask_name": obj.subtask_name,
+            "description": obj.description,
+            "estimated_hours": obj.estimated_hours,
+            "is_completed": obj.is_completed,
+        }
+    return {
+        "date": obj.date.isoformat() if obj.date else None,
+        "task_id": obj.task_id,
+        "subtask_id": obj.subtask_id or 0,
+        "allocated_hours": obj.allocated_hours,
+        "is_completed": obj.is_completed,
+    }
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_change_events(session, flush_context):
+    # flush 之后新行已有 ID，在这里序列化
+    for user_id, op, obj in session.info.pop(_STAGED_KEY, ()):
+        entity = TOMBSTONE_ENTITIES[type(obj)]
+        data = None if op == "deleted" else _event_data(obj)
+        _stage_event(session, user_id, f"{entity}.{op}", obj.id, data)
+
+
+@event.listens_for(Session, "after_commit")
+def _publish_change_events(session):
+    pending = session.info.pop(_EVENTS_KEY, None)
+    if not pending or not _change_listeners:
+        return
+    by_user = {}
+    for user_id, event_data in pending:
+        by_user.setdefault(user_id, []).append(event_data)
+    for listener in _change_listeners:
+        for user_id, events in by_user.items():
+            try:
+                listener(user_id, events)
+            except Exception as e:
+                print(f"⚠️  变更事件推送失败: {str(e)}")
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_change_events(session):
+    session.info.pop(_STAGED_KEY, None)
+    session.info.pop(_EVENTS_KEY, None)
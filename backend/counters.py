@@ -0,0 +1,67 @@
+"""
+汇总表的原子增量更新
+
+汇总表（例如 load_index 的 user_daily_loads）的行由多个并发事务同时修改（多个 worker、归档线程），
+不能先读出旧值、在 Python 中相加再写回：两个事务读到同一个旧值时，后提交的会覆盖先提交的增量；
+两个事务同时插入同一主键的新行时，后提交的违反唯一约束。
+
+这里只发出 "列 = 列 + 增量" 的语句，由数据库保证原子性：increment_rows 在 PostgreSQL / SQLite 上使用 INSERT ... ON CONFLICT DO UPDATE（一条语句完成插入或累加），
+其他数据库退回到 UPDATE，影响 0 行时再 INSERT。
+
+多行更新按主键排序后执行，并发事务以相同顺序加锁，避免 PostgreSQL 上的死锁。
+"""
+from typing import Dict, Sequence
+
+from sqlalchemy import and_, insert, update
+from sqlalchemy.orm import Session
+
+# SQLite 旧版本每条语句最多 999 个绑定参数
+UPSERT_BATCH_ROWS = 100
+
+
+def _dialect_insert(dialect: str):
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        return dialect_insert
+    if dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        return dialect_insert
+    return None
+
+
+def increment_rows(
+    session: Session,
+    table,
+    key_columns: Sequence[str],
+    value_columns: Sequence[str],
+    deltas: Dict[tuple, tuple],
+):
+    """
+    按 {主键值元组: 增量元组} 累加汇总表的行，行不存在时以增量作为初始值插入（不提交事务）
+    可以在 before_flush 事件中调用：只执行 Core 语句，不经过 ORM 的 unit of work
+    """
+    if not deltas:
+        return
+    dialect_insert = _dialect_insert(session.get_bind().dialect.name)
+    rows = [
+        {**dict(zip(key_columns, key)), **dict(zip(value_columns, vector))}
+        for key, vector in sorted(deltas.items())
+    ]
+    if dialect_insert is not None:
+        for start in range(0, len(rows), UPSERT_BATCH_ROWS):
+            stmt = dialect_insert(table).values(rows[start:start + UPSERT_BATCH_ROWS])
+            stmt = stmt.on_conflict_do_update(
+                index_elements=list(key_columns),
+                set_={column: table.c[column] + stmt.excluded[column] for column in value_columns},
+            )
+            session.execute(stmt)
+        return
+
+    for row in rows:
+        result = session.execute(
+            update(table)
+            .where(and_(*(table.c[column] == row[column] for column in key_columns)))
+            .values({column: table.c[column] + row[column] for column in value_columns})
+        )
+        if result.rowcount == 0:
+            session.execute(insert(table).values(row))
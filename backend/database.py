@@ -6,7 +6,7 @@ import sys
 # 添加当前目录到路径，以便导入 models
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
-from models import Base, User, Task, Subtask, DailyTaskItem, DailyPlan
+from models import Base, User, Task, Subtask, DailyTaskItem, DailyPlan, UserDailyLoad, DailyTaskItemArchive, SyncTombstone, UserDailyStat
 
 # 支持 Railway 的 PostgreSQL 或使用 SQLite
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./plans.db")
@@ -27,17 +27,31 @@ else:
 if DATABASE_URL.startswith("postgres://"):
     DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
 
-# 如果是 SQLite，使用 check_same_thread=False
-# 如果是 PostgreSQL，不需要这个参数
-if DATABASE_URL.startswith("sqlite"):
-    engine = create_engine(
-        DATABASE_URL, connect_args={"check_same_thread": False}
-    )
-else:
-    engine = create_engine(DATABASE_URL)
+def _make_engine(url):
+    # 如果是 SQLite，使用 check_same_thread=False
+    # 如果是 PostgreSQL，不需要这个参数
+    if url.startswith("sqlite"):
+        return create_engine(url, connect_args={"check_same_thread": False})
+    return create_engine(url)
+
+
+engine = _make_engine(DATABASE_URL)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# 可选的只读副本：设置 DATABASE_READ_URL 后，只读接口的查询走副本（路由逻辑见 db_router.py）
+DATABASE_READ_URL = os.getenv("DATABASE_READ_URL") or None
+if DATABASE_READ_URL:
+    if DATABASE_READ_URL.startswith("postgres://"):
+        DATABASE_READ_URL = DATABASE_READ_URL.replace("postgres://", "postgresql://", 1)
+    read_info = DATABASE_READ_URL.split("@")[-1] if "@" in DATABASE_READ_URL else DATABASE_READ_URL
+    print(f"✅ 使用只读副本: {read_info}")
+    read_engine = _make_engine(DATABASE_READ_URL)
+else:
+    read_engine = engine
+
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+
 # 创建数据库表
 def init_db():
     from sqlalchemy import inspect
@@ -45,7 +59,7 @@ def init_db():
     # 检查是否需要创建表（优化：只在必要时输出日志）
     inspector = inspect(engine)
     existing_tables = inspector.get_table_names()
-    required_tables = ['users', 'tasks', 'subtasks', 'daily_task_items']
+    required_tables = ['users', 'tasks', 'subtasks', 'daily_task_items', 'user_daily_loads', 'daily_task_items_archive', 'sync_tombstones', 'user_daily_stats']
     missing_tables = [t for t in required_tables if t not in existing_tables]
     
     if missing_tables:
@@ -97,6 +111,146 @@ def _run_migrations():
                         print("✅ start_date 字段已存在")
                     else:
                         print(f"⚠️  添加 start_date 字段时出现警告: {str(e)}")
+        
+        # 迁移 3: 为 users 表添加 calendar_updated_at 字段
+        if 'users' in inspector.get_table_names():
+            columns = [col['name'] for col in inspector.get_columns('users')]
+            if 'calendar_updated_at' not in columns:
+                print("🔹 正在添加 calendar_updated_at 字段到 users 表...")
+                try:
+                    with engine.begin() as conn:
+                        conn.execute(text("ALTER TABLE users ADD COLUMN calendar_updated_at TIMESTAMP"))
+                    print("✅ calendar_updated_at 字段已添加")
+                except Exception as e:
+                    error_str = str(e).lower()
+                    if "duplicate column" in error_str or "already exists" in error_str:
+                        print("✅ calendar_updated_at 字段已存在")
+                    else:
+                        print(f"⚠️  添加 calendar_updated_at 字段时出现警告: {str(e)}")
+        
+        # 迁移 4: 为 tasks、subtasks、daily_task_items 添加 updated_at 字段（增量同步），用 created_at 回填
+        for table in ('tasks', 'subtasks', 'daily_task_items'):
+            if table not in inspector.get_table_names():
+                continue
+            columns = [col['name'] for col in inspector.get_columns(table)]
+            if 'updated_at' in columns:
+                continue
+            print(f"🔹 正在添加 updated_at 字段到 {table} 表...")
+            try:
+                with engine.begin() as conn:
+                    conn.execute(text(f"ALTER TABLE {table} ADD COLUMN updated_at TIMESTAMP"))
+                    conn.execute(text(f"UPDATE {table} SET updated_at = COALESCE(created_at, CURRENT_TIMESTAMP)"))
+                    conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{table}_updated_at ON {table} (updated_at)"))
+                print(f"✅ {table}.updated_at 字段已添加")
+            except Exception as e:
+                error_str = str(e).lower()
+                if "duplicate column" in error_str or "already exists" in error_str:
+                    print(f"✅ {table}.updated_at 字段已存在")
+                else:
+                    print(f"⚠️  添加 {table}.updated_at 字段时出现警告: {str(e)}")
+        
+        # 迁移 5: 为 tasks 表添加进度计数字段，并从已有数据回填
+        if 'tasks' in inspector.get_table_names():
+            columns = [col['name'] for col in inspector.get_columns('tasks')]
+            progress_columns = (
+                ("total_hours", "FLOAT NOT NULL DEFAULT 0"),
+                ("completed_hours", "FLOAT NOT NULL DEFAULT 0"),
+                ("subtask_count", "INTEGER NOT NULL DEFAULT 0"),
+                ("completed_subtasks", "INTEGER NOT NULL DEFAULT 0"),
+                ("next_item_date", "DATE"),
+            )
+            missing = [(name, ddl) for name, ddl in progress_columns if name not in columns]
+            if missing:
+                print("🔹 正在添加进度计数字段到 tasks 表...")
+                try:
+                    with engine.begin() as conn:
+                        for name, ddl in missing:
+                            conn.execute(text(f"ALTER TABLE tasks ADD COLUMN {name} {ddl}"))
+                    db = SessionLocal()
+                    try:
+                        from task_progress import rebuild_task_progress
+                        rebuild_task_progress(db)
+                        db.commit()
+                    finally:
+                        db.close()
+                    print("✅ 进度计数字段已添加并回填")
+                except Exception as e:
+                    error_str = str(e).lower()
+                    if "duplicate column" in error_str or "already exists" in error_str:
+                        print("✅ 进度计数字段已存在")
+                    else:
+                        print(f"⚠️  添加进度计数字段时出现警告: {str(e)}")
+        
+        # 迁移 5b: 为 tasks 表添加 is_custom 字段（自定义计划项）
+        # 旧的自定义计划项无法可靠区分，保持 FALSE；批量生成计划时已有计划项的长期任务不会被展开
+        if 'tasks' in inspector.get_table_names():
+            columns = [col['name'] for col in inspector.get_columns('tasks')]
+            if 'is_custom' not in columns:
+                print("🔹 正在添加 is_custom 字段到 tasks 表...")
+                try:
+                    with engine.begin() as conn:
+                        conn.execute(text("ALTER TABLE tasks ADD COLUMN is_custom BOOLEAN NOT NULL DEFAULT FALSE"))
+                    print("✅ is_custom 字段已添加")
+                except Exception as e:
+                    error_str = str(e).lower()
+                    if "duplicate column" in error_str or "already exists" in error_str:
+                        print("✅ is_custom 字段已存在")
+                    else:
+                        print(f"⚠️  添加 is_custom 字段时出现警告: {str(e)}")
+        
+        # 迁移 6: 新建的 user_daily_loads 索引表从已有计划项回填
+        if 'user_daily_loads' in inspector.get_table_names():
+            db = SessionLocal()
+            try:
+                has_loads = db.query(UserDailyLoad.user_id).first() is not None
+                has_items = db.query(DailyTaskItem.id).first() is not None
+                if has_items and not has_loads:
+                    from load_index import rebuild_loads
+                    print("🔹 正在回填 user_daily_loads 索引...")
+                    rebuild_loads(db)
+                    db.commit()
+                    print("✅ user_daily_loads 索引已回填")
+            except Exception as e:
+                db.rollback()
+                print(f"⚠️  回填 user_daily_loads 索引时出现警告: {str(e)}")
+            finally:
+                db.close()
+        
+        # 迁移 7: 新建的 user_daily_stats 统计表从已有计划项（含归档）回填
+        if 'user_daily_stats' in inspector.get_table_names():
+            db = SessionLocal()
+            try:
+                has_stats = db.query(UserDailyStat.user_id).first() is not None
+                has_items = (
+                    db.query(DailyTaskItem.id).first() is not None
+                    or db.query(DailyTaskItemArchive.id).first() is not None
+                )
+                if has_items and not has_stats:
+                    from stats_rollup import rebuild_stats
+                    print("🔹 正在回填 user_daily_stats 统计...")
+                    rebuild_stats(db)
+                    db.commit()
+                    print("✅ user_daily_stats 统计已回填")
+            except Exception as e:
+                db.rollback()
+                print(f"⚠️  回填 user_daily_stats 统计时出现警告: {str(e)}")
+            finally:
+                db.close()
+        
+        # 迁移 8: 全文搜索索引（SQLite FTS5 / PostgreSQL tsvector + GIN），为空时从已有任务回填
+        from search_index import ensure_search_index
+        try:
+            ensure_search_index(engine)
+        except Exception as e:
+            print(f"⚠️  建立全文搜索索引时出现警告: {str(e)}")
+        
+        # 迁移 9: PostgreSQL 上按月分区 daily_task_items（需设置 DAILY_ITEMS_PARTITIONED=1）
+        from partitioning import migrate_to_partitioned, ensure_partitions
+        try:
+            migrate_to_partitioned(engine)
+            ensure_partitions(engine)
+        except Exception as e:
+            print(f"⚠️  daily_task_items 分区时出现警告: {str(e)}")
     except Exception as e:
         # 迁移失败不应阻止应用启动
         print(f"⚠️  数据库迁移检查失败: {str(e)}")
@@ -0,0 +1,120 @@
+"""
+读写分离的会话路由
+
+- 写操作和普通接口使用主库会话（database.get_db）
+- 只读接口使用 get_read_db：配置了 DATABASE_READ_URL 时走只读副本，否则与主库相同
+- read-your-writes：用户执行写操作后的 READ_YOUR_WRITES_SECONDS 秒内（默认 5），
+  该用户的读请求仍然走主库，避免副本复制延迟导致读不到刚写入的数据。
+  用户由会话令牌（auth.py）、查询参数 user_id 或 /users/{user_id} 路径识别；另外写请求的响应会设置
+  rw_until cookie，多进程部署或无法识别用户的写请求（user_id 在请求体中）也能生效。
+"""
+import os
+import threading
+import time
+
+from fastapi import Request
+
+from auth import token_user_id
+from database import SessionLocal, ReadSessionLocal, DATABASE_READ_URL
+
+READ_YOUR_WRITES_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", "5"))
+READ_YOUR_WRITES_COOKIE = "rw_until"
+MUTATING_METHODS = ("POST", "PUT", "PATCH", "DELETE")
+
+
+class ReadRouter:
+    """记录每个用户最近一次写操作的时间，决定读请求走主库还是副本"""
+
+    def __init__(self, window_seconds: float = READ_YOUR_WRITES_SECONDS, max_users: int = 100000):
+        self.window_seconds = window_seconds
+        self.max_users = max_users
+        self._last_write = {}
+        self._lock = threading.Lock()
+        self.stats = {"replica": 0, "primary": 0, "pinned": 0}
+
+    def mark_write(self, user_key: str):
+        if not user_key:
+            return
+        now = time.monotonic()
+        with self._lock:
+            self._last_write[user_key] = now
+            if len(self._last_write) > self.max_users:
+                # 清理已经超出窗口的记录
+                cutoff = now - self.window_seconds
+                self._last_write = {k: t for k, t in self._last_write.items() if t >= cutoff}
+
+    def recently_wrote(self, user_key: str) -> bool:
+        if not user_key:
+            return False
+        last = self._last_write.get(user_key)
+        return last is not None and time.monotonic() - last < self.window_seconds
+
+    def use_primary(self, request: Request) -> bool:
+        """读请求是否需要走主库"""
+        if not DATABASE_READ_URL:
+            return True
+        if self.recently_wrote(request_user_key(request)):
+            return True
+        try:
+            until = float(request.cookies.get(READ_YOUR_WRITES_COOKIE, "0"))
+        except ValueError:
+            until = 0.0
+        return time.time() < until
+
+
+read_router = ReadRouter()
+
+
+def request_user_key(request: Request):
+    """从会话令牌、查询参数或 /users/{user_id} 路径中取用户 ID"""
+    authorization = request.headers.get("authorization", "")
+    scheme, _, token = authorization.partition(" ")
+    user_key = token_user_id(token.strip() if scheme.lower() == "bearer" else request.query_params.get("access_token"))
+    if user_key:
+        return user_key
+    user_key = request.query_params.get("user_id")
+    if user_key:
+        return user_key
+    parts = request.url.path.strip("/").split("/")
+    if len(parts) >= 2 and parts[0] == "users" and parts[1] != "by-nickname":
+        return parts[1]
+    return None
+
+
+def read_session_factory(request: Request):
+    """为只读请求选择会话工厂（主库或副本）"""
+    if read_router.use_primary(request):
+        if DATABASE_READ_URL:
+            read_router.stats["pinned"] += 1
+        read_router.stats["primary"] += 1
+        return SessionLocal
+    read_router.stats["replica"] += 1
+    return ReadSessionLocal
+
+
+def get_read_db(request: Request):
+    """只读接口的数据库会话依赖"""
+    db = read_session_factory(request)()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+async def track_writes(request: Request, call_next):
+    """HTTP 中间件：记录成功的写请求，开启该用户的 read-your-writes 窗口"""
+    response = await call_next(request)
+    if (
+        DATABASE_READ_URL
+        and request.method in MUTATING_METHODS
+        and response.status_code < 400
+    ):
+        read_router.mark_write(request_user_key(request))
+        response.set_cookie(
+            READ_YOUR_WRITES_COOKIE,
+            f"{time.time() + read_router.window_seconds:.3f}",
+            max_age=max(1, int(read_router.window_seconds) + 1),
+            httponly=True,
+            samesite="lax",
+        )
+    return response
@@ -6,6 +6,13 @@ BACKEND_DIR="/app/backend"
 # 确保 Python 可以找到后端模块
 export PYTHONPATH="$BACKEND_DIR${PYTHONPATH:+:$PYTHONPATH}"
 
+# 生产环境必须配置 SESSION_SECRET（见 auth.py），缺少时启动失败而不是每次重启令牌全部失效
+export SESSION_SECRET_REQUIRED="${SESSION_SECRET_REQUIRED:-1}"
+if [ "$SESSION_SECRET_REQUIRED" = "1" ] && [ -z "$SESSION_SECRET" ]; then
+    echo "❌ 未配置 SESSION_SECRET：请在环境变量中设置（或设置 SESSION_SECRET_REQUIRED=0 允许使用进程内随机密钥）"
+    exit 1
+fi
+
 echo "🔹 正在初始化数据库..."
 python3 -c "from database import init_db; init_db()"
 
@@ -0,0 +1,236 @@
+"""
+日历变更的服务端推送（SSE）
+
+- change_tracking 在事务提交后给出每个用户的行级变更事件，EventBroker 推送给该用户在本进程内的所有订阅连接
+- GET /users/{user_id}/events 是 text/event-stream 长连接（main.py），每次提交是一条 "changes" 消息；
+  客户端连接（或重连）后先调用 /sync 补齐，再按 ID 应用推送的事件
+- 订阅者的队列满了（客户端太慢）或一次提交的事件超过 EVENTS_MAX_BATCH（默认 200，例如清空日历）时，
+  改为推送一条 {"type": "resync"}，客户端调用 /sync 即可
+- 多个 worker 部署时通过 EVENTS_FANOUT 选择跨进程广播：
+  none（默认，只推送本进程的变更）、postgres（LISTEN/NOTIFY，需要 PostgreSQL）
+"""
+import asyncio
+import json
+import os
+import queue
+import select
+import threading
+import time
+import uuid
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Set
+
+from sqlalchemy import text
+
+EVENTS_QUEUE_SIZE = int(os.getenv("EVENTS_QUEUE_SIZE", "100"))
+EVENTS_MAX_BATCH = int(os.getenv("EVENTS_MAX_BATCH", "200"))
+EVENTS_HEARTBEAT_SECONDS = float(os.getenv("EVENTS_HEARTBEAT_SECONDS", "15"))
+EVENTS_PG_CHANNEL = os.getenv("EVENTS_PG_CHANNEL", "plan_events")
+PG_NOTIFY_MAX_BYTES = 7900  # NOTIFY 的 payload 上限是 8000 字节
+
+RESYNC = [{"type": "resync"}]
+
+
+class Subscription:
+    """一个订阅连接：绑定到创建它的事件循环，其他线程通过 call_soon_threadsafe 投递"""
+
+    def __init__(self, user_id: int, queue_size: int):
+        self.user_id = user_id
+        self.loop = asyncio.get_running_loop()
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+
+    def push(self, events: List[dict]):
+        try:
+            self.queue.put_nowait(events)
+        except asyncio.QueueFull:
+            # 客户端跟不上：丢弃积压，让它重新同步
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(RESYNC)
+
+    async def next(self, timeout: float) -> Optional[List[dict]]:
+        """等待下一批事件，超时返回 None（用于发送心跳）"""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class EventBroker:
+    """进程内的按用户发布/订阅"""
+
+    def __init__(self, queue_size: int = EVENTS_QUEUE_SIZE, max_batch: int = EVENTS_MAX_BATCH, fanout=None):
+        self.queue_size = queue_size
+        self.max_batch = max_batch
+        self.fanout = fanout
+        self._subscribers: Dict[int, Set[Subscription]] = defaultdict(set)
+        self._lock = threading.Lock()
+        self.stats = {"published": 0, "delivered": 0, "remote": 0, "resync": 0}
+
+    @classmethod
+    def from_env(cls, engine=None):
+        return cls(fanout=create_fanout(os.getenv("EVENTS_FANOUT", "none"), engine))
+
+    def subscribe(self, user_id: int) -> Subscription:
+        subscription = Subscription(user_id, self.queue_size)
+        with self._lock:
+            self._subscribers[user_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.user_id)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[subscription.user_id]
+
+    def subscriber_count(self) -> int:
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+    def publish(self, user_id: int, events: List[dict]):
+        """发布本进程提交的变更（可在任意线程调用）"""
+        if len(events) > self.max_batch:
+            events = RESYNC
+            self.stats["resync"] += 1
+        self.stats["published"] += 1
+        self.deliver(user_id, events)
+        if self.fanout is not None:
+            self.fanout.publish(user_id, events)
+
+    def deliver(self, user_id: int, events: List[dict]):
+        """投递给本进程内该用户的订阅连接"""
+        with self._lock:
+            subscribers = list(self._subscribers.get(user_id, ()))
+        for subscription in subscribers:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.push, events)
+                self.stats["delivered"] += 1
+            except RuntimeError:
+                # 事件循环已关闭
+                self.unsubscribe(subscription)
+
+    def _deliver_remote(self, user_id: int, events: List[dict]):
+        self.stats["remote"] += 1
+        self.deliver(user_id, events)
+
+    def start(self):
+        if self.fanout is not None:
+            self.fanout.start(self._deliver_remote)
+
+    def stop(self):
+        if self.fanout is not None:
+            self.fanout.stop()
+
+
+def sse_message(event: str, data) -> bytes:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, separators=(',', ':'))}\n\n".encode("utf-8")
+
+
+SSE_HEARTBEAT = b": ping\n\n"
+
+
+# ============================================================================
+# 跨进程广播
+# ============================================================================
+
+class PostgresFanout:
+    """
+    通过 PostgreSQL LISTEN/NOTIFY 在多个 worker 之间广播变更事件
+    发送在后台线程中批量进行，不占用请求路径；每个进程带 origin 标识，忽略自己发出的通知
+    """
+
+    def __init__(self, engine, channel: str = EVENTS_PG_CHANNEL):
+        self.engine = engine
+        self.channel = channel
+        self.origin = uuid.uuid4().hex[:12]
+        self._outbox: "queue.Queue" = queue.Queue(maxsize=10000)
+        self._stopped = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    def publish(self, user_id: int, events: List[dict]):
+        payload = json.dumps({"o": self.origin, "u": user_id, "e": events}, separators=(",", ":"))
+        if len(payload.encode("utf-8")) > PG_NOTIFY_MAX_BYTES:
+            payload = json.dumps({"o": self.origin, "u": user_id, "e": RESYNC}, separators=(",", ":"))
+        try:
+            self._outbox.put_nowait(payload)
+        except queue.Full:
+            print("⚠️  变更事件广播队列已满，丢弃一条通知")
+
+    def start(self, deliver: Callable[[int, List[dict]], None]):
+        self._stopped.clear()
+        self._threads = [
+            threading.Thread(target=self._send_loop, name="events-notify", daemon=True),
+            threading.Thread(target=self._listen_loop, args=(deliver,), name="events-listen", daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+        print(f"✅ 变更事件跨进程广播已启用（PostgreSQL 通道 {self.channel}）")
+
+    def stop(self):
+        self._stopped.set()
+
+    def _send_loop(self):
+        while not self._stopped.is_set():
+            try:
+                payloads = [self._outbox.get(timeout=1)]
+            except queue.Empty:
+                continue
+            while len(payloads) < 100:
+                try:
+                    payloads.append(self._outbox.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with self.engine.begin() as conn:
+                    for payload in payloads:
+                        conn.execute(text("SELECT pg_notify(:channel, :payload)"),
+                                     {"channel": self.channel, "payload": payload})
+            except Exception as e:
+                print(f"⚠️  发送变更通知失败: {str(e)}")
+
+    def _listen_loop(self, deliver: Callable[[int, List[dict]], None]):
+        while not self._stopped.is_set():
+            raw = None
+            try:
+                raw = self.engine.raw_connection()
+                conn = raw.driver_connection
+                conn.autocommit = True
+                with conn.cursor() as cursor:
+                    cursor.execute(f'LISTEN "{self.channel}"')
+                while not self._stopped.is_set():
+                    if select.select([conn], [], [], 5)[0]:
+                        conn.poll()
+                        while conn.notifies:
+                            self._dispatch(conn.notifies.pop(0).payload, deliver)
+            except Exception as e:
+                print(f"⚠️  变更通知监听中断，稍后重连: {str(e)}")
+                time.sleep(2)
+            finally:
+                if raw is not None:
+                    try:
+                        raw.invalidate()
+                    except Exception:
+                        pass
+
+    def _dispatch(self, payload: str, deliver: Callable[[int, List[dict]], None]):
+        try:
+            message = json.loads(payload)
+        except ValueError:
+            return
+        if message.get("o") == self.origin:
+            return
+        deliver(message["u"], message["e"])
+
+
+def create_fanout(name: str, engine=None):
+    name = (name or "none").lower()
+    if name in ("none", "memory", ""):
+        return None
+    if name == "postgres":
+        if engine is None or engine.dialect.name != "postgresql":
+            print("⚠️  EVENTS_FANOUT=postgres 需要 PostgreSQL，变更事件只在本进程内推送")
+            return None
+        return PostgresFanout(engine)
+    raise ValueError(f"Unknown EVENTS_FANOUT: {name}")
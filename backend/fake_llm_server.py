@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+"""
+本地 OpenAI 兼容的模拟服务器（用于压测 generate-subtasks / generate-plan）
+
+实现 /v1/chat/completions（含 stream=true 的 SSE 流式输出）和 /v1/models，
+延迟分布、错误率、返回内容都可以通过环境变量或命令行参数配置。
+
+用法：
+    python fake_llm_server.py --port 9000 --latency lognormal:0.0,0.5 --error-rate 0.05
+
+然后让后端指向它：
+    OPENAI_BASE_URL=http://127.0.0.1:9000/v1 uvicorn main:app
+
+环境变量：
+    FAKE_LLM_LATENCY        延迟分布，格式见 parse_latency_spec()，默认 "fixed:0.3"
+    FAKE_LLM_TOKEN_DELAY    流式输出时每个 chunk 之间的间隔（秒），默认 0.01
+    FAKE_LLM_ERROR_RATE     返回错误的概率（0-1），默认 0
+    FAKE_LLM_ERROR_CODES    错误时随机选取的状态码，默认 "429,500,503"
+    FAKE_LLM_HANG_RATE      请求"挂起"（长时间不返回）的概率，默认 0
+    FAKE_LLM_HANG_SECONDS   挂起时长（秒），默认 300
+    FAKE_LLM_RESPONSE_FILE  固定返回内容的文件路径（可选，内容支持 {today} 等占位符）
+    FAKE_LLM_SEED           随机种子（可选，便于复现）
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import time
+import uuid
+from datetime import date, datetime, timedelta
+from typing import List, Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+def parse_latency_spec(spec: str):
+    """
+    解析延迟分布配置，返回一个无参采样函数（单位：秒）
+    支持：
+        fixed:0.5              固定 0.5 秒
+        uniform:0.2,1.5        [0.2, 1.5] 均匀分布
+        normal:1.0,0.3         正态分布（截断到 >= 0）
+        lognormal:0.0,0.5      对数正态分布（mu, sigma），长尾延迟
+        exp:0.8                指数分布，均值 0.8 秒
+    """
+    kind, _, args = spec.partition(":")
+    params = [float(x) for x in args.split(",") if x.strip()] if args else []
+    kind = kind.strip().lower()
+
+    if kind == "fixed":
+        value = params[0] if params else 0.0
+        return lambda: value
+    if kind == "uniform":
+        low, high = params
+        return lambda: random.uniform(low, high)
+    if kind == "normal":
+        mean, std = params
+        return lambda: max(0.0, random.gauss(mean, std))
+    if kind == "lognormal":
+        mu, sigma = params
+        return lambda: random.lognormvariate(mu, sigma)
+    if kind == "exp":
+        mean = params[0]
+        return lambda: random.expovariate(1.0 / mean) if mean > 0 else 0.0
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+class FakeLLMConfig:
+    """模拟服务器配置"""
+
+    def __init__(
+        self,
+        latency: str = "fixed:0.3",
+        token_delay: float = 0.01,
+        error_rate: float = 0.0,
+        error_codes: str = "429,500,503",
+        hang_rate: float = 0.0,
+        hang_seconds: float = 300.0,
+        response_file: Optional[str] = None,
+    ):
+        self.latency_spec = latency
+        self.sample_latency = parse_latency_spec(latency)
+        self.token_delay = token_delay
+        self.error_rate = error_rate
+        self.error_codes = [int(c) for c in error_codes.split(",") if c.strip()]
+        self.hang_rate = hang_rate
+        self.hang_seconds = hang_seconds
+        self.canned_response = None
+        if response_file:
+            with open(response_file, "r", encoding="utf-8") as f:
+                self.canned_response = f.read()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            latency=os.getenv("FAKE_LLM_LATENCY", "fixed:0.3"),
+            token_delay=float(os.getenv("FAKE_LLM_TOKEN_DELAY", "0.01")),
+            error_rate=float(os.getenv("FAKE_LLM_ERROR_RATE", "0")),
+            error_codes=os.getenv("FAKE_LLM_ERROR_CODES", "429,500,503"),
+            hang_rate=float(os.getenv("FAKE_LLM_HANG_RATE", "0")),
+            hang_seconds=float(os.getenv("FAKE_LLM_HANG_SECONDS", "300")),
+            response_file=os.getenv("FAKE_LLM_RESPONSE_FILE"),
+        )
+
+
+# ============================================================================
+# 模板化输出：根据提示词内容生成结构合法的 JSON
+# ============================================================================
+
+_DATE_RE = re.compile(r"\d{4}-\d{2}-\d{2}")
+_SUBTASK_LINE_RE = re.compile(r"^\s*(\d+)\.\s*(.+?)\s*\(estimated\s+([\d.]+)\s+hours\)\s*$", re.MULTILINE)
+
+
+def _parse_date(value: str) -> Optional[date]:
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").date()
+    except ValueError:
+        return None
+
+
+def _extract_max_subtasks(prompt: str) -> Optional[int]:
+    match = re.search(r"at most (\d+) subtasks", prompt)
+    return int(match.group(1)) if match else None
+
+
+def build_subtasks_payload(prompt: str) -> dict:
+    """为子任务生成请求构造返回内容"""
+    count = random.randint(3, 5)
+    max_subtasks = _extract_max_subtasks(prompt)
+    if max_subtasks:
+        count = min(count, max_subtasks)
+    return {
+        "subtasks": [
+            {"name": f"Subtask {i + 1}", "estimated_hours": round(random.choice([1.0, 1.5, 2.0, 2.5, 3.0]), 1)}
+            for i in range(count)
+        ]
+    }
+
+
+def build_plan_payload(prompt: str) -> dict:
+    """为每日计划生成请求构造返回内容：把每个子任务的预计时间摊到日期区间内"""
+    subtasks = [
+        (int(num), name, float(hours))
+        for num, name, hours in _SUBTASK_LINE_RE.findall(prompt)
+    ]
+    dates = [d for d in (_parse_date(s) for s in _DATE_RE.findall(prompt)) if d]
+    start = min(dates) if dates else date.today()
+    end = max(dates) if dates else start + timedelta(days=6)
+    days = max(1, (end - start).days + 1)
+
+    plan = []
+    day_index = 0
+    for num, name, hours in subtasks or [(1, "Subtask 1", 2.0)]:
+        remaining = hours
+        while remaining > 0:
+            chunk = min(2.0, remaining)
+            plan.append({
+                "date": (start + timedelta(days=day_index % days)).isoformat(),
+                "subtask_id": num,
+                "allocated_hours": round(chunk, 2),
+                "subtask_name": name,
+            })
+            remaining -= chunk
+            day_index += 1
+    return {"plan": plan}
+
+
+_COMPACT_SUBTASK_LINE_RE = re.compile(r"^(\d+)\|(.+)\|([\d.]+)$", re.MULTILINE)
+
+
+def _compact_field(prompt: str, name: str) -> Optional[str]:
+    match = re.search(rf"^{name}: (.*)$", prompt, re.MULTILINE)
+    return match.group(1).strip() if match else None
+
+
+def build_compact_subtasks_payload(prompt: str) -> dict:
+    """结构化输出格式（prompts.SUBTASKS_SCHEMA）的子任务返回内容"""
+    payload = build_subtasks_payload(prompt)
+    max_subtasks = _compact_field(prompt, "max")
+    items = payload["subtasks"][:int(max_subtasks)] if max_subtasks else payload["subtasks"]
+    return {"s": [{"n": item["name"], "h": item["estimated_hours"]} for item in items]}
+
+
+def build_compact_plan_payload(prompt: str) -> dict:
+    """结构化输出格式（prompts.PLAN_SCHEMA）的计划返回内容：[[day, no, hours], ...]"""
+    days = int(_compact_field(prompt, "days") or 7)
+    plan = []
+    day_index = 0
+    for num, _name, hours in _COMPACT_SUBTASK_LINE_RE.findall(prompt) or [("1", "", "2")]:
+        remaining = float(hours)
+        while remaining > 0:
+            chunk = min(2.0, remaining)
+            plan.append([day_index % max(1, days), int(num), round(chunk, 2)])
+            remaining -= chunk
+            day_index += 1
+    return {"p": plan}
+
+
+_COMPACT_BATCH_SUBTASK_LINE_RE = re.compile(r"^(\d+)\.(\d+)\|(.+)\|([\d.]+)$", re.MULTILINE)
+_COMPACT_BATCH_TASK_LINE_RE = re.compile(r"^T\|(\d+)\|.*\|(\d+)\|(\d+)$", re.MULTILINE)
+
+
+def build_compact_batch_plan_payload(prompt: str) -> dict:
+    """批量计划（prompts.BATCH_PLAN_RESPONSE_FORMAT）的返回内容：[[day, task, no, hours], ...]"""
+    windows = {
+        int(task_no): (int(first), int(last))
+        for task_no, first, last in _COMPACT_BATCH_TASK_LINE_RE.findall(prompt)
+    }
+    plan = []
+    offsets = {}
+    for task_no, num, _name, hours in _COMPACT_BATCH_SUBTASK_LINE_RE.findall(prompt):
+        task_no = int(task_no)
+        first, last = windows.get(task_no, (0, 0))
+        remaining = float(hours)
+        while remaining > 0:
+            chunk = min(2.0, remaining)
+            offset = offsets.get(task_no, 0)
+            plan.append([first + offset % (last - first + 1), task_no, int(num), round(chunk, 2)])
+            offsets[task_no] = offset + 1
+            remaining -= chunk
+    return {"p": plan}
+
+
+def render_content(prompt: str, config: FakeLLMConfig, schema_name: Optional[str] = None) -> str:
+    """根据配置、提示词和结构化输出的 schema 名称生成 assistant 消息内容"""
+    if config.canned_response is not None:
+        return config.canned_response.replace("{today}", date.today().isoformat())
+    if schema_name == "plan":
+        return json.dumps(build_compact_plan_payload(prompt), ensure_ascii=False)
+    if schema_name == "batch_plan":
+        return json.dumps(build_compact_batch_plan_payload(prompt), ensure_ascii=False)
+    if schema_name == "subtasks":
+        return json.dumps(build_compact_subtasks_payload(prompt), ensure_ascii=False)
+    if '"plan"' in prompt or "daily plan" in prompt.lower():
+        return json.dumps(build_plan_payload(prompt), ensure_ascii=False)
+    return json.dumps(build_subtasks_payload(prompt), ensure_ascii=False)
+
+
+def _approx_tokens(text: str) -> int:
+    """粗略估计 token 数（约 4 个字符 1 个 token）"""
+    return max(1, len(text) // 4)
+
+
+def _chunk_text(text: str, size: int = 16) -> List[str]:
+    return [text[i:i + size] for i in range(0, len(text), size)] or [""]
+
+
+# ============================================================================
+# 应用
+# ============================================================================
+
+def create_app(config: Optional[FakeLLMConfig] = None) -> FastAPI:
+    config = config or FakeLLMConfig.from_env()
+    fake_app = FastAPI(title="Fake OpenAI-compatible LLM Server")
+    fake_app.state.config = config
+    fake_app.state.stats = {"requests": 0, "errors": 0, "hangs": 0, "streams": 0}
+
+    @fake_app.get("/v1/models")
+    async def list_models():
+        return {"object": "list", "data": [{"id": "gpt-4o-mini", "object": "model", "owned_by": "fake"}]}
+
+    @fake_app.get("/stats")
+    async def get_stats():
+        return fake_app.state.stats
+
+    @fake_app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        stats = fake_app.state.stats
+        stats["requests"] += 1
+        body = await request.json()
+        messages = body.get("messages", [])
+        prompt = "\n".join(str(m.get("content", "")) for m in messages)
+        model = body.get("model", "gpt-4o-mini")
+
+        # 模拟挂起（用于测试客户端超时）
+        if config.hang_rate and random.random() < config.hang_rate:
+            stats["hangs"] += 1
+            await asyncio.sleep(config.hang_seconds)
+
+        # 模拟首 token 延迟
+        await asyncio.sleep(config.sample_latency())
+
+        # 模拟错误
+        if config.error_rate and random.random() < config.error_rate:
+            stats["errors"] += 1
+            status = random.choice(config.error_codes or [500])
+            headers = {"retry-after": "1"} if status == 429 else {}
+            return JSONResponse(
+                status_code=status,
+                headers=headers,
+                content={"error": {"message": f"Simulated error {status}", "type": "fake_error", "code": status}},
+            )
+
+        response_format = body.get("response_format") or {}
+        schema_name = (response_format.get("json_schema") or {}).get("name")
+        content = render_content(prompt, config, schema_name)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+        created = int(time.time())
+        usage = {
+            "prompt_tokens": _approx_tokens(prompt),
+            "completion_tokens": _approx_tokens(content),
+            "total_tokens": _approx_tokens(prompt) + _approx_tokens(content),
+        }
+
+        if not body.get("stream"):
+            return {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": content},
+                    "finish_reason": "stop",
+                }],
+                "usage": usage,
+            }
+
+        stats["streams"] += 1
+
+        async def event_stream():
+            def chunk(delta, finish_reason=None):
+                payload = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": model,
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+                }
+                return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+            yield chunk({"role": "assistant", "content": ""})
+            for piece in _chunk_text(content):
+                if config.token_delay:
+                    await asyncio.sleep(config.token_delay)
+                yield chunk({"content": piece})
+            yield chunk({}, finish_reason="stop")
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+    return fake_app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake OpenAI-compatible LLM server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency", default=os.getenv("FAKE_LLM_LATENCY", "fixed:0.3"))
+    parser.add_argument("--token-delay", type=float, default=float(os.getenv("FAKE_LLM_TOKEN_DELAY", "0.01")))
+    parser.add_argument("--error-rate", type=float, default=float(os.getenv("FAKE_LLM_ERROR_RATE", "0")))
+    parser.add_argument("--error-codes", default=os.getenv("FAKE_LLM_ERROR_CODES", "429,500,503"))
+    parser.add_argument("--hang-rate", type=float, default=float(os.getenv("FAKE_LLM_HANG_RATE", "0")))
+    parser.add_argument("--hang-seconds", type=float, default=float(os.getenv("FAKE_LLM_HANG_SECONDS", "300")))
+    parser.add_argument("--response-file", default=os.getenv("FAKE_LLM_RESPONSE_FILE"))
+    parser.add_argument("--seed", type=int, default=int(os.getenv("FAKE_LLM_SEED")) if os.getenv("FAKE_LLM_SEED") else None)
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    config = FakeLLMConfig(
+        latency=args.latency,
+        token_delay=args.token_delay,
+        error_rate=args.error_rate,
+        error_codes=args.error_codes,
+        hang_rate=args.hang_rate,
+        hang_seconds=args.hang_seconds,
+        response_file=args.response_file,
+    )
+
+    import uvicorn
+    print(f"🔹 Fake LLM server: http://{args.host}:{args.port}/v1 (latency={args.latency}, error_rate={args.error_rate})")
+    uvicorn.run(create_app(config), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+iCalendar（RFC 5545）格式输出
+
+只包含订阅源需要的部分：VCALENDAR 头尾和全天 VEVENT，逐行生成，便于流式输出。
+"""
+from datetime import date, datetime, timedelta
+from typing import Iterable, Iterator, Optional
+
+CALENDAR_HEADER = (
+    "BEGIN:VCALENDAR",
+    "VERSION:2.0",
+    "PRODID:-//LLM Task Planner//Calendar Feed//ZH",
+    "CALSCALE:GREGORIAN",
+    "METHOD:PUBLISH",
+)
+CALENDAR_FOOTER = ("END:VCALENDAR",)
+IMPORTANCE_PRIORITY = {"high": 1, "medium": 5, "low": 9}
+
+
+def escape_text(value: str) -> str:
+    return (
+        str(value or "")
+        .replace("\\", "\\\\")
+        .replace(";", "\\;")
+        .replace(",", "\\,")
+        .replace("\r\n", "\\n")
+        .replace("\n", "\\n")
+    )
+
+
+def fold_line(line: str) -> str:
+    """按 75 字节折行（续行以空格开头），不截断 UTF-8 多字节字符"""
+    encoded = line.encode("utf-8")
+    if len(encoded) <= 75:
+        return line
+    parts = []
+    current = ""
+    current_len = 0
+    limit = 75
+    for char in line:
+        size = len(char.encode("utf-8"))
+        if current_len + size > limit:
+            parts.append(current)
+            current, current_len = char, size
+            limit = 74  # 续行开头的空格占 1 字节
+        else:
+            current += char
+            current_len += size
+    parts.append(current)
+    return "\r\n ".join(parts)
+
+
+def _format_date(day: date) -> str:
+    return day.strftime("%Y%m%d")
+
+
+def _format_timestamp(value: Optional[datetime]) -> str:
+    return (value or datetime.utcnow()).strftime("%Y%m%dT%H%M%SZ")
+
+
+def calendar_name_lines(name: str) -> Iterable[str]:
+    return (f"X-WR-CALNAME:{escape_text(name)}", "X-PUBLISHED-TTL:PT15M")
+
+
+def vevent_lines(
+    uid: str,
+    day: date,
+    summary: str,
+    description: str,
+    importance: str,
+    completed: bool,
+    stamp: Optional[datetime],
+) -> Iterator[str]:
+    yield "BEGIN:VEVENT"
+    yield f"UID:{uid}"
+    yield f"DTSTAMP:{_format_timestamp(stamp)}"
+    yield f"DTSTART;VALUE=DATE:{_format_date(day)}"
+    yield f"DTEND;VALUE=DATE:{_format_date(day + timedelta(days=1))}"
+    yield f"SUMMARY:{escape_text(('✓ ' if completed else '') + summary)}"
+    if description:
+        yield f"DESCRIPTION:{escape_text(description)}"
+    yield f"CATEGORIES:{escape_text(importance or 'medium')}"
+    yield f"PRIORITY:{IMPORTANCE_PRIORITY.get(importance, 5)}"
+    yield "TRANSP:TRANSPARENT"
+    yield "END:VEVENT"
+
+
+def encode_lines(lines: Iterable[str]) -> bytes:
+    return "".join(fold_line(line) + "\r\n" for line in lines).encode("utf-8")
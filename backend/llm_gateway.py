@@ -0,0 +1,424 @@
+"""
+LLM 网关：应用级共享的 LLM 客户端
+
+- 整个进程共用一个 provider 实例，OpenAI provider 持有长连接池（httpx keep-alive），
+  不再每个请求新建客户端、重新建立 TCP/TLS 连接
+- 提供同步 complete()、异步 acomplete() 和流式 stream()/astream() 调用
+- provider 可插拔（LLM_PROVIDER）：
+    openai   OpenAI 或任意 OpenAI 兼容服务（OPENAI_BASE_URL），默认
+    fake     本地模拟服务器 fake_llm_server.py（默认地址 http://127.0.0.1:9000/v1）
+    offline  不发网络请求，根据提示词确定性地生成结构合法的返回（开发、离线演示用）
+- 每个调用端点（subtasks / plan / batch_plan）可以单独配置模型和参数：
+    LLM_MODEL                      默认模型（默认 gpt-4o-mini）
+    LLM_MODEL_<ENDPOINT>           端点模型，例如 LLM_MODEL_PLAN=gpt-4o
+    LLM_TEMPERATURE[_<ENDPOINT>]   temperature（默认 0.7）
+    LLM_MAX_TOKENS[_<ENDPOINT>]    max_tokens（默认不限制）
+
+连接池配置：
+    LLM_POOL_MAX_CONNECTIONS       最大连接数（默认 20）
+    LLM_POOL_MAX_KEEPALIVE         保持的空闲连接数（默认 10）
+    LLM_POOL_KEEPALIVE_SECONDS     空闲连接保持时间（秒，默认 60）
+
+重试、超时、熔断仍由 llm_resilience.ResilientLLMCaller 负责，这里的 SDK 重试关闭。
+追踪开启时（tracing.py）每次调用记录一个 CLIENT span，带模型和 token 用量。
+"""
+import json
+import os
+import re
+import threading
+from dataclasses import dataclass
+from datetime import date, timedelta
+from typing import AsyncIterator, Dict, Iterator, List, Optional
+
+import planner
+import tracing
+
+
+ENDPOINTS = ("subtasks", "plan", "batch_plan")
+DEFAULT_MODEL = "gpt-4o-mini"
+DEFAULT_FAKE_BASE_URL = "http://127.0.0.1:9000/v1"
+
+
+class LLMConfigError(RuntimeError):
+    """LLM 网关配置错误（例如缺少 API key）"""
+
+
+@dataclass
+class EndpointConfig:
+    """单个调用端点的模型参数"""
+    model: str = DEFAULT_MODEL
+    temperature: float = 0.7
+    max_tokens: Optional[int] = None
+
+
+@dataclass
+class CompletionResult:
+    """一次补全调用的结果"""
+    content: str
+    model: str
+    total_tokens: Optional[int] = None
+    prompt_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
+
+
+def _endpoint_configs_from_env() -> Dict[str, EndpointConfig]:
+    default_model = os.getenv("LLM_MODEL", DEFAULT_MODEL)
+    default_temperature = float(os.getenv("LLM_TEMPERATURE", "0.7"))
+    default_max_tokens = os.getenv("LLM_MAX_TOKENS")
+    configs = {}
+    for endpoint in ENDPOINTS:
+        suffix = endpoint.upper()
+        max_tokens = os.getenv(f"LLM_MAX_TOKENS_{suffix}", default_max_tokens)
+        configs[endpoint] = EndpointConfig(
+            model=os.getenv(f"LLM_MODEL_{suffix}", default_model),
+            temperature=float(os.getenv(f"LLM_TEMPERATURE_{suffix}", str(default_temperature))),
+            max_tokens=int(max_tokens) if max_tokens else None,
+        )
+    return configs
+
+
+# ============================================================================
+# Providers
+# ============================================================================
+
+class OpenAIProvider:
+    """OpenAI / OpenAI 兼容服务；同步和异步客户端各自持有一个 keep-alive 连接池"""
+
+    name = "openai"
+
+    def __init__(self, api_key: Optional[str], base_url: Optional[str], timeout: float):
+        if not api_key:
+            if not base_url:
+                raise LLMConfigError(
+                    "OPENAI_API_KEY is not set. Please configure OPENAI_API_KEY in the production environment variables"
+                )
+            # 本地模拟服务不校验 key，但 OpenAI SDK 要求非空
+            api_key = "sk-local"
+        self.api_key = api_key
+        self.base_url = base_url
+        self.timeout = timeout
+        self._client = None
+        self._async_client = None
+        self._lock = threading.Lock()
+
+    def _limits(self):
+        import httpx
+        return httpx.Limits(
+            max_connections=int(os.getenv("LLM_POOL_MAX_CONNECTIONS", "20")),
+            max_keepalive_connections=int(os.getenv("LLM_POOL_MAX_KEEPALIVE", "10")),
+            keepalive_expiry=float(os.getenv("LLM_POOL_KEEPALIVE_SECONDS", "60")),
+        )
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    import httpx
+                    from openai import OpenAI
+                    self._client = OpenAI(
+                        api_key=self.api_key,
+                        base_url=self.base_url,
+                        timeout=self.timeout,
+                        max_retries=0,
+                        http_client=httpx.Client(limits=self._limits(), timeout=self.timeout),
+                    )
+        return self._client
+
+    @property
+    def async_client(self):
+        if self._async_client is None:
+            import httpx
+            from openai import AsyncOpenAI
+            self._async_client = AsyncOpenAI(
+                api_key=self.api_key,
+                base_url=self.base_url,
+                timeout=self.timeout,
+                max_retries=0,
+                http_client=httpx.AsyncClient(limits=self._limits(), timeout=self.timeout),
+            )
+        return self._async_client
+
+    @staticmethod
+    def _params(config: EndpointConfig, messages: List[dict], response_format: Optional[dict]) -> dict:
+        params = {"model": config.model, "messages": messages, "temperature": config.temperature}
+        if response_format:
+            params["response_format"] = response_format
+        if config.max_tokens:
+            params["max_tokens"] = config.max_tokens
+        return params
+
+    @staticmethod
+    def _result(response) -> CompletionResult:
+        return CompletionResult(
+            content=response.choices[0].message.content or "",
+            model=response.model,
+            total_tokens=response.usage.total_tokens if response.usage else None,
+            prompt_tokens=response.usage.prompt_tokens if response.usage else None,
+            completion_tokens=response.usage.completion_tokens if response.usage else None,
+        )
+
+    def complete(self, config, messages, response_format=None) -> CompletionResult:
+        return self._result(self.client.chat.completions.create(**self._params(config, messages, response_format)))
+
+    async def acomplete(self, config, messages, response_format=None) -> CompletionResult:
+        response = await self.async_client.chat.completions.create(**self._params(config, messages, response_format))
+        return self._result(response)
+
+    def stream(self, config, messages, response_format=None) -> Iterator[str]:
+        for chunk in self.client.chat.completions.create(
+            stream=True, **self._params(config, messages, response_format)
+        ):
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    async def astream(self, config, messages, response_format=None) -> AsyncIterator[str]:
+        stream = await self.async_client.chat.completions.create(
+            stream=True, **self._params(config, messages, response_format)
+        )
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    def close(self):
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+    async def aclose(self):
+        if self._async_client is not None:
+            await self._async_client.close()
+            self._async_client = None
+        self.close()
+
+
+class OfflineProvider:
+    """
+    离线 provider：不发网络请求，解析 prompts.py 生成的紧凑用户消息，
+    按 response_format 的 schema 名称返回确定性的结构化结果（计划部分复用本地规划器）
+    """
+
+    name = "offline"
+
+    _SPLIT_RE = re.compile(r"[，,、；;。\n]|\band\b|和|以及")
+    _SUBTASK_LINE_RE = re.compile(r"^(\d+)\|(.+)\|([\d.]+)$", re.MULTILINE)
+    _BATCH_TASK_RE = re.compile(r"^T\|(\d+)\|.*\|(\w+)\|(\d+)\|(\d+)$", re.MULTILINE)
+    _BATCH_SUBTASK_RE = re.compile(r"^(\d+)\.(\d+)\|(.+)\|([\d.]+)$", re.MULTILINE)
+
+    def render(self, messages: List[dict], response_format: Optional[dict]) -> str:
+        schema = ((response_format or {}).get("json_schema") or {}).get("name")
+        text = messages[-1]["content"] if messages else ""
+        if schema == "plan":
+            payload = self._plan(text)
+        elif schema == "batch_plan":
+            payload = self._batch_plan(text)
+        else:
+            payload = self._subtasks(text)
+        return json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+
+    @staticmethod
+    def _field(text: str, name: str) -> Optional[str]:
+        match = re.search(rf"^{name}: (.*)$", text, re.MULTILINE)
+        return match.group(1).strip() if match else None
+
+    def _subtasks(self, text: str) -> dict:
+        description = self._field(text, "desc") or self._field(text, "task") or ""
+        parts = [part.strip(" 　.:：") for part in self._SPLIT_RE.split(description)]
+        parts = [part for part in parts if part] or [self._field(text, "task") or "Task"]
+        max_subtasks = self._field(text, "max")
+        if max_subtasks:
+            parts = parts[:int(max_subtasks)]
+        # 按描述长度估计时间：每 20 个字符 0.5 小时，1-3 小时之间
+        return {"s": [
+            {"n": part, "h": min(3.0, max(1.0, round(len(part) / 20 * 2) / 2))}
+            for part in parts
+        ]}
+
+    def _plan(self, text: str) -> dict:
+        start = date.fromisoformat(self._field(text, "start") or date.today().isoformat())
+        days = max(1, int(self._field(text, "days") or 1))
+        subtasks = [(name, float(hours)) for _, name, hours in self._SUBTASK_LINE_RE.findall(text)]
+        plan = planner.build_local_plan(subtasks, start, start + timedelta(days=days - 1))
+        return {"p": [
+            [(entry["date"] - start).days, entry["subtask_no"], entry["allocated_hours"]]
+            for entry in plan
+        ]}
+
+    def _batch_plan(self, text: str) -> dict:
+        start = date.fromisoformat(self._field(text, "start") or date.today().isoformat())
+        cap = float(self._field(text, "cap") or planner.DEFAULT_DAILY_CAP)
+        reserved = {}
+        for pair in (self._field(text, "busy") or "").split(","):
+            if ":" in pair:
+                day, hours = pair.split(":", 1)
+                reserved[start + timedelta(days=int(day))] = float(hours)
+        tasks = []
+        for task_no, importance, first, last in self._BATCH_TASK_RE.findall(text):
+            subtasks = [
+                (name, float(hours))
+                for t_no, _, name, hours in self._BATCH_SUBTASK_RE.findall(text)
+                if t_no == task_no
+            ]
+            tasks.append({
+                "start": start + timedelta(days=int(first)),
+                "end": start + timedelta(days=int(last)),
+                "importance": importance,
+                "subtasks": subtasks,
+            })
+        plan = planner.build_local_batch_plan(tasks, cap, reserved)
+        return {"p": [
+            [(entry["date"] - start).days, entry["task_no"], entry["subtask_no"], entry["allocated_hours"]]
+            for entry in plan
+        ]}
+
+    def _result(self, config, messages, response_format) -> CompletionResult:
+        content = self.render(messages, response_format)
+        prompt_tokens = sum(len(m.get("content", "")) for m in messages) // 4
+        completion_tokens = len(content) // 4
+        return CompletionResult(
+            content=content, model=config.model, total_tokens=prompt_tokens + completion_tokens,
+            prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+        )
+
+    def complete(self, config, messages, response_format=None) -> CompletionResult:
+        return self._result(config, messages, response_format)
+
+    async def acomplete(self, config, messages, response_format=None) -> CompletionResult:
+        return self._result(config, messages, response_format)
+
+    def stream(self, config, messages, response_format=None) -> Iterator[str]:
+        content = self.render(messages, response_format)
+        for i in range(0, len(content), 16):
+            yield content[i:i + 16]
+
+    async def astream(self, config, messages, response_format=None) -> AsyncIterator[str]:
+        for piece in self.stream(config, messages, response_format):
+            yield piece
+
+    def close(self):
+        pass
+
+    async def aclose(self):
+        pass
+
+
+def create_provider(name: str, timeout: float):
+    """按名称创建 provider"""
+    name = (name or "openai").lower()
+    if name == "openai":
+        return OpenAIProvider(os.getenv("OPENAI_API_KEY"), os.getenv("OPENAI_BASE_URL") or None, timeout)
+    if name == "fake":
+        return OpenAIProvider(None, os.getenv("FAKE_LLM_BASE_URL", DEFAULT_FAKE_BASE_URL), timeout)
+    if name == "offline":
+        return OfflineProvider()
+    raise LLMConfigError(f"Unknown LLM_PROVIDER: {name}")
+
+
+# ============================================================================
+# 网关
+# ============================================================================
+
+class LLMGateway:
+    """
+    应用级 LLM 网关
+    provider 在第一次调用时创建（启动时不要求配置 API key），之后整个进程复用
+    """
+
+    def __init__(self, provider_name: str, timeout: float, endpoints: Optional[Dict[str, EndpointConfig]] = None):
+        self.provider_name = provider_name
+        self.timeout = timeout
+        self.endpoints = endpoints or {endpoint: EndpointConfig() for endpoint in ENDPOINTS}
+        self._provider = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, timeout: float = 60.0):
+        return cls(
+            provider_name=os.getenv("LLM_PROVIDER", "openai"),
+            timeout=timeout,
+            endpoints=_endpoint_configs_from_env(),
+        )
+
+    @property
+    def provider(self):
+        if self._provider is None:
+            with self._lock:
+                if self._provider is None:
+                    self._provider = create_provider(self.provider_name, self.timeout)
+        return self._provider
+
+    def endpoint(self, name: str) -> EndpointConfig:
+        return self.endpoints.get(name) or EndpointConfig()
+
+    def _span_attributes(self, endpoint: str, config: EndpointConfig, streaming: bool) -> dict:
+        return {
+            "gen_ai.system": self.provider_name,
+            "gen_ai.operation.name": "chat",
+            "gen_ai.request.model": config.model,
+            "gen_ai.request.temperature": config.temperature,
+            "gen_ai.request.max_tokens": config.max_tokens,
+            "llm.endpoint": endpoint,
+            "llm.streaming": streaming,
+        }
+
+    @staticmethod
+    def _record_usage(span, result: CompletionResult):
+        if span is None:
+            return
+        span.set_attribute("gen_ai.response.model", result.model)
+        span.set_attribute("gen_ai.usage.input_tokens", result.prompt_tokens)
+        span.set_attribute("gen_ai.usage.output_tokens", result.completion_tokens)
+        span.set_attribute("llm.usage.total_tokens", result.total_tokens)
+
+    def complete(self, endpoint: str, messages: List[dict], response_format: Optional[dict] = None) -> CompletionResult:
+        """同步调用（阻塞，在线程池中使用）"""
+        config = self.endpoint(endpoint)
+        with tracing.span(f"llm {endpoint}", tracing.KIND_CLIENT, self._span_attributes(endpoint, config, False)) as span:
+            result = self.provider.complete(config, messages, response_format)
+            self._record_usage(span, result)
+            return result
+
+    async def acomplete(self, endpoint: str, messages: List[dict], response_format: Optional[dict] = None) -> CompletionResult:
+        """异步调用"""
+        config = self.endpoint(endpoint)
+        with tracing.span(f"llm {endpoint}", tracing.KIND_CLIENT, self._span_attributes(endpoint, config, False)) as span:
+            result = await self.provider.acomplete(config, messages, response_format)
+            self._record_usage(span, result)
+            return result
+
+    def stream(self, endpoint: str, messages: List[dict], response_format: Optional[dict] = None) -> Iterator[str]:
+        """同步流式调用，逐段返回内容"""
+        config = self.endpoint(endpoint)
+        with tracing.span(f"llm {endpoint}", tracing.KIND_CLIENT, self._span_attributes(endpoint, config, True)) as span:
+            chunks = 0
+            for piece in self.provider.stream(config, messages, response_format):
+                chunks += 1
+                yield piece
+            if span is not None:
+                span.set_attribute("llm.stream.chunks", chunks)
+
+    async def astream(self, endpoint: str, messages: List[dict], response_format: Optional[dict] = None) -> AsyncIterator[str]:
+        """异步流式调用，逐段返回内容"""
+        config = self.endpoint(endpoint)
+        with tracing.span(f"llm {endpoint}", tracing.KIND_CLIENT, self._span_attributes(endpoint, config, True)) as span:
+            chunks = 0
+            async for piece in self.provider.astream(config, messages, response_format):
+                chunks += 1
+                yield piece
+            if span is not None:
+                span.set_attribute("llm.stream.chunks", chunks)
+
+    async def aclose(self):
+        """关闭连接池（应用关闭时调用）"""
+        if self._provider is not None:
+            await self._provider.aclose()
+            self._provider = None
+
+    def describe(self) -> dict:
+        return {
+            "provider": self.provider_name,
+            "endpoints": {
+                name: {"model": config.model, "temperature": config.temperature, "max_tokens": config.max_tokens}
+                for name, config in self.endpoints.items()
+            },
+        }
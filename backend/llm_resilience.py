@@ -0,0 +1,322 @@
+"""
+LLM 调用的尾延迟控制：超时、带抖动的指数退避重试、对冲请求、熔断器
+
+所有 OpenAI SDK 调用都是阻塞的，这里统一放到线程池执行，
+由 ResilientLLMCaller 负责整体截止时间、重试、对冲和熔断。
+
+环境变量：
+    LLM_TIMEOUT_SECONDS            单次调用超时（秒），默认 30
+    LLM_DEADLINE_SECONDS           一次生成请求的总截止时间（含重试），默认 60
+    LLM_MAX_RETRIES                可重试错误的最大重试次数，默认 2
+    LLM_RETRY_BASE_DELAY           退避基础间隔（秒），默认 0.5
+    LLM_RETRY_MAX_DELAY            退避最大间隔（秒），默认 8
+    LLM_HEDGE_ENABLED              是否启用对冲请求，默认 0
+    LLM_HEDGE_AFTER_SECONDS        对冲触发时间（秒）；不设置时使用最近调用延迟的 p95
+    LLM_HEDGE_MIN_SAMPLES          使用 p95 前至少需要的样本数，默认 20
+    LLM_BREAKER_FAILURE_THRESHOLD  连续失败多少次后熔断，默认 5
+    LLM_BREAKER_RESET_SECONDS      熔断后多久进入半开状态，默认 30
+"""
+import asyncio
+import os
+import random
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Optional
+
+from fastapi.concurrency import run_in_threadpool
+import openai
+
+
+class LLMError(Exception):
+    """LLM 调用失败的基类"""
+
+
+class LLMTimeoutError(LLMError):
+    """超过截止时间"""
+
+
+class CircuitOpenError(LLMError):
+    """熔断器打开，快速失败"""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"LLM provider circuit is open, retry after {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+# 可重试的错误：超时、连接错误、限流、服务端 5xx
+RETRYABLE_ERRORS = (
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+    asyncio.TimeoutError,
+)
+
+
+def is_retryable(error: BaseException) -> bool:
+    if isinstance(error, RETRYABLE_ERRORS):
+        return True
+    status = getattr(error, "status_code", None)
+    return status is not None and (status == 429 or status >= 500)
+
+
+def _env_float(name: str, default: float) -> float:
+    value = os.getenv(name)
+    return float(value) if value not in (None, "") else default
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if value in (None, ""):
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+class ResilienceConfig:
+    """尾延迟控制配置"""
+
+    def __init__(
+        self,
+        timeout: float = 30.0,
+        deadline: float = 60.0,
+        max_retries: int = 2,
+        retry_base_delay: float = 0.5,
+        retry_max_delay: float = 8.0,
+        hedge_enabled: bool = False,
+        hedge_after: Optional[float] = None,
+        hedge_min_samples: int = 20,
+        breaker_failure_threshold: int = 5,
+        breaker_reset_seconds: float = 30.0,
+    ):
+        self.timeout = timeout
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.hedge_enabled = hedge_enabled
+        self.hedge_after = hedge_after
+        self.hedge_min_samples = hedge_min_samples
+        self.breaker_failure_threshold = breaker_failure_threshold
+        self.breaker_reset_seconds = breaker_reset_seconds
+
+    @classmethod
+    def from_env(cls):
+        hedge_after = os.getenv("LLM_HEDGE_AFTER_SECONDS")
+        return cls(
+            timeout=_env_float("LLM_TIMEOUT_SECONDS", 30.0),
+            deadline=_env_float("LLM_DEADLINE_SECONDS", 60.0),
+            max_retries=int(_env_float("LLM_MAX_RETRIES", 2)),
+            retry_base_delay=_env_float("LLM_RETRY_BASE_DELAY", 0.5),
+            retry_max_delay=_env_float("LLM_RETRY_MAX_DELAY", 8.0),
+            hedge_enabled=_env_bool("LLM_HEDGE_ENABLED", False),
+            hedge_after=float(hedge_after) if hedge_after else None,
+            hedge_min_samples=int(_env_float("LLM_HEDGE_MIN_SAMPLES", 20)),
+            breaker_failure_threshold=int(_env_float("LLM_BREAKER_FAILURE_THRESHOLD", 5)),
+            breaker_reset_seconds=_env_float("LLM_BREAKER_RESET_SECONDS", 30.0),
+        )
+
+
+class LatencyTracker:
+    """记录最近的成功调用延迟，用于计算对冲阈值"""
+
+    def __init__(self, window: int = 200):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, pct: float) -> Optional[float]:
+        with self._lock:
+            if not self._samples:
+                return None
+            ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, int(len(ordered) * pct / 100.0))
+        return ordered[index]
+
+    def __len__(self):
+        return len(self._samples)
+
+
+class CircuitBreaker:
+    """
+    连续失败计数熔断器
+    closed -> (连续失败达到阈值) -> open -> (等待 reset_seconds) -> half_open
+    half_open 状态只放行一个探测请求：成功则 closed，失败则重新 open；
+    探测被取消（客户端断开）时由 release_probe() 归还名额，超过 probe_timeout 仍未结束的探测视为丢失
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_seconds: float = 30.0, probe_timeout: Optional[float] = None):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.probe_timeout = probe_timeout if probe_timeout is not None else reset_seconds
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self._probe_started_at = 0.0
+        self._lock = threading.Lock()
+
+    def before_call(self) -> bool:
+        """调用前检查，熔断时抛出 CircuitOpenError；返回本次调用是否为半开状态的探测请求"""
+        with self._lock:
+            now = time.monotonic()
+            if self.state == self.OPEN:
+                elapsed = now - self.opened_at
+                if elapsed < self.reset_seconds:
+                    raise CircuitOpenError(self.reset_seconds - elapsed)
+                self.state = self.HALF_OPEN
+                self._probe_in_flight = False
+            if self.state == self.HALF_OPEN:
+                if self._probe_in_flight and now - self._probe_started_at < self.probe_timeout:
+                    raise CircuitOpenError(self.probe_timeout - (now - self._probe_started_at))
+                self._probe_in_flight = True
+                self._probe_started_at = now
+                return True
+            return False
+
+    def release_probe(self):
+        """探测请求没有得出结果就结束（被取消）时归还名额，下一个请求重新探测"""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.consecutive_failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+            self._probe_in_flight = False
+
+    @property
+    def is_open(self) -> bool:
+        with self._lock:
+            return self.state == self.OPEN and time.monotonic() - self.opened_at < self.reset_seconds
+
+
+class ResilientLLMCaller:
+    """在线程池中执行阻塞的 LLM 调用，附加截止时间、重试、对冲和熔断"""
+
+    def __init__(self, config: Optional[ResilienceConfig] = None):
+        self.config = config or ResilienceConfig.from_env()
+        self.latency = LatencyTracker()
+        self.breaker = CircuitBreaker(
+            self.config.breaker_failure_threshold,
+            self.config.breaker_reset_seconds,
+            probe_timeout=self.config.deadline,
+        )
+        self.stats = {"calls": 0, "retries": 0, "hedges": 0, "hedge_wins": 0, "failures": 0, "short_circuits": 0}
+
+    def hedge_delay(self) -> Optional[float]:
+        """对冲触发时间：显式配置优先，否则使用观察到的 p95"""
+        if not self.config.hedge_enabled:
+            return None
+        if self.config.hedge_after is not None:
+            return self.config.hedge_after
+        if len(self.latency) < self.config.hedge_min_samples:
+            return None
+        return self.latency.percentile(95)
+
+    def backoff(self, attempt: int) -> float:
+        """全抖动指数退避"""
+        cap = min(self.config.retry_max_delay, self.config.retry_base_delay * (2 ** attempt))
+        return random.uniform(0, cap)
+
+    async def _attempt(self, fn: Callable[[], Any]) -> Any:
+        """执行一次调用；超过对冲阈值仍未返回时并发发出第二个相同请求，取先返回的结果"""
+        started = time.monotonic()
+        primary = asyncio.ensure_future(run_in_threadpool(fn))
+        delay = self.hedge_delay()
+        if delay is None:
+            result = await primary
+            self.latency.record(time.monotonic() - started)
+            return result
+
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done:
+            result = primary.result()
+            self.latency.record(time.monotonic() - started)
+            return result
+
+        self.stats["hedges"] += 1
+        hedge = asyncio.ensure_future(run_in_threadpool(fn))
+        pending = {primary, hedge}
+        last_error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for finished in done:
+                if finished.exception() is None:
+                    if finished is hedge:
+                        self.stats["hedge_wins"] += 1
+                    # 阻塞调用无法真正取消，剩余的请求会被 SDK 超时兜底，结果直接丢弃
+                    for other in pending:
+                        other.add_done_callback(lambda f: f.exception())
+                    self.latency.record(time.monotonic() - started)
+                    return finished.result()
+                last_error = finished.exception()
+        raise last_error
+
+    async def call(self, fn: Callable[[], Any]) -> Any:
+        """
+        执行 fn（阻塞函数，通常是一次 chat.completions.create 调用）
+        Raises:
+            CircuitOpenError: 熔断器打开
+            LLMTimeoutError: 超过总截止时间
+            其他异常: 不可重试的错误或重试耗尽后的最后一个错误
+        """
+        try:
+            is_probe = self.breaker.before_call()
+        except CircuitOpenError:
+            self.stats["short_circuits"] += 1
+            raise
+
+        self.stats["calls"] += 1
+        try:
+            return await self._call(fn)
+        finally:
+            # 成功或失败都已经由 record_* 清除探测标记；这里处理 CancelledError 等没有记录结果的情况
+            if is_probe:
+                self.breaker.release_probe()
+
+    async def _call(self, fn: Callable[[], Any]) -> Any:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.config.deadline
+        attempt = 0
+        while True:
+            remaining = deadline - loop.time()
+            try:
+                if remaining <= 0:
+                    raise asyncio.TimeoutError()
+                result = await asyncio.wait_for(self._attempt(fn), timeout=remaining)
+            except Exception as e:
+                retryable = is_retryable(e)
+                delay = self.backoff(attempt)
+                out_of_time = loop.time() + delay >= deadline
+                if not retryable or attempt >= self.config.max_retries or out_of_time:
+                    self.stats["failures"] += 1
+                    if retryable:
+                        # 只有服务端问题（超时、限流、5xx）计入熔断
+                        self.breaker.record_failure()
+                    else:
+                        self.breaker.record_success()
+                    if isinstance(e, asyncio.TimeoutError) or (retryable and out_of_time):
+                        raise LLMTimeoutError(f"LLM call exceeded deadline of {self.config.deadline:.0f}s") from e
+                    raise
+                attempt += 1
+                self.stats["retries"] += 1
+                await asyncio.sleep(delay)
+                continue
+            self.breaker.record_success()
+            return result
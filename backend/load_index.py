@@ -0,0 +1,290 @@
+"""
+每用户每日已分配时间索引（user_daily_loads）
+
+- UserDailyLoad 表保存 (用户, 日期) -> 已分配小时数，是 daily_task_items 的增量汇总
+- 通过 SQLAlchemy 的 before_flush 事件维护：任何经由 ORM 的新增、修改、删除 DailyTaskItem
+  （包括删除 Task/Subtask 时级联删除的计划项）都会在同一次 flush 中更新索引
+- 索引行用 INSERT ... ON CONFLICT DO UPDATE 原子累加（counters.increment_rows），并发事务修改同一天的负载不会丢失增量
+- 绕过 ORM 的批量操作（query.delete() 等）需要调用 reset_user_loads()/adjust_user_loads()/rebuild_loads()
+- 索引只统计 daily_task_items 中的计划项，归档（archive.py）移出的历史计划项同时从索引中扣除
+- DailyLoadTree 是规划时使用的线段树：从索引表读取窗口内的日负载后，
+  单点更新、区间求和、区间最小负载日期查询都是 O(log n)，单日负载查询 O(1)
+"""
+from collections import defaultdict
+from datetime import date, timedelta
+from typing import Dict, Iterable, Optional, Tuple
+
+from sqlalchemy import event, func
+from sqlalchemy.orm import Session, attributes
+
+from counters import increment_rows
+from models import DailyTaskItem, Subtask, Task, UserDailyLoad
+
+
+# ============================================================================
+# 索引维护
+# ============================================================================
+
+def _history_old(obj, key):
+    """取属性在本次 flush 前的值（未修改时返回当前值）"""
+    hist = attributes.get_history(obj, key)
+    if hist.deleted:
+        return hist.deleted[0]
+    if hist.unchanged:
+        return hist.unchanged[0]
+    return getattr(obj, key)
+
+
+def loaded_tasks(session: Session, task_ids: Iterable[int]) -> Tuple[Dict[int, Task], set]:
+    """
+    从 identity map 中取已加载（未过期）的任务，返回 ({task_id: Task}, 仍需查询的 task_id)
+    写接口已经用 JOIN 加载了任务时，各个 flush 事件不必再各自查询任务的所属用户
+    """
+    found, missing = {}, set()
+    for task_id in task_ids:
+        if task_id is None:
+            continue
+        task = session.identity_map.get(Session.identity_key(Task, task_id))
+        if task is not None and "user_id" in task.__dict__ and "importance" in task.__dict__:
+            found[task_id] = task
+        else:
+            missing.add(task_id)
+    return found, missing
+
+
+def _collect_deltas(session: Session) -> Dict[Tuple[int, date], float]:
+    """收集本次 flush 中 DailyTaskItem 变化对 (task_id, date) 负载的影响"""
+    deltas: Dict[Tuple[int, date], float] = defaultdict(float)
+    deleted_ids = set()
+
+    def removed(item):
+        if id(item) in deleted_ids or item in session.new:
+            return
+        deleted_ids.add(id(item))
+        deltas[(_history_old(item, "task_id"), _history_old(item, "date"))] -= _history_old(item, "allocated_hours") or 0.0
+
+    for obj in session.deleted:
+        if isinstance(obj, DailyTaskItem):
+            removed(obj)
+        elif isinstance(obj, (Task, Subtask)):
+            # 级联删除的计划项在 flush 过程中才会进入 session.deleted，这里提前计入
+            for item in obj.daily_items:
+                removed(item)
+
+    for obj in session.new:
+        if isinstance(obj, DailyTaskItem) and obj.date is not None:
+            task_id = obj.task_id if obj.task_id is not None else (obj.task.id if obj.task else None)
+            if task_id is not None:
+                deltas[(task_id, obj.date)] += obj.allocated_hours or 0.0
+
+    for obj in session.dirty:
+        if not isinstance(obj, DailyTaskItem) or id(obj) in deleted_ids:
+            continue
+        if not session.is_modified(obj, include_collections=False):
+            continue
+        old_key = (_history_old(obj, "task_id"), _history_old(obj, "date"))
+        new_key = (obj.task_id, obj.date)
+        old_hours = _history_old(obj, "allocated_hours") or 0.0
+        new_hours = obj.allocated_hours or 0.0
+        if old_key != new_key or old_hours != new_hours:
+            deltas[old_key] -= old_hours
+            deltas[new_key] += new_hours
+
+    return {key: value for key, value in deltas.items() if abs(value) > 1e-9 and None not in key}
+
+
+def _apply_deltas(session: Session, deltas: Dict[Tuple[int, date], float]):
+    """把 (task_id, date) 的负载变化折算到 (user_id, date) 并更新索引行"""
+    task_ids = {task_id for task_id, _ in deltas}
+    with session.no_autoflush:
+        found, missing = loaded_tasks(session, task_ids)
+        owners = {task_id: task.user_id for task_id, task in found.items()}
+        if missing:
+            owners.update(session.query(Task.id, Task.user_id).filter(Task.id.in_(missing)).all())
+        # 本次 flush 新建（尚未写入数据库）的任务
+        for obj in session.new:
+            if isinstance(obj, Task) and obj.id in task_ids:
+                owners[obj.id] = obj.user_id
+
+        user_deltas: Dict[Tuple[int, date], float] = defaultdict(float)
+        for (task_id, day), delta in deltas.items():
+            user_id = owners.get(task_id)
+            if user_id is not None:
+                user_deltas[(user_id, day)] += delta
+
+        adjust_user_loads(session, user_deltas)
+
+
+def adjust_user_loads(session: Session, user_deltas: Dict[Tuple[int, date], float]):
+    """按 {(user_id, date): 变化的小时} 原子累加索引行，行不存在时插入（不提交事务）"""
+    increment_rows(
+        session, UserDailyLoad.__table__, ("user_id", "date"), ("allocated_hours",),
+        {key: (delta,) for key, delta in user_deltas.items() if abs(delta) > 1e-9}
+    )
+
+
+@event.listens_for(Session, "before_flush")
+def _maintain_user_daily_loads(session, flush_context, instances):
+    deltas = _collect_deltas(session)
+    if deltas:
+        _apply_deltas(session, deltas)
+
+
+def reset_user_loads(db: Session, user_id: int, start: Optional[date] = None, end: Optional[date] = None):
+    """批量删除某用户的计划项（绕过 ORM）后清空对应的索引行"""
+    query = db.query(UserDailyLoad).filter(UserDailyLoad.user_id == user_id)
+    if start is not None:
+        query = query.filter(UserDailyLoad.date >= start)
+    if end is not None:
+        query = query.filter(UserDailyLoad.date <= end)
+    query.delete(synchronize_session=False)
+
+
+def rebuild_loads(db: Session, user_id: Optional[int] = None):
+    """从 daily_task_items 全量重建索引（迁移或批量操作后使用）"""
+    delete_query = db.query(UserDailyLoad)
+    if user_id is not None:
+        delete_query = delete_query.filter(UserDailyLoad.user_id == user_id)
+    delete_query.delete(synchronize_session=False)
+
+    query = db.query(
+        Task.user_id, DailyTaskItem.date, func.sum(DailyTaskItem.allocated_hours)
+    ).join(Task, DailyTaskItem.task_id == Task.id)
+    if user_id is not None:
+        query = query.filter(Task.user_id == user_id)
+    rows = [
+        {"user_id": uid, "date": day, "allocated_hours": float(hours or 0.0)}
+        for uid, day, hours in query.group_by(Task.user_id, DailyTaskItem.date)
+    ]
+    if rows:
+        db.bulk_insert_mappings(UserDailyLoad, rows)
+
+
+# ============================================================================
+# 规划用的线段树
+# ============================================================================
+
+class DailyLoadTree:
+    """
+    覆盖 [start, start + days) 的日负载线段树
+    支持 O(log n) 的单点增加、区间求和、区间最小负载日期（并列时取最早的一天）
+    """
+
+    def __init__(self, start: date, days: int, loads: Optional[Dict[date, float]] = None):
+        self.start = start
+        self.days = max(1, days)
+        size = 1
+        while size < self.days:
+            size *= 2
+        self._size = size
+        self._values = [0.0] * self.days
+        self._sum = [0.0] * (2 * size)
+        # 叶子之外的填充位置用 +inf，避免被选为最小值
+        self._min = [float("inf")] * (2 * size)
+        self._argmin = [-1] * (2 * size)
+        for i in range(self.days):
+            self._min[size + i] = 0.0
+            self._argmin[size + i] = i
+        for day, hours in (loads or {}).items():
+            offset = (day - start).days
+            if 0 <= offset < self.days:
+                self._values[offset] += hours
+                self._sum[size + offset] = self._values[offset]
+                self._min[size + offset] = self._values[offset]
+        for node in range(size - 1, 0, -1):
+            self._pull(node)
+
+    def _pull(self, node: int):
+        left, right = 2 * node, 2 * node + 1
+        self._sum[node] = self._sum[left] + self._sum[right]
+        if self._min[right] < self._min[left]:
+            self._min[node], self._argmin[node] = self._min[right], self._argmin[right]
+        else:
+            self._min[node], self._argmin[node] = self._min[left], self._argmin[left]
+
+    def _offset(self, day: date) -> int:
+        offset = (day - self.start).days
+        if not 0 <= offset < self.days:
+            raise IndexError(f"{day} is outside the load window")
+        return offset
+
+    def load(self, day: date) -> float:
+        return self._values[self._offset(day)]
+
+    def add(self, day: date, hours: float):
+        offset = self._offset(day)
+        self._values[offset] += hours
+        node = self._size + offset
+        self._sum[node] = self._values[offset]
+        self._min[node] = self._values[offset]
+        node //= 2
+        while node:
+            self._pull(node)
+            node //= 2
+
+    def range_sum(self, first: date, last: date) -> float:
+        lo, hi = self._offset(first) + self._size, self._offset(last) + self._size + 1
+        total = 0.0
+        while lo < hi:
+            if lo & 1:
+                total += self._sum[lo]
+                lo += 1
+            if hi & 1:
+                hi -= 1
+                total += self._sum[hi]
+            lo //= 2
+            hi //= 2
+        return total
+
+    def least_loaded(self, first: date, last: date) -> Tuple[date, float]:
+        """区间内负载最小的日期（并列时取最早的一天）"""
+        lo, hi = self._offset(first) + self._size, self._offset(last) + self._size + 1
+        best = (float("inf"), self.days)
+        while lo < hi:
+            if lo & 1:
+                best = min(best, (self._min[lo], self._argmin[lo]))
+                lo += 1
+            if hi & 1:
+                hi -= 1
+                best = min(best, (self._min[hi], self._argmin[hi]))
+            lo //= 2
+            hi //= 2
+        return self.start + timedelta(days=best[1]), best[0]
+
+    def as_dict(self) -> Dict[date, float]:
+        return {
+            self.start + timedelta(days=i): hours
+            for i, hours in enumerate(self._values)
+            if hours > 1e-9
+        }
+
+
+def load_window(
+    db: Session,
+    user_id: int,
+    start: date,
+    end: date,
+    exclude_task_ids: Iterable[int] = (),
+) -> DailyLoadTree:
+    """
+    从索引表读取用户在 [start, end] 内的日负载并构建线段树
+    exclude_task_ids 中任务的现有计划项会被扣除（重新规划这些任务时，它们的旧计划会被覆盖）
+    """
+    loads: Dict[date, float] = defaultdict(float)
+    for row in db.query(UserDailyLoad.date, UserDailyLoad.allocated_hours).filter(
+        UserDailyLoad.user_id == user_id,
+        UserDailyLoad.date >= start,
+        UserDailyLoad.date <= end
+    ):
+        loads[row.date] += row.allocated_hours or 0.0
+
+    exclude_task_ids = list(exclude_task_ids)
+    if exclude_task_ids:
+        for day, hours in db.query(DailyTaskItem.date, func.sum(DailyTaskItem.allocated_hours)).filter(
+            DailyTaskItem.task_id.in_(exclude_task_ids),
+            DailyTaskItem.date >= start,
+            DailyTaskItem.date <= end
+        ).group_by(DailyTaskItem.date):
+            loads[day] = max(0.0, loads[day] - (hours or 0.0))
+
+    return DailyLoadTree(start, (end - start).days + 1, loads)
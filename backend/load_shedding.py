@@ -0,0 +1,339 @@
+"""
+HTTP 层的限流和自适应降载（中间件，在路由之前执行）
+
+- 请求按优先级分为三类：write（POST/PUT/DELETE）、read（GET）、llm（生成子任务/计划的接口）
+- 令牌桶限流：每个用户（会话令牌或 user_id 参数识别，见 db_router.request_user_key）和每个客户端 IP 各一组，
+  每类请求单独计数；超过后返回 429 + Retry-After
+- 自适应并发上限（梯度算法）：对比近期请求延迟和无负载时的延迟基线（近期延迟的最小值，随时间缓慢上浮），
+  延迟升高时按比例收缩上限，恢复后逐步放大；每类请求只能使用上限的一部分（LOAD_SHED_SHARES），
+  上限收缩时 llm 最先被拒绝，其次是 read，write 最后；被拒绝的请求立即返回 503 + Retry-After，不在进程内排队
+- llm 请求的耗时主要是等待模型，不占用并发名额、不作为延迟样本（它们的排队和并发由 admission.py 控制）
+
+所有状态只在事件循环线程中访问，不需要加锁。
+
+环境变量：
+    RATE_LIMIT_ENABLED            是否启用令牌桶限流，默认 1
+    RATE_LIMIT_READ_PER_MINUTE    每用户每分钟 read 请求数，默认 600（突发容量为 1/6，即 100）
+    RATE_LIMIT_WRITE_PER_MINUTE   每用户每分钟 write 请求数，默认 240
+    RATE_LIMIT_LLM_PER_MINUTE     每用户每分钟 llm 请求数，默认 20
+    RATE_LIMIT_IP_MULTIPLIER      每个 IP 的限额是每用户限额的倍数（同一出口 IP 后可能有多个用户），默认 5
+    RATE_LIMIT_TRUST_PROXY        是否使用 X-Forwarded-For 最后一跳作为客户端 IP（部署在反向代理后时开启），
+                                  在 Railway 上（存在 RAILWAY_ENVIRONMENT）默认 1，其他情况默认 0。
+                                  不信任代理时，来自内网或本机地址的连接（多半是代理本身，所有客户端共用）不使用 IP 令牌桶，只按用户限流
+    LOAD_SHED_ENABLED             是否启用自适应降载，默认 1
+    LOAD_SHED_INITIAL_LIMIT       初始并发上限，默认 32
+    LOAD_SHED_MIN_LIMIT           并发上限下限，默认 4
+    LOAD_SHED_MAX_LIMIT           并发上限上限，默认 256
+    LOAD_SHED_TOLERANCE           允许的延迟升高倍数（超过后开始收缩），默认 2.0
+    LOAD_SHED_SHARES              各类请求可使用的上限比例，默认 write=1.0,read=0.9,llm=0.5
+"""
+import ipaddress
+import math
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from fastapi import Request
+from fastapi.responses import JSONResponse
+
+from db_router import request_user_key
+
+PRIORITY_WRITE = "write"
+PRIORITY_READ = "read"
+PRIORITY_LLM = "llm"
+
+LLM_PATH_SUFFIXES = ("/generate-subtasks", "/generate-plan", "/generate-plans")
+# /admin/：诊断接口（例如性能剖析）在过载时也必须可用，且长时间运行的剖析请求不能作为延迟样本
+EXEMPT_PREFIXES = ("/assets/", "/docs", "/redoc", "/openapi.json", "/favicon", "/admin/")
+MUTATING_METHODS = ("POST", "PUT", "PATCH", "DELETE")
+
+
+def _env_flag(name: str, default: str) -> bool:
+    return os.getenv(name, default).lower() in ("1", "true", "yes", "on")
+
+
+def classify(method: str, path: str) -> Optional[str]:
+    """请求的优先级类别；None 表示不受限（静态资源、文档、管理接口、CORS 预检）"""
+    if method == "OPTIONS" or path == "/" or path.startswith(EXEMPT_PREFIXES):
+        return None
+    if method in MUTATING_METHODS:
+        return PRIORITY_LLM if path.rstrip("/").endswith(LLM_PATH_SUFFIXES) else PRIORITY_WRITE
+    return PRIORITY_READ
+
+
+# ============================================================================
+# 令牌桶限流
+# ============================================================================
+
+class RateLimiter:
+    """按 (维度, 键, 类别) 的令牌桶；桶的数量有上限，最久未使用的先淘汰"""
+
+    def __init__(self, per_minute: Dict[str, float], ip_multiplier: float = 5.0, max_buckets: int = 100000):
+        self.per_minute = per_minute
+        self.ip_multiplier = ip_multiplier
+        self.max_buckets = max_buckets
+        # 键 -> [剩余令牌, 上次补充时间]
+        self._buckets: "OrderedDict[tuple, list]" = OrderedDict()
+        self.stats = {"allowed": 0, "limited": 0}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            per_minute={
+                PRIORITY_READ: float(os.getenv("RATE_LIMIT_READ_PER_MINUTE", "600")),
+                PRIORITY_WRITE: float(os.getenv("RATE_LIMIT_WRITE_PER_MINUTE", "240")),
+                PRIORITY_LLM: float(os.getenv("RATE_LIMIT_LLM_PER_MINUTE", "20")),
+            },
+            ip_multiplier=float(os.getenv("RATE_LIMIT_IP_MULTIPLIER", "5")),
+        )
+
+    def _bucket(self, key: tuple, rate: float, now: float) -> Tuple[list, float]:
+        """取出并补充令牌桶；容量为 rate / 6（10 秒的量，至少 1 个）"""
+        capacity = max(1.0, rate / 6.0)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = [capacity, now]
+            self._buckets[key] = bucket
+            if len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * rate / 60.0)
+            bucket[1] = now
+        return bucket, capacity
+
+    def check(self, priority: str, user_key: Optional[str], ip: Optional[str]) -> Optional[float]:
+        """
+        用户桶和 IP 桶都有令牌时各扣一个并返回 None；
+        否则不扣令牌，返回需要等待的秒数（用于 Retry-After）
+        """
+        rate = self.per_minute.get(priority, 0.0)
+        if rate <= 0:
+            return None
+        now = time.monotonic()
+        buckets = []
+        if user_key:
+            buckets.append((self._bucket(("user", user_key, priority), rate, now)[0], rate))
+        if ip:
+            ip_rate = rate * self.ip_multiplier
+            buckets.append((self._bucket(("ip", ip, priority), ip_rate, now)[0], ip_rate))
+        wait = max((((1.0 - bucket[0]) * 60.0 / bucket_rate) for bucket, bucket_rate in buckets if bucket[0] < 1.0), default=None)
+        if wait is not None:
+            self.stats["limited"] += 1
+            return wait
+        for bucket, _ in buckets:
+            bucket[0] -= 1.0
+        self.stats["allowed"] += 1
+        return None
+
+
+# ============================================================================
+# 自适应并发上限
+# ============================================================================
+
+class AdaptiveConcurrencyLimit:
+    """
+    梯度算法，每 window 个延迟样本更新一次上限：
+    gradient = tolerance * 延迟基线 / 近期延迟（限制在 [0.5, 1]），
+    新上限 = 上限 * gradient + sqrt(上限)，再与旧上限做指数平滑
+    - 近期延迟是各窗口平均延迟的 EWMA
+    - 延迟没有明显升高时 gradient 为 1，上限按 sqrt(上限) 缓慢增长（只在窗口内并发确实接近上限时增长）
+    - 延迟升高到基线的 tolerance 倍以上（过载）时上限按比例收缩
+    - 基线取近期延迟的最小值，并随时间上浮（接口或数据量变化使正常延迟变长后能跟上）：
+      没有过载时每秒最多上浮 drift_idle，过载期间只按 drift_congested 缓慢上浮，避免被排队延迟抬高
+    - 上限和延迟样本只统计 read/write 请求；llm 请求长时间等待模型，不占用名额，
+      只在 read/write 的并发达到上限的 llm 份额时被拒绝
+    """
+
+    def __init__(
+        self,
+        initial_limit: int = 32,
+        min_limit: int = 4,
+        max_limit: int = 256,
+        tolerance: float = 2.0,
+        shares: Optional[Dict[str, float]] = None,
+        smoothing: float = 0.2,
+        window: int = 20,
+        drift_idle: float = 0.1,
+        drift_congested: float = 0.002,
+    ):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.tolerance = tolerance
+        self.shares = shares or {PRIORITY_WRITE: 1.0, PRIORITY_READ: 0.9, PRIORITY_LLM: 0.5}
+        self.smoothing = smoothing
+        self.window = window
+        self.drift_idle = drift_idle
+        self.drift_congested = drift_congested
+        self.inflight = 0  # read/write 请求的并发
+        self.inflight_by_priority = {priority: 0 for priority in self.shares}
+        self._short_rtt: Optional[float] = None
+        self._baseline_rtt: Optional[float] = None
+        self._baseline_at = 0.0
+        self._window_sum = 0.0
+        self._window_count = 0
+        self._window_peak = 0  # 窗口内的最大并发
+        self._window_min = math.inf  # 窗口内的最小延迟
+        self.stats = {"admitted": 0, "shed": 0}
+
+    @classmethod
+    def from_env(cls):
+        shares = {}
+        for part in os.getenv("LOAD_SHED_SHARES", "write=1.0,read=0.9,llm=0.5").split(","):
+            name, _, value = part.partition("=")
+            if name.strip() and value.strip():
+                shares[name.strip()] = float(value)
+        return cls(
+            initial_limit=int(os.getenv("LOAD_SHED_INITIAL_LIMIT", "32")),
+            min_limit=int(os.getenv("LOAD_SHED_MIN_LIMIT", "4")),
+            max_limit=int(os.getenv("LOAD_SHED_MAX_LIMIT", "256")),
+            tolerance=float(os.getenv("LOAD_SHED_TOLERANCE", "2.0")),
+            shares=shares or None,
+        )
+
+    def try_acquire(self, priority: str) -> bool:
+        # 每类至少保留 1 个名额，避免上限收缩到最小时某类请求完全无法执行
+        if self.inflight >= max(1.0, self.limit * self.shares.get(priority, 1.0)):
+            self.stats["shed"] += 1
+            return False
+        if priority != PRIORITY_LLM:
+            self.inflight += 1
+        self.inflight_by_priority[priority] = self.inflight_by_priority.get(priority, 0) + 1
+        self.stats["admitted"] += 1
+        return True
+
+    def release(self, priority: str, latency: Optional[float], now: Optional[float] = None):
+        """请求结束；latency 为 None（请求异常）时不作为延迟样本"""
+        self.inflight_by_priority[priority] -= 1
+        if priority == PRIORITY_LLM:
+            return
+        inflight = self.inflight
+        self.inflight -= 1
+        if latency is not None:
+            self._update(latency, inflight, time.monotonic() if now is None else now)
+
+    def _update(self, latency: float, inflight: int, now: float):
+        self._window_sum += latency
+        self._window_count += 1
+        self._window_peak = max(self._window_peak, inflight)
+        self._window_min = min(self._window_min, latency)
+        if self._window_count < self.window:
+            return
+        sample = self._window_sum / self._window_count
+        peak, fastest = self._window_peak, self._window_min
+        self._window_sum, self._window_count, self._window_peak, self._window_min = 0.0, 0, 0, math.inf
+
+        if self._short_rtt is None:
+            # 冷启动时可能已经过载，基线取第一个窗口里最快的请求
+            self._short_rtt, self._baseline_rtt, self._baseline_at = sample, fastest, now
+        self._short_rtt = 0.5 * self._short_rtt + 0.5 * sample
+        congested = self._short_rtt > self.tolerance * self._baseline_rtt
+        drift = self.drift_congested if congested and self.limit > self.min_limit else self.drift_idle
+        elapsed = max(0.0, now - self._baseline_at)
+        self._baseline_rtt = min(self._baseline_rtt * (1 + drift * elapsed), self._short_rtt)
+        self._baseline_at = now
+
+        gradient = max(0.5, min(1.0, self.tolerance * self._baseline_rtt / self._short_rtt))
+        if gradient >= 1.0 and peak < self.limit / 2:
+            # 并发远低于上限，延迟正常不代表还能承受更多请求，不增长
+            return
+        new_limit = self.limit * gradient + math.sqrt(self.limit)
+        self.limit = (1 - self.smoothing) * self.limit + self.smoothing * new_limit
+        self.limit = max(float(self.min_limit), min(float(self.max_limit), self.limit))
+
+    def retry_after(self) -> float:
+        return max(1.0, math.ceil((self._short_rtt or 0.0) * 2))
+
+    def snapshot(self) -> dict:
+        return {
+            "limit": round(self.limit, 1),
+            "inflight": self.inflight,
+            "inflight_by_priority": dict(self.inflight_by_priority),
+            "short_rtt_ms": round(self._short_rtt * 1000, 1) if self._short_rtt is not None else None,
+            "baseline_rtt_ms": round(self._baseline_rtt * 1000, 1) if self._baseline_rtt is not None else None,
+            **self.stats,
+        }
+
+
+# ============================================================================
+# 中间件
+# ============================================================================
+
+# 运营商级 NAT 地址段（100.64.0.0/10），云平台的内部网络和边缘代理常用，ipaddress 不把它算作 is_private
+_SHARED_ADDRESS_SPACE = ipaddress.ip_network("100.64.0.0/10")
+
+
+def _is_internal(host: Optional[str]) -> bool:
+    try:
+        address = ipaddress.ip_address(host)
+    except (TypeError, ValueError):
+        return False
+    return address.is_private or address.is_loopback or address in _SHARED_ADDRESS_SPACE
+
+
+class LoadShedder:
+    def __init__(self, rate_limiter: Optional[RateLimiter], concurrency: Optional[AdaptiveConcurrencyLimit], trust_proxy: bool = False):
+        self.rate_limiter = rate_limiter
+        self.concurrency = concurrency
+        self.trust_proxy = trust_proxy
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            rate_limiter=RateLimiter.from_env() if _env_flag("RATE_LIMIT_ENABLED", "1") else None,
+            concurrency=AdaptiveConcurrencyLimit.from_env() if _env_flag("LOAD_SHED_ENABLED", "1") else None,
+            trust_proxy=_env_flag("RATE_LIMIT_TRUST_PROXY", "1" if os.getenv("RAILWAY_ENVIRONMENT") else "0"),
+        )
+
+    def client_ip(self, request: Request) -> Optional[str]:
+        """IP 令牌桶使用的客户端 IP；无法区分客户端时返回 None（不按 IP 限流）"""
+        if self.trust_proxy:
+            forwarded = request.headers.get("x-forwarded-for")
+            if forwarded:
+                # 最后一跳由我们自己的代理追加，客户端无法伪造
+                return forwarded.split(",")[-1].strip()
+        host = request.client.host if request.client else None
+        if not self.trust_proxy and _is_internal(host):
+            # 对端是内网或本机地址：通常是反向代理，所有客户端会共用同一个桶
+            return None
+        return host
+
+    async def __call__(self, request: Request, call_next):
+        priority = classify(request.method, request.url.path)
+        if priority is None:
+            return await call_next(request)
+
+        if self.rate_limiter is not None:
+            wait = self.rate_limiter.check(priority, request_user_key(request), self.client_ip(request))
+            if wait is not None:
+                return JSONResponse(
+                    status_code=429,
+                    content={"detail": "Too many requests, please slow down"},
+                    headers={"Retry-After": str(max(1, math.ceil(wait)))}
+                )
+
+        if self.concurrency is None:
+            return await call_next(request)
+        if not self.concurrency.try_acquire(priority):
+            return JSONResponse(
+                status_code=503,
+                content={"detail": "Server is busy, please try again later"},
+                headers={"Retry-After": str(int(self.concurrency.retry_after()))}
+            )
+        started = time.monotonic()
+        latency = None
+        try:
+            response = await call_next(request)
+            # 流式响应（SSE、日历订阅）只计到开始返回为止
+            latency = time.monotonic() - started
+            return response
+        finally:
+            self.concurrency.release(priority, latency)
+
+    def snapshot(self) -> dict:
+        return {
+            "rate_limit": dict(self.rate_limiter.stats) if self.rate_limiter is not None else None,
+            "concurrency": self.concurrency.snapshot() if self.concurrency is not None else None,
+        }
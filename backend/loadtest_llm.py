@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+LLM 生成接口压测脚本
+
+在并发生成计划时测量端到端吞吐量、延迟分位数，以及事件循环饥饿程度：
+压测期间以固定间隔请求一个廉价接口（GET /users/{user_id}），
+如果 LLM 调用阻塞了事件循环，这个探针的延迟会明显升高。
+
+用法（三个终端）：
+    python fake_llm_server.py --port 9000 --latency lognormal:-0.5,0.4
+    OPENAI_BASE_URL=http://127.0.0.1:9000/v1 uvicorn main:app --port 8000
+    python loadtest_llm.py --base-url http://127.0.0.1:8000 --tasks 50 --concurrency 20
+"""
+import argparse
+import asyncio
+import statistics
+import time
+import uuid
+from datetime import date, timedelta
+from typing import List, Optional
+
+import httpx
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """计算分位数（最近秩法）"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def summarize(name: str, latencies: List[float], errors: int, elapsed: Optional[float] = None):
+    """打印延迟统计"""
+    count = len(latencies)
+    line = f"{name:<18} n={count:<5} err={errors:<4}"
+    if count:
+        line += (
+            f" p50={percentile(latencies, 50) * 1000:8.1f}ms"
+            f" p95={percentile(latencies, 95) * 1000:8.1f}ms"
+            f" p99={percentile(latencies, 99) * 1000:8.1f}ms"
+            f" max={max(latencies) * 1000:8.1f}ms"
+            f" mean={statistics.mean(latencies) * 1000:8.1f}ms"
+        )
+    if elapsed:
+        line += f" throughput={count / elapsed:6.2f} req/s"
+    print(line)
+
+
+async def setup_tasks(client: httpx.AsyncClient, n_tasks: int, horizon_days: int):
+    """创建压测用户和任务，并为每个任务生成子任务"""
+    nickname = f"loadtest-{uuid.uuid4().hex[:8]}"
+    response = await client.post("/users", json={"nickname": nickname})
+    response.raise_for_status()
+    user_id = response.json()["user_id"]
+
+    deadline = (date.today() + timedelta(days=horizon_days)).isoformat()
+    task_ids = []
+    for i in range(n_tasks):
+        response = await client.post("/tasks", json={
+            "task_name": f"Load test task {i}",
+            "description": f"Review chapter {i}, do exercises, write summary",
+            "importance": ["low", "medium", "high"][i % 3],
+            "is_long_term": False,
+            "deadline": deadline,
+            "user_id": user_id,
+        })
+        response.raise_for_status()
+        task_ids.append(response.json()["id"])
+    return user_id, task_ids
+
+
+async def run_phase(client, name, paths, concurrency, probe_path, probe_interval):
+    """并发请求一组 POST 接口，同时运行事件循环探针"""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    errors = 0
+    done = asyncio.Event()
+
+    async def one(path):
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                response = await client.post(path, json={"description": "load test", "is_long_term": False}
+                                             if path.endswith("generate-subtasks") else None)
+                if response.status_code >= 400:
+                    errors += 1
+                    return
+            except httpx.HTTPError:
+                errors += 1
+                return
+            latencies.append(time.perf_counter() - started)
+
+    probe_latencies: List[float] = []
+    probe_errors = 0
+
+    async def probe():
+        nonlocal probe_errors
+        while not done.is_set():
+            started = time.perf_counter()
+            try:
+                response = await client.get(probe_path)
+                if response.status_code >= 400:
+                    probe_errors += 1
+                else:
+                    probe_latencies.append(time.perf_counter() - started)
+            except httpx.HTTPError:
+                probe_errors += 1
+            await asyncio.sleep(probe_interval)
+
+    probe_task = asyncio.create_task(probe())
+    started = time.perf_counter()
+    await asyncio.gather(*(one(p) for p in paths))
+    elapsed = time.perf_counter() - started
+    done.set()
+    await probe_task
+
+    print(f"\n== {name} ({len(paths)} requests, concurrency={concurrency}, {elapsed:.2f}s) ==")
+    summarize(name, latencies, errors, elapsed)
+    summarize("probe (starvation)", probe_latencies, probe_errors)
+
+
+async def main_async(args):
+    limits = httpx.Limits(max_connections=args.concurrency + 4, max_keepalive_connections=args.concurrency + 4)
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=args.timeout, limits=limits) as client:
+        user_id, task_ids = await setup_tasks(client, args.tasks, args.horizon_days)
+        print(f"🔹 Created user {user_id} with {len(task_ids)} tasks")
+        probe_path = f"/users/{user_id}"
+
+        await run_phase(
+            client, "generate-subtasks",
+            [f"/tasks/{task_id}/generate-subtasks" for task_id in task_ids],
+            args.concurrency, probe_path, args.probe_interval,
+        )
+        await run_phase(
+            client, "generate-plan",
+            [f"/tasks/{task_id}/generate-plan?user_id={user_id}" for task_id in task_ids] * args.rounds,
+            args.concurrency, probe_path, args.probe_interval,
+        )
+
+        if not args.keep:
+            for task_id in task_ids:
+                await client.delete(f"/tasks/{task_id}", params={"user_id": user_id})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test generate-subtasks / generate-plan")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--tasks", type=int, default=20, help="number of tasks to create")
+    parser.add_argument("--rounds", type=int, default=1, help="generate-plan calls per task")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--horizon-days", type=int, default=14)
+    parser.add_argument("--probe-interval", type=float, default=0.05)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--keep", action="store_true", help="keep created tasks after the run")
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
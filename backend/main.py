@@ -1,18 +1,41 @@
-from fastapi import FastAPI, Depends, HTTPException
+from fastapi import FastAPI, Depends, HTTPException, Header, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
-from sqlalchemy.orm import Session
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.orm import Session, contains_eager, selectinload
 from pydantic import BaseModel, validator
 from datetime import date, datetime, timedelta, timezone
+from email.utils import format_datetime, parsedate_to_datetime
 from typing import List, Optional
-import json
+import asyncio
+import hashlib
 import os
 from pathlib import Path
 from dotenv import load_dotenv
-from openai import OpenAI
-from database import init_db, get_db
-from models import User, Task, Subtask, DailyTaskItem
+from database import init_db, get_db, engine, read_engine, SessionLocal
+from db_router import get_read_db, read_session_factory, request_user_key, track_writes
+from models import User, Task, Subtask, DailyTaskItem, DailyTaskItemArchive, SyncTombstone
+from singleflight import SingleFlight, IdempotencyStore
+from llm_resilience import ResilientLLMCaller, CircuitOpenError, LLMTimeoutError, is_retryable
+from planner import build_capacity_plan, build_local_batch_plan, replan_subtask_hours, DEFAULT_DAILY_CAP
+from load_index import load_window, reset_user_loads
+from task_progress import progress_percent, reset_task_progress
+from search_index import KIND_NAMES, KIND_SUBTASK, KIND_TASK, search_documents
+from stats_rollup import adjust_user_stats, archived_task_stats, negate, reset_user_stats, user_stats
+from admission import AdmissionController, AdmissionRejected, estimate_tokens
+from llm_gateway import LLMGateway, LLMConfigError
+from similarity_index import SimilarTaskIndex
+from archive import run_archival
+from change_tracking import add_change_listener, record_tombstones, tombstone_horizon, touch_users
+from events import EventBroker, EVENTS_HEARTBEAT_SECONDS, SSE_HEARTBEAT, sse_message
+from auth import ADMIN_TOKEN, AUTH_ALLOW_USER_ID_PARAM, SessionUser, issue_token, require_admin, session_user
+from load_shedding import LoadShedder
+from tracing import setup_tracing, trace_requests
+import profiling
+from slow_query_log import SlowQueryLog, track_endpoint
+import ical
+import prompts
 import uuid
 
 # 加载环境变量
@@ -56,6 +79,11 @@ if not FRONTEND_DIR.exists():
 # 确保目录存在（即使为空）
 FRONTEND_DIR.mkdir(parents=True, exist_ok=True)
 
+# 限流和自适应降载（配置见 load_shedding.py）
+# 在 CORS 之前注册，位于 CORS 内层：被拒绝的 429/503 响应也带 CORS 头，前端可以读取
+load_shedder = LoadShedder.from_env()
+app.middleware("http")(load_shedder)
+
 # 配置 CORS
 # 从环境变量获取允许的来源，如果没有则使用默认值
 allowed_origins = os.getenv("ALLOWED_ORIGINS", "http://localhost:5173,http://127.0.0.1:5173").split(",")
@@ -67,6 +95,26 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 读写分离：记录写请求，开启 read-your-writes 窗口（只读副本见 db_router.py）
+app.middleware("http")(track_writes)
+
+# 慢查询日志（配置见 slow_query_log.py）：主库和只读副本都计时，中间件记录慢查询所属的接口
+slow_query_log = SlowQueryLog.from_env()
+if slow_query_log.enabled:
+    slow_query_log.attach(engine, "primary")
+    if read_engine is not engine:
+        slow_query_log.attach(read_engine, "replica")
+    app.middleware("http")(track_endpoint)
+
+# 单个请求的性能剖析（X-Profile 请求头，见 profiling.py）；只有配置了管理员令牌时才注册
+if ADMIN_TOKEN:
+    app.middleware("http")(profiling.profile_requests)
+
+# 分布式追踪（配置见 tracing.py，默认关闭）
+# 最后注册，位于最外层：被限流拒绝的请求和其他中间件的耗时也计入请求 span
+if setup_tracing(user_key=request_user_key):
+    app.middleware("http")(trace_requests)
+
 # 初始化数据库
 init_db()
 
@@ -114,15 +162,95 @@ else:
         except Exception as e:
             print(f"   Error listing files: {e}")
 
-# 初始化 OpenAI 客户端（延迟初始化，避免启动时就需要 API key）
-def get_openai_client():
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
-        raise HTTPException(
-            status_code=500, 
-            detail="OPENAI_API_KEY is not set. Please configure OPENAI_API_KEY in the production environment variables"
+# LLM 调用的尾延迟控制（超时、重试、对冲、熔断），配置见 llm_resilience.py
+llm_caller = ResilientLLMCaller()
+# LLM 生成请求的准入控制（全局/每用户并发上限、token 预算、公平排队），配置见 admission.py
+llm_admission = AdmissionController.from_env()
+# LLM 不可用时是否退回本地计划生成
+LLM_FALLBACK_LOCAL_PLAN = os.getenv("LLM_FALLBACK_LOCAL_PLAN", "1").lower() in ("1", "true", "yes", "on")
+# 每个用户每天所有任务合计的计划时间上限（小时）
+DAILY_CAPACITY_HOURS = float(os.getenv("DAILY_CAPACITY_HOURS", str(DEFAULT_DAILY_CAP)))
+# 修改子任务预计时间时是否自动增量调整计划（请求中的 replan 参数优先）
+AUTO_REPLAN = os.getenv("AUTO_REPLAN", "1").lower() in ("1", "true", "yes", "on")
+
+
+def llm_http_error(e: Exception) -> HTTPException:
+    """把 LLM 调用异常转换为 HTTP 错误：排队已满 429、熔断 503、超时 504、上游错误 502"""
+    if isinstance(e, HTTPException):
+        return e
+    if isinstance(e, LLMConfigError):
+        return HTTPException(status_code=500, detail=str(e))
+    if isinstance(e, AdmissionRejected):
+        return HTTPException(
+            status_code=429,
+            detail=f"Too many generation requests, please try again later ({str(e)})",
+            headers={"Retry-After": str(max(1, int(e.retry_after)))}
+        )
+    if isinstance(e, CircuitOpenError):
+        return HTTPException(
+            status_code=503,
+            detail="LLM service is temporarily unavailable, please try again later",
+            headers={"Retry-After": str(max(1, int(e.retry_after)))}
         )
-    return OpenAI(api_key=api_key)
+    if isinstance(e, LLMTimeoutError):
+        return HTTPException(status_code=504, detail=f"OpenAI API call timed out: {str(e)}")
+    return HTTPException(status_code=502, detail=f"OpenAI API call failed: {str(e)}")
+
+
+# 应用级共享的 LLM 网关（provider、连接池、各端点的模型配置见 llm_gateway.py）
+# provider 在第一次调用时创建，启动时不要求配置 API key
+llm_gateway = LLMGateway.from_env(timeout=llm_caller.config.timeout)
+
+
+@app.on_event("shutdown")
+async def close_llm_gateway():
+    await llm_gateway.aclose()
+
+
+# 定期归档已完成的历史计划项（ARCHIVE_INTERVAL_HOURS=0 时不在进程内执行，可用 cron 运行 archive.py）
+ARCHIVE_INTERVAL_HOURS = float(os.getenv("ARCHIVE_INTERVAL_HOURS", "0"))
+
+
+@app.on_event("startup")
+async def start_archival_loop():
+    if ARCHIVE_INTERVAL_HOURS <= 0:
+        return
+    
+    async def archival_loop():
+        while True:
+            try:
+                await run_in_threadpool(run_archival)
+            except Exception as e:
+                print(f"⚠️  归档任务失败: {str(e)}")
+            await asyncio.sleep(ARCHIVE_INTERVAL_HOURS * 3600)
+    
+    asyncio.create_task(archival_loop())
+
+
+# 日历变更推送：每次提交后把行级变更事件推送给该用户的 SSE 连接（跨进程广播见 events.py）
+event_broker = EventBroker.from_env(engine)
+add_change_listener(event_broker.publish)
+
+
+@app.on_event("startup")
+async def start_event_broker():
+    event_broker.start()
+
+
+@app.on_event("shutdown")
+async def stop_event_broker():
+    event_broker.stop()
+
+
+# 近似重复任务索引：措辞略有不同的任务复用已有的子任务分解，不调用 LLM（配置见 similarity_index.py）
+similar_tasks = SimilarTaskIndex.from_env()
+
+
+@app.on_event("startup")
+async def load_similar_tasks():
+    # 在线程池中后台加载，不阻塞事件循环和启动；加载完成前生成子任务照常调用 LLM
+    if similar_tasks.enabled:
+        asyncio.ensure_future(run_in_threadpool(similar_tasks.load, SessionLocal))
 
 
 # Pydantic 模型
@@ -135,6 +263,8 @@ class UserResponse(BaseModel):
     user_id: str
     nickname: str
     created_at: str
+    token: Optional[str] = None  # 会话令牌（只由 POST /users 和 /users/by-nickname 签发，见 auth.py）
+    token_expires_at: Optional[str] = None
 
 
 class TaskCreate(BaseModel):
@@ -144,7 +274,7 @@ class TaskCreate(BaseModel):
     is_long_term: bool = False
     start_date: Optional[str] = None  # 开始日期（YYYY-MM-DD 格式，可选）
     deadline: Optional[str] = None  # YYYY-MM-DD 格式，长期任务为 None
-    user_id: str  # 用户ID
+    user_id: Optional[str] = None  # 用户ID（带会话令牌时可省略）
 
 
 class SubtaskResponse(BaseModel):
@@ -155,6 +285,20 @@ class SubtaskResponse(BaseModel):
     is_completed: bool
 
 
+class SubtaskUpdateResponse(SubtaskResponse):
+    replanned: bool = False  # 是否增量调整了计划
+    replanned_items: List[dict] = []  # 被调整的计划项（allocated_hours 为 0 表示已删除）
+
+
+class TaskProgress(BaseModel):
+    total_hours: float = 0.0  # 计划项分配时间合计（含已归档）
+    completed_hours: float = 0.0
+    subtask_count: int = 0
+    completed_subtasks: int = 0
+    next_date: Optional[str] = None  # 最早的未完成计划项日期
+    percent: float = 0.0
+
+
 class TaskResponse(BaseModel):
     id: int
     task_name: str
@@ -165,6 +309,7 @@ class TaskResponse(BaseModel):
     deadline: Optional[str]
     subtasks: List[SubtaskResponse]
     created_at: str
+    progress: TaskProgress = TaskProgress()
 
 
 class DailyItemResponse(BaseModel):
@@ -177,6 +322,64 @@ class DailyItemResponse(BaseModel):
     allocated_hours: float
     is_completed: bool
     importance: str
+    archived: bool = False  # 来自归档表（只读）
+
+
+class SyncTask(BaseModel):
+    id: int
+    task_name: str
+    description: str
+    importance: str
+    is_long_term: bool
+    start_date: Optional[str] = None
+    deadline: Optional[str] = None
+    progress: TaskProgress = TaskProgress()
+
+
+class SyncSubtask(SubtaskResponse):
+    task_id: int
+
+
+class SyncItem(BaseModel):
+    id: int
+    date: str
+    task_id: int
+    subtask_id: int  # 0 表示长期任务
+    allocated_hours: float
+    is_completed: bool
+
+
+class SyncDeleted(BaseModel):
+    tasks: List[int] = []
+    subtasks: List[int] = []
+    items: List[int] = []
+
+
+class SyncResponse(BaseModel):
+    cursor: str  # 下次请求作为 since 传回
+    full: bool  # True 表示全量快照，客户端应替换本地数据
+    tasks: List[SyncTask]
+    subtasks: List[SyncSubtask]
+    items: List[SyncItem]
+    deleted: SyncDeleted
+
+
+class SearchHit(BaseModel):
+    kind: str  # task 或 subtask
+    id: int
+    task_id: int
+    title: str
+    description: Optional[str] = None
+    task_name: str  # 子任务所属任务的名称（任务命中时与 title 相同）
+    score: float
+
+
+class SearchResponse(BaseModel):
+    query: str
+    limit: int
+    offset: int
+    has_more: bool
+    results: List[SearchHit]
 
 
 class GenerateSubtasksRequest(BaseModel):
@@ -184,6 +387,7 @@ class GenerateSubtasksRequest(BaseModel):
     deadline: Optional[str] = None
     is_long_term: bool = False
     max_subtasks: Optional[int] = None  # 子任务数量上限，如果不指定则不做限制
+    reuse_similar: bool = True  # 有足够相似的已分解任务时直接复用其子任务（False 时仍调用 LLM，只在响应中给出相似任务）
     
     @validator('max_subtasks')
     def validate_max_subtasks(cls, v):
@@ -217,6 +421,12 @@ class AllocatedHoursUpdate(BaseModel):
     allocated_hours: float
 
 
+class BatchPlanRequest(BaseModel):
+    """批量生成计划的请求模型"""
+    task_ids: Optional[List[int]] = None  # 要规划的任务，不指定则规划该用户的所有任务
+    use_llm: bool = True  # False 时直接使用本地求解，不调用 LLM
+
+
 class CustomTaskItemCreate(BaseModel):
     """创建自定义任务项的请求模型"""
     task_name: str
@@ -224,23 +434,77 @@ class CustomTaskItemCreate(BaseModel):
     date: str  # YYYY-MM-DD 格式
     allocated_hours: float
     importance: str = "medium"  # low, medium, high
-    user_id: str
+    user_id: Optional[str] = None  # 带会话令牌时可省略
+
+
+# 生成请求去重：并发的相同请求共享一次 LLM 调用和一次数据库写入；
+# 带 Idempotency-Key 的重试请求直接返回已保存的结果
+generation_flight = SingleFlight()
+idempotency_store = IdempotencyStore(
+    ttl_seconds=float(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+)
+
+
+async def _run_deduplicated(flight_key, idempotency_key, fn):
+    """通过 single-flight 执行 fn，并按幂等键保存成功的结果"""
+    if idempotency_key is not None:
+        stored = idempotency_store.get(idempotency_key)
+        if stored is not None:
+            return stored
+    
+    result, _shared = await generation_flight.do(flight_key, fn)
+    
+    if idempotency_key is not None:
+        idempotency_store.put(idempotency_key, result)
+    return result
+
+
+def _user_response(user: User, with_token: bool = False) -> UserResponse:
+    response = UserResponse(
+        id=user.id,
+        user_id=user.user_id,
+        nickname=user.nickname,
+        created_at=user.created_at.isoformat()
+    )
+    if with_token:
+        token, expires_at = issue_token(user.id, user.user_id)
+        response.token = token
+        response.token_expires_at = expires_at.isoformat() + "Z"
+    return response
+
+
+def _resolve_user(db: Session, caller: Optional[SessionUser], user_id: Optional[str], required: bool = True) -> Optional[SessionUser]:
+    """
+    确定请求所属的用户
+    带有会话令牌时直接使用令牌中的身份，不查询数据库（同时提供的 user_id 必须与令牌一致）；
+    没有令牌时按 user_id 查询一次 users 表（兼容旧客户端，AUTH_ALLOW_USER_ID_PARAM=0 时关闭）
+    required=False 时两者都没有则返回 None（不做归属检查，与旧行为一致）
+    """
+    if caller is not None:
+        if user_id and user_id != caller.user_id:
+            raise HTTPException(status_code=403, detail="user_id does not match the session token")
+        return caller
+    if not user_id:
+        if required:
+            raise HTTPException(status_code=400, detail="user_id parameter or session token is required")
+        return None
+    if not AUTH_ALLOW_USER_ID_PARAM:
+        raise HTTPException(status_code=401, detail="Session token is required", headers={"WWW-Authenticate": "Bearer"})
+    row = db.query(User.id, User.user_id).filter(User.user_id == user_id).first()
+    if row is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return SessionUser(row.id, row.user_id)
 
 
 @app.post("/users", response_model=UserResponse)
 async def create_user(user: UserCreate, db: Session = Depends(get_db)):
-    """创建新用户"""
+    """创建新用户（响应中带会话令牌）"""
     try:
         # 检查昵称是否已存在
         existing_user = db.query(User).filter(User.nickname == user.nickname).first()
         if existing_user:
             # 如果用户已存在，返回现有用户
-            return UserResponse(
-                id=existing_user.id,
-                user_id=existing_user.user_id,
-                nickname=existing_user.nickname,
-                created_at=existing_user.created_at.isoformat()
-            )
+            return _user_response(existing_user, with_token=True)
         
         # 生成唯一用户ID
         user_id = str(uuid.uuid4())[:8]  # 使用UUID的前8位作为用户ID
@@ -253,56 +517,37 @@ async def create_user(user: UserCreate, db: Session = Depends(get_db)):
         db.commit()
         db.refresh(db_user)
         
-        return UserResponse(
-            id=db_user.id,
-            user_id=db_user.user_id,
-            nickname=db_user.nickname,
-            created_at=db_user.created_at.isoformat()
-        )
+        return _user_response(db_user, with_token=True)
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=500, detail=f"Failed to create user: {str(e)}")
 
 
 @app.get("/users/by-nickname/{nickname}", response_model=UserResponse)
-async def get_user_by_nickname(nickname: str, db: Session = Depends(get_db)):
-    """根据昵称获取用户信息"""
+async def get_user_by_nickname(nickname: str, db: Session = Depends(get_read_db)):
+    """根据昵称获取用户信息（响应中带会话令牌）"""
     user = db.query(User).filter(User.nickname == nickname).first()
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    return UserResponse(
-        id=user.id,
-        user_id=user.user_id,
-        nickname=user.nickname,
-        created_at=user.created_at.isoformat()
-    )
+    return _user_response(user, with_token=True)
 
 
 @app.get("/users/{user_id}", response_model=UserResponse)
-async def get_user(user_id: str, db: Session = Depends(get_db)):
+async def get_user(user_id: str, db: Session = Depends(get_read_db)):
     """根据用户ID获取用户信息"""
     user = db.query(User).filter(User.user_id == user_id).first()
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    return UserResponse(
-        id=user.id,
-        user_id=user.user_id,
-        nickname=user.nickname,
-        created_at=user.created_at.isoformat()
-    )
+    return _user_response(user)
 
 
 @app.post("/tasks", response_model=TaskResponse)
-async def create_task(task: TaskCreate, db: Session = Depends(get_db)):
+async def create_task(task: TaskCreate, caller: Optional[SessionUser] = Depends(session_user), db: Session = Depends(get_db)):
     """创建新任务"""
+    user = _resolve_user(db, caller, task.user_id)
     try:
-        # 根据 user_id 查找用户
-        user = db.query(User).filter(User.user_id == task.user_id).first()
-        if not user:
-            raise HTTPException(status_code=404, detail="User not found")
-        
         # 解析开始日期
         start_date_obj = None
         if task.start_date:
@@ -349,19 +594,28 @@ async def create_task(task: TaskCreate, db: Session = Depends(get_db)):
         raise HTTPException(status_code=500, detail=f"Failed to create task: {str(e)}")
 
 
+def _task_progress(task: Task) -> TaskProgress:
+    """读取任务上维护的进度计数（见 task_progress.py）"""
+    return TaskProgress(
+        total_hours=round(task.total_hours or 0.0, 2),
+        completed_hours=round(task.completed_hours or 0.0, 2),
+        subtask_count=task.subtask_count or 0,
+        completed_subtasks=task.completed_subtasks or 0,
+        next_date=task.next_item_date.isoformat() if task.next_item_date else None,
+        percent=progress_percent(task)
+    )
+
+
 @app.get("/tasks", response_model=List[TaskResponse])
-async def get_tasks(user_id: str = None, db: Session = Depends(get_db)):
+async def get_tasks(user_id: str = None, caller: Optional[SessionUser] = Depends(session_user), db: Session = Depends(get_read_db)):
     """获取所有任务（可筛选用户）"""
     query = db.query(Task)
     
-    if user_id:
-        # 根据 user_id 查找用户
-        user = db.query(User).filter(User.user_id == user_id).first()
-        if not user:
-            raise HTTPException(status_code=404, detail="User not found")
+    user = _resolve_user(db, caller, user_id, required=False)
+    if user:
         query = query.filter(Task.user_id == user.id)
     
-    tasks = query.order_by(Task.created_at.desc()).all()
+    tasks = query.options(selectinload(Task.subtasks)).order_by(Task.created_at.desc()).all()
     result = []
     for task in tasks:
         subtasks = [
@@ -383,23 +637,23 @@ async def get_tasks(user_id: str = None, db: Session = Depends(get_db)):
             start_date=task.start_date.isoformat() if task.start_date else None,
             deadline=task.deadline.isoformat() if task.deadline else None,
             subtasks=subtasks,
-            created_at=task.created_at.isoformat()
+            created_at=task.created_at.isoformat(),
+            progress=_task_progress(task)
         ))
     return result
 
 
 @app.get("/tasks/{task_id}", response_model=TaskResponse)
-async def get_task(task_id: int, user_id: str = None, db: Session = Depends(get_db)):
+async def get_task(task_id: int, user_id: str = None, caller: Optional[SessionUser] = Depends(session_user), db: Session = Depends(get_read_db)):
     """获取任务详情"""
+    user = _resolve_user(db, caller, user_id, required=False)
     task = db.query(Task).filter(Task.id == task_id).first()
     if not task:
         raise HTTPException(status_code=404, detail="Task not found")
     
-    # 如果提供了 user_id，验证任务是否属于该用户
-    if user_id:
-        user = db.query(User).filter(User.user_id == user_id).first()
-        if not user or task.user_id != user.id:
-            raise HTTPException(status_code=403, detail="无权访问此任务")
+    # 如果提供了 user_id 或令牌，验证任务是否属于该用户
+    if user and task.user_id != user.id:
+        raise HTTPException(status_code=403, detail="无权访问此任务")
     
     subtasks = [
         SubtaskResponse(
@@ -421,18 +675,20 @@ async def get_task(task_id: int, user_id: str = None, db: Session = Depends(get_
         start_date=task.start_date.isoformat() if task.start_date else None,
         deadline=task.deadline.isoformat() if task.deadline else None,
         subtasks=subtasks,
-        created_at=task.created_at.isoformat()
+        created_at=task.created_at.isoformat(),
+        progress=_task_progress(task)
     )
 
 
 @app.post("/custom-task-item", response_model=DailyItemResponse)
-async def create_custom_task_item(request: CustomTaskItemCreate, db: Session = Depends(get_db)):
+async def create_custom_task_item(
+    request: CustomTaskItemCreate,
+    caller: Optional[SessionUser] = Depends(session_user),
+    db: Session = Depends(get_db)
+):
     """创建自定义任务项（不通过LLM，直接在指定日期创建任务）"""
     try:
-        # 根据 user_id 查找用户
-        user = db.query(User).filter(User.user_id == request.user_id).first()
-        if not user:
-            raise HTTPException(status_code=404, detail="User not found")
+        user = _resolve_user(db, caller, request.user_id)
         
         # 解析日期
         try:
@@ -456,6 +712,7 @@ async def create_custom_task_item(request: CustomTaskItemCreate, db: Session = D
             description=request.description or request.task_name,
             importance=request.importance,
             is_long_term=True,  # 自定义任务项视为长期任务
+            is_custom=True,  # 一次性的计划项，生成计划时不展开为每日计划
             start_date=task_date,
             deadline=None
         )
@@ -498,159 +755,280 @@ async def create_custom_task_item(request: CustomTaskItemCreate, db: Session = D
 
 
 @app.post("/tasks/{task_id}/generate-subtasks")
-async def generate_subtasks(task_id: int, request: GenerateSubtasksRequest, db: Session = Depends(get_db)):
-    """根据任务描述生成子任务"""
+async def generate_subtasks(
+    task_id: int,
+    request: GenerateSubtasksRequest,
+    user_id: str = None,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+    caller: Optional[SessionUser] = Depends(session_user),
+    db: Session = Depends(get_db)
+):
+    """根据任务描述生成子任务（相同参数的并发请求只调用一次 LLM、只写一次数据库）"""
+    user = _resolve_user(db, caller, user_id, required=False)
+    owner_id = user.id if user else None
+    flight_key = (
+        "generate-subtasks", task_id, owner_id, request.description, request.deadline,
+        request.is_long_term, request.max_subtasks, request.reuse_similar
+    )
+    return await _run_deduplicated(
+        flight_key,
+        ("generate-subtasks", task_id, owner_id, idempotency_key) if idempotency_key else None,
+        lambda: _generate_subtasks(task_id, owner_id, request, db)
+    )
+
+
+async def _generate_subtasks(task_id: int, owner_id: Optional[int], request: GenerateSubtasksRequest, db: Session):
+    """生成子任务的实际逻辑（owner_id 为请求用户的 users.id，None 时不检查归属）"""
     try:
         task = db.query(Task).filter(Task.id == task_id).first()
         if not task:
             raise HTTPException(status_code=404, detail="Task not found")
         
-        # 构建提示词
-        today = get_today_cst()
-        deadline_str = request.deadline if request.deadline else "No deadline (long-term task)"
-        
-        # Build note about subtask quantity limit
-        max_subtasks_note = ""
-        if request.max_subtasks is not None and request.max_subtasks > 0:
-            max_subtasks_note = f"\nImportant: Generate at most {request.max_subtasks} subtasks. If the task is simple, you can generate only 1 subtask, or even treat the entire task as a single subtask."
-        
-        prompt = f"""As a professional learning and work planning assistant, please generate a detailed list of subtasks based on the following task description.
-
-Task Name: {task.task_name}
-Task Description: {request.description}
-Deadline: {deadline_str}
-Is Long-term Task: {'Yes' if request.is_long_term else 'No'}{max_subtasks_note}
-
-Requirements:
-1. Carefully analyze the task description and identify all subtasks that need to be completed
-2. Break down the task description into specific, executable subtasks
-3. Estimate the time required to complete each subtask (in hours), with reasonable estimates
-4. Subtasks should be specific and clear, easy to execute
-5. If the task is large, it can be split into multiple subtasks
-6. If a maximum number of subtasks is specified, strictly adhere to the limit and do not exceed it
-7. If the task is very simple or the user explicitly indicates they only need a few subtasks, reduce the number of subtasks, or even treat the entire task as a single subtask
-8. Return JSON format as follows:
-{{
-  "subtasks": [
-    {{"name": "Subtask 1", "estimated_hours": 2.0}},
-    {{"name": "Subtask 2", "estimated_hours": 3.5}},
-    {{"name": "Subtask 3", "estimated_hours": 1.0}}
-  ]
-}}
-
-Return only the JSON object, no other explanatory text. Ensure estimated_hours is a numeric type."""
-
-        # 调用 OpenAI API
-        openai_client = get_openai_client()
+        # 如果提供了 user_id 或令牌，验证任务是否属于该用户
+        if owner_id is not None and task.user_id != owner_id:
+            raise HTTPException(status_code=403, detail="No access to this task")
+        
+        # 查找措辞相近、已经分解过的任务
+        similar = similar_tasks.find(task.task_name, request.description, task.user_id, exclude_task_id=task.id)
+        similar_info = None
+        if similar:
+            similar_task_id, similarity = similar
+            similar_info = {"task_id": similar_task_id, "similarity": round(similarity, 3)}
+            if request.reuse_similar:
+                source_subtasks = db.query(Subtask).filter(
+                    Subtask.task_id == similar_task_id
+                ).order_by(Subtask.id).all()
+                if source_subtasks:
+                    return _save_generated_subtasks(
+                        db, task,
+                        [(st.subtask_name, st.estimated_hours) for st in source_subtasks],
+                        request,
+                        {"source": "similar", "similar_task": similar_info}
+                    )
+        
+        # 构建提示词（静态说明在 system 消息中，用户消息只包含本次任务的数据）
+        messages = prompts.subtasks_messages(
+            task.task_name,
+            request.description,
+            request.deadline,
+            request.is_long_term,
+            request.max_subtasks
+        )
+
+        # 调用 LLM
         try:
-            response = openai_client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": "You are a professional learning and work planning assistant. Always return valid JSON format data."},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.7,
-            )
+            # 准入控制：超过并发/token 限制时排队，队列满时返回 429
+            async with llm_admission.slot(task.user_id, estimate_tokens(prompts.messages_text(messages), 300)) as ticket:
+                # 在线程池中执行阻塞的 HTTP 调用，避免阻塞事件循环（否则并发请求无法合并）
+                response = await llm_caller.call(lambda: llm_gateway.complete(
+                    "subtasks", messages, prompts.SUBTASKS_RESPONSE_FORMAT
+                ))
+                ticket.record_usage(response.total_tokens)
         except Exception as e:
-            raise HTTPException(status_code=500, detail=f"OpenAI API call failed: {str(e)}")
-        
-        # 解析响应
-        content = response.choices[0].message.content.strip()
-        # 移除可能的 markdown 代码块标记
-        if content.startswith("```json"):
-            content = content[7:]
-        if content.startswith("```"):
-            content = content[3:]
-        if content.endswith("```"):
-            content = content[:-3]
-        content = content.strip()
-        
-        result = json.loads(content)
-        
-        # 获取子任务列表
-        subtasks_list = result.get("subtasks", [])
-        
-        # 如果指定了上限，只保留前 N 个子任务
-        if request.max_subtasks is not None and request.max_subtasks > 0:
-            subtasks_list = subtasks_list[:request.max_subtasks]
-        
-        # 创建子任务
-        created_subtasks = []
-        for subtask_data in subtasks_list:
-            db_subtask = Subtask(
-                task_id=task_id,
-                subtask_name=subtask_data["name"],
-                estimated_hours=float(subtask_data.get("estimated_hours", 0.0))
-            )
-            db.add(db_subtask)
-            db.commit()
-            db.refresh(db_subtask)
-            created_subtasks.append(SubtaskResponse(
+            raise llm_http_error(e)
+        
+        # 解析响应：[(名称, 小时), ...]
+        subtasks_list = prompts.parse_subtasks(response.content)
+        
+        extra = {"source": "llm"}
+        if similar_info:
+            extra["similar_task"] = similar_info
+        return _save_generated_subtasks(db, task, subtasks_list, request, extra)
+        
+    except HTTPException:
+        raise
+    except prompts.LLMParseError as e:
+        raise HTTPException(status_code=502, detail=f"Failed to parse LLM response: {str(e)}")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to generate subtasks: {str(e)}")
+
+
+def _save_generated_subtasks(db: Session, task: Task, subtasks_list: list, request: GenerateSubtasksRequest, extra: dict) -> dict:
+    """写入生成的子任务（一个事务）并加入相似任务索引"""
+    # 如果指定了上限，只保留前 N 个子任务
+    if request.max_subtasks is not None and request.max_subtasks > 0:
+        subtasks_list = subtasks_list[:request.max_subtasks]
+    
+    # 创建子任务
+    created_subtasks = []
+    for subtask_name, estimated_hours in subtasks_list:
+        db_subtask = Subtask(
+            task_id=task.id,
+            subtask_name=subtask_name,
+            estimated_hours=estimated_hours
+        )
+        db.add(db_subtask)
+        created_subtasks.append(db_subtask)
+    
+    # 所有子任务在一个事务中写入
+    db.commit()
+    if created_subtasks:
+        similar_tasks.add(task.id, task.task_name, request.description, task.user_id)
+    
+    return {
+        "subtasks": [
+            SubtaskResponse(
                 id=db_subtask.id,
                 subtask_name=db_subtask.subtask_name,
                 description=db_subtask.description,
                 estimated_hours=db_subtask.estimated_hours,
                 is_completed=db_subtask.is_completed
+            )
+            for db_subtask in created_subtasks
+        ],
+        **extra
+    }
+
+
+def _fallback_or_raise(e: Exception):
+    """计划生成时 LLM 调用失败：服务降级且允许兜底时返回（由调用方改用本地计划），否则抛出 HTTP 错误"""
+    degraded = (
+        isinstance(e, (CircuitOpenError, LLMTimeoutError, prompts.LLMParseError))
+        or is_retryable(e)
+    )
+    if not (LLM_FALLBACK_LOCAL_PLAN and degraded):
+        if isinstance(e, prompts.LLMParseError):
+            raise HTTPException(status_code=502, detail=f"Failed to parse LLM response: {str(e)}")
+        raise llm_http_error(e)
+    print(f"⚠️  LLM unavailable, falling back to local plan: {str(e)}")
+
+
+LONG_TERM_DAILY_HOURS = 1.5  # 长期任务每天1.5小时
+LONG_TERM_PLAN_DAYS = 30  # 长期任务生成未来30天的计划
+
+
+def _long_term_window(task: Task):
+    """长期任务的计划区间：如果指定了开始日期，使用开始日期；否则使用今天"""
+    start_date = task.start_date if task.start_date else get_today_cst()
+    return start_date, start_date + timedelta(days=LONG_TERM_PLAN_DAYS)
+
+
+def _add_long_term_items(db: Session, task: Task) -> list:
+    """为长期任务添加每日计划项（已有计划项的日期跳过），不提交事务"""
+    start_date, end_date = _long_term_window(task)
+    existing_dates = {
+        row.date for row in db.query(DailyTaskItem.date).filter(
+            DailyTaskItem.task_id == task.id,
+            DailyTaskItem.date >= start_date,
+            DailyTaskItem.date <= end_date
+        )
+    }
+    
+    created_items = []
+    current_date = start_date
+    while current_date <= end_date:
+        if current_date not in existing_dates:
+            # 创建计划项（长期任务不需要子任务，subtask_id 为 NULL）
+            db.add(DailyTaskItem(
+                date=current_date,
+                task_id=task.id,
+                subtask_id=None,  # 长期任务没有子任务，设为 NULL
+                allocated_hours=LONG_TERM_DAILY_HOURS
             ))
-        
-        return {"subtasks": created_subtasks}
-        
-    except json.JSONDecodeError as e:
-        raise HTTPException(status_code=500, detail=f"Failed to parse LLM response: {str(e)}")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to generate subtasks: {str(e)}")
+            created_items.append({
+                "date": current_date.isoformat(),
+                "task_name": task.task_name,
+                "allocated_hours": LONG_TERM_DAILY_HOURS
+            })
+        current_date += timedelta(days=1)
+    return created_items
+
+
+def _write_plan_items(db: Session, task_id: int, subtasks_list: list, plan_entries: list) -> list:
+    """
+    把计划条目写入 daily_task_items（不提交事务）
+    同一天同一子任务的多个条目合并为一项；已存在的计划项覆盖分配时间
+    Args:
+        subtasks_list: 任务的子任务列表，下标 + 1 即计划条目中的 subtask_no
+        plan_entries: [{"date", "subtask_no", "allocated_hours", "subtask_name"(可选)}, ...]
+    """
+    planned = {}
+    for entry in plan_entries:
+        subtask_index = entry["subtask_no"] - 1  # 转换为索引（从1开始）
+        if 0 <= subtask_index < len(subtasks_list):
+            subtask = subtasks_list[subtask_index]
+        else:
+            # 如果序号无效，尝试按名称匹配
+            subtask = next(
+                (st for st in subtasks_list if st.subtask_name == entry.get("subtask_name")), None
+            )
+            if not subtask:
+                continue  # 跳过无效的子任务
+        key = (entry["date"], subtask.id)
+        hours = planned[key][1] if key in planned else 0.0
+        planned[key] = (subtask, hours + entry["allocated_hours"])
+    
+    if not planned:
+        return []
+    
+    # 一次查询取出区间内已有的计划项，避免逐条查询
+    dates = [plan_date for plan_date, _ in planned]
+    existing = {
+        (item.date, item.subtask_id): item
+        for item in db.query(DailyTaskItem).filter(
+            DailyTaskItem.task_id == task_id,
+            DailyTaskItem.subtask_id.isnot(None),
+            DailyTaskItem.date >= min(dates),
+            DailyTaskItem.date <= max(dates)
+        )
+    }
+    
+    created_items = []
+    for (plan_date, subtask_id), (subtask, allocated_hours) in sorted(planned.items(), key=lambda kv: kv[0]):
+        allocated_hours = round(allocated_hours, 2)
+        item = existing.get((plan_date, subtask_id))
+        if item:
+            item.allocated_hours = allocated_hours
+        else:
+            db.add(DailyTaskItem(
+                date=plan_date,
+                task_id=task_id,
+                subtask_id=subtask_id,
+                allocated_hours=allocated_hours
+            ))
+        created_items.append({
+            "date": plan_date.isoformat(),
+            "subtask_name": subtask.subtask_name,
+            "allocated_hours": allocated_hours
+        })
+    return created_items
 
 
 @app.post("/tasks/{task_id}/generate-plan")
-async def generate_plan(task_id: int, user_id: str = None, db: Session = Depends(get_db)):
-    """为任务生成每日计划"""
+async def generate_plan(
+    task_id: int,
+    user_id: str = None,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+    caller: Optional[SessionUser] = Depends(session_user),
+    db: Session = Depends(get_db)
+):
+    """为任务生成每日计划（相同任务的并发请求只调用一次 LLM、只写一次数据库）"""
+    user = _resolve_user(db, caller, user_id, required=False)
+    owner_id = user.id if user else None
+    return await _run_deduplicated(
+        ("generate-plan", task_id, owner_id),
+        ("generate-plan", task_id, idempotency_key) if idempotency_key else None,
+        lambda: _generate_plan(task_id, owner_id, db)
+    )
+
+
+async def _generate_plan(task_id: int, owner_id: Optional[int], db: Session):
+    """生成每日计划的实际逻辑（owner_id 为请求用户的 users.id，None 时不检查归属）"""
     try:
         task = db.query(Task).filter(Task.id == task_id).first()
         if not task:
             raise HTTPException(status_code=404, detail="Task not found")
         
-        # 如果提供了 user_id，验证任务是否属于该用户
-        if user_id:
-            user = db.query(User).filter(User.user_id == user_id).first()
-            if not user or task.user_id != user.id:
-                raise HTTPException(status_code=403, detail="No access to this task")
+        # 如果提供了 user_id 或令牌，验证任务是否属于该用户
+        if owner_id is not None and task.user_id != owner_id:
+            raise HTTPException(status_code=403, detail="No access to this task")
+        
+        if task.is_custom:
+            raise HTTPException(status_code=400, detail="Custom task items are one-off and cannot be planned")
         
         # 长期任务不需要子任务，直接生成计划
         if task.is_long_term:
-            # 为长期任务生成未来30天的计划
-            # 如果指定了开始日期，使用开始日期；否则使用今天
-            start_date = task.start_date if task.start_date else get_today_cst()
-            end_date = start_date + timedelta(days=30)
-            
-            # 创建每日计划项（长期任务每天分配固定时间）
-            created_items = []
-            current_date = start_date
-            daily_hours = 1.5  # 长期任务每天1.5小时
-            
-            while current_date <= end_date:
-                # 检查是否已存在该日期的计划项
-                existing = db.query(DailyTaskItem).filter(
-                    DailyTaskItem.date == current_date,
-                    DailyTaskItem.task_id == task_id
-                ).first()
-                
-                if not existing:
-                    # 创建计划项（长期任务不需要子任务，subtask_id 为 NULL）
-                    db_item = DailyTaskItem(
-                        date=current_date,
-                        task_id=task_id,
-                        subtask_id=None,  # 长期任务没有子任务，设为 NULL
-                        allocated_hours=daily_hours
-                    )
-                    db.add(db_item)
-                    created_items.append({
-                        "date": current_date.isoformat(),
-                        "task_name": task.task_name,
-                        "allocated_hours": daily_hours
-                    })
-                
-                current_date += timedelta(days=1)
-            
+            created_items = _add_long_term_items(db, task)
             db.commit()
             return {"message": "Long-term task plan generated successfully", "items": created_items}
         
@@ -674,144 +1052,323 @@ async def generate_plan(task_id: int, user_id: str = None, db: Session = Depends
         if days <= 0:
             raise HTTPException(status_code=400, detail="Deadline cannot be earlier than start date")
         
-        # Build prompt
-        subtasks_info = [
-            f"{st.subtask_name} (estimated {st.estimated_hours} hours)"
-            for st in task.subtasks
-        ]
+        # 用户在窗口内其他任务上已占用的时间（来自 user_daily_loads 索引，本任务的旧计划会被覆盖，不计入）
+        loads = load_window(db, task.user_id, start_date, end_date, exclude_task_ids=[task.id])
+        busy = loads.as_dict()
         
-        prompt = f"""As a professional learning and work planning assistant, please generate a detailed daily plan for the following task.
-
-Task Name: {task.task_name}
-Task Description: {task.description}
-Task Importance: {task.importance}
-Is Long-term Task: {'Yes' if task.is_long_term else 'No'}
-{'Deadline: ' + task.deadline.isoformat() if task.deadline else ''}
-
-Subtask List (numbered in order):
-{chr(10).join([f"{i+1}. {info}" for i, info in enumerate(subtasks_info)])}
-
-Requirements:
-1. Generate a daily plan from {start_date.isoformat()} to {'the next 30 days' if task.is_long_term else end_date.isoformat()}
-2. **Important: Multiple subtasks can be allocated per day**, for example, you can review PPT and MP on the same day, or review PPT and WA on the same day
-3. Reasonably allocate each subtask to different dates, ensuring all subtasks are completed before the deadline
-4. If there are many tasks or the time is long, a subtask can be split across multiple days
-5. Ensure daily workload is balanced (recommended 2-4 hours per day), adjust task allocation based on importance
-6. Long-term tasks should allocate a small amount of time daily (1-2 hours) to maintain continuity
-7. Allocated hours should be reasonable and not exceed the subtask's estimated_hours
-8. Try to make multiple subtasks per day work well together, for example, related tasks can be placed on the same day
-9. Return JSON format as follows:
-{{
-  "plan": [
-    {{"date": "YYYY-MM-DD", "subtask_id": 1, "allocated_hours": 2.0, "subtask_name": "Subtask 1"}},
-    {{"date": "YYYY-MM-DD", "subtask_id": 2, "allocated_hours": 1.5, "subtask_name": "Subtask 2"}},
-    {{"date": "YYYY-MM-DD", "subtask_id": 1, "allocated_hours": 1.0, "subtask_name": "Subtask 1"}},
-    {{"date": "YYYY-MM-DD", "subtask_id": 3, "allocated_hours": 1.5, "subtask_name": "Subtask 3"}}
-  ]
-}}
-
-Notes:
-- **Multiple subtasks can be allocated per day**, for example, subtask_id 1 and subtask_id 2 can be on the same day
-- subtask_id corresponds to the subtask's sequential number (starting from 1)
-- subtask_name is the name of the subtask (for verification)
-- allocated_hours is the allocated time (in hours), recommended total time per day is 2-4 hours
-- Date format must be YYYY-MM-DD
-- Ensure all subtasks are allocated in the plan
-
-Return only the JSON object, no other explanatory text."""
-
-        # 调用 OpenAI API
-        openai_client = get_openai_client()
+        # 构建提示词（静态说明在 system 消息中，用户消息只包含本次任务的数据）
+        subtasks_list = list(task.subtasks)
+        messages = prompts.plan_messages(
+            task.task_name,
+            task.description,
+            task.importance,
+            start_date,
+            days,
+            [(st.subtask_name, st.estimated_hours) for st in subtasks_list],
+            DAILY_CAPACITY_HOURS,
+            busy
+        )
+
+        # 调用 LLM
+        plan_entries = None
+        plan_source = "llm"
         try:
-            response = openai_client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": "You are a professional learning and work planning assistant. Always return valid JSON format data."},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.7,
-            )
+            # 准入控制：超过并发/token 限制时排队，队列满时返回 429
+            async with llm_admission.slot(task.user_id, estimate_tokens(prompts.messages_text(messages), 600)) as ticket:
+                # 在线程池中执行阻塞的 HTTP 调用，避免阻塞事件循环（否则并发请求无法合并）
+                response = await llm_caller.call(lambda: llm_gateway.complete(
+                    "plan", messages, prompts.PLAN_RESPONSE_FORMAT
+                ))
+                ticket.record_usage(response.total_tokens)
+            # 解析响应：[{"date", "subtask_no", "allocated_hours", "subtask_name"}, ...]
+            plan_entries = prompts.parse_plan(response.content, start_date, days)
         except Exception as e:
-            raise HTTPException(status_code=500, detail=f"OpenAI API call failed: {str(e)}")
+            # 服务降级（熔断、超时、限流、5xx）或返回内容无法解析时退回本地计划，其他错误直接返回
+            _fallback_or_raise(e)
+            plan_source = "local"
+
+        if plan_entries is None:
+            plan_entries = build_capacity_plan(
+                [(st.subtask_name, st.estimated_hours) for st in subtasks_list],
+                start_date,
+                end_date,
+                loads,
+                DAILY_CAPACITY_HOURS
+            )
+
+        # 创建每日计划
+        created_items = _write_plan_items(db, task_id, subtasks_list, plan_entries)
         
-        # 解析响应
-        content = response.choices[0].message.content.strip()
-        if content.startswith("```json"):
-            content = content[7:]
-        if content.startswith("```"):
-            content = content[3:]
-        if content.endswith("```"):
-            content = content[:-3]
-        content = content.strip()
+        db.commit()
         
-        result = json.loads(content)
+        return {
+            "message": "Plan generated successfully",
+            "items": created_items,
+            "source": plan_source,
+            "capacity": {
+                "daily_cap": DAILY_CAPACITY_HOURS,
+                "busy_hours": round(sum(busy.values()), 2),
+                "free_hours": round(max(0.0, DAILY_CAPACITY_HOURS * days - sum(busy.values())), 2)
+            }
+        }
         
-        # 创建每日计划
-        # 刷新任务以获取最新的子任务列表
-        db.refresh(task)
-        subtasks_list = list(task.subtasks)
-        created_items = []
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to generate plan: {str(e)}")
+
+
+@app.post("/users/{user_id}/generate-plans")
+async def generate_plans(
+    user_id: str,
+    request: BatchPlanRequest,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+    caller: Optional[SessionUser] = Depends(session_user),
+    db: Session = Depends(get_db)
+):
+    """
+    一次为用户的多个任务生成每日计划
+    所有任务放在同一次 LLM 调用（或一次本地求解）中规划，共享每日容量，
+    全部计划项在一个事务中写入
+    """
+    user = _resolve_user(db, caller, user_id)
+    task_ids = tuple(sorted(set(request.task_ids))) if request.task_ids else None
+    return await _run_deduplicated(
+        ("generate-plans", user.id, task_ids, request.use_llm),
+        ("generate-plans", user.id, idempotency_key) if idempotency_key else None,
+        lambda: _generate_plans(user, task_ids, request.use_llm, db)
+    )
+
+
+async def _generate_plans(user: SessionUser, task_ids: Optional[tuple], use_llm: bool, db: Session):
+    """批量生成计划的实际逻辑"""
+    try:
+        query = db.query(Task).options(selectinload(Task.subtasks)).filter(Task.user_id == user.id)
+        if task_ids:
+            query = query.filter(Task.id.in_(task_ids))
+        tasks = query.order_by(Task.id).all()
         
-        for item in result.get("plan", []):
-            try:
-                plan_date = datetime.strptime(item["date"], "%Y-%m-%d").date()
-                subtask_index = item.get("subtask_id", 1) - 1  # 转换为索引（从1开始）
-                
-                if subtask_index < 0 or subtask_index >= len(subtasks_list):
-                    # 如果索引无效，尝试按名称匹配
-                    subtask_name = item.get("subtask_name", "")
-                    subtask = next((st for st in subtasks_list if st.subtask_name == subtask_name), None)
-                    if not subtask:
-                        continue  # 跳过无效的子任务
-                else:
-                    subtask = subtasks_list[subtask_index]
-                
-                allocated_hours = float(item.get("allocated_hours", 0.0))
-                
-                # 检查是否已存在相同的计划项
-                existing = db.query(DailyTaskItem).filter(
-                    DailyTaskItem.date == plan_date,
-                    DailyTaskItem.task_id == task_id,
-                    DailyTaskItem.subtask_id == subtask.id
-                ).first()
-                
-                if existing:
-                    existing.allocated_hours = allocated_hours
-                else:
-                    db_item = DailyTaskItem(
-                        date=plan_date,
-                        task_id=task_id,
-                        subtask_id=subtask.id,
-                        allocated_hours=allocated_hours
-                    )
-                    db.add(db_item)
-                
-                created_items.append({
-                    "date": plan_date.isoformat(),
-                    "subtask_name": subtask.subtask_name,
-                    "allocated_hours": allocated_hours
-                })
-            except (ValueError, KeyError) as e:
-                continue  # 跳过无效的数据项
+        if task_ids:
+            found = {task.id for task in tasks}
+            missing = [task_id for task_id in task_ids if task_id not in found]
+            if missing:
+                raise HTTPException(status_code=404, detail=f"Tasks not found: {missing}")
         
-        db.commit()
+        today = get_today_cst()
+        skipped = []
+        long_term_tasks = []
+        planned_tasks = []  # [(task, 子任务列表, 开始日期, 截止日期)]
+        # 未指定 task_ids 时只展开还没有计划项的长期任务：已有计划的不重复生成，
+        # 也避免把迁移前创建、没有 is_custom 标记的自定义计划项展开成每日计划
+        planned_long_term = set()
+        if not task_ids:
+            long_term_ids = [task.id for task in tasks if task.is_long_term and not task.is_custom]
+            if long_term_ids:
+                planned_long_term = {
+                    task_id for (task_id,) in db.query(DailyTaskItem.task_id).filter(
+                        DailyTaskItem.task_id.in_(long_term_ids)
+                    ).distinct()
+                }
+        for task in tasks:
+            if task.is_custom:
+                skipped.append({"task_id": task.id, "reason": "Custom task items are one-off and cannot be planned"})
+                continue
+            if task.is_long_term:
+                if task.id in planned_long_term:
+                    skipped.append({"task_id": task.id, "reason": "Long-term task already has plan items"})
+                    continue
+                long_term_tasks.append(task)
+                continue
+            if not task.subtasks:
+                skipped.append({"task_id": task.id, "reason": "Task has no subtasks yet"})
+                continue
+            if not task.deadline:
+                skipped.append({"task_id": task.id, "reason": "Non-long-term tasks must have a deadline"})
+                continue
+            start_date = task.start_date if task.start_date else today
+            if start_date > task.deadline:
+                reason = "Deadline has already passed" if task.deadline < today else "Start date is later than deadline"
+                skipped.append({"task_id": task.id, "reason": reason})
+                continue
+            planned_tasks.append((task, list(task.subtasks), start_date, task.deadline))
+        
+        plan_entries = None
+        plan_source = "local"
+        if planned_tasks:
+            batch_start = min(start for _, _, start, _ in planned_tasks)
+            batch_end = max(end for _, _, _, end in planned_tasks)
+            batch_days = (batch_end - batch_start).days + 1
+            
+            # 其他任务已占用的时间来自 user_daily_loads 索引；本次规划的任务会被重写，先扣除；
+            # 长期任务每天固定时间，按将要写入的计划计入共享的每日容量
+            reserved = load_window(
+                db, user.id, batch_start, batch_end,
+                exclude_task_ids=[task.id for task in long_term_tasks] + [task.id for task, _, _, _ in planned_tasks]
+            ).as_dict()
+            for task in long_term_tasks:
+                window_start, window_end = _long_term_window(task)
+                current_date = window_start
+                while current_date <= window_end:
+                    reserved[current_date] = reserved.get(current_date, 0.0) + LONG_TERM_DAILY_HOURS
+                    current_date += timedelta(days=1)
+            
+            if use_llm:
+                plan_source = "llm"
+                messages = prompts.batch_plan_messages(
+                    batch_start,
+                    batch_days,
+                    DAILY_CAPACITY_HOURS,
+                    [
+                        {
+                            "name": task.task_name,
+                            "importance": task.importance,
+                            "first_day": (start - batch_start).days,
+                            "last_day": (end - batch_start).days,
+                            "subtasks": [(st.subtask_name, st.estimated_hours) for st in subtasks]
+                        }
+                        for task, subtasks, start, end in planned_tasks
+                    ],
+                    reserved
+                )
+                try:
+                    expected_output = 200 + 60 * sum(len(subtasks) for _, subtasks, _, _ in planned_tasks)
+                    async with llm_admission.slot(user.id, estimate_tokens(prompts.messages_text(messages), expected_output)) as ticket:
+                        response = await llm_caller.call(lambda: llm_gateway.complete(
+                            "batch_plan", messages, prompts.BATCH_PLAN_RESPONSE_FORMAT
+                        ))
+                        ticket.record_usage(response.total_tokens)
+                    plan_entries = prompts.parse_batch_plan(response.content, batch_start, batch_days)
+                except Exception as e:
+                    _fallback_or_raise(e)
+                    plan_source = "local"
+            
+            if plan_entries is None:
+                plan_entries = build_local_batch_plan(
+                    [
+                        {
+                            "start": start,
+                            "end": end,
+                            "importance": task.importance,
+                            "subtasks": [(st.subtask_name, st.estimated_hours) for st in subtasks]
+                        }
+                        for task, subtasks, start, end in planned_tasks
+                    ],
+                    DAILY_CAPACITY_HOURS,
+                    reserved
+                )
+        
+        # 所有计划项在一个事务中写入
+        results = []
+        for task in long_term_tasks:
+            results.append({
+                "task_id": task.id,
+                "task_name": task.task_name,
+                "items": _add_long_term_items(db, task)
+            })
+        for task_no, (task, subtasks, start, end) in enumerate(planned_tasks, start=1):
+            entries = [
+                entry for entry in plan_entries
+                if entry["task_no"] == task_no and start <= entry["date"] <= end
+            ]
+            results.append({
+                "task_id": task.id,
+                "task_name": task.task_name,
+                "items": _write_plan_items(db, task.id, subtasks, entries)
+            })
         
-        return {"message": "Plan generated successfully", "items": created_items}
+        db.commit()
         
-    except json.JSONDecodeError as e:
-        raise HTTPException(status_code=500, detail=f"Failed to parse LLM response: {str(e)}")
+        return {
+            "message": f"Plans generated for {len(results)} tasks",
+            "source": plan_source,
+            "tasks": results,
+            "skipped": skipped
+        }
+    
+    except HTTPException:
+        raise
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to generate plan: {str(e)}")
+        db.rollback()
+        raise HTTPException(status_code=500, detail=f"Failed to generate plans: {str(e)}")
+
+
+def _replan_subtask(db: Session, subtask: Subtask) -> list:
+    """
+    子任务预计时间变化后增量调整计划（不调用 LLM，不提交事务）
+    只调整今天及以后、未完成的计划项；已完成和已过去的分配保持不变并从新预计时间中扣除
+    """
+    task = subtask.task
+    today = get_today_cst()
+    items = db.query(DailyTaskItem).filter(DailyTaskItem.subtask_id == subtask.id).all()
+    if task.is_long_term or not items:
+        return []
+    
+    fixed_hours = sum(
+        item.allocated_hours for item in items
+        if item.is_completed or item.date < today
+    )
+    mutable = {item.date: item for item in items if not item.is_completed and item.date >= today}
+    
+    start_date = max(today, task.start_date) if task.start_date else today
+    end_date = task.deadline or max(item.date for item in items)
+    if mutable:
+        start_date = min(start_date, min(mutable))
+        end_date = max(end_date, max(mutable))
+    if start_date > end_date:
+        # 截止日期已过：剩余时间都放在今天
+        end_date = start_date
+    
+    loads = load_window(db, task.user_id, start_date, end_date)
+    new_hours = replan_subtask_hours(
+        {day: item.allocated_hours for day, item in mutable.items()},
+        subtask.estimated_hours - fixed_hours,
+        start_date,
+        end_date,
+        loads,
+        DAILY_CAPACITY_HOURS
+    )
+    
+    changed = []
+    for day, hours in sorted(new_hours.items()):
+        item = mutable.get(day)
+        if item is not None and abs(item.allocated_hours - hours) < 1e-9:
+            continue
+        if item is None:
+            if hours <= 0:
+                continue
+            db.add(DailyTaskItem(date=day, task_id=task.id, subtask_id=subtask.id, allocated_hours=hours))
+        elif hours <= 0:
+            db.delete(item)
+        else:
+            item.allocated_hours = hours
+        changed.append({"date": day.isoformat(), "allocated_hours": hours})
+    return changed
 
 
 @app.put("/subtasks/{subtask_id}")
-async def update_subtask(subtask_id: int, update: SubtaskUpdate, db: Session = Depends(get_db)):
-    """更新子任务（名称、描述、预计时间）"""
+async def update_subtask(
+    subtask_id: int,
+    update: SubtaskUpdate,
+    replan: Optional[bool] = None,
+    user_id: str = None,
+    caller: Optional[SessionUser] = Depends(session_user),
+    db: Session = Depends(get_db)
+):
+    """
+    更新子任务（名称、描述、预计时间）
+    预计时间变化时增量调整该子任务未来的计划项（replan=false 可关闭，默认由 AUTO_REPLAN 决定），
+    与子任务的修改在同一个事务中提交
+    """
     try:
+        user = _resolve_user(db, caller, user_id, required=False)
         subtask = db.query(Subtask).filter(Subtask.id == subtask_id).first()
         if not subtask:
             raise HTTPException(status_code=404, detail="Subtask not found")
         
+        # 如果提供了 user_id 或令牌，验证子任务所属的任务是否属于该用户（在修改和重新规划之前）
+        if user and subtask.task.user_id != user.id:
+            raise HTTPException(status_code=403, detail="No access to this task")
+        
         # 更新名称（如果提供）
         if update.subtask_name is not None:
             subtask.subtask_name = update.subtask_name
@@ -821,20 +1378,30 @@ async def update_subtask(subtask_id: int, update: SubtaskUpdate, db: Session = D
             subtask.description = update.description if update.description.strip() else None
         
         # 更新预计时间（如果提供）
+        hours_changed = False
         if update.estimated_hours is not None:
             if update.estimated_hours < 0:
                 raise HTTPException(status_code=400, detail="预计时间不能为负数")
+            hours_changed = abs(update.estimated_hours - (subtask.estimated_hours or 0.0)) > 1e-9
             subtask.estimated_hours = update.estimated_hours
         
+        # 增量调整计划（只涉及该子任务未来未完成的计划项）
+        replanned_items = []
+        should_replan = hours_changed and (AUTO_REPLAN if replan is None else replan)
+        if should_replan:
+            replanned_items = _replan_subtask(db, subtask)
+        
         db.commit()
         db.refresh(subtask)
         
-        return SubtaskResponse(
+        return SubtaskUpdateResponse(
             id=subtask.id,
             subtask_name=subtask.subtask_name,
             description=subtask.description,
             estimated_hours=subtask.estimated_hours,
-            is_completed=subtask.is_completed
+            is_completed=subtask.is_completed,
+            replanned=should_replan,
+            replanned_items=replanned_items
         )
     except HTTPException:
         raise
@@ -843,13 +1410,63 @@ async def update_subtask(subtask_id: int, update: SubtaskUpdate, db: Session = D
         raise HTTPException(status_code=500, detail=f"Failed to update subtask: {str(e)}")
 
 
+def _columnar_calendar(items: List[DailyItemResponse], start: date, include_archived: bool) -> dict:
+    """
+    列式日历响应：每个字段一个数组，任务和子任务名称去重后按下标引用
+    items.day 是相对 start 的天数；items.subtask 为 -1 表示长期任务（subtask_id 为 0，名称即任务名称）
+    """
+    tasks = {"id": [], "name": [], "importance": []}
+    subtasks = {"id": [], "name": []}
+    task_index = {}
+    subtask_index = {}
+    columns = {"id": [], "day": [], "task": [], "subtask": [], "allocated_hours": [], "is_completed": []}
+    if include_archived:
+        columns["archived"] = []
+    
+    for item in items:
+        t = task_index.get(item.task_id)
+        if t is None:
+            t = task_index[item.task_id] = len(tasks["id"])
+            tasks["id"].append(item.task_id)
+            tasks["name"].append(item.task_name)
+            tasks["importance"].append(item.importance)
+        if item.subtask_id:
+            st = subtask_index.get(item.subtask_id)
+            if st is None:
+                st = subtask_index[item.subtask_id] = len(subtasks["id"])
+                subtasks["id"].append(item.subtask_id)
+                subtasks["name"].append(item.subtask_name)
+        else:
+            st = -1
+        columns["id"].append(item.id)
+        columns["day"].append((date.fromisoformat(item.date) - start).days)
+        columns["task"].append(t)
+        columns["subtask"].append(st)
+        columns["allocated_hours"].append(item.allocated_hours)
+        columns["is_completed"].append(1 if item.is_completed else 0)
+        if include_archived:
+            columns["archived"].append(1 if item.archived else 0)
+    
+    return {
+        "format": "columnar",
+        "start": start.isoformat(),
+        "count": len(items),
+        "tasks": tasks,
+        "subtasks": subtasks,
+        "items": columns,
+    }
+
+
 @app.get("/calendar")
 async def get_calendar(
     user_id: str = None, 
     start_date: Optional[str] = None, 
     end_date: Optional[str] = None,
     timezone_offset: Optional[int] = None,
-    db: Session = Depends(get_db)
+    include_archived: bool = False,
+    format: Optional[str] = None,
+    caller: Optional[SessionUser] = Depends(session_user),
+    db: Session = Depends(get_read_db)
 ):
     """
     获取日历视图数据
@@ -858,15 +1475,14 @@ async def get_calendar(
         start_date: 开始日期（YYYY-MM-DD），如果不提供，默认使用今天（根据时区）
         end_date: 结束日期（YYYY-MM-DD），如果不提供，默认显示未来60天
         timezone_offset: 时区偏移（小时），例如 8 表示 UTC+8
+        include_archived: 是否同时返回已归档的计划项（archive.py 移出的已完成历史项）
+        format: 为 columnar 时返回列式格式（见 _columnar_calendar），默认返回 DailyItemResponse 列表
     """
     try:
-        if not user_id:
-            raise HTTPException(status_code=400, detail="user_id parameter is required")
+        if format not in (None, "rows", "columnar"):
+            raise HTTPException(status_code=400, detail="format must be rows or columnar")
         
-        # 根据 user_id 查找用户
-        user = db.query(User).filter(User.user_id == user_id).first()
-        if not user:
-            raise HTTPException(status_code=404, detail="User not found")
+        user = _resolve_user(db, caller, user_id)
         
         if start_date:
             start = datetime.strptime(start_date, "%Y-%m-%d").date()
@@ -937,51 +1553,468 @@ async def get_calendar(
                 importance=task.importance
             ))
         
+        # 归档数据只在请求时读取，且只查询与归档范围重叠的区间
+        if include_archived:
+            archived_items = db.query(DailyTaskItemArchive).filter(
+                DailyTaskItemArchive.user_id == user.id,
+                DailyTaskItemArchive.date >= start,
+                DailyTaskItemArchive.date <= end
+            ).order_by(DailyTaskItemArchive.date).all()
+            for item in archived_items:
+                result.append(DailyItemResponse(
+                    id=item.id,
+                    date=item.date.isoformat(),
+                    task_id=item.task_id,
+                    task_name=item.task_name,
+                    subtask_id=item.subtask_id if item.subtask_id is not None else 0,
+                    subtask_name=item.subtask_name or item.task_name,
+                    allocated_hours=item.allocated_hours,
+                    is_completed=True,
+                    importance=item.importance or "medium",
+                    archived=True
+                ))
+            result.sort(key=lambda r: r.date)
+        
+        if format == "columnar":
+            # 直接返回 JSONResponse，跳过对大数组的 jsonable_encoder
+            return JSONResponse(content=_columnar_calendar(result, start, include_archived))
         return result
     except ValueError as e:
         raise HTTPException(status_code=400, detail=f"Date format error: {str(e)}")
 
 
-@app.put("/daily-items/{item_id}")
-async def update_daily_item(item_id: int, update: AllocatedHoursUpdate, db: Session = Depends(get_db)):
-    """更新每日任务项的分配时间"""
-    item = db.query(DailyTaskItem).filter(DailyTaskItem.id == item_id).first()
-    if not item:
-        raise HTTPException(status_code=404, detail="Task item not found")
+ICS_BATCH_SIZE = 500  # 服务端游标每次取的行数，也是每次输出的事件数
+
+
+def _not_modified(request: Request, etag: str, last_modified: datetime) -> bool:
+    """按 If-None-Match / If-Modified-Since 判断客户端缓存是否仍然有效"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags or f"W/{etag}" in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return last_modified <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def _stream_calendar_feed(session_factory, user_pk: int, nickname: str, start, end, include_archived: bool):
+    """逐批从服务端游标读取计划项并输出 VEVENT，内存占用与时间范围无关"""
+    db = session_factory()
+    try:
+        yield ical.encode_lines(ical.CALENDAR_HEADER + tuple(ical.calendar_name_lines(f"{nickname} 的计划")))
+        
+        query = db.query(
+            DailyTaskItem.id,
+            DailyTaskItem.date,
+            DailyTaskItem.allocated_hours,
+            DailyTaskItem.is_completed,
+            DailyTaskItem.created_at,
+            Task.task_name,
+            Task.importance,
+            Subtask.subtask_name,
+        ).join(
+            Task, DailyTaskItem.task_id == Task.id
+        ).outerjoin(
+            Subtask, DailyTaskItem.subtask_id == Subtask.id
+        ).filter(Task.user_id == user_pk)
+        if start:
+            query = query.filter(DailyTaskItem.date >= start)
+        if end:
+            query = query.filter(DailyTaskItem.date <= end)
+        sources = [query.order_by(DailyTaskItem.date, DailyTaskItem.id).yield_per(ICS_BATCH_SIZE)]
+        
+        if include_archived:
+            archived = db.query(
+                DailyTaskItemArchive.id,
+                DailyTaskItemArchive.date,
+                DailyTaskItemArchive.allocated_hours,
+                DailyTaskItemArchive.created_at,
+                DailyTaskItemArchive.task_name,
+                DailyTaskItemArchive.importance,
+                DailyTaskItemArchive.subtask_name,
+            ).filter(DailyTaskItemArchive.user_id == user_pk)
+            if start:
+                archived = archived.filter(DailyTaskItemArchive.date >= start)
+            if end:
+                archived = archived.filter(DailyTaskItemArchive.date <= end)
+            sources.append(
+                (row.id, row.date, row.allocated_hours, True, row.created_at, row.task_name, row.importance, row.subtask_name)
+                for row in archived.order_by(DailyTaskItemArchive.date, DailyTaskItemArchive.id).yield_per(ICS_BATCH_SIZE)
+            )
+        
+        lines = []
+        count = 0
+        for rows in sources:
+            for item_id, day, hours, completed, created_at, task_name, importance, subtask_name in rows:
+                summary = f"{subtask_name or task_name} ({hours:g}h)"
+                lines.extend(ical.vevent_lines(
+                    f"item-{item_id}@llm-task-planner",
+                    day,
+                    summary,
+                    task_name if subtask_name else "",
+                    importance,
+                    completed,
+                    created_at
+                ))
+                count += 1
+                if count % ICS_BATCH_SIZE == 0:
+                    yield ical.encode_lines(lines)
+                    lines = []
+        lines.extend(ical.CALENDAR_FOOTER)
+        yield ical.encode_lines(lines)
+    finally:
+        db.close()
+
+
+@app.get("/users/{user_id}/calendar.ics")
+async def get_calendar_feed(
+    user_id: str,
+    request: Request,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    include_archived: bool = False,
+    caller: Optional[SessionUser] = Depends(session_user),
+    db: Session = Depends(get_read_db)
+):
+    """
+    iCalendar 订阅源（外部日历应用订阅）
+    日历应用不能设置请求头，令牌通过 ?access_token= 传递（AUTH_ALLOW_USER_ID_PARAM=0 时必须提供）
+    计划项从服务端游标流式输出；带 ETag/Last-Modified，日历没有变化时返回 304（只查询 users 表）
+    """
+    owner = _resolve_user(db, caller, user_id)
+    user = db.query(User).filter(User.id == owner.id).first()
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
     
-    item.allocated_hours = update.allocated_hours
-    db.commit()
-    db.refresh(item)
+    try:
+        start = datetime.strptime(start_date, "%Y-%m-%d").date() if start_date else None
+        end = datetime.strptime(end_date, "%Y-%m-%d").date() if end_date else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Date format error, please use YYYY-MM-DD format")
+    
+    # 日历版本：任务/计划最近一次变化的时间（秒级，与 HTTP 日期精度一致）
+    last_modified = (user.calendar_updated_at or user.created_at or datetime(1970, 1, 1))
+    last_modified = last_modified.replace(microsecond=0, tzinfo=timezone.utc)
+    variant = hashlib.sha1(f"{start_date}|{end_date}|{include_archived}".encode()).hexdigest()[:8]
+    etag = f'"{user.id}-{int(last_modified.timestamp())}-{variant}"'
+    headers = {
+        "ETag": etag,
+        "Last-Modified": format_datetime(last_modified, usegmt=True),
+        "Cache-Control": "private, max-age=0, must-revalidate",
+    }
+    if _not_modified(request, etag, last_modified):
+        return Response(status_code=304, headers=headers)
+    
+    headers["Content-Disposition"] = 'inline; filename="calendar.ics"'
+    return StreamingResponse(
+        _stream_calendar_feed(read_session_factory(request), user.id, user.nickname, start, end, include_archived),
+        media_type="text/calendar; charset=utf-8",
+        headers=headers
+    )
+
+
+@app.get("/users/{user_id}/stats")
+async def get_user_stats(
+    user_id: str,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    caller: Optional[SessionUser] = Depends(session_user),
+    db: Session = Depends(get_read_db)
+):
+    """
+    计划统计（年度热力图、进度统计）：按日、按周、按月的分配/完成小时和计划项数，以及按重要性的分组
+    Args:
+        start_date: 开始日期（YYYY-MM-DD），默认今年 1 月 1 日
+        end_date: 结束日期（YYYY-MM-DD），默认今年 12 月 31 日
+    从 user_daily_stats 汇总表读取（含已归档的计划项），不扫描计划项
+    """
+    user = _resolve_user(db, caller, user_id)
     
-    task = db.query(Task).filter(Task.id == item.task_id).first()
+    today = get_today_cst()
+    try:
+        start = datetime.strptime(start_date, "%Y-%m-%d").date() if start_date else date(today.year, 1, 1)
+        end = datetime.strptime(end_date, "%Y-%m-%d").date() if end_date else date(today.year, 12, 31)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Date format error, please use YYYY-MM-DD format")
+    if end < start:
+        raise HTTPException(status_code=400, detail="end_date must not be earlier than start_date")
+    if (end - start).days > 366 * 5:
+        raise HTTPException(status_code=400, detail="Date range must not exceed 5 years")
     
-    # 长期任务可能没有子任务（subtask_id 为 NULL）
-    if item.subtask_id is None:
-        # 长期任务
-        subtask_name = task.task_name if task else ""
+    return user_stats(db, user.id, start, end)
+
+
+async def _stream_events(request: Request, subscription):
+    """SSE 消息流：changes 为一次提交的变更事件，空闲时定期发送心跳注释"""
+    try:
+        yield b"retry: 3000\n\n"
+        yield sse_message("ready", {"heartbeat": EVENTS_HEARTBEAT_SECONDS})
+        while True:
+            events = await subscription.next(EVENTS_HEARTBEAT_SECONDS)
+            if events is None:
+                if await request.is_disconnected():
+                    break
+                yield SSE_HEARTBEAT
+                continue
+            yield sse_message("changes", {"events": events})
+    finally:
+        event_broker.unsubscribe(subscription)
+
+
+@app.get("/users/{user_id}/events")
+async def get_user_events(
+    user_id: str,
+    request: Request,
+    caller: Optional[SessionUser] = Depends(session_user),
+    db: Session = Depends(get_read_db)
+):
+    """
+    日历变更推送（Server-Sent Events）
+    其他设备或后台生成计划提交的任务、子任务、计划项变化会以 changes 消息推送；
+    收到 {"type": "resync"} 或重连后调用 /sync 补齐
+    EventSource 不能设置请求头，令牌通过 ?access_token= 传递
+    """
+    user = _resolve_user(db, caller, user_id)
+    
+    subscription = event_broker.subscribe(user.id)
+    return StreamingResponse(
+        _stream_events(request, subscription),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+SYNC_CURSOR_LAG_SECONDS = float(os.getenv("SYNC_CURSOR_LAG_SECONDS", "2"))
+
+
+def _encode_sync_cursor(moment: datetime) -> str:
+    return str(int((moment - datetime(1970, 1, 1)).total_seconds() * 1_000_000))
+
+
+def _decode_sync_cursor(cursor: str) -> Optional[datetime]:
+    try:
+        return datetime(1970, 1, 1) + timedelta(microseconds=int(cursor))
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+@app.get("/sync", response_model=SyncResponse)
+async def sync_changes(
+    user_id: str = None,
+    since: Optional[str] = None,
+    start_date: Optional[str] = None,
+    caller: Optional[SessionUser] = Depends(session_user),
+    db: Session = Depends(get_db)
+):
+    """
+    增量同步：返回游标 since 之后变化的任务、子任务、计划项，以及被删除（含归档）的行 ID
+    Args:
+        user_id: 用户ID
+        since: 上次响应中的 cursor；不提供、无法解析或早于墓碑保留期时返回全量快照（full=true）
+        start_date: 全量快照中计划项的起始日期（YYYY-MM-DD），默认不限；增量结果不按日期过滤
+    
+    游标取查询开始时间减去 SYNC_CURSOR_LAG_SECONDS（默认 2 秒），并用 >= 比较，
+    提交较晚的事务中的行会在下一次同步时再次返回，客户端按 ID 覆盖即可。
+    使用主库会话：副本的复制延迟会让游标越过尚未复制的行。
+    """
+    user = _resolve_user(db, caller, user_id)
+    try:
+        window_start = datetime.strptime(start_date, "%Y-%m-%d").date() if start_date else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Date format error, please use YYYY-MM-DD format")
+    
+    cursor = datetime.utcnow() - timedelta(seconds=SYNC_CURSOR_LAG_SECONDS)
+    since_at = _decode_sync_cursor(since) if since else None
+    full = since_at is None or since_at < tombstone_horizon()
+    
+    task_query = db.query(Task).filter(Task.user_id == user.id)
+    subtask_query = db.query(Subtask).join(Task, Subtask.task_id == Task.id).filter(Task.user_id == user.id)
+    item_query = db.query(DailyTaskItem).join(Task, DailyTaskItem.task_id == Task.id).filter(Task.user_id == user.id)
+    deleted = SyncDeleted()
+    if full:
+        if window_start:
+            item_query = item_query.filter(DailyTaskItem.date >= window_start)
     else:
-        # 普通任务
-        subtask = db.query(Subtask).filter(Subtask.id == item.subtask_id).first()
-        subtask_name = subtask.subtask_name if subtask else ""
+        task_query = task_query.filter(Task.updated_at >= since_at)
+        subtask_query = subtask_query.filter(Subtask.updated_at >= since_at)
+        item_query = item_query.filter(DailyTaskItem.updated_at >= since_at)
+        tombstones = db.query(SyncTombstone.entity, SyncTombstone.entity_id).filter(
+            SyncTombstone.user_id == user.id,
+            SyncTombstone.deleted_at >= since_at
+        ).all()
+        deleted_ids = {"task": set(), "subtask": set(), "item": set()}
+        for entity, entity_id in tombstones:
+            deleted_ids.setdefault(entity, set()).add(entity_id)
+        deleted = SyncDeleted(
+            tasks=sorted(deleted_ids["task"]),
+            subtasks=sorted(deleted_ids["subtask"]),
+            items=sorted(deleted_ids["item"]),
+        )
+    
+    return SyncResponse(
+        cursor=_encode_sync_cursor(cursor),
+        full=full,
+        tasks=[
+            SyncTask(
+                id=task.id,
+                task_name=task.task_name,
+                description=task.description,
+                importance=task.importance,
+                is_long_term=task.is_long_term,
+                start_date=task.start_date.isoformat() if task.start_date else None,
+                deadline=task.deadline.isoformat() if task.deadline else None,
+                progress=_task_progress(task),
+            )
+            for task in task_query.order_by(Task.id)
+        ],
+        subtasks=[
+            SyncSubtask(
+                id=subtask.id,
+                task_id=subtask.task_id,
+                subtask_name=subtask.subtask_name,
+                description=subtask.description,
+                estimated_hours=subtask.estimated_hours,
+                is_completed=subtask.is_completed,
+            )
+            for subtask in subtask_query.order_by(Subtask.id)
+        ],
+        items=[
+            SyncItem(
+                id=item.id,
+                date=item.date.isoformat(),
+                task_id=item.task_id,
+                subtask_id=item.subtask_id or 0,
+                allocated_hours=item.allocated_hours,
+                is_completed=item.is_completed,
+            )
+            for item in item_query.order_by(DailyTaskItem.date, DailyTaskItem.id)
+        ],
+        deleted=deleted,
+    )
+
+
+@app.get("/search", response_model=SearchResponse)
+async def search(
+    q: str,
+    user_id: str = None,
+    limit: int = 20,
+    offset: int = 0,
+    caller: Optional[SessionUser] = Depends(session_user),
+    db: Session = Depends(get_read_db)
+):
+    """
+    全文搜索当前用户的任务和子任务（名称、描述），按相关度排序，分页返回
+    多个词之间是 AND；中文按连续字符匹配，英文和数字按前缀匹配（见 search_index.py）
+    """
+    if not 1 <= limit <= 100 or offset < 0:
+        raise HTTPException(status_code=400, detail="limit must be between 1 and 100 and offset must not be negative")
+    user = _resolve_user(db, caller, user_id)
     
+    hits = search_documents(db, user.id, q, limit, offset)
+    if hits is None:
+        raise HTTPException(status_code=400, detail="Query must contain at least one searchable word")
+    has_more = len(hits) > limit
+    hits = hits[:limit]
+    
+    # 只为当前页的结果读取原文
+    task_ids = {task_id for _, _, task_id, _ in hits}
+    subtask_ids = [entity_id for kind, entity_id, _, _ in hits if kind == KIND_SUBTASK]
+    tasks = {
+        task.id: task for task in db.query(Task).filter(Task.id.in_(task_ids), Task.user_id == user.id)
+    } if task_ids else {}
+    subtasks = {
+        subtask.id: subtask for subtask in db.query(Subtask).filter(Subtask.id.in_(subtask_ids))
+    } if subtask_ids else {}
+    
+    results = []
+    for kind, entity_id, task_id, score in hits:
+        task = tasks.get(task_id)
+        if task is None:
+            continue
+        if kind == KIND_TASK:
+            title, description = task.task_name, task.description
+        else:
+            subtask = subtasks.get(entity_id)
+            if subtask is None:
+                continue
+            title, description = subtask.subtask_name, subtask.description
+        results.append(SearchHit(
+            kind=KIND_NAMES[kind],
+            id=entity_id,
+            task_id=task_id,
+            title=title,
+            description=description,
+            task_name=task.task_name,
+            score=round(score, 6)
+        ))
+    return SearchResponse(query=q, limit=limit, offset=offset, has_more=has_more, results=results)
+
+
+def _load_owned_item(db: Session, item_id: int, user: Optional[SessionUser] = None) -> DailyTaskItem:
+    """
+    一次 JOIN 查询取出计划项、所属任务和子任务，并检查归属（user 为 None 时不检查）
+    任务和子任务留在 identity map 中，之后 flush 时各个维护事件不再单独查询
+    """
+    item = db.query(DailyTaskItem).join(
+        Task, DailyTaskItem.task_id == Task.id
+    ).outerjoin(
+        Subtask, DailyTaskItem.subtask_id == Subtask.id
+    ).options(
+        contains_eager(DailyTaskItem.task),
+        contains_eager(DailyTaskItem.subtask)
+    ).filter(DailyTaskItem.id == item_id).first()
+    if item is None:
+        raise HTTPException(status_code=404, detail="Task item not found")
+    # 如果提供了 user_id 或令牌，验证任务是否属于该用户
+    if user is not None and item.task.user_id != user.id:
+        raise HTTPException(status_code=403, detail="无权访问此任务")
+    return item
+
+
+def _item_response(item: DailyTaskItem) -> DailyItemResponse:
+    """用已加载的任务、子任务构造响应（在提交前调用，提交后对象会过期）"""
+    task = item.task
+    # 长期任务没有子任务（subtask_id 为 NULL），显示任务名称
+    subtask_name = item.subtask.subtask_name if item.subtask is not None else task.task_name
     return DailyItemResponse(
         id=item.id,
         date=item.date.isoformat(),
         task_id=item.task_id,
-        task_name=task.task_name if task else "",
+        task_name=task.task_name,
         subtask_id=item.subtask_id if item.subtask_id is not None else 0,
         subtask_name=subtask_name,
         allocated_hours=item.allocated_hours,
-        is_completed=item.is_completed,
-        importance=task.importance if task else "medium"
+        is_completed=bool(item.is_completed),
+        importance=task.importance or "medium"
     )
 
 
+@app.put("/daily-items/{item_id}")
+async def update_daily_item(
+    item_id: int,
+    update: AllocatedHoursUpdate,
+    user_id: str = None,
+    caller: Optional[SessionUser] = Depends(session_user),
+    db: Session = Depends(get_db)
+):
+    """更新每日任务项的分配时间"""
+    item = _load_owned_item(db, item_id, _resolve_user(db, caller, user_id, required=False))
+    item.allocated_hours = update.allocated_hours
+    response = _item_response(item)
+    db.commit()
+    return response
+
+
 @app.delete("/daily-items/{item_id}")
 async def delete_daily_item(
     item_id: int, 
     user_id: str = None, 
     delete_future: bool = False,
+    caller: Optional[SessionUser] = Depends(session_user),
     db: Session = Depends(get_db)
 ):
     """删除日历中的特定任务项
@@ -991,25 +2024,10 @@ async def delete_daily_item(
         user_id: 用户ID（可选）
         delete_future: 如果为True，删除该任务的所有未来日期项（从该任务项的日期开始）
     """
-    item = db.query(DailyTaskItem).filter(DailyTaskItem.id == item_id).first()
-    if not item:
-        raise HTTPException(status_code=404, detail="Task item not found")
-    
-    # 如果提供了 user_id，验证任务是否属于该用户
-    if user_id:
-        user = db.query(User).filter(User.user_id == user_id).first()
-        task = db.query(Task).filter(Task.id == item.task_id).first()
-        if not user or not task or task.user_id != user.id:
-            raise HTTPException(status_code=403, detail="无权访问此任务")
-    
+    item = _load_owned_item(db, item_id, _resolve_user(db, caller, user_id, required=False))
     deleted_count = 0
     
     if delete_future:
-        # 获取任务信息
-        task = db.query(Task).filter(Task.id == item.task_id).first()
-        if not task:
-            raise HTTPException(status_code=404, detail="Task not found")
-        
         # 删除该任务的所有未来日期项（从当前任务项的日期开始，包括当前项）
         # 如果是长期任务（subtask_id 为 None），删除所有未来的长期任务项
         # 如果是普通任务，删除该任务的所有未来项（所有子任务）
@@ -1045,41 +2063,40 @@ async def delete_daily_item(
 
 
 @app.delete("/tasks/{task_id}")
-async def delete_task(task_id: int, user_id: str = None, db: Session = Depends(get_db)):
+async def delete_task(task_id: int, user_id: str = None, caller: Optional[SessionUser] = Depends(session_user), db: Session = Depends(get_db)):
     """删除任务（会级联删除所有子任务和计划项）"""
+    user = _resolve_user(db, caller, user_id, required=False)
     task = db.query(Task).filter(Task.id == task_id).first()
     if not task:
         raise HTTPException(status_code=404, detail="Task not found")
     
-    # 如果提供了 user_id，验证任务是否属于该用户
-    if user_id:
-        user = db.query(User).filter(User.user_id == user_id).first()
-        if not user or task.user_id != user.id:
-            raise HTTPException(status_code=403, detail="无权访问此任务")
+    # 如果提供了 user_id 或令牌，验证任务是否属于该用户
+    if user and task.user_id != user.id:
+        raise HTTPException(status_code=403, detail="无权访问此任务")
     
     # 显式删除相关的每日任务项（双重保险，确保数据一致性）
     daily_items = db.query(DailyTaskItem).filter(DailyTaskItem.task_id == task_id).all()
     for item in daily_items:
         db.delete(item)
     
+    # 已归档的计划项一起删除（批量删除绕过了 ORM，先从统计中扣除）
+    adjust_user_stats(db, negate(archived_task_stats(db, [task_id])))
+    db.query(DailyTaskItemArchive).filter(
+        DailyTaskItemArchive.task_id == task_id
+    ).delete(synchronize_session=False)
+    
     # 删除任务（SQLAlchemy 的级联删除会处理子任务）
     db.delete(task)
     db.commit()
+    similar_tasks.remove(task_id)
     return {"message": "任务已删除"}
 
 
 @app.delete("/calendar/clear")
-async def clear_calendar(user_id: str = None, db: Session = Depends(get_db)):
+async def clear_calendar(user_id: str = None, caller: Optional[SessionUser] = Depends(session_user), db: Session = Depends(get_db)):
     """清空指定用户的日历计划项"""
+    user = _resolve_user(db, caller, user_id)
     try:
-        if not user_id:
-            raise HTTPException(status_code=400, detail="user_id parameter is required")
-        
-        # 根据 user_id 查找用户
-        user = db.query(User).filter(User.user_id == user_id).first()
-        if not user:
-            raise HTTPException(status_code=404, detail="User not found")
-        
         # 先获取该用户的所有任务ID
         user_tasks = db.query(Task.id).filter(Task.user_id == user.id).all()
         task_ids = [task.id for task in user_tasks]
@@ -1087,10 +2104,22 @@ async def clear_calendar(user_id: str = None, db: Session = Depends(get_db)):
         if not task_ids:
             return {"message": "没有需要清空的计划项"}
         
-        # 删除所有属于这些任务的任务项
+        # 删除所有属于这些任务的任务项（先记下 ID，写入增量同步的墓碑）
+        item_ids = [
+            item_id for (item_id,) in db.query(DailyTaskItem.id).filter(DailyTaskItem.task_id.in_(task_ids))
+        ]
         deleted_count = db.query(DailyTaskItem).filter(
             DailyTaskItem.task_id.in_(task_ids)
         ).delete(synchronize_session=False)
+        deleted_count += db.query(DailyTaskItemArchive).filter(
+            DailyTaskItemArchive.user_id == user.id
+        ).delete(synchronize_session=False)
+        # 批量删除绕过了 ORM，同步清空每日负载索引并标记日历已变化
+        reset_user_loads(db, user.id)
+        reset_user_stats(db, user.id)
+        reset_task_progress(db, user.id)
+        touch_users(db, [user.id])
+        record_tombstones(db, user.id, "item", item_ids)
         
         db.commit()
         return {"message": f"Cleared {deleted_count} plan items"}
@@ -1103,7 +2132,8 @@ async def clear_calendar(user_id: str = None, db: Session = Depends(get_db)):
 async def get_today_plans(
     user_id: str = None, 
     timezone_offset: Optional[int] = None,
-    db: Session = Depends(get_db)
+    caller: Optional[SessionUser] = Depends(session_user),
+    db: Session = Depends(get_read_db)
 ):
     """
     获取今日计划
@@ -1112,13 +2142,7 @@ async def get_today_plans(
         timezone_offset: 时区偏移（小时），例如 8 表示 UTC+8，-5 表示 UTC-5
                         如果不提供，默认使用 UTC+8（中国时区）
     """
-    if not user_id:
-        raise HTTPException(status_code=400, detail="必须提供 user_id 参数")
-    
-    # 根据 user_id 查找用户
-    user = db.query(User).filter(User.user_id == user_id).first()
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
+    user = _resolve_user(db, caller, user_id)
     
     # 根据时区偏移计算"今天"，如果未提供则使用默认值（UTC+8）
     if timezone_offset is not None:
@@ -1182,6 +2206,63 @@ async def get_today_plans(
     return result
 
 
+# ============================================================================
+# 管理接口（需要 X-Admin-Token，见 auth.require_admin）
+# ============================================================================
+
+@app.post("/admin/profile", dependencies=[Depends(require_admin)])
+async def run_profile(
+    seconds: float = 10,
+    mode: str = profiling.MODE_SAMPLING,
+    format: Optional[str] = None,
+    interval_ms: Optional[float] = None,
+    include_idle: bool = False
+):
+    """
+    剖析接下来 seconds 秒内进程的全部负载并返回结果
+    mode=sampling 返回 collapsed stacks（format=collapsed，可生成火焰图）或 format=text 的函数汇总；
+    mode=cprofile 返回 format=text 的摘要或 format=pstats 文件
+    """
+    if seconds <= 0:
+        raise HTTPException(status_code=400, detail="seconds must be positive")
+    if mode not in profiling.MODES:
+        raise HTTPException(status_code=400, detail=f"mode must be one of {', '.join(profiling.MODES)}")
+    try:
+        profiler = await profiling.profile_for(seconds, mode, interval_ms, include_idle)
+    except profiling.ProfilerBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return profiling.render(profiler, format)
+
+
+@app.get("/admin/profiles/{profile_id}", dependencies=[Depends(require_admin)])
+async def get_profile(profile_id: str, format: Optional[str] = None):
+    """取回 X-Profile 请求头触发的单请求剖析结果"""
+    result = profiling.get_result(profile_id)
+    if result is None:
+        raise HTTPException(status_code=404, detail="Profile not found (expired or never recorded)")
+    profiler, request_line, elapsed_ms = result
+    response = profiling.render(profiler, format)
+    response.headers["X-Profile-Request"] = request_line
+    response.headers["X-Profile-Elapsed-Ms"] = f"{elapsed_ms:.1f}"
+    return response
+
+
+@app.get("/admin/slow-queries", dependencies=[Depends(require_admin)])
+async def get_slow_queries(limit: int = 50, min_ms: float = 0, endpoint: Optional[str] = None):
+    """最近的慢查询（新的在前），带接口、参数形状、耗时和 EXPLAIN 结果；endpoint 按子串过滤，例如 /calendar"""
+    return {
+        **slow_query_log.snapshot(),
+        "queries": slow_query_log.recent(max(1, min(limit, 1000)), min_ms, endpoint),
+    }
+
+
+@app.delete("/admin/slow-queries", dependencies=[Depends(require_admin)])
+async def clear_slow_queries():
+    """清空内存中的慢查询记录（同时允许已记录过的语句重新 EXPLAIN）"""
+    slow_query_log.clear()
+    return {"message": "Slow query log cleared"}
+
+
 # ============================================================================
 # 前端静态文件服务（必须在所有 API 路由之后定义）
 # ============================================================================
@@ -1189,7 +2270,7 @@ async def get_today_plans(
 # 定义 API 路径列表，这些路径不应该被前端路由处理
 API_PATHS = [
     "tasks", "calendar", "today", "daily-items", "subtasks", 
-    "users", "user", "docs", "openapi.json", "redoc", "api"
+    "users", "user", "docs", "openapi.json", "redoc", "api", "admin"
 ]
 
 @app.get("/")
@@ -1247,42 +2328,15 @@ async def serve_frontend(full_path: str):
 
 
 @app.put("/daily-items/{item_id}/toggle-complete")
-async def toggle_item_complete(item_id: int, user_id: str = None, db: Session = Depends(get_db)):
+async def toggle_item_complete(
+    item_id: int,
+    user_id: str = None,
+    caller: Optional[SessionUser] = Depends(session_user),
+    db: Session = Depends(get_db)
+):
     """切换任务项的完成状态"""
-    item = db.query(DailyTaskItem).filter(DailyTaskItem.id == item_id).first()
-    if not item:
-        raise HTTPException(status_code=404, detail="Task item not found")
-    
-    # 如果提供了 user_id，验证任务是否属于该用户
-    if user_id:
-        user = db.query(User).filter(User.user_id == user_id).first()
-        task = db.query(Task).filter(Task.id == item.task_id).first()
-        if not user or not task or task.user_id != user.id:
-            raise HTTPException(status_code=403, detail="无权访问此任务")
-    
+    item = _load_owned_item(db, item_id, _resolve_user(db, caller, user_id, required=False))
     item.is_completed = not item.is_completed
+    response = _item_response(item)
     db.commit()
-    db.refresh(item)
-    
-    task = db.query(Task).filter(Task.id == item.task_id).first()
-    
-    # 长期任务可能没有子任务（subtask_id 为 NULL）
-    if item.subtask_id is None:
-        # 长期任务
-        subtask_name = task.task_name if task else ""
-    else:
-        # 普通任务
-        subtask = db.query(Subtask).filter(Subtask.id == item.subtask_id).first()
-        subtask_name = subtask.subtask_name if subtask else ""
-    
-    return DailyItemResponse(
-        id=item.id,
-        date=item.date.isoformat(),
-        task_id=item.task_id,
-        task_name=task.task_name if task else "",
-        subtask_id=item.subtask_id if item.subtask_id is not None else 0,
-        subtask_name=subtask_name,
-        allocated_hours=item.allocated_hours,
-        is_completed=item.is_completed,
-        importance=task.importance if task else "medium"
-    )
+    return response
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Date, Float, Boolean, ForeignKey, Text, DateTime
+from sqlalchemy import Column, Integer, String, Date, Float, Boolean, ForeignKey, Text, DateTime, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, sessionmaker
 from datetime import date, datetime
@@ -15,6 +15,7 @@ class User(Base):
     user_id = Column(String, unique=True, nullable=False, index=True)  # 唯一用户ID
     nickname = Column(String, nullable=False, index=True)  # 昵称
     created_at = Column(DateTime, default=datetime.utcnow)
+    calendar_updated_at = Column(DateTime, nullable=True)  # 任务/计划最近一次变化的时间（change_tracking 维护）
     
     # 关联关系
     tasks = relationship("Task", back_populates="user", cascade="all, delete-orphan")
@@ -30,9 +31,17 @@ class Task(Base):
     description = Column(Text, nullable=False)  # 自然语言描述
     importance = Column(String, default="medium")  # low, medium, high
     is_long_term = Column(Boolean, default=False)  # 是否长期任务
+    is_custom = Column(Boolean, nullable=False, default=False)  # 自定义计划项（/custom-task-item 创建的一次性任务），不参与计划生成
     start_date = Column(Date, nullable=True, index=True)  # 开始日期（可选）
     deadline = Column(Date, nullable=True, index=True)  # 截止日期，长期任务为 None
     created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)  # 增量同步用
+    # 进度计数（由 task_progress 在写入时维护，含已归档的计划项）
+    total_hours = Column(Float, nullable=False, default=0.0)  # 计划项分配时间合计
+    completed_hours = Column(Float, nullable=False, default=0.0)  # 已完成计划项的时间合计
+    subtask_count = Column(Integer, nullable=False, default=0)
+    completed_subtasks = Column(Integer, nullable=False, default=0)
+    next_item_date = Column(Date, nullable=True)  # 最早的未完成计划项日期
     
     # 关联关系
     user = relationship("User", back_populates="tasks")
@@ -51,6 +60,7 @@ class Subtask(Base):
     estimated_hours = Column(Float, nullable=False, default=0.0)  # 预计时间（小时）
     is_completed = Column(Boolean, default=False)
     created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)  # 增量同步用
     
     # 关联关系
     task = relationship("Task", back_populates="subtasks")
@@ -68,12 +78,71 @@ class DailyTaskItem(Base):
     allocated_hours = Column(Float, nullable=False, default=0.0)  # 分配的时间（小时）
     is_completed = Column(Boolean, default=False)
     created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)  # 增量同步用
     
     # 关联关系
     task = relationship("Task", back_populates="daily_items")
     subtask = relationship("Subtask", back_populates="daily_items")
 
 
+class DailyTaskItemArchive(Base):
+    """已归档的每日任务项（已完成且早于保留期限，从 daily_task_items 移出；冗余任务信息，读取时无需 JOIN）"""
+    __tablename__ = "daily_task_items_archive"
+    
+    id = Column(Integer, primary_key=True)  # 原 daily_task_items.id
+    date = Column(Date, nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    task_id = Column(Integer, nullable=False, index=True)
+    subtask_id = Column(Integer, nullable=True)
+    allocated_hours = Column(Float, nullable=False, default=0.0)
+    task_name = Column(String, nullable=False)
+    subtask_name = Column(String, nullable=True)
+    importance = Column(String, default="medium")
+    created_at = Column(DateTime, nullable=True)
+    archived_at = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        Index("ix_daily_task_items_archive_user_date", "user_id", "date"),
+    )
+
+
+class SyncTombstone(Base):
+    """已删除行的墓碑记录（增量同步时告诉客户端哪些行被删除，过期后清理）"""
+    __tablename__ = "sync_tombstones"
+    
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    entity = Column(String, nullable=False)  # task, subtask, item
+    entity_id = Column(Integer, nullable=False)
+    deleted_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    
+    __table_args__ = (
+        Index("ix_sync_tombstones_user_deleted", "user_id", "deleted_at"),
+    )
+
+
+class UserDailyLoad(Base):
+    """每用户每日已分配时间（daily_task_items 按用户和日期的汇总，由 load_index 增量维护）"""
+    __tablename__ = "user_daily_loads"
+    
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    date = Column(Date, primary_key=True)
+    allocated_hours = Column(Float, nullable=False, default=0.0)
+
+
+class UserDailyStat(Base):
+    """每用户每日按重要性的计划统计（含已归档的计划项，由 stats_rollup 增量维护）"""
+    __tablename__ = "user_daily_stats"
+    
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    date = Column(Date, primary_key=True)
+    importance = Column(String, primary_key=True)
+    allocated_hours = Column(Float, nullable=False, default=0.0)
+    completed_hours = Column(Float, nullable=False, default=0.0)
+    item_count = Column(Integer, nullable=False, default=0)
+    completed_count = Column(Integer, nullable=False, default=0)
+
+
 # 保留旧表以兼容现有数据
 class DailyPlan(Base):
     __tablename__ = "daily_plans"
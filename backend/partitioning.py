@@ -0,0 +1,144 @@
+"""
+daily_task_items 按月分区（仅 PostgreSQL，声明式 RANGE 分区）
+
+设置 DAILY_ITEMS_PARTITIONED=1 后，启动迁移会：
+1. 把现有的普通表 daily_task_items 转换为按 date 分区的表（主键变为 (id, date)，沿用原来的 id 序列），
+   为已有数据涉及的每个月建分区并搬迁数据
+2. 每次启动确保未来 DAILY_ITEMS_PARTITION_MONTHS_AHEAD 个月（默认 12）的分区存在，
+   超出范围的日期落入 daily_task_items_default 分区；之后为这些月份建分区时会先把默认分区里的数据搬过去
+
+分区后按日期范围的查询只扫描相关月份，旧月份的分区随归档（archive.py）变小，不影响热数据的索引大小。
+SQLite 不支持分区，这里的函数在 SQLite 上直接跳过。
+"""
+import os
+from datetime import date
+
+from sqlalchemy import text
+
+PARENT = "daily_task_items"
+DEFAULT_PARTITION = f"{PARENT}_default"
+MONTHS_AHEAD = int(os.getenv("DAILY_ITEMS_PARTITION_MONTHS_AHEAD", "12"))
+
+
+def partitioning_enabled(engine) -> bool:
+    return (
+        engine.dialect.name == "postgresql"
+        and os.getenv("DAILY_ITEMS_PARTITIONED", "0").lower() in ("1", "true", "yes", "on")
+    )
+
+
+def _month_start(day: date) -> date:
+    return day.replace(day=1)
+
+
+def _next_month(day: date) -> date:
+    return date(day.year + (day.month == 12), day.month % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f"{PARENT}_y{month.year}m{month.month:02d}"
+
+
+def is_partitioned(conn) -> bool:
+    return bool(conn.execute(text(
+        "SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid "
+        "WHERE c.relname = :name"
+    ), {"name": PARENT}).scalar())
+
+
+def _existing_partitions(conn) -> set:
+    return set(conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent "
+        "WHERE p.relname = :name"
+    ), {"name": PARENT}).scalars())
+
+
+def _create_month_partition(conn, month: date, existing: set):
+    """创建一个月份分区；默认分区中已有该月数据时先搬迁"""
+    name = partition_name(month)
+    if name in existing:
+        return
+    bounds = {"lo": month, "hi": _next_month(month)}
+    has_default_rows = DEFAULT_PARTITION in existing and conn.execute(text(
+        f"SELECT 1 FROM {DEFAULT_PARTITION} WHERE date >= :lo AND date < :hi LIMIT 1"
+    ), bounds).scalar()
+    if has_default_rows:
+        conn.execute(text(f"ALTER TABLE {PARENT} DETACH PARTITION {DEFAULT_PARTITION}"))
+    conn.execute(text(
+        f"CREATE TABLE {name} PARTITION OF {PARENT} "
+        f"FOR VALUES FROM ('{bounds['lo'].isoformat()}') TO ('{bounds['hi'].isoformat()}')"
+    ))
+    if has_default_rows:
+        conn.execute(text(
+            f"INSERT INTO {PARENT} SELECT * FROM {DEFAULT_PARTITION} WHERE date >= :lo AND date < :hi"
+        ), bounds)
+        conn.execute(text(f"DELETE FROM {DEFAULT_PARTITION} WHERE date >= :lo AND date < :hi"), bounds)
+        conn.execute(text(f"ALTER TABLE {PARENT} ATTACH PARTITION {DEFAULT_PARTITION} DEFAULT"))
+    existing.add(name)
+
+
+def ensure_partitions(engine, first_month: date = None, months_ahead: int = MONTHS_AHEAD):
+    """确保 first_month（默认本月）到未来 months_ahead 个月的分区以及默认分区存在"""
+    if not partitioning_enabled(engine):
+        return
+    with engine.begin() as conn:
+        if not is_partitioned(conn):
+            return
+        existing = _existing_partitions(conn)
+        if DEFAULT_PARTITION not in existing:
+            conn.execute(text(f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF {PARENT} DEFAULT"))
+            existing.add(DEFAULT_PARTITION)
+        month = _month_start(first_month or date.today())
+        for _ in range(months_ahead + 1):
+            _create_month_partition(conn, month, existing)
+            month = _next_month(month)
+
+
+def migrate_to_partitioned(engine):
+    """把普通表 daily_task_items 转换为按月分区的表（在一个事务中完成）"""
+    if not partitioning_enabled(engine):
+        return
+    with engine.begin() as conn:
+        if is_partitioned(conn):
+            return
+        print("🔹 正在把 daily_task_items 转换为按月分区的表...")
+        legacy = f"{PARENT}_unpartitioned"
+        conn.execute(text(f"ALTER TABLE {PARENT} RENAME TO {legacy}"))
+        # 序列归属原表，删除原表前解除，避免序列被一起删除
+        conn.execute(text(f"ALTER SEQUENCE IF EXISTS {PARENT}_id_seq OWNED BY NONE"))
+        conn.execute(text(
+            f"CREATE TABLE {PARENT} (LIKE {legacy} INCLUDING DEFAULTS) PARTITION BY RANGE (date)"
+        ))
+        conn.execute(text(f"ALTER TABLE {PARENT} ADD PRIMARY KEY (id, date)"))
+        conn.execute(text(
+            f"ALTER TABLE {PARENT} ADD FOREIGN KEY (task_id) REFERENCES tasks(id) ON DELETE CASCADE"
+        ))
+        conn.execute(text(
+            f"ALTER TABLE {PARENT} ADD FOREIGN KEY (subtask_id) REFERENCES subtasks(id) ON DELETE CASCADE"
+        ))
+
+        bounds = conn.execute(text(f"SELECT MIN(date), MAX(date) FROM {legacy}")).one()
+        existing = set()
+        conn.execute(text(f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF {PARENT} DEFAULT"))
+        existing.add(DEFAULT_PARTITION)
+        if bounds[0] is not None:
+            month = _month_start(bounds[0])
+            while month <= bounds[1]:
+                _create_month_partition(conn, month, existing)
+                month = _next_month(month)
+
+        columns = ", ".join(
+            row[0] for row in conn.execute(text(
+                "SELECT column_name FROM information_schema.columns "
+                "WHERE table_name = :name ORDER BY ordinal_position"
+            ), {"name": legacy})
+        )
+        moved = conn.execute(text(
+            f"INSERT INTO {PARENT} ({columns}) SELECT {columns} FROM {legacy}"
+        )).rowcount
+        conn.execute(text(f"DROP TABLE {legacy}"))
+        conn.execute(text(f"ALTER SEQUENCE IF EXISTS {PARENT}_id_seq OWNED BY {PARENT}.id"))
+        for column in ("date", "task_id", "subtask_id", "updated_at"):
+            conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{PARENT}_{column} ON {PARENT} ({column})"))
+        print(f"✅ daily_task_items 已转换为分区表，搬迁 {moved} 行")
@@ -0,0 +1,227 @@
+"""
+本地（不依赖 LLM）的计划生成
+
+- build_local_plan：单个任务。在 LLM 服务不可用（熔断、超时）时作为兜底，
+  把每个子任务的预计时间按顺序分摊到开始日期到截止日期之间，每天不超过 daily_cap 小时。
+  返回结构与 prompts.parse_plan() 相同，可以直接复用写库逻辑。
+- build_local_batch_plan：多个任务共享每日容量，返回结构与 prompts.parse_batch_plan() 相同。
+- build_capacity_plan：单个任务，考虑用户在其他任务上已占用的时间（load_index.DailyLoadTree），
+  每次把一块时间放到窗口内负载最小的一天，返回结构与 build_local_plan() 相同。
+- replan_subtask_hours：子任务预计时间变化后，只调整该子任务未来未完成的分配。
+"""
+import math
+from collections import defaultdict
+from datetime import date, timedelta
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# 与 LLM 提示词中的建议保持一致：每天 2-4 小时
+DEFAULT_DAILY_CAP = 4.0
+# 最小分配粒度（小时）
+MIN_CHUNK = 0.5
+
+
+def build_local_plan(
+    subtasks: Sequence[Tuple[str, float]],
+    start_date: date,
+    end_date: date,
+    daily_cap: float = DEFAULT_DAILY_CAP,
+) -> List[dict]:
+    """
+    生成本地计划
+    Args:
+        subtasks: [(子任务名称, 预计小时), ...]，顺序即执行顺序
+        start_date: 开始日期
+        end_date: 截止日期（包含）
+        daily_cap: 每天最多分配的小时数；总时间放不下时自动提高到平均值
+    Returns:
+        [{"date": date, "subtask_no": 子任务序号(从1开始), "allocated_hours", "subtask_name"}, ...]
+    """
+    days = max(1, (end_date - start_date).days + 1)
+    total = sum(max(0.0, hours) for _, hours in subtasks)
+    cap = max(daily_cap, math.ceil(total / days / MIN_CHUNK) * MIN_CHUNK)
+
+    plan: List[dict] = []
+    day_index = 0
+    used_today = 0.0
+    for number, (name, hours) in enumerate(subtasks, start=1):
+        remaining = max(0.0, float(hours))
+        while remaining > 1e-9:
+            if used_today >= cap - 1e-9 and day_index < days - 1:
+                day_index += 1
+                used_today = 0.0
+            available = cap - used_today if day_index < days - 1 else remaining
+            chunk = min(remaining, available)
+            plan.append({
+                "date": start_date + timedelta(days=day_index),
+                "subtask_no": number,
+                "allocated_hours": round(chunk, 2),
+                "subtask_name": name,
+            })
+            remaining -= chunk
+            used_today += chunk
+    return plan
+
+
+def build_capacity_plan(
+    subtasks: Sequence[Tuple[str, float]],
+    start_date: date,
+    end_date: date,
+    loads,
+    daily_cap: float = DEFAULT_DAILY_CAP,
+    chunk: float = 1.0,
+) -> List[dict]:
+    """
+    按每日容量生成本地计划
+    Args:
+        subtasks: [(子任务名称, 预计小时), ...]，顺序即执行顺序
+        loads: 覆盖 [start_date, end_date] 的 DailyLoadTree（包含其他任务已占用的时间），分配后会被更新
+        daily_cap: 每天所有任务合计的小时上限
+        chunk: 每次放置的最大小时数
+    所有天都已满时仍放在负载最小的一天（超出容量，保证截止前完成）
+    """
+    allocated: Dict[Tuple[date, int], float] = defaultdict(float)
+    names = {}
+    for number, (name, hours) in enumerate(subtasks, start=1):
+        names[number] = name
+        remaining = max(0.0, float(hours))
+        while remaining > 1e-9:
+            day, load = loads.least_loaded(start_date, end_date)
+            free = daily_cap - load
+            piece = min(remaining, chunk, free) if free >= MIN_CHUNK else min(remaining, chunk)
+            allocated[(day, number)] += piece
+            loads.add(day, piece)
+            remaining -= piece
+
+    return [
+        {
+            "date": day,
+            "subtask_no": number,
+            "allocated_hours": round(hours, 2),
+            "subtask_name": names[number],
+        }
+        for (day, number), hours in sorted(allocated.items())
+        if hours > 1e-9
+    ]
+
+
+def replan_subtask_hours(
+    current: Dict[date, float],
+    target_hours: float,
+    start_date: date,
+    end_date: date,
+    loads,
+    daily_cap: float = DEFAULT_DAILY_CAP,
+    chunk: float = 1.0,
+) -> Dict[date, float]:
+    """
+    增量调整一个子任务的分配
+    Args:
+        current: {日期: 小时}，该子任务在 [start_date, end_date] 内可调整（未完成）的分配
+        target_hours: 调整后这些分配的合计（新预计时间减去已完成和已过去的部分）
+        loads: 覆盖 [start_date, end_date] 的 DailyLoadTree（包含 current），调整后会被更新
+    Returns:
+        调整后的 {日期: 小时}；小时为 0 表示该天的分配应删除
+    减少时从最晚的一天往前扣减；增加时每次把一块时间放到负载最小的一天，
+    所有天都已满时仍放在负载最小的一天（超出容量，保证截止前完成）
+    """
+    result = dict(current)
+    delta = max(0.0, target_hours) - sum(current.values())
+
+    if delta < 0:
+        excess = -delta
+        for day in sorted(result, reverse=True):
+            if excess <= 1e-9:
+                break
+            take = min(result[day], excess)
+            result[day] -= take
+            loads.add(day, -take)
+            excess -= take
+    else:
+        while delta > 1e-9:
+            day, load = loads.least_loaded(start_date, end_date)
+            free = daily_cap - load
+            piece = min(delta, chunk, free) if free >= MIN_CHUNK else min(delta, chunk)
+            result[day] = result.get(day, 0.0) + piece
+            loads.add(day, piece)
+            delta -= piece
+
+    return {day: round(max(0.0, hours), 2) for day, hours in result.items()}
+
+
+# 重要性排序（越小越优先）
+IMPORTANCE_RANK = {"high": 0, "medium": 1, "low": 2}
+
+
+def build_local_batch_plan(
+    tasks: Sequence[dict],
+    daily_cap: float = DEFAULT_DAILY_CAP,
+    reserved: Optional[Dict[date, float]] = None,
+) -> List[dict]:
+    """
+    多任务共享每日容量的本地计划
+    截止日期早、重要性高的任务先排；每个任务先按均摊量分配到窗口内各天，
+    再用满剩余容量，仍放不下的部分平均摊到窗口内（超出容量，保证截止前完成）。
+    Args:
+        tasks: [{"start": date, "end": date, "importance": str, "subtasks": [(名称, 小时), ...]}, ...]
+               列表顺序即任务序号（从 1 开始）
+        daily_cap: 每天所有任务合计的小时上限
+        reserved: {日期: 已占用小时}（例如长期任务或其他已有计划）
+    Returns:
+        [{"date": date, "task_no": 任务序号, "subtask_no": 子任务序号, "allocated_hours": float}, ...]
+    """
+    load: Dict[date, float] = defaultdict(float)
+    for day, hours in (reserved or {}).items():
+        load[day] += hours
+
+    allocated: Dict[Tuple[date, int, int], float] = defaultdict(float)
+    order = sorted(
+        range(len(tasks)),
+        key=lambda i: (tasks[i]["end"], IMPORTANCE_RANK.get(tasks[i].get("importance"), 1), i)
+    )
+
+    for index in order:
+        task = tasks[index]
+        task_no = index + 1
+        days = max(1, (task["end"] - task["start"]).days + 1)
+        window = [task["start"] + timedelta(days=i) for i in range(days)]
+        pending = [
+            [number, max(0.0, float(hours))]
+            for number, (_, hours) in enumerate(task["subtasks"], start=1)
+            if hours > 0
+        ]
+        total = sum(hours for _, hours in pending)
+        if total <= 0:
+            continue
+        target = max(MIN_CHUNK, math.ceil(total / days / MIN_CHUNK) * MIN_CHUNK)
+
+        def fill(day: date, budget: float):
+            # 按子任务顺序消耗 budget
+            while budget > 1e-9 and pending:
+                number, remaining = pending[0]
+                chunk = min(remaining, budget)
+                allocated[(day, task_no, number)] += chunk
+                load[day] += chunk
+                budget -= chunk
+                pending[0][1] -= chunk
+                if pending[0][1] <= 1e-9:
+                    pending.pop(0)
+
+        # 第一轮：均摊量；第二轮：用满剩余容量
+        for limit in (target, daily_cap):
+            for day in window:
+                fill(day, min(limit, daily_cap - load[day]))
+            if not pending:
+                break
+        # 第三轮：放不下的部分平均摊到窗口内
+        if pending:
+            overflow = sum(hours for _, hours in pending)
+            for day in window:
+                fill(day, overflow / days)
+            if pending:
+                fill(window[-1], sum(hours for _, hours in pending))
+
+    return [
+        {"date": day, "task_no": task_no, "subtask_no": number, "allocated_hours": round(hours, 2)}
+        for (day, task_no, number), hours in sorted(allocated.items())
+        if hours > 1e-9
+    ]
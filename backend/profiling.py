@@ -0,0 +1,262 @@
+"""
+按需性能剖析（需要管理员令牌，见 auth.ADMIN_TOKEN）
+
+两种采集方式：
+- sampling  采样剖析：后台线程每隔 PROFILE_SAMPLE_INTERVAL_MS 毫秒读取所有线程的调用栈
+            （事件循环线程和线程池线程都包括在内），输出 collapsed stacks（"线程;函数;函数 次数"），
+            可以直接交给 flamegraph.pl / speedscope / inferno 生成火焰图。开销与请求数量无关
+- cprofile  确定性剖析：在事件循环线程上开启 cProfile（所有路由都是 async，ORM 查询、对象装配、
+            响应序列化都在这个线程上执行），输出 pstats（snakeviz / flameprof / python -m pstats 可读）或文本摘要
+
+两种触发方式：
+- POST /admin/profile?seconds=10&mode=sampling   剖析接下来 N 秒内进程的全部负载，直接返回结果
+- 请求头 X-Profile: sampling|cprofile（同时带 X-Admin-Token）  只剖析这一个请求，
+  响应头 X-Profile-Id 返回结果 ID，之后用 GET /admin/profiles/{id}?format=... 取回（保留最近 PROFILE_KEEP 个）
+  两种方式剖析的都是请求期间的整个进程（cprofile 为整个事件循环线程），并发的其他请求也会计入
+
+同一时间只允许一个剖析（cProfile 每个线程只能有一个，采样线程也没必要叠加），其余返回 409。
+没有配置 ADMIN_TOKEN 时不注册请求头中间件，正常请求没有任何额外开销。
+
+环境变量：
+    PROFILE_SAMPLE_INTERVAL_MS   采样间隔（毫秒），默认 5
+    PROFILE_MAX_SECONDS          单次剖析最长时间（秒），默认 60
+    PROFILE_KEEP                 保留的单请求剖析结果个数，默认 20
+"""
+import asyncio
+import cProfile
+import io
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from typing import Dict, Optional, Tuple
+
+from fastapi import Request
+from fastapi.responses import JSONResponse, Response
+
+from auth import admin_token_valid
+
+PROFILE_SAMPLE_INTERVAL_MS = float(os.getenv("PROFILE_SAMPLE_INTERVAL_MS", "5"))
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "20"))
+
+MODE_SAMPLING = "sampling"
+MODE_CPROFILE = "cprofile"
+MODES = (MODE_SAMPLING, MODE_CPROFILE)
+
+# 各模式支持的输出格式（第一个为默认）
+FORMATS = {
+    MODE_SAMPLING: ("collapsed", "text"),
+    MODE_CPROFILE: ("text", "pstats"),
+}
+
+# 空闲等待的栈顶（事件循环等待 IO、线程池线程等待任务），默认不计入采样结果
+IDLE_FRAMES = {
+    ("selectors.py", "select"),
+    ("threading.py", "wait"),
+    ("queue.py", "get"),
+    ("thread.py", "_worker"),
+    ("_thread.py", "run"),
+}
+
+
+class ProfilerBusy(RuntimeError):
+    """已经有一个剖析在进行"""
+
+
+_lock = threading.Lock()
+
+
+def _frame_label(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """读取 sys._current_frames() 的采样剖析器，结果为 {调用栈: 次数}"""
+
+    def __init__(self, interval: float, include_idle: bool = False):
+        self.interval = interval
+        self.include_idle = include_idle
+        self.samples: Counter = Counter()
+        self.sample_count = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._labels: Dict[object, str] = {}  # code 对象 -> 标签（避免每次采样都格式化字符串）
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _label(self, code) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = _frame_label(code)
+        return label
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                code = frame.f_code
+                if not self.include_idle and (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self._label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                stack.reverse()
+                self.samples[tuple(stack)] += 1
+            self.sample_count += 1
+
+    def collapsed(self) -> str:
+        return "".join(
+            f"{';'.join(stack)} {count}\n"
+            for stack, count in sorted(self.samples.items(), key=lambda item: -item[1])
+        )
+
+    def text(self, limit: int = 40) -> str:
+        """按函数汇总：self（位于栈顶）和 total（出现在栈中）的采样数"""
+        own, total = Counter(), Counter()
+        for stack, count in self.samples.items():
+            own[stack[-1]] += count
+            for label in set(stack[1:]):
+                total[label] += count
+        samples = sum(self.samples.values()) or 1
+        lines = [f"{self.sample_count} 次采样，{sum(self.samples.values())} 个非空闲调用栈，间隔 {self.interval * 1000:g} ms", ""]
+        lines.append(f"{'self%':>7}{'total%':>8}  function")
+        for label, count in total.most_common(limit):
+            lines.append(f"{own[label] * 100 / samples:>7.1f}{count * 100 / samples:>8.1f}  {label}")
+        return "\n".join(lines) + "\n"
+
+
+class DeterministicProfiler:
+    """当前线程上的 cProfile"""
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def pstats(self) -> bytes:
+        """与 pstats.Stats.dump_stats() 相同的格式"""
+        self.profile.create_stats()
+        return marshal.dumps(self.profile.stats)
+
+    def text(self, limit: int = 60) -> str:
+        out = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=out)
+        stats.strip_dirs().sort_stats("cumulative").print_stats(limit)
+        return out.getvalue()
+
+
+def create_profiler(mode: str, interval_ms: Optional[float] = None, include_idle: bool = False):
+    if mode == MODE_SAMPLING:
+        return SamplingProfiler((interval_ms or PROFILE_SAMPLE_INTERVAL_MS) / 1000.0, include_idle)
+    if mode == MODE_CPROFILE:
+        return DeterministicProfiler()
+    raise ValueError(f"mode must be one of {', '.join(MODES)}")
+
+
+def acquire():
+    if not _lock.acquire(blocking=False):
+        raise ProfilerBusy("Another profile is already running")
+
+
+def release():
+    _lock.release()
+
+
+def render(profiler, fmt: Optional[str] = None) -> Response:
+    """把剖析结果转成 HTTP 响应"""
+    mode = MODE_SAMPLING if isinstance(profiler, SamplingProfiler) else MODE_CPROFILE
+    fmt = fmt or FORMATS[mode][0]
+    if fmt not in FORMATS[mode]:
+        return JSONResponse(status_code=400, content={"detail": f"format for {mode} must be one of {', '.join(FORMATS[mode])}"})
+    if fmt == "collapsed":
+        return Response(content=profiler.collapsed(), media_type="text/plain; charset=utf-8")
+    if fmt == "pstats":
+        return Response(
+            content=profiler.pstats(),
+            media_type="application/octet-stream",
+            headers={"Content-Disposition": 'attachment; filename="profile.pstats"'},
+        )
+    return Response(content=profiler.text(), media_type="text/plain; charset=utf-8")
+
+
+async def profile_for(seconds: float, mode: str, interval_ms: Optional[float] = None, include_idle: bool = False):
+    """剖析接下来 seconds 秒（在事件循环中等待，不阻塞其他请求）"""
+    profiler = create_profiler(mode, interval_ms, include_idle)
+    acquire()
+    try:
+        profiler.start()
+        try:
+            await asyncio.sleep(min(seconds, PROFILE_MAX_SECONDS))
+        finally:
+            profiler.stop()
+    finally:
+        release()
+    return profiler
+
+
+# ============================================================================
+# 单个请求的剖析（X-Profile 请求头）
+# ============================================================================
+
+_results: "OrderedDict[str, Tuple[object, str, float]]" = OrderedDict()  # id -> (profiler, 请求, 耗时 ms)
+
+
+def get_result(profile_id: str):
+    return _results.get(profile_id)
+
+
+async def profile_requests(request: Request, call_next):
+    """HTTP 中间件：带 X-Profile 请求头和有效管理员令牌的请求被单独剖析"""
+    mode = request.headers.get("x-profile")
+    if not mode:
+        return await call_next(request)
+    if not admin_token_valid(request.headers.get("x-admin-token")):
+        return JSONResponse(status_code=403, content={"detail": "X-Profile requires a valid X-Admin-Token"})
+    mode = mode.strip().lower()
+    if mode in ("1", "true"):
+        mode = MODE_CPROFILE
+    try:
+        profiler = create_profiler(mode)
+        acquire()
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"detail": str(e)})
+    except ProfilerBusy as e:
+        return JSONResponse(status_code=409, content={"detail": str(e)})
+    started = time.perf_counter()
+    try:
+        profiler.start()
+        try:
+            response = await call_next(request)
+        finally:
+            profiler.stop()
+    finally:
+        release()
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    profile_id = uuid.uuid4().hex[:16]
+    _results[profile_id] = (profiler, f"{request.method} {request.url.path}", elapsed_ms)
+    while len(_results) > PROFILE_KEEP:
+        _results.popitem(last=False)
+    response.headers["X-Profile-Id"] = profile_id
+    print(f"🔹 已剖析 {request.method} {request.url.path}（{mode}，{elapsed_ms:.1f} ms），结果 ID: {profile_id}")
+    return response
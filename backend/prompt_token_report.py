@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+提示词 token 数对比：旧的冗长英文提示词 vs prompts.py 中的紧凑模板 + 结构化输出
+
+用法：
+    python prompt_token_report.py
+
+安装了 tiktoken 时使用 o200k_base 编码精确计数，否则按约 4 个字符 1 个 token 估算。
+输出 token 用同一份计划/子任务分别按旧格式和紧凑格式序列化后计数。
+"""
+import json
+from datetime import date, timedelta
+from types import SimpleNamespace
+
+import prompts
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("o200k_base")
+
+    def count_tokens(text: str) -> int:
+        return len(_encoding.encode(text))
+
+    COUNTER = "tiktoken o200k_base"
+except ImportError:
+    def count_tokens(text: str) -> int:
+        return max(1, round(len(text) / 4))
+
+    COUNTER = "approx (chars / 4)"
+
+LEGACY_SYSTEM_PROMPT = "You are a professional learning and work planning assistant. Always return valid JSON format data."
+
+
+def legacy_subtasks_prompt(task, request):
+    """旧版 generate_subtasks 的提示词（原样保留用于对比）"""
+    deadline_str = request.deadline if request.deadline else "No deadline (long-term task)"
+    max_subtasks_note = ""
+    if request.max_subtasks is not None and request.max_subtasks > 0:
+        max_subtasks_note = f"\nImportant: Generate at most {request.max_subtasks} subtasks. If the task is simple, you can generate only 1 subtask, or even treat the entire task as a single subtask."
+
+    prompt = f"""As a professional learning and work planning assistant, please generate a detailed list of subtasks based on the following task description.
+
+Task Name: {task.task_name}
+Task Description: {request.description}
+Deadline: {deadline_str}
+Is Long-term Task: {'Yes' if request.is_long_term else 'No'}{max_subtasks_note}
+
+Requirements:
+1. Carefully analyze the task description and identify all subtasks that need to be completed
+2. Break down the task description into specific, executable subtasks
+3. Estimate the time required to complete each subtask (in hours), with reasonable estimates
+4. Subtasks should be specific and clear, easy to execute
+5. If the task is large, it can be split into multiple subtasks
+6. If a maximum number of subtasks is specified, strictly adhere to the limit and do not exceed it
+7. If the task is very simple or the user explicitly indicates they only need a few subtasks, reduce the number of subtasks, or even treat the entire task as a single subtask
+8. Return JSON format as follows:
+{{
+  "subtasks": [
+    {{"name": "Subtask 1", "estimated_hours": 2.0}},
+    {{"name": "Subtask 2", "estimated_hours": 3.5}},
+    {{"name": "Subtask 3", "estimated_hours": 1.0}}
+  ]
+}}
+
+Return only the JSON object, no other explanatory text. Ensure estimated_hours is a numeric type."""
+    return prompt
+
+
+def legacy_plan_prompt(task, start_date, end_date):
+    """旧版 generate_plan 的提示词（原样保留用于对比）"""
+    subtasks_info = [
+        f"{st.subtask_name} (estimated {st.estimated_hours} hours)"
+        for st in task.subtasks
+    ]
+    
+    prompt = f"""As a professional learning and work planning assistant, please generate a detailed daily plan for the following task.
+
+Task Name: {task.task_name}
+Task Description: {task.description}
+Task Importance: {task.importance}
+Is Long-term Task: {'Yes' if task.is_long_term else 'No'}
+{'Deadline: ' + task.deadline.isoformat() if task.deadline else ''}
+
+Subtask List (numbered in order):
+{chr(10).join([f"{i+1}. {info}" for i, info in enumerate(subtasks_info)])}
+
+Requirements:
+1. Generate a daily plan from {start_date.isoformat()} to {'the next 30 days' if task.is_long_term else end_date.isoformat()}
+2. **Important: Multiple subtasks can be allocated per day**, for example, you can review PPT and MP on the same day, or review PPT and WA on the same day
+3. Reasonably allocate each subtask to different dates, ensuring all subtasks are completed before the deadline
+4. If there are many tasks or the time is long, a subtask can be split across multiple days
+5. Ensure daily workload is balanced (recommended 2-4 hours per day), adjust task allocation based on importance
+6. Long-term tasks should allocate a small amount of time daily (1-2 hours) to maintain continuity
+7. Allocated hours should be reasonable and not exceed the subtask's estimated_hours
+8. Try to make multiple subtasks per day work well together, for example, related tasks can be placed on the same day
+9. Return JSON format as follows:
+{{
+  "plan": [
+    {{"date": "YYYY-MM-DD", "subtask_id": 1, "allocated_hours": 2.0, "subtask_name": "Subtask 1"}},
+    {{"date": "YYYY-MM-DD", "subtask_id": 2, "allocated_hours": 1.5, "subtask_name": "Subtask 2"}},
+    {{"date": "YYYY-MM-DD", "subtask_id": 1, "allocated_hours": 1.0, "subtask_name": "Subtask 1"}},
+    {{"date": "YYYY-MM-DD", "subtask_id": 3, "allocated_hours": 1.5, "subtask_name": "Subtask 3"}}
+  ]
+}}
+
+Notes:
+- **Multiple subtasks can be allocated per day**, for example, subtask_id 1 and subtask_id 2 can be on the same day
+- subtask_id corresponds to the subtask's sequential number (starting from 1)
+- subtask_name is the name of the subtask (for verification)
+- allocated_hours is the allocated time (in hours), recommended total time per day is 2-4 hours
+- Date format must be YYYY-MM-DD
+- Ensure all subtasks are allocated in the plan
+
+Return only the JSON object, no other explanatory text."""
+    return prompt
+
+
+def main():
+    start_date = date(2025, 12, 1)
+    end_date = date(2025, 12, 14)
+    days = (end_date - start_date).days + 1
+    subtask_rows = [
+        ("Review lecture slides (PPT)", 3.0),
+        ("Redo written assignments (WA)", 2.5),
+        ("Review machine problems (MP)", 2.0),
+        ("Do practice quiz", 1.5),
+    ]
+    task = SimpleNamespace(
+        task_name="CS421 Midterm3",
+        description="Prepare for CS421 midterm 3: review PPT, review WA, review MP, do the practice quiz",
+        importance="high",
+        is_long_term=False,
+        deadline=end_date,
+        subtasks=[SimpleNamespace(subtask_name=n, estimated_hours=h) for n, h in subtask_rows],
+    )
+    request = SimpleNamespace(
+        description=task.description,
+        deadline=end_date.isoformat(),
+        is_long_term=False,
+        max_subtasks=None,
+    )
+
+    # 输入 token
+    legacy_sub_in = count_tokens(LEGACY_SYSTEM_PROMPT) + count_tokens(legacy_subtasks_prompt(task, request))
+    new_sub_messages = prompts.subtasks_messages(task.task_name, request.description, request.deadline, False)
+    new_sub_static = count_tokens(new_sub_messages[0]["content"])
+    new_sub_in = new_sub_static + count_tokens(new_sub_messages[1]["content"])
+
+    legacy_plan_in = count_tokens(LEGACY_SYSTEM_PROMPT) + count_tokens(legacy_plan_prompt(task, start_date, end_date))
+    new_plan_messages = prompts.plan_messages(
+        task.task_name, task.description, task.importance, start_date, days, subtask_rows
+    )
+    new_plan_static = count_tokens(new_plan_messages[0]["content"])
+    new_plan_in = new_plan_static + count_tokens(new_plan_messages[1]["content"])
+
+    # 输出 token（同一份结果的两种序列化）
+    legacy_sub_out = count_tokens(json.dumps(
+        {"subtasks": [{"name": n, "estimated_hours": h} for n, h in subtask_rows]}, indent=2
+    ))
+    new_sub_out = count_tokens(json.dumps(
+        {"s": [{"n": n, "h": h} for n, h in subtask_rows]}, separators=(",", ":")
+    ))
+    schedule = [(i % days, no, 1.5) for i, no in enumerate([1, 1, 2, 2, 3, 3, 4, 1, 2])]
+    legacy_plan_out = count_tokens(json.dumps({"plan": [
+        {
+            "date": (start_date + timedelta(days=d)).isoformat(),
+            "subtask_id": no,
+            "allocated_hours": h,
+            "subtask_name": subtask_rows[no - 1][0],
+        }
+        for d, no, h in schedule
+    ]}, indent=2))
+    new_plan_out = count_tokens(json.dumps({"p": [list(row) for row in schedule]}, separators=(",", ":")))
+
+    print(f"Token counter: {COUNTER}\n")
+    print(f"{'':<22}{'legacy':>8}{'compact':>9}{'saved':>8}   static prefix")
+    rows = [
+        ("subtasks input", legacy_sub_in, new_sub_in, new_sub_static),
+        ("subtasks output", legacy_sub_out, new_sub_out, None),
+        ("plan input", legacy_plan_in, new_plan_in, new_plan_static),
+        ("plan output", legacy_plan_out, new_plan_out, None),
+    ]
+    for name, legacy, new, static in rows:
+        saved = f"{(1 - new / legacy) * 100:.0f}%"
+        static_str = f"{static} tokens" if static is not None else ""
+        print(f"{name:<22}{legacy:>8}{new:>9}{saved:>8}   {static_str}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,350 @@
+"""
+LLM 提示词模板与结构化输出
+
+- 固定的说明放在 system 消息中，作为每次调用都完全相同的静态前缀，便于服务端的 prompt caching
+- 用户消息只包含本次任务的数据，使用紧凑的 key: value 行格式
+- 通过 JSON Schema（structured outputs）约束返回格式，字段名使用短名以减少输出 token：
+    子任务：{"s": [{"n": 名称, "h": 小时}]}
+    计划：  {"p": [[第几天(从0开始), 子任务序号(从1开始), 小时], ...]}
+- 解析函数同时兼容旧的冗长格式（subtasks/name/estimated_hours、plan/date/subtask_id），
+  遇到 markdown 代码块或多余文本时尽量恢复，无法解析时抛出 LLMParseError
+"""
+import json
+import re
+from datetime import date, timedelta
+from typing import Dict, List, Optional, Sequence, Tuple
+
+
+class LLMParseError(ValueError):
+    """LLM 返回内容无法解析"""
+
+
+# ============================================================================
+# 子任务生成
+# ============================================================================
+
+SUBTASKS_SYSTEM_PROMPT = """You are a learning and work planning assistant. Break the user's task into concrete, executable subtasks and estimate hours for each.
+Rules:
+- Identify every piece of work in the description; each subtask is specific and actionable.
+- Split large tasks into several subtasks; simple tasks may be a single subtask.
+- If "max" is given, return at most that many subtasks.
+- Hours are realistic numbers (e.g. 0.5, 1, 2.5).
+Input lines: task, desc, deadline (or "none" for long-term), long_term (y/n), optional max.
+Output JSON only: {"s":[{"n":"<subtask name>","h":<hours>}]}"""
+
+SUBTASKS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "s": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "n": {"type": "string"},
+                    "h": {"type": "number"},
+                },
+                "required": ["n", "h"],
+                "additionalProperties": False,
+            },
+        },
+    },
+    "required": ["s"],
+    "additionalProperties": False,
+}
+
+SUBTASKS_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "subtasks", "strict": True, "schema": SUBTASKS_SCHEMA},
+}
+
+
+def subtasks_messages(
+    task_name: str,
+    description: str,
+    deadline: Optional[str],
+    is_long_term: bool,
+    max_subtasks: Optional[int] = None,
+) -> List[dict]:
+    """构造子任务生成的消息列表"""
+    lines = [
+        f"task: {task_name}",
+        f"desc: {description}",
+        f"deadline: {deadline or 'none'}",
+        f"long_term: {'y' if is_long_term else 'n'}",
+    ]
+    if max_subtasks:
+        lines.append(f"max: {max_subtasks}")
+    return [
+        {"role": "system", "content": SUBTASKS_SYSTEM_PROMPT},
+        {"role": "user", "content": "\n".join(lines)},
+    ]
+
+
+def parse_subtasks(content: str) -> List[Tuple[str, float]]:
+    """解析子任务返回内容，返回 [(名称, 小时), ...]"""
+    data = _load_json(content)
+    items = data.get("s")
+    if items is None:
+        items = data.get("subtasks", [])
+    result = []
+    for item in items or []:
+        if not isinstance(item, dict):
+            continue
+        name = item.get("n", item.get("name"))
+        if not name:
+            continue
+        try:
+            hours = float(item.get("h", item.get("estimated_hours", 0.0)) or 0.0)
+        except (TypeError, ValueError):
+            hours = 0.0
+        result.append((str(name).strip(), max(0.0, hours)))
+    return result
+
+
+# ============================================================================
+# 每日计划生成
+# ============================================================================
+
+PLAN_SYSTEM_PROMPT = """You are a learning and work planning assistant. Schedule the user's subtasks into a daily plan.
+Rules:
+- Every subtask must be fully scheduled within days 0..days-1 (day 0 = start date).
+- Several subtasks may share a day; a subtask may be split across days. Group related subtasks on the same day when sensible.
+- Keep daily totals balanced, about 2-4 hours; prioritize by importance.
+- If "cap" is given, the user's total per day is at most cap hours; "busy" lists hours already taken by other tasks as "<day>:<hours>" pairs, so prefer days with free capacity.
+- Hours per subtask should add up to its estimate and never exceed it.
+Input lines: task, desc, importance, start (YYYY-MM-DD), days, optional cap and busy, then one subtask per line as "<no>|<name>|<hours>".
+Output JSON only: {"p":[[day,no,hours],...]} where day is the 0-based day index, no is the subtask number, hours is a number."""
+
+PLAN_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "p": {
+            "type": "array",
+            "items": {"type": "array", "items": {"type": "number"}},
+        },
+    },
+    "required": ["p"],
+    "additionalProperties": False,
+}
+
+PLAN_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "plan", "strict": True, "schema": PLAN_SCHEMA},
+}
+
+
+def plan_messages(
+    task_name: str,
+    description: str,
+    importance: str,
+    start_date: date,
+    days: int,
+    subtasks: Sequence[Tuple[str, float]],
+    daily_cap: Optional[float] = None,
+    busy: Optional[Dict[date, float]] = None,
+) -> List[dict]:
+    """
+    构造每日计划生成的消息列表；subtasks 的顺序即子任务序号（从 1 开始）
+    busy: {日期: 其他任务已占用的小时}，只输出有占用的日期
+    """
+    lines = [
+        f"task: {task_name}",
+        f"desc: {description}",
+        f"importance: {importance}",
+        f"start: {start_date.isoformat()}",
+        f"days: {days}",
+    ]
+    if daily_cap:
+        lines.append(f"cap: {_format_hours(daily_cap)}")
+    busy_pairs = _busy_pairs(start_date, days, busy)
+    if busy_pairs:
+        lines.append(f"busy: {busy_pairs}")
+    lines.extend(
+        f"{number}|{_one_line(name)}|{_format_hours(hours)}"
+        for number, (name, hours) in enumerate(subtasks, start=1)
+    )
+    return [
+        {"role": "system", "content": PLAN_SYSTEM_PROMPT},
+        {"role": "user", "content": "\n".join(lines)},
+    ]
+
+
+def parse_plan(content: str, start_date: date, days: int) -> List[dict]:
+    """
+    解析计划返回内容
+    Returns:
+        [{"date": date, "subtask_no": 子任务序号(从1开始), "allocated_hours": float,
+          "subtask_name": 名称或 None}, ...]
+        超出日期范围或格式错误的条目会被跳过
+    """
+    data = _load_json(content)
+    end_date = start_date + timedelta(days=max(1, days) - 1)
+    result = []
+
+    for entry in data.get("p") or []:
+        if not isinstance(entry, (list, tuple)) or len(entry) < 3:
+            continue
+        try:
+            day, number, hours = int(entry[0]), int(entry[1]), float(entry[2])
+        except (TypeError, ValueError):
+            continue
+        if not 0 <= day < days or hours <= 0:
+            continue
+        result.append({
+            "date": start_date + timedelta(days=day),
+            "subtask_no": number,
+            "allocated_hours": hours,
+            "subtask_name": None,
+        })
+
+    # 兼容旧格式
+    for entry in data.get("plan") or []:
+        if not isinstance(entry, dict):
+            continue
+        try:
+            plan_date = date.fromisoformat(str(entry["date"]))
+            hours = float(entry.get("allocated_hours", 0.0))
+            number = int(entry.get("subtask_id", 0))
+        except (KeyError, TypeError, ValueError):
+            continue
+        if not start_date <= plan_date <= end_date or hours <= 0:
+            continue
+        result.append({
+            "date": plan_date,
+            "subtask_no": number,
+            "allocated_hours": hours,
+            "subtask_name": entry.get("subtask_name"),
+        })
+    return result
+
+
+# ============================================================================
+# 多任务批量计划生成（一次调用规划同一用户的多个任务）
+# ============================================================================
+
+BATCH_PLAN_SYSTEM_PROMPT = """You are a learning and work planning assistant. Schedule subtasks of several tasks into one shared daily plan.
+Rules:
+- Day 0 is the start date. Each task may only use days first..last given on its line.
+- Every subtask must be fully scheduled; a subtask may be split across days and several subtasks may share a day.
+- The user's total hours per day are shared by all tasks: keep each day at most "cap" hours and balanced across days. "busy" lists hours already taken by other plans as "<day>:<hours>" pairs.
+- Earlier deadlines and higher importance get scheduled first.
+- Hours per subtask should add up to its estimate and never exceed it.
+Input lines: start (YYYY-MM-DD), days, cap, optional busy, then per task "T|<task no>|<name>|<importance>|<first>|<last>" followed by its subtasks as "<task no>.<subtask no>|<name>|<hours>".
+Output JSON only: {"p":[[day,task,subtask,hours],...]} with 0-based day index, task number and subtask number."""
+
+BATCH_PLAN_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "batch_plan", "strict": True, "schema": PLAN_SCHEMA},
+}
+
+
+def batch_plan_messages(
+    start_date: date,
+    days: int,
+    daily_cap: float,
+    tasks: Sequence[dict],
+    busy: Optional[Dict[date, float]] = None,
+) -> List[dict]:
+    """
+    构造批量计划的消息列表
+    Args:
+        tasks: [{"name", "importance", "first_day", "last_day", "subtasks": [(名称, 小时), ...]}, ...]
+               列表顺序即任务序号（从 1 开始）
+        busy: {日期: 已占用的小时}
+    """
+    lines = [
+        f"start: {start_date.isoformat()}",
+        f"days: {days}",
+        f"cap: {_format_hours(daily_cap)}",
+    ]
+    busy_pairs = _busy_pairs(start_date, days, busy)
+    if busy_pairs:
+        lines.append(f"busy: {busy_pairs}")
+    for task_no, task in enumerate(tasks, start=1):
+        lines.append(
+            f"T|{task_no}|{_one_line(task['name'])}|{task['importance']}|{task['first_day']}|{task['last_day']}"
+        )
+        lines.extend(
+            f"{task_no}.{number}|{_one_line(name)}|{_format_hours(hours)}"
+            for number, (name, hours) in enumerate(task["subtasks"], start=1)
+        )
+    return [
+        {"role": "system", "content": BATCH_PLAN_SYSTEM_PROMPT},
+        {"role": "user", "content": "\n".join(lines)},
+    ]
+
+
+def parse_batch_plan(content: str, start_date: date, days: int) -> List[dict]:
+    """
+    解析批量计划返回内容
+    Returns:
+        [{"date": date, "task_no": 任务序号, "subtask_no": 子任务序号, "allocated_hours": float}, ...]
+    """
+    data = _load_json(content)
+    result = []
+    for entry in data.get("p") or []:
+        if not isinstance(entry, (list, tuple)) or len(entry) < 4:
+            continue
+        try:
+            day, task_no, number, hours = int(entry[0]), int(entry[1]), int(entry[2]), float(entry[3])
+        except (TypeError, ValueError):
+            continue
+        if not 0 <= day < days or hours <= 0:
+            continue
+        result.append({
+            "date": start_date + timedelta(days=day),
+            "task_no": task_no,
+            "subtask_no": number,
+            "allocated_hours": hours,
+        })
+    return result
+
+
+# ============================================================================
+# 工具函数
+# ============================================================================
+
+_FENCE_RE = re.compile(r"^```(?:json)?\s*|\s*```$")
+
+
+def _load_json(content: Optional[str]) -> dict:
+    """解析 JSON 对象，容忍 markdown 代码块和前后多余文本"""
+    if not content:
+        raise LLMParseError("Empty LLM response")
+    text = _FENCE_RE.sub("", content.strip()).strip()
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError:
+        start, end = text.find("{"), text.rfind("}")
+        if start < 0 or end <= start:
+            raise LLMParseError(f"LLM response is not JSON: {text[:200]}")
+        try:
+            data = json.loads(text[start:end + 1])
+        except json.JSONDecodeError as e:
+            raise LLMParseError(f"Failed to parse LLM response: {str(e)}")
+    if not isinstance(data, dict):
+        raise LLMParseError("LLM response is not a JSON object")
+    return data
+
+
+def _one_line(text: str) -> str:
+    return " ".join(str(text).replace("|", "/").split())
+
+
+def _format_hours(hours: float) -> str:
+    return f"{float(hours):g}"
+
+
+def _busy_pairs(start_date: date, days: int, busy: Optional[Dict[date, float]]) -> str:
+    """{日期: 小时} -> "第几天:小时,..."（只包含窗口内有占用的日期）"""
+    pairs = []
+    for day, hours in sorted((busy or {}).items()):
+        offset = (day - start_date).days
+        if 0 <= offset < days and hours > 1e-9:
+            pairs.append(f"{offset}:{round(hours, 2):g}")
+    return ",".join(pairs)
+
+
+def messages_text(messages: Sequence[dict]) -> str:
+    """消息内容拼接（用于估计 token 数）"""
+    return "\n".join(m["content"] for m in messages)
@@ -0,0 +1,326 @@
+"""
+任务和子任务的全文搜索
+
+- 每个任务（task_name + description）和子任务（subtask_name + description）是一条文档，
+  文档 ID 为 entity_id * 2 + (0 任务 / 1 子任务)
+- 中文没有空格分词，入库和查询时都把连续的中日韩字符切成重叠的二元组（"复习资料" -> 复习 习资 资料），
+  查询词按短语匹配二元组，英文和数字按前缀匹配
+- 索引词带用户前缀（"u42#复习"），每个用户的倒排列表是独立的：常见词在百万级文档中也只读取该用户的文档，
+  相关度统计也按用户计算
+- SQLite：FTS5 虚拟表 search_fts，bm25 排序（名称权重 10，描述 1）
+- PostgreSQL：search_documents 表的 tsv 列（由 Python 生成带位置和权重的 tsvector，名称 A、描述 B）+ GIN 索引，
+  ts_rank_cd 排序
+- 通过 after_flush 事件在同一个事务中维护索引（新增、改名、改描述、删除，包括级联删除的子任务）
+- SQLite 没有编译 FTS5 时退回 LIKE 查询（不排序，只适合小数据量）
+"""
+import re
+import unicodedata
+from typing import Iterable, List, Optional, Tuple
+
+from sqlalchemy import bindparam, event, text
+from sqlalchemy.orm import Session
+
+from models import Subtask, Task
+
+KIND_TASK = 0
+KIND_SUBTASK = 1
+KIND_NAMES = {KIND_TASK: "task", KIND_SUBTASK: "subtask"}
+BACKFILL_BATCH_SIZE = 2000
+
+_CJK = "぀-ヿ㐀-䶿一-鿿豈-﫿가-힯"
+_TOKEN_RE = re.compile(f"[{_CJK}]+|[^\\W{_CJK}]+")
+_CJK_RE = re.compile(f"[{_CJK}]")
+
+# 数据库方言和 FTS5 是否可用，由 ensure_search_index() 在启动迁移时确定
+_state = {"dialect": None, "fts": False}
+
+
+def search_tokens(value: str) -> List[str]:
+    """把文本切成索引用的词：英文、数字按单词，中日韩字符按重叠二元组"""
+    tokens = []
+    for run in _TOKEN_RE.findall(unicodedata.normalize("NFKC", value or "").lower()):
+        if _CJK_RE.match(run):
+            if len(run) == 1:
+                tokens.append(run)
+            else:
+                tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.append(run)
+    return tokens
+
+
+def _scoped(user_id: int, token: str) -> str:
+    return f"u{user_id}#{token}"
+
+
+def doc_id(kind: int, entity_id: int) -> int:
+    return entity_id * 2 + kind
+
+
+def _query_terms(query: str) -> List[Tuple[List[str], bool]]:
+    """查询的每个词 -> (索引词列表, 是否前缀匹配)；多个词之间是 AND"""
+    terms = []
+    for word in (query or "").split():
+        tokens = search_tokens(word)
+        if not tokens:
+            continue
+        # 单个英文词或单个汉字按前缀匹配，多个索引词按短语匹配
+        terms.append((tokens, len(tokens) == 1))
+    return terms
+
+
+def _fts5_query(user_id: int, terms) -> str:
+    parts = []
+    for tokens, prefix in terms:
+        phrase = '"' + " ".join(_scoped(user_id, token) for token in tokens) + '"'
+        parts.append(phrase + "*" if prefix else phrase)
+    return " AND ".join(parts)
+
+
+def _tsquery(user_id: int, terms) -> str:
+    parts = []
+    for tokens, prefix in terms:
+        if prefix:
+            parts.append(f"'{_scoped(user_id, tokens[0])}':*")
+        else:
+            parts.append("(" + " <-> ".join(f"'{_scoped(user_id, token)}'" for token in tokens) + ")")
+    return " & ".join(parts)
+
+
+def _tsvector_literal(user_id: int, title: str, body: str) -> str:
+    """带位置和权重的 tsvector 字面量（索引词不经过 PostgreSQL 的分词器，用户前缀中的 # 不会被拆开）"""
+    lexemes = {}
+    position = 1
+    for value, weight in ((title, "A"), (body, "B")):
+        for token in search_tokens(value):
+            if position > 16383:
+                break
+            lexemes.setdefault(_scoped(user_id, token), []).append(f"{position}{weight}")
+            position += 1
+        position += 1  # 名称和描述之间隔开，短语不会跨字段匹配
+    return " ".join(f"'{lexeme}':{','.join(positions)}" for lexeme, positions in lexemes.items())
+
+
+# ============================================================================
+# 索引结构
+# ============================================================================
+
+def ensure_search_index(engine) -> bool:
+    """创建索引结构，索引为空而已有任务时回填；返回是否新建"""
+    _state["dialect"] = engine.dialect.name
+    created = False
+    with engine.begin() as conn:
+        if engine.dialect.name == "postgresql":
+            conn.execute(text(
+                "CREATE TABLE IF NOT EXISTS search_documents ("
+                "doc_id BIGINT PRIMARY KEY, kind SMALLINT NOT NULL, entity_id INTEGER NOT NULL, "
+                "user_id INTEGER NOT NULL, task_id INTEGER NOT NULL, tsv TSVECTOR NOT NULL)"
+            ))
+            conn.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_search_documents_tsv ON search_documents USING GIN (tsv)"
+            ))
+            conn.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_search_documents_user ON search_documents (user_id)"
+            ))
+            _state["fts"] = True
+        elif engine.dialect.name == "sqlite":
+            try:
+                conn.execute(text(
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5("
+                    "title, body, kind UNINDEXED, entity_id UNINDEXED, task_id UNINDEXED, "
+                    "tokenize = \"unicode61 remove_diacritics 2 tokenchars '#'\")"
+                ))
+                _state["fts"] = True
+            except Exception as e:
+                print(f"⚠️  SQLite 不支持 FTS5，搜索退回 LIKE 查询: {str(e)}")
+                _state["fts"] = False
+                return False
+        else:
+            return False
+
+    table = "search_documents" if engine.dialect.name == "postgresql" else "search_fts"
+    with engine.begin() as conn:
+        empty = conn.execute(text(f"SELECT 1 FROM {table} LIMIT 1")).first() is None
+        has_tasks = conn.execute(text("SELECT 1 FROM tasks LIMIT 1")).first() is not None
+        if empty and has_tasks:
+            print("🔹 正在建立全文搜索索引...")
+            count = _backfill(conn)
+            print(f"✅ 全文搜索索引已建立（{count} 条文档）")
+            created = True
+    return created
+
+
+def _backfill(conn) -> int:
+    count = 0
+    for kind, sql in (
+        (KIND_TASK, "SELECT id, user_id, id, task_name, description FROM tasks WHERE id > :after ORDER BY id LIMIT :limit"),
+        (KIND_SUBTASK, "SELECT s.id, t.user_id, s.task_id, s.subtask_name, s.description FROM subtasks s "
+                       "JOIN tasks t ON t.id = s.task_id WHERE s.id > :after ORDER BY s.id LIMIT :limit"),
+    ):
+        after = 0
+        while True:
+            rows = conn.execute(text(sql), {"after": after, "limit": BACKFILL_BATCH_SIZE}).all()
+            if not rows:
+                break
+            _write_documents(conn, [(kind,) + tuple(row) for row in rows])
+            count += len(rows)
+            after = rows[-1][0]
+    return count
+
+
+def _write_documents(conn, documents: Iterable[tuple]):
+    """写入或替换文档：(kind, entity_id, user_id, task_id, title, body)"""
+    documents = list(documents)
+    if not documents or not _state["fts"]:
+        return
+    if _state["dialect"] == "postgresql":
+        conn.execute(text(
+            "INSERT INTO search_documents (doc_id, kind, entity_id, user_id, task_id, tsv) VALUES ("
+            ":doc_id, :kind, :entity_id, :user_id, :task_id, CAST(:tsv AS tsvector)) "
+            "ON CONFLICT (doc_id) DO UPDATE SET user_id = EXCLUDED.user_id, task_id = EXCLUDED.task_id, tsv = EXCLUDED.tsv"
+        ), [_document_params(document) for document in documents])
+    else:
+        _delete_documents(conn, [(kind, entity_id) for kind, entity_id, *_ in documents])
+        conn.execute(text(
+            "INSERT INTO search_fts (rowid, title, body, kind, entity_id, task_id) "
+            "VALUES (:doc_id, :title, :body, :kind, :entity_id, :task_id)"
+        ), [_document_params(document) for document in documents])
+
+
+def _document_params(document: tuple) -> dict:
+    kind, entity_id, user_id, task_id, title, body = document
+    params = {"doc_id": doc_id(kind, entity_id), "kind": kind, "entity_id": entity_id, "task_id": task_id}
+    if _state["dialect"] == "postgresql":
+        params["user_id"] = user_id
+        params["tsv"] = _tsvector_literal(user_id, title, body)
+    else:
+        params["title"] = " ".join(_scoped(user_id, token) for token in search_tokens(title))
+        params["body"] = " ".join(_scoped(user_id, token) for token in search_tokens(body))
+    return params
+
+
+def _delete_documents(conn, keys: Iterable[Tuple[int, int]]):
+    doc_ids = [{"doc_id": doc_id(kind, entity_id)} for kind, entity_id in keys]
+    if not doc_ids or not _state["fts"]:
+        return
+    table, column = ("search_documents", "doc_id") if _state["dialect"] == "postgresql" else ("search_fts", "rowid")
+    conn.execute(text(f"DELETE FROM {table} WHERE {column} = :doc_id"), doc_ids)
+
+
+# ============================================================================
+# 写入时维护
+# ============================================================================
+
+_INDEXED_FIELDS = {Task: ("task_name", "description"), Subtask: ("subtask_name", "description")}
+
+
+def _text_changed(session: Session, obj) -> bool:
+    if obj in session.new:
+        return True
+    state = obj._sa_instance_state
+    return any(state.attrs[key].history.has_changes() for key in _INDEXED_FIELDS[type(obj)])
+
+
+@event.listens_for(Session, "before_flush")
+def _collect_search_changes(session, flush_context, instances):
+    if not _state["fts"]:
+        return
+    upserts = session.info.setdefault("search_upserts", [])
+    deletes = session.info.setdefault("search_deletes", set())
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, (Task, Subtask)) and obj not in session.deleted and _text_changed(session, obj):
+            upserts.append(obj)
+    with session.no_autoflush:
+        for obj in list(session.deleted):
+            if isinstance(obj, Task):
+                deletes.add((KIND_TASK, obj.id))
+                deletes.update((KIND_SUBTASK, subtask.id) for subtask in obj.subtasks)
+            elif isinstance(obj, Subtask):
+                deletes.add((KIND_SUBTASK, obj.id))
+
+
+@event.listens_for(Session, "after_flush")
+def _apply_search_changes(session, flush_context):
+    upserts = session.info.pop("search_upserts", None)
+    deletes = session.info.pop("search_deletes", None)
+    if not upserts and not deletes:
+        return
+    conn = session.connection()
+    if deletes:
+        _delete_documents(conn, deletes)
+    if not upserts:
+        return
+    # 子任务的文档需要所属用户
+    task_ids = {obj.task_id for obj in upserts if isinstance(obj, Subtask) and obj.task_id is not None}
+    owners = {}
+    if task_ids:
+        owners = dict(conn.execute(
+            text("SELECT id, user_id FROM tasks WHERE id IN :ids").bindparams(bindparam("ids", expanding=True)),
+            {"ids": list(task_ids)}
+        ).all())
+    documents = {}
+    for obj in upserts:
+        if obj.id is None:
+            continue
+        if isinstance(obj, Task):
+            documents[(KIND_TASK, obj.id)] = (KIND_TASK, obj.id, obj.user_id, obj.id, obj.task_name, obj.description)
+        elif obj.task_id in owners:
+            documents[(KIND_SUBTASK, obj.id)] = (
+                KIND_SUBTASK, obj.id, owners[obj.task_id], obj.task_id, obj.subtask_name, obj.description
+            )
+    _write_documents(conn, documents.values())
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_search_changes(session):
+    session.info.pop("search_upserts", None)
+    session.info.pop("search_deletes", None)
+
+
+# ============================================================================
+# 查询
+# ============================================================================
+
+def search_documents(db: Session, user_id: int, query: str, limit: int = 20, offset: int = 0) -> Optional[list]:
+    """
+    返回 [(kind, entity_id, task_id, score)]，按相关度降序；多取一条用于判断是否还有下一页
+    查询里没有可索引的词时返回 None
+    """
+    terms = _query_terms(query)
+    if not terms:
+        return None
+    params = {"limit": limit + 1, "offset": offset, "user_id": user_id}
+    if _state["fts"] and _state["dialect"] == "postgresql":
+        params["q"] = _tsquery(user_id, terms)
+        rows = db.execute(text(
+            "SELECT kind, entity_id, task_id, ts_rank_cd(tsv, q) AS score "
+            "FROM search_documents, CAST(:q AS tsquery) q "
+            "WHERE user_id = :user_id AND tsv @@ q "
+            "ORDER BY score DESC, doc_id DESC LIMIT :limit OFFSET :offset"
+        ), params).all()
+    elif _state["fts"]:
+        params["q"] = _fts5_query(user_id, terms)
+        # bm25 越小越相关；名称列权重 10，描述 1
+        rows = db.execute(text(
+            "SELECT kind, entity_id, task_id, -bm25(search_fts, 10.0, 1.0) AS score "
+            "FROM search_fts WHERE search_fts MATCH :q "
+            "ORDER BY bm25(search_fts, 10.0, 1.0), rowid DESC LIMIT :limit OFFSET :offset"
+        ), params).all()
+    else:
+        rows = _like_search(db, user_id, query, limit + 1, offset)
+    return [(int(kind), int(entity_id), int(task_id), float(score)) for kind, entity_id, task_id, score in rows]
+
+
+def _like_search(db: Session, user_id: int, query: str, limit: int, offset: int) -> list:
+    words = [word for word in (query or "").split() if word]
+    task_query = db.query(Task.id).filter(Task.user_id == user_id)
+    subtask_query = db.query(Subtask.id, Subtask.task_id).join(Task, Subtask.task_id == Task.id).filter(
+        Task.user_id == user_id
+    )
+    for word in words:
+        pattern = f"%{word}%"
+        task_query = task_query.filter(Task.task_name.ilike(pattern) | Task.description.ilike(pattern))
+        subtask_query = subtask_query.filter(Subtask.subtask_name.ilike(pattern) | Subtask.description.ilike(pattern))
+    rows = [(KIND_TASK, task_id, task_id, 1.0) for (task_id,) in task_query.order_by(Task.id.desc())]
+    rows += [(KIND_SUBTASK, sid, task_id, 1.0) for sid, task_id in subtask_query.order_by(Subtask.id.desc())]
+    return rows[offset:offset + limit]
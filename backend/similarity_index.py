@@ -0,0 +1,270 @@
+"""
+近似重复任务索引（MinHash + LSH，纯本地计算，不依赖网络）
+
+用户经常提交措辞略有不同的同一个任务（空格、标点、日期不同），精确匹配缓存无法命中。
+这里对 task_name + description 做归一化后取字符 n-gram，计算 MinHash 签名并按 LSH 分桶：
+
+- 归一化：NFKC、小写、日期和数字替换为占位符、去掉空白和标点
+- 签名：one-permutation hashing，每个 n-gram 只哈希一次（crc32），按哈希值分到 num_perm 个桶取最小值，
+  空桶从右侧相邻桶借值（densification），计算量与文本长度成线性关系
+- LSH：签名切成 bands 段，每段的哈希作为桶键；两个任务至少有一段完全相同才成为候选，
+  相似度阈值约为 (1/bands)^(1/rows)（默认 6x6，约 0.74）
+- 查询只比较候选的签名，估计 Jaccard 相似度，与索引规模基本无关（见 bench_similarity.py）
+
+索引只保存在当前进程内存中：应用启动后在线程池中从数据库加载已有子任务的任务（不阻塞事件循环，
+加载完成前查询不返回结果），加载期间和之后的写入由写路径增量更新。
+
+配置：
+    SIMILARITY_ENABLED       是否启用（默认 1）
+    SIMILARITY_THRESHOLD     认为是同一任务的最小相似度（默认 0.85）
+    SIMILARITY_SCOPE         user（只匹配同一用户的任务，默认）或 global（跨用户匹配：会把其他用户的子任务分解
+                             复制给当前用户，并在响应中返回对方的任务 ID，只适合单租户部署）
+"""
+import os
+import re
+import threading
+import time
+import unicodedata
+import zlib
+from array import array
+from typing import Dict, Iterable, List, Optional, Tuple
+
+_MASK32 = 0xFFFFFFFF
+_DATE_RE = re.compile(r"\d{2,4}[-/.年]\d{1,2}[-/.月]\d{1,4}日?")
+_NUMBER_RE = re.compile(r"\d+")
+_NOISE_RE = re.compile(r"[\W_]+", re.UNICODE)
+
+
+def normalize_text(text: str) -> str:
+    """归一化：忽略大小写、空白、标点，日期和数字替换为占位符"""
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    text = _DATE_RE.sub("#", text)
+    text = _NUMBER_RE.sub("0", text)
+    return _NOISE_RE.sub("", text)
+
+
+def shingles(text: str, n: int = 3) -> set:
+    """字符 n-gram 集合"""
+    if len(text) <= n:
+        return {text} if text else set()
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+def jaccard(a: Iterable, b: Iterable) -> float:
+    a, b = set(a), set(b)
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+class MinHashLSH:
+    """MinHash 签名 + LSH 分桶"""
+
+    def __init__(self, bands: int = 6, rows: int = 6, ngram: int = 3):
+        self.bands = bands
+        self.rows = rows
+        self.num_perm = bands * rows
+        self.ngram = ngram
+        self._signatures: Dict[int, array] = {}
+        self._owners: Dict[int, int] = {}
+        # 每个 band 一个 {桶键: 任务 ID 或任务 ID 列表}；大多数桶只有一个任务，不建列表以节省内存
+        self._buckets: List[Dict[int, object]] = [{} for _ in range(bands)]
+
+    def __len__(self):
+        return len(self._signatures)
+
+    def __contains__(self, key: int):
+        return key in self._signatures
+
+    def signature(self, text: str) -> array:
+        """计算归一化文本的 MinHash 签名"""
+        k = self.num_perm
+        mins = [_MASK32] * k
+        for gram in shingles(normalize_text(text), self.ngram):
+            h = zlib.crc32(gram.encode("utf-8"))
+            # 再混合一次，使分桶位和桶内取值互相独立
+            h = (h * 0x9E3779B1) & _MASK32
+            slot = h % k
+            value = h // k
+            if value < mins[slot]:
+                mins[slot] = value
+        # densification：空桶从右侧（循环）最近的非空桶借值
+        if _MASK32 in mins and any(v != _MASK32 for v in mins):
+            for i in range(k):
+                if mins[i] == _MASK32:
+                    offset = 1
+                    while mins[(i + offset) % k] == _MASK32:
+                        offset += 1
+                    mins[i] = (mins[(i + offset) % k] + offset * 0x9E3779B1) & _MASK32
+        return array("I", mins)
+
+    def _band_keys(self, signature: array):
+        rows = self.rows
+        for band in range(self.bands):
+            yield band, hash(tuple(signature[band * rows:(band + 1) * rows]))
+
+    def add(self, key: int, text: str, owner: Optional[int] = None):
+        """添加或更新一个任务"""
+        if key in self._signatures:
+            self.remove(key)
+        signature = self.signature(text)
+        self._signatures[key] = signature
+        if owner is not None:
+            self._owners[key] = owner
+        for band, band_key in self._band_keys(signature):
+            bucket = self._buckets[band]
+            existing = bucket.get(band_key)
+            if existing is None:
+                bucket[band_key] = key
+            elif isinstance(existing, list):
+                existing.append(key)
+            else:
+                bucket[band_key] = [existing, key]
+
+    def remove(self, key: int):
+        signature = self._signatures.pop(key, None)
+        self._owners.pop(key, None)
+        if signature is None:
+            return
+        for band, band_key in self._band_keys(signature):
+            bucket = self._buckets[band]
+            existing = bucket.get(band_key)
+            if isinstance(existing, list):
+                if key in existing:
+                    existing.remove(key)
+                if len(existing) == 1:
+                    bucket[band_key] = existing[0]
+            elif existing == key:
+                del bucket[band_key]
+
+    def query(
+        self,
+        text: str,
+        threshold: float = 0.0,
+        owner: Optional[int] = None,
+        exclude: Iterable[int] = (),
+        limit: int = 5,
+    ) -> List[Tuple[int, float]]:
+        """
+        查找相似任务
+        Returns:
+            [(任务 ID, 估计相似度), ...]，按相似度从高到低，只包含 >= threshold 的结果
+        """
+        signature = self.signature(text)
+        excluded = set(exclude)
+        candidates = set()
+        for band, band_key in self._band_keys(signature):
+            existing = self._buckets[band].get(band_key)
+            if existing is None:
+                continue
+            if isinstance(existing, list):
+                candidates.update(existing)
+            else:
+                candidates.add(existing)
+
+        results = []
+        k = self.num_perm
+        for key in candidates:
+            if key in excluded or (owner is not None and self._owners.get(key) != owner):
+                continue
+            other = self._signatures[key]
+            score = sum(1 for a, b in zip(signature, other) if a == b) / k
+            if score >= threshold:
+                results.append((key, score))
+        results.sort(key=lambda item: (-item[1], item[0]))
+        return results[:limit]
+
+
+def task_text(task_name: str, description: str) -> str:
+    return f"{task_name or ''} {description or ''}"
+
+
+class SimilarTaskIndex:
+    """
+    已分解任务（有子任务）的相似度索引
+    load() 从数据库加载（在线程池中执行），之后通过 add()/remove() 增量维护
+    """
+
+    def __init__(self, threshold: float = 0.85, scope: str = "user", enabled: bool = True):
+        self.threshold = threshold
+        self.scope = scope
+        self.enabled = enabled
+        self.lsh = MinHashLSH()
+        self._loaded = False
+        # 加载期间的 add/remove 先记下来，加载完成后按顺序重放
+        self._pending: List[tuple] = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            threshold=float(os.getenv("SIMILARITY_THRESHOLD", "0.85")),
+            scope=os.getenv("SIMILARITY_SCOPE", "user").lower(),
+            enabled=os.getenv("SIMILARITY_ENABLED", "1").lower() in ("1", "true", "yes", "on"),
+        )
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded
+
+    def load(self, session_factory):
+        """
+        从数据库加载所有有子任务的任务（阻塞，应用启动时在线程池中执行一次）
+        在新的索引上构建，完成后替换当前索引并重放加载期间的增量更新
+        """
+        if self._loaded or not self.enabled:
+            return
+        from models import Task
+        started = time.perf_counter()
+        lsh = MinHashLSH()
+        db = session_factory()
+        try:
+            rows = db.query(Task.id, Task.user_id, Task.task_name, Task.description).filter(
+                Task.subtasks.any()
+            ).yield_per(10000)
+            for task_id, user_id, task_name, description in rows:
+                lsh.add(task_id, task_text(task_name, description), owner=user_id)
+        except Exception as e:
+            # 加载失败时关闭相似任务匹配（生成子任务照常调用 LLM），不再积累增量更新
+            with self._lock:
+                self.enabled = False
+                self._pending = []
+            print(f"⚠️  相似任务索引加载失败，已关闭相似任务匹配: {str(e)}")
+            return
+        finally:
+            db.close()
+        with self._lock:
+            for operation, args in self._pending:
+                getattr(lsh, operation)(*args)
+            self._pending = []
+            self.lsh = lsh
+            self._loaded = True
+        print(f"✅ 相似任务索引已加载: {len(lsh)} 个任务，用时 {time.perf_counter() - started:.2f}s")
+
+    def find(self, task_name: str, description: str, user_id: int, exclude_task_id: int = None):
+        """返回最相似的 (任务 ID, 相似度)，没有超过阈值的任务或索引尚未加载完成时返回 None"""
+        if not self.enabled or not self._loaded:
+            return None
+        matches = self.lsh.query(
+            task_text(task_name, description),
+            threshold=self.threshold,
+            owner=user_id if self.scope == "user" else None,
+            exclude=[exclude_task_id] if exclude_task_id is not None else (),
+            limit=1,
+        )
+        return matches[0] if matches else None
+
+    def _apply(self, operation: str, *args):
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._loaded:
+                getattr(self.lsh, operation)(*args)
+            else:
+                self._pending.append((operation, args))
+
+    def add(self, task_id: int, task_name: str, description: str, user_id: int):
+        self._apply("add", task_id, task_text(task_name, description), user_id)
+
+    def remove(self, task_id: int):
+        self._apply("remove", task_id)
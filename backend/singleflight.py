@@ -0,0 +1,80 @@
+"""
+请求去重：single-flight 合并并发的相同请求 + 幂等键结果缓存
+
+- SingleFlight：同一个 key 同时只执行一次，其他并发调用者等待并共享同一个结果（或异常）
+- IdempotencyStore：按幂等键保存已完成请求的结果，客户端重试时直接返回，不再重复执行
+
+两者都是进程内实现（单个 uvicorn worker 内有效）。
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+
+class SingleFlight:
+    """
+    按 key 合并并发调用
+    fn() 作为独立的任务执行，发起者和跟随者都通过 shield 等待：任何一个调用者被取消（客户端断开）
+    都不会取消执行本身，也不会把 CancelledError 传给其他调用者
+    """
+
+    def __init__(self):
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+
+    def is_inflight(self, key: Hashable) -> bool:
+        return key in self._inflight
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """
+        执行 fn()，如果相同 key 的调用正在进行，则等待它的结果
+        Returns:
+            (结果, 是否与其他调用共享了结果)
+        """
+        existing = self._inflight.get(key)
+        if existing is not None:
+            return await asyncio.shield(existing), True
+
+        task = asyncio.ensure_future(fn())
+        self._inflight[key] = task
+        task.add_done_callback(lambda finished: self._finish(key, finished))
+        return await asyncio.shield(task), False
+
+    def _finish(self, key: Hashable, task: asyncio.Future):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            # 所有调用者都已取消时避免 "exception was never retrieved" 警告
+            task.exception()
+
+
+class IdempotencyStore:
+    """幂等键 -> 结果 的 LRU + TTL 缓存"""
+
+    def __init__(self, ttl_seconds: float = 24 * 3600, max_entries: int = 10000):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        stored_at, value = entry
+        if time.monotonic() - stored_at > self.ttl_seconds:
+            self._entries.pop(key, None)
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: Hashable, value: Any):
+        self._entries[key] = (time.monotonic(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key) is not None
+
+    def __len__(self) -> int:
+        return len(self._entries)
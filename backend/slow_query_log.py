@@ -0,0 +1,261 @@
+"""
+慢查询日志：超过阈值的 SQL 语句记录下来，并自动抓取执行计划
+
+- 在 engine 的 before/after_cursor_execute 事件中计时，超过 SLOW_QUERY_MS 的语句记录：
+  时间、耗时、所属接口（"GET /calendar" 这样的路由模板）、语句、绑定参数的形状（类型和长度，不记录值）、
+  影响/返回行数、数据库（primary / replica）、trace ID（开启追踪时，见 tracing.py）
+- 自动执行 EXPLAIN（SQLite 为 EXPLAIN QUERY PLAN）：用同一个连接、同样的参数，因此看到的是同一事务内的数据；
+  SLOW_QUERY_EXPLAIN_ANALYZE=1 时 PostgreSQL 上的 SELECT 使用 EXPLAIN (ANALYZE, BUFFERS)（会再执行一次查询），
+  写语句只做 EXPLAIN，不会被重复执行。PostgreSQL 上 EXPLAIN 包在 SAVEPOINT 中，失败也不影响当前事务。
+  只 EXPLAIN SELECT/INSERT/UPDATE/DELETE/WITH 语句，DDL（CREATE INDEX、ALTER TABLE 等）只记录，不带执行计划
+- 同一条语句在 SLOW_QUERY_EXPLAIN_INTERVAL 秒内只 EXPLAIN 一次，避免数据库变慢时诊断本身放大负载
+- 记录保存在内存环形缓冲区（GET /admin/slow-queries 查看），配置 SLOW_QUERY_LOG_FILE 时同时写入按大小轮转的 JSONL 文件
+
+环境变量：
+    SLOW_QUERY_MS                  阈值（毫秒），默认 200；0 表示关闭（不注册任何事件）
+    SLOW_QUERY_EXPLAIN             是否自动 EXPLAIN，默认 1
+    SLOW_QUERY_EXPLAIN_ANALYZE     PostgreSQL 上的 SELECT 是否使用 EXPLAIN ANALYZE，默认 0
+    SLOW_QUERY_EXPLAIN_INTERVAL    同一语句两次 EXPLAIN 的最短间隔（秒），默认 300
+    SLOW_QUERY_BUFFER              内存中保留的记录数，默认 200
+    SLOW_QUERY_LOG_FILE            轮转日志文件路径（可选）
+    SLOW_QUERY_LOG_MAX_BYTES       单个日志文件大小上限，默认 10 MB
+    SLOW_QUERY_LOG_BACKUPS         保留的轮转文件个数，默认 5
+"""
+import contextvars
+import json
+import logging
+import os
+import time
+from collections import deque
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+from typing import Dict, List, Optional
+
+from fastapi import Request
+
+import tracing
+
+STATEMENT_MAX_LENGTH = 4000
+EXPLAINABLE_KEYWORDS = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+
+# 当前请求的 ASGI scope（路由匹配后 scope["route"] 即为路由模板）
+_current_scope: contextvars.ContextVar = contextvars.ContextVar("slow_query_scope", default=None)
+
+
+async def track_endpoint(request: Request, call_next):
+    """HTTP 中间件：记录当前请求，慢查询据此标注所属接口"""
+    token = _current_scope.set(request.scope)
+    try:
+        return await call_next(request)
+    finally:
+        _current_scope.reset(token)
+
+
+def current_endpoint() -> Optional[str]:
+    scope = _current_scope.get()
+    if scope is None:
+        return None
+    route = scope.get("route")
+    path = getattr(route, "path", None) or scope.get("path")
+    return f"{scope.get('method')} {path}"
+
+
+def parameter_shape(value):
+    """参数的形状：类型名，字符串和二进制带长度，列表带长度和元素形状（不包含值本身）"""
+    if value is None:
+        return "null"
+    if isinstance(value, (str, bytes)):
+        return f"{type(value).__name__}({len(value)})"
+    if isinstance(value, dict):
+        return {key: parameter_shape(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        if len(value) > 20:
+            return f"{type(value).__name__}[{len(value)}] of {parameter_shape(value[0])}"
+        return [parameter_shape(item) for item in value]
+    return type(value).__name__
+
+
+class SlowQueryLog:
+    """按 engine 注册的慢查询记录器"""
+
+    def __init__(
+        self,
+        threshold_ms: float,
+        explain: bool = True,
+        explain_analyze: bool = False,
+        explain_interval: float = 300.0,
+        buffer_size: int = 200,
+        log_file: Optional[str] = None,
+        log_max_bytes: int = 10 * 1024 * 1024,
+        log_backups: int = 5,
+    ):
+        self.threshold = threshold_ms / 1000.0
+        self.threshold_ms = threshold_ms
+        self.explain = explain
+        self.explain_analyze = explain_analyze
+        self.explain_interval = explain_interval
+        self.records: deque = deque(maxlen=buffer_size)
+        self._explained_at: Dict[str, float] = {}
+        self.stats = {"recorded": 0, "explained": 0, "explain_failed": 0}
+        self._logger = None
+        if log_file:
+            self._logger = logging.getLogger("slow_query")
+            self._logger.setLevel(logging.INFO)
+            self._logger.propagate = False
+            handler = RotatingFileHandler(log_file, maxBytes=log_max_bytes, backupCount=log_backups, encoding="utf-8")
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self._logger.addHandler(handler)
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            threshold_ms=float(os.getenv("SLOW_QUERY_MS", "200")),
+            explain=os.getenv("SLOW_QUERY_EXPLAIN", "1").lower() in ("1", "true", "yes", "on"),
+            explain_analyze=os.getenv("SLOW_QUERY_EXPLAIN_ANALYZE", "0").lower() in ("1", "true", "yes", "on"),
+            explain_interval=float(os.getenv("SLOW_QUERY_EXPLAIN_INTERVAL", "300")),
+            buffer_size=int(os.getenv("SLOW_QUERY_BUFFER", "200")),
+            log_file=os.getenv("SLOW_QUERY_LOG_FILE") or None,
+            log_max_bytes=int(os.getenv("SLOW_QUERY_LOG_MAX_BYTES", str(10 * 1024 * 1024))),
+            log_backups=int(os.getenv("SLOW_QUERY_LOG_BACKUPS", "5")),
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.threshold_ms > 0
+
+    def attach(self, engine, name: str):
+        """在 engine 上注册计时事件；name 记录在每条慢查询中（primary / replica）"""
+        from sqlalchemy import event
+
+        @event.listens_for(engine, "before_cursor_execute")
+        def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault("slow_query_started", []).append(time.perf_counter())
+
+        @event.listens_for(engine, "after_cursor_execute")
+        def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            started = conn.info.get("slow_query_started")
+            if not started:
+                return
+            elapsed = time.perf_counter() - started.pop()
+            if elapsed >= self.threshold:
+                self._record(conn, cursor, statement, parameters, executemany, elapsed, name)
+
+        @event.listens_for(engine, "handle_error")
+        def _handle_error(context):
+            if context.connection is not None:
+                started = context.connection.info.get("slow_query_started")
+                if started:
+                    started.pop()
+
+    # ------------------------------------------------------------------
+    # 记录
+    # ------------------------------------------------------------------
+
+    def _record(self, conn, cursor, statement, parameters, executemany, elapsed, database):
+        rowcount = getattr(cursor, "rowcount", -1)
+        record = {
+            "time": datetime.utcnow().isoformat(timespec="milliseconds") + "Z",
+            "duration_ms": round(elapsed * 1000, 2),
+            "endpoint": current_endpoint(),
+            "database": database,
+            "statement": statement[:STATEMENT_MAX_LENGTH],
+            "parameters": (
+                {"executemany": len(parameters), "first": parameter_shape(parameters[0]) if parameters else None}
+                if executemany else parameter_shape(parameters)
+            ),
+            "rowcount": rowcount if rowcount is not None and rowcount >= 0 else None,
+            "trace_id": tracing.current_trace_id(),
+            "plan": None,
+        }
+        if self.explain:
+            record["plan"] = self._explain(conn, statement, parameters[0] if executemany and parameters else parameters)
+        self.records.append(record)
+        self.stats["recorded"] += 1
+        print(f"⚠️  慢查询 {record['duration_ms']:.1f} ms [{record['endpoint'] or '-'}]: {' '.join(statement.split())[:200]}")
+        if self._logger is not None:
+            self._logger.info(json.dumps(record, ensure_ascii=False, default=str))
+
+    def _explain_sql(self, dialect: str, statement: str) -> Optional[str]:
+        # 只有 SELECT 会被 ANALYZE 重新执行（WITH 在 PostgreSQL 中可能包含写操作）
+        is_select = statement.lstrip().upper().startswith("SELECT")
+        if dialect == "sqlite":
+            return "EXPLAIN QUERY PLAN " + statement
+        if dialect == "postgresql":
+            if self.explain_analyze and is_select:
+                return "EXPLAIN (ANALYZE, BUFFERS) " + statement
+            return "EXPLAIN " + statement
+        if dialect in ("mysql", "mariadb"):
+            return "EXPLAIN " + statement
+        return None
+
+    def _explain(self, conn, statement: str, parameters) -> Optional[List[str]]:
+        """在同一个连接上执行 EXPLAIN（直接使用 DBAPI 游标，不触发 engine 事件）"""
+        words = statement.lstrip(" \t\r\n(").split(None, 1)
+        if not words or words[0].upper() not in EXPLAINABLE_KEYWORDS:
+            return None
+        now = time.monotonic()
+        last = self._explained_at.get(statement)
+        if last is not None and now - last < self.explain_interval:
+            return None
+        if len(self._explained_at) > 1000:
+            self._explained_at.clear()
+        self._explained_at[statement] = now
+
+        dialect = conn.dialect.name
+        sql = self._explain_sql(dialect, statement)
+        if sql is None:
+            return None
+        use_savepoint = dialect == "postgresql"
+        cursor = conn.connection.cursor()
+        try:
+            if use_savepoint:
+                cursor.execute("SAVEPOINT slow_query_explain")
+            try:
+                cursor.execute(sql, parameters or ())
+                rows = cursor.fetchall()
+            except Exception:
+                if use_savepoint:
+                    cursor.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+                raise
+            if use_savepoint:
+                cursor.execute("RELEASE SAVEPOINT slow_query_explain")
+        except Exception as e:
+            self.stats["explain_failed"] += 1
+            return [f"EXPLAIN failed: {type(e).__name__}: {str(e)[:300]}"]
+        finally:
+            cursor.close()
+        self.stats["explained"] += 1
+        if dialect == "sqlite":
+            # EXPLAIN QUERY PLAN 的每一行为 (id, parent, notused, detail)
+            return [str(row[-1]) for row in rows]
+        return [" | ".join(str(column) for column in row) for row in rows]
+
+    # ------------------------------------------------------------------
+    # 查询
+    # ------------------------------------------------------------------
+
+    def recent(self, limit: int = 50, min_ms: float = 0, endpoint: Optional[str] = None) -> List[dict]:
+        """最近的慢查询，新的在前"""
+        result = []
+        for record in reversed(self.records):
+            if record["duration_ms"] < min_ms:
+                continue
+            if endpoint and endpoint not in (record["endpoint"] or ""):
+                continue
+            result.append(record)
+            if len(result) >= limit:
+                break
+        return result
+
+    def clear(self):
+        self.records.clear()
+        self._explained_at.clear()
+
+    def snapshot(self) -> dict:
+        return {
+            "threshold_ms": self.threshold_ms,
+            "explain": self.explain,
+            "explain_analyze": self.explain_analyze,
+            "buffered": len(self.records),
+            **self.stats,
+        }
@@ -0,0 +1,283 @@
+"""
+计划统计汇总（user_daily_stats）
+
+- UserDailyStat 表保存 (用户, 日期, 重要性) -> 分配小时、完成小时、计划项数、完成项数
+- 与 load_index 一样通过 before_flush 事件维护：经由 ORM 的新增、修改、删除、勾选完成计划项，
+  以及删除任务/子任务级联删除的计划项，都在同一次 flush 中更新统计；修改任务重要性时把该任务的计划项移到新的分组
+- 统计包含已归档的计划项：archive.py 只是搬迁行，不改变统计；归档项按归档时记录的重要性统计
+- 统计行用 INSERT ... ON CONFLICT DO UPDATE 原子累加（counters.increment_rows），并发事务不会丢失增量
+- 绕过 ORM 删除计划项或归档项时需要调用 adjust_user_stats()/reset_user_stats()/rebuild_stats()
+- user_stats() 一次按主键范围读取，再在内存中汇总为按日、按周、按月和按重要性的统计
+"""
+from datetime import date, timedelta
+from typing import Dict, Iterable, Optional, Tuple
+
+from sqlalchemy import case, event, func
+from sqlalchemy.orm import Session
+
+from counters import increment_rows
+from models import DailyTaskItem, DailyTaskItemArchive, Subtask, Task, UserDailyStat
+from load_index import _history_old, loaded_tasks
+
+STAT_FIELDS = ("allocated_hours", "completed_hours", "item_count", "completed_count")
+ZERO = (0.0, 0.0, 0, 0)
+
+
+def _item_vector(hours, completed) -> Tuple[float, float, int, int]:
+    hours = hours or 0.0
+    return (hours, hours if completed else 0.0, 1, 1 if completed else 0)
+
+
+def _add(target: dict, key, vector, sign: int = 1):
+    current = target.get(key, ZERO)
+    target[key] = tuple(a + sign * b for a, b in zip(current, vector))
+
+
+# ============================================================================
+# 统计维护
+# ============================================================================
+
+def _collect_item_deltas(session: Session) -> dict:
+    """收集本次 flush 中 DailyTaskItem 变化对 (task_id, date) 统计的影响"""
+    deltas: dict = {}
+    deleted_ids = set()
+
+    def removed(item):
+        if id(item) in deleted_ids or item in session.new:
+            return
+        deleted_ids.add(id(item))
+        key = (_history_old(item, "task_id"), _history_old(item, "date"))
+        _add(deltas, key, _item_vector(_history_old(item, "allocated_hours"), _history_old(item, "is_completed")), -1)
+
+    for obj in session.deleted:
+        if isinstance(obj, DailyTaskItem):
+            removed(obj)
+        elif isinstance(obj, (Task, Subtask)):
+            for item in obj.daily_items:
+                removed(item)
+
+    for obj in session.new:
+        if isinstance(obj, DailyTaskItem) and obj.date is not None:
+            task_id = obj.task_id if obj.task_id is not None else (obj.task.id if obj.task else None)
+            if task_id is not None:
+                _add(deltas, (task_id, obj.date), _item_vector(obj.allocated_hours, obj.is_completed))
+
+    for obj in session.dirty:
+        if not isinstance(obj, DailyTaskItem) or id(obj) in deleted_ids:
+            continue
+        if not session.is_modified(obj, include_collections=False):
+            continue
+        old_key = (_history_old(obj, "task_id"), _history_old(obj, "date"))
+        old_vector = _item_vector(_history_old(obj, "allocated_hours"), _history_old(obj, "is_completed"))
+        new_key = (obj.task_id, obj.date)
+        new_vector = _item_vector(obj.allocated_hours, obj.is_completed)
+        if old_key != new_key or old_vector != new_vector:
+            _add(deltas, old_key, old_vector, -1)
+            _add(deltas, new_key, new_vector)
+
+    return {key: value for key, value in deltas.items() if None not in key and value != ZERO}
+
+
+def _importance_changes(session: Session, user_deltas: dict) -> Dict[int, str]:
+    """重要性被修改的任务：把它在热表中的计划项从旧分组移到新分组，返回 {task_id: 新重要性}"""
+    changed = {}
+    for obj in session.dirty:
+        if not isinstance(obj, Task) or obj in session.deleted:
+            continue
+        old = _history_old(obj, "importance")
+        if old == obj.importance:
+            continue
+        changed[obj.id] = obj.importance
+        # 数据库中的现有计划项（本次 flush 的计划项变化另行计入，使用新的重要性）
+        rows = session.query(
+            DailyTaskItem.date,
+            func.sum(DailyTaskItem.allocated_hours),
+            func.sum(case((DailyTaskItem.is_completed == True, DailyTaskItem.allocated_hours), else_=0.0)),
+            func.count(DailyTaskItem.id),
+            func.sum(case((DailyTaskItem.is_completed == True, 1), else_=0)),
+        ).filter(DailyTaskItem.task_id == obj.id).group_by(DailyTaskItem.date).all()
+        for day, hours, done_hours, count, done_count in rows:
+            vector = (float(hours or 0.0), float(done_hours or 0.0), int(count or 0), int(done_count or 0))
+            _add(user_deltas, (obj.user_id, day, old or "medium"), vector, -1)
+            _add(user_deltas, (obj.user_id, day, obj.importance or "medium"), vector)
+    return changed
+
+
+def adjust_user_stats(session: Session, user_deltas: dict):
+    """按 {(user_id, date, importance): (分配小时, 完成小时, 项数, 完成项数)} 原子累加统计行，行不存在时插入（不提交事务）"""
+    increment_rows(
+        session, UserDailyStat.__table__, ("user_id", "date", "importance"), STAT_FIELDS,
+        {key: value for key, value in user_deltas.items() if any(abs(v) > 1e-9 for v in value)}
+    )
+
+
+@event.listens_for(Session, "before_flush")
+def _maintain_user_daily_stats(session, flush_context, instances):
+    deltas = _collect_item_deltas(session)
+    has_task_changes = any(
+        isinstance(obj, Task) and obj not in session.deleted for obj in session.dirty
+    )
+    if not deltas and not has_task_changes:
+        return
+
+    with session.no_autoflush:
+        user_deltas: dict = {}
+        importance = _importance_changes(session, user_deltas) if has_task_changes else {}
+
+        task_ids = {task_id for task_id, _ in deltas}
+        owners = {}
+        if task_ids:
+            found, missing = loaded_tasks(session, task_ids)
+            owners = {task_id: (task.user_id, task.importance) for task_id, task in found.items()}
+            if missing:
+                owners.update(
+                    (task_id, (user_id, level))
+                    for task_id, user_id, level in session.query(Task.id, Task.user_id, Task.importance).filter(
+                        Task.id.in_(missing)
+                    )
+                )
+            for obj in session.new:
+                if isinstance(obj, Task) and obj.id in task_ids:
+                    owners[obj.id] = (obj.user_id, obj.importance)
+
+        for (task_id, day), vector in deltas.items():
+            owner = owners.get(task_id)
+            if owner is None:
+                continue
+            user_id, level = owner
+            _add(user_deltas, (user_id, day, importance.get(task_id, level) or "medium"), vector)
+
+        adjust_user_stats(session, user_deltas)
+
+
+def archived_task_stats(db: Session, task_ids: Iterable[int]) -> dict:
+    """归档表中这些任务的统计（批量删除归档项前取出，用负值调用 adjust_user_stats）"""
+    task_ids = list(task_ids)
+    if not task_ids:
+        return {}
+    rows = db.query(
+        DailyTaskItemArchive.user_id,
+        DailyTaskItemArchive.date,
+        DailyTaskItemArchive.importance,
+        func.sum(DailyTaskItemArchive.allocated_hours),
+        func.count(DailyTaskItemArchive.id),
+    ).filter(
+        DailyTaskItemArchive.task_id.in_(task_ids)
+    ).group_by(
+        DailyTaskItemArchive.user_id, DailyTaskItemArchive.date, DailyTaskItemArchive.importance
+    ).all()
+    result: dict = {}
+    for user_id, day, level, hours, count in rows:
+        hours = float(hours or 0.0)
+        # 归档项都是已完成的
+        _add(result, (user_id, day, level or "medium"), (hours, hours, int(count), int(count)))
+    return result
+
+
+def negate(user_deltas: dict) -> dict:
+    return {key: tuple(-value for value in vector) for key, vector in user_deltas.items()}
+
+
+def reset_user_stats(db: Session, user_id: int):
+    """批量删除某用户的全部计划项和归档项（绕过 ORM）后清空统计"""
+    db.query(UserDailyStat).filter(UserDailyStat.user_id == user_id).delete(synchronize_session=False)
+
+
+def rebuild_stats(db: Session, user_id: Optional[int] = None):
+    """从 daily_task_items 和 daily_task_items_archive 全量重建统计（迁移或批量操作后使用）"""
+    delete_query = db.query(UserDailyStat)
+    if user_id is not None:
+        delete_query = delete_query.filter(UserDailyStat.user_id == user_id)
+    delete_query.delete(synchronize_session=False)
+
+    totals: dict = {}
+    hot = db.query(
+        Task.user_id,
+        DailyTaskItem.date,
+        Task.importance,
+        func.sum(DailyTaskItem.allocated_hours),
+        func.sum(case((DailyTaskItem.is_completed == True, DailyTaskItem.allocated_hours), else_=0.0)),
+        func.count(DailyTaskItem.id),
+        func.sum(case((DailyTaskItem.is_completed == True, 1), else_=0)),
+    ).join(Task, DailyTaskItem.task_id == Task.id)
+    if user_id is not None:
+        hot = hot.filter(Task.user_id == user_id)
+    for uid, day, level, hours, done_hours, count, done_count in hot.group_by(
+        Task.user_id, DailyTaskItem.date, Task.importance
+    ):
+        vector = (float(hours or 0.0), float(done_hours or 0.0), int(count or 0), int(done_count or 0))
+        _add(totals, (uid, day, level or "medium"), vector)
+
+    archived = db.query(
+        DailyTaskItemArchive.user_id,
+        DailyTaskItemArchive.date,
+        DailyTaskItemArchive.importance,
+        func.sum(DailyTaskItemArchive.allocated_hours),
+        func.count(DailyTaskItemArchive.id),
+    )
+    if user_id is not None:
+        archived = archived.filter(DailyTaskItemArchive.user_id == user_id)
+    for uid, day, level, hours, count in archived.group_by(
+        DailyTaskItemArchive.user_id, DailyTaskItemArchive.date, DailyTaskItemArchive.importance
+    ):
+        hours = float(hours or 0.0)
+        _add(totals, (uid, day, level or "medium"), (hours, hours, int(count), int(count)))
+
+    rows = [
+        dict(zip(("user_id", "date", "importance") + STAT_FIELDS, key + vector))
+        for key, vector in totals.items()
+    ]
+    if rows:
+        db.bulk_insert_mappings(UserDailyStat, rows)
+
+
+# ============================================================================
+# 读取
+# ============================================================================
+
+def _bucket(vector) -> dict:
+    return {
+        "allocated_hours": round(vector[0], 2),
+        "completed_hours": round(vector[1], 2),
+        "items": vector[2],
+        "completed_items": vector[3],
+    }
+
+
+def user_stats(db: Session, user_id: int, start: date, end: date) -> dict:
+    """[start, end] 内按日、按周（周一开始）、按月和按重要性汇总的统计"""
+    daily: dict = {}
+    weekly: dict = {}
+    monthly: dict = {}
+    by_importance: dict = {}
+    total = ZERO
+    rows = db.query(
+        UserDailyStat.date,
+        UserDailyStat.importance,
+        UserDailyStat.allocated_hours,
+        UserDailyStat.completed_hours,
+        UserDailyStat.item_count,
+        UserDailyStat.completed_count,
+    ).filter(
+        UserDailyStat.user_id == user_id,
+        UserDailyStat.date >= start,
+        UserDailyStat.date <= end,
+        UserDailyStat.item_count > 0
+    ).order_by(UserDailyStat.date)
+    for day, level, *values in rows:
+        vector = tuple(values)
+        _add(daily, day, vector)
+        _add(weekly, day - timedelta(days=day.weekday()), vector)
+        _add(monthly, day.replace(day=1), vector)
+        _add(by_importance, level, vector)
+        total = tuple(a + b for a, b in zip(total, vector))
+
+    return {
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "totals": _bucket(total),
+        "by_importance": {level: _bucket(vector) for level, vector in sorted(by_importance.items())},
+        "daily": [{"date": day.isoformat(), **_bucket(vector)} for day, vector in sorted(daily.items())],
+        "weekly": [{"week_start": day.isoformat(), **_bucket(vector)} for day, vector in sorted(weekly.items())],
+        "monthly": [{"month": day.strftime("%Y-%m"), **_bucket(vector)} for day, vector in sorted(monthly.items())],
+    }
@@ -0,0 +1,234 @@
+"""
+任务进度计数（tasks.total_hours / completed_hours / subtask_count / completed_subtasks / next_item_date）
+
+- 通过 before_flush 事件在写入计划项、子任务的同一次 flush 中增量维护，TaskResponse 直接读取，不需要 JOIN
+- 勾选计划项完成状态时同步子任务：子任务的计划项全部完成则标记完成，取消勾选则恢复未完成
+- 时间合计包含已归档的计划项（归档项都已完成，archive.py 搬迁时不改变计数）
+- next_item_date 是最早的未完成计划项日期（早于今天表示逾期）；被删除或完成的恰好是这一天的计划项时重新查询一次
+- 计数以 "列 = 列 + 增量" 的 UPDATE 写入（不在 Python 中读出旧值再写回），多个事务同时修改同一任务的计划项不会丢失增量
+- 绕过 ORM 批量删除计划项后需要调用 reset_task_progress() 或 rebuild_task_progress()
+"""
+from collections import defaultdict
+from typing import Optional
+
+from sqlalchemy import case, event, func
+from sqlalchemy.orm import Session
+
+from models import DailyTaskItem, DailyTaskItemArchive, Subtask, Task
+from load_index import _history_old
+
+PROGRESS_ITEM_FIELDS = ("task_id", "date", "allocated_hours", "is_completed")
+
+
+def _task_of(session: Session, obj) -> Optional[Task]:
+    task = obj.__dict__.get("task")
+    if task is not None:
+        return task
+    task_id = _history_old(obj, "task_id") if obj not in session.new else obj.task_id
+    return session.get(Task, task_id) if task_id is not None else None
+
+
+def _subtask_items_completed(session: Session, subtask: Subtask) -> bool:
+    """
+    子任务的计划项是否全部完成（按本次 flush 之后的状态）
+    本次 flush 涉及的计划项直接看内存中的值：其中有未完成的（取消勾选）就不查询数据库；
+    否则只查询其余计划项中是否还有未完成的一条，不加载整个 daily_items 集合
+    """
+    if "daily_items" in subtask.__dict__:
+        items = [item for item in subtask.daily_items if item not in session.deleted]
+        return bool(items) and all(item.is_completed for item in items)
+    touched = [
+        obj for obj in (*session.new, *session.dirty, *session.deleted)
+        if isinstance(obj, DailyTaskItem) and obj.subtask_id == subtask.id
+    ]
+    remaining = [obj for obj in touched if obj not in session.deleted]
+    if any(not obj.is_completed for obj in remaining):
+        return False
+    touched_ids = [obj.id for obj in touched if obj.id is not None]
+    other = session.query(DailyTaskItem.is_completed).filter(
+        DailyTaskItem.subtask_id == subtask.id,
+        DailyTaskItem.id.notin_(touched_ids or [-1])
+    ).order_by(DailyTaskItem.is_completed).first()  # 未完成（False）排在前面
+    if other is None:
+        return bool(remaining)
+    return bool(other[0])
+
+
+def _sync_subtask_completion(session: Session):
+    """计划项的完成状态变化后，同步所属子任务的 is_completed"""
+    subtasks = {}
+    for obj in session.dirty:
+        if not isinstance(obj, DailyTaskItem) or obj.subtask_id is None:
+            continue
+        if _history_old(obj, "is_completed") == obj.is_completed:
+            continue
+        subtask = obj.subtask if obj.subtask is not None else session.get(Subtask, obj.subtask_id)
+        if subtask is not None and subtask not in session.deleted:
+            subtasks[subtask.id] = subtask
+    for subtask in subtasks.values():
+        completed = _subtask_items_completed(session, subtask)
+        if bool(subtask.is_completed) != completed:
+            subtask.is_completed = completed
+
+
+def _increment(session: Session, task: Task, key: str, delta):
+    """
+    累加任务的计数列：已有任务赋值为 SQL 表达式，flush 时生成 UPDATE tasks SET key = key + :delta，
+    并发事务的增量由数据库累加，不会互相覆盖；flush 后该属性过期，下次访问时重新读取
+    """
+    if not delta:
+        return
+    if task in session.new:
+        setattr(task, key, (getattr(task, key) or 0) + delta)
+    else:
+        setattr(task, key, getattr(Task, key) + delta)
+
+
+@event.listens_for(Session, "before_flush", insert=True)
+def _maintain_task_progress(session, flush_context, instances):
+    # insert=True：先于其他 before_flush 监听器执行，同步出的子任务变化也能被它们看到
+    with session.no_autoflush:
+        _sync_subtask_completion(session)
+
+        hours = defaultdict(lambda: [0.0, 0.0])  # task -> [分配时间变化, 完成时间变化]
+        subtask_counts = defaultdict(lambda: [0, 0])  # task -> [子任务数变化, 完成子任务数变化]
+        earliest = {}  # task -> 本次 flush 后仍未完成的计划项的最早日期
+        recompute = set()  # 需要重新查询 next_item_date 的任务
+        changed_items = defaultdict(set)  # task -> 本次 flush 涉及的已有计划项 ID
+        deleted_tasks = {obj for obj in session.deleted if isinstance(obj, Task)}
+
+        def old_item(item):
+            if item in session.new:
+                return
+            task = _task_of(session, item)
+            if task is None or task in deleted_tasks:
+                return
+            allocated = _history_old(item, "allocated_hours") or 0.0
+            completed = _history_old(item, "is_completed")
+            hours[task][0] -= allocated
+            hours[task][1] -= allocated if completed else 0.0
+            changed_items[task].add(item.id)
+            if not completed and _history_old(item, "date") == task.next_item_date:
+                recompute.add(task)
+
+        def new_item(item):
+            task = item.task if item.task is not None else _task_of(session, item)
+            if task is None or task in deleted_tasks:
+                return
+            allocated = item.allocated_hours or 0.0
+            hours[task][0] += allocated
+            hours[task][1] += allocated if item.is_completed else 0.0
+            if not item.is_completed and item.date is not None:
+                earliest[task] = min(earliest.get(task, item.date), item.date)
+
+        for obj in list(session.deleted):
+            if isinstance(obj, DailyTaskItem):
+                old_item(obj)
+            elif isinstance(obj, Subtask):
+                task = _task_of(session, obj)
+                if task is not None and task not in deleted_tasks:
+                    subtask_counts[task][0] -= 1
+                    subtask_counts[task][1] -= 1 if _history_old(obj, "is_completed") else 0
+                    for item in obj.daily_items:
+                        if item not in session.deleted:
+                            old_item(item)
+
+        for obj in list(session.new):
+            if isinstance(obj, DailyTaskItem):
+                new_item(obj)
+            elif isinstance(obj, Subtask):
+                task = obj.task if obj.task is not None else _task_of(session, obj)
+                if task is not None:
+                    subtask_counts[task][0] += 1
+                    subtask_counts[task][1] += 1 if obj.is_completed else 0
+
+        for obj in list(session.dirty):
+            if obj in session.deleted or not session.is_modified(obj, include_collections=False):
+                continue
+            if isinstance(obj, DailyTaskItem):
+                if any(_history_old(obj, key) != getattr(obj, key) for key in PROGRESS_ITEM_FIELDS):
+                    old_item(obj)
+                    new_item(obj)
+            elif isinstance(obj, Subtask):
+                was, now = bool(_history_old(obj, "is_completed")), bool(obj.is_completed)
+                task = _task_of(session, obj)
+                if was != now and task is not None:
+                    subtask_counts[task][1] += 1 if now else -1
+
+        for task, (allocated, completed) in hours.items():
+            _increment(session, task, "total_hours", allocated)
+            _increment(session, task, "completed_hours", completed)
+        for task, (count, completed) in subtask_counts.items():
+            _increment(session, task, "subtask_count", count)
+            _increment(session, task, "completed_subtasks", completed)
+
+        for task in set(hours) | recompute:
+            if task in recompute and task.id is not None:
+                remaining = session.query(func.min(DailyTaskItem.date)).filter(
+                    DailyTaskItem.task_id == task.id,
+                    DailyTaskItem.is_completed == False,
+                    DailyTaskItem.id.notin_(list(changed_items[task]) or [-1])
+                ).scalar()
+                candidates = [day for day in (remaining, earliest.get(task)) if day is not None]
+                task.next_item_date = min(candidates) if candidates else None
+            elif task in earliest:
+                current = task.next_item_date
+                task.next_item_date = earliest[task] if current is None else min(current, earliest[task])
+
+
+def progress_percent(task: Task) -> float:
+    """按时间计算的完成百分比；没有计划项时按子任务计算"""
+    if task.total_hours:
+        return round(min(100.0, (task.completed_hours or 0.0) * 100.0 / task.total_hours), 1)
+    if task.subtask_count:
+        return round((task.completed_subtasks or 0) * 100.0 / task.subtask_count, 1)
+    return 0.0
+
+
+def reset_task_progress(db: Session, user_id: int):
+    """批量删除某用户的全部计划项和归档项（绕过 ORM）后清零时间计数"""
+    db.query(Task).filter(Task.user_id == user_id).update(
+        {Task.total_hours: 0.0, Task.completed_hours: 0.0, Task.next_item_date: None},
+        synchronize_session="fetch"
+    )
+
+
+def rebuild_task_progress(db: Session, user_id: Optional[int] = None):
+    """从计划项、归档项和子任务全量重建进度计数（迁移时使用）"""
+    totals = defaultdict(lambda: {
+        "total_hours": 0.0, "completed_hours": 0.0,
+        "subtask_count": 0, "completed_subtasks": 0, "next_item_date": None,
+    })
+
+    def scoped(query, user_column):
+        return query.filter(user_column == user_id) if user_id is not None else query
+
+    items = scoped(db.query(
+        DailyTaskItem.task_id,
+        func.sum(DailyTaskItem.allocated_hours),
+        func.sum(case((DailyTaskItem.is_completed == True, DailyTaskItem.allocated_hours), else_=0.0)),
+        func.min(case((DailyTaskItem.is_completed == False, DailyTaskItem.date), else_=None)),
+    ).join(Task, DailyTaskItem.task_id == Task.id), Task.user_id).group_by(DailyTaskItem.task_id)
+    for task_id, allocated, completed, next_date in items:
+        totals[task_id]["total_hours"] += float(allocated or 0.0)
+        totals[task_id]["completed_hours"] += float(completed or 0.0)
+        totals[task_id]["next_item_date"] = next_date
+
+    archived = scoped(db.query(
+        DailyTaskItemArchive.task_id, func.sum(DailyTaskItemArchive.allocated_hours)
+    ), DailyTaskItemArchive.user_id).group_by(DailyTaskItemArchive.task_id)
+    for task_id, allocated in archived:
+        totals[task_id]["total_hours"] += float(allocated or 0.0)
+        totals[task_id]["completed_hours"] += float(allocated or 0.0)
+
+    subtasks = scoped(db.query(
+        Subtask.task_id,
+        func.count(Subtask.id),
+        func.sum(case((Subtask.is_completed == True, 1), else_=0)),
+    ).join(Task, Subtask.task_id == Task.id), Task.user_id).group_by(Subtask.task_id)
+    for task_id, count, completed in subtasks:
+        totals[task_id]["subtask_count"] = int(count or 0)
+        totals[task_id]["completed_subtasks"] = int(completed or 0)
+
+    task_ids = [task_id for (task_id,) in scoped(db.query(Task.id), Task.user_id)]
+    db.bulk_update_mappings(Task, [{"id": task_id, **totals[task_id]} for task_id in task_ids])
@@ -0,0 +1,10 @@
+"""
+后端测试的公共配置
+
+后端模块是 backend/ 下的平铺模块（import database、import llm_resilience），
+这里把 backend/ 加入 sys.path，从仓库根目录或 backend/ 运行 pytest 都可以
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,229 @@
+"""
+llm_resilience.ResilientLLMCaller 对 fake_llm_server.py 的端到端测试：重试、对冲、超时、熔断器状态转换
+
+模拟服务器在后台线程中用 uvicorn 启动（随机端口），每个测试修改它的 FakeLLMConfig 控制延迟、错误和挂起；
+调用方使用真实的 OpenAI SDK（关闭 SDK 自身的重试），与 llm_gateway 的调用方式一致。
+"""
+import asyncio
+import socket
+import threading
+import time
+
+import openai
+import pytest
+import uvicorn
+
+from fake_llm_server import FakeLLMConfig, create_app
+from llm_resilience import CircuitBreaker, CircuitOpenError, LLMTimeoutError, ResilienceConfig, ResilientLLMCaller
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture(scope="module")
+def fake_server():
+    config = FakeLLMConfig(latency="fixed:0", token_delay=0)
+    app = create_app(config)
+    port = _free_port()
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    yield app, f"http://127.0.0.1:{port}/v1"
+    server.should_exit = True
+    thread.join(timeout=5)
+
+
+@pytest.fixture
+def server(fake_server):
+    """每个测试从无延迟、无错误的配置开始"""
+    app, base_url = fake_server
+    config = app.state.config
+    config.sample_latency = lambda: 0.0
+    config.error_rate = 0.0
+    config.error_codes = [503]
+    config.hang_rate = 0.0
+    config.hang_seconds = 2.0
+    app.state.stats.update({"requests": 0, "errors": 0, "hangs": 0, "streams": 0})
+    return app, base_url
+
+
+def _completion(base_url: str, timeout: float = 10.0):
+    client = openai.OpenAI(base_url=base_url, api_key="test", max_retries=0, timeout=timeout)
+
+    def call():
+        response = client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=[{"role": "user", "content": "split this task into subtasks"}],
+        )
+        return response.choices[0].message.content
+
+    return call
+
+
+def _caller(**overrides) -> ResilientLLMCaller:
+    options = dict(timeout=5.0, deadline=5.0, max_retries=2, retry_base_delay=0.01, retry_max_delay=0.05)
+    options.update(overrides)
+    return ResilientLLMCaller(ResilienceConfig(**options))
+
+
+def test_retries_server_errors_until_success(server):
+    app, base_url = server
+    config = app.state.config
+    config.error_rate = 1.0
+    call = _completion(base_url)
+
+    def flaky():
+        # 第二次请求开始前恢复正常：第一次 503 被重试
+        if app.state.stats["requests"] >= 1:
+            config.error_rate = 0.0
+        return call()
+
+    caller = _caller()
+    assert asyncio.run(caller.call(flaky))
+    assert app.state.stats["requests"] == 2
+    assert caller.stats["retries"] == 1
+    assert caller.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_gives_up_after_max_retries(server):
+    app, base_url = server
+    app.state.config.error_rate = 1.0
+    caller = _caller(max_retries=2)
+    with pytest.raises(openai.InternalServerError):
+        asyncio.run(caller.call(_completion(base_url)))
+    assert app.state.stats["requests"] == 3
+    assert caller.stats["failures"] == 1
+
+
+def test_non_retryable_error_is_not_retried(server):
+    app, base_url = server
+    app.state.config.error_rate = 1.0
+    app.state.config.error_codes = [400]
+    caller = _caller()
+    with pytest.raises(openai.BadRequestError):
+        asyncio.run(caller.call(_completion(base_url)))
+    assert app.state.stats["requests"] == 1
+    assert caller.breaker.consecutive_failures == 0
+
+
+def test_deadline_raises_timeout(server):
+    app, base_url = server
+    app.state.config.sample_latency = lambda: 2.0
+    caller = _caller(deadline=0.3)
+    started = time.monotonic()
+    with pytest.raises(LLMTimeoutError):
+        asyncio.run(caller.call(_completion(base_url)))
+    assert time.monotonic() - started < 1.5
+
+
+def test_hedge_wins_over_hanging_request(server):
+    app, base_url = server
+    config = app.state.config
+    config.hang_rate = 1.0
+    call = _completion(base_url)
+
+    def hedged():
+        # 主请求挂起；对冲请求发出前关闭挂起，第二个请求立即返回
+        if app.state.stats["requests"] >= 1:
+            config.hang_rate = 0.0
+        return call()
+
+    caller = _caller(hedge_enabled=True, hedge_after=0.2)
+    started = time.monotonic()
+    assert asyncio.run(caller.call(hedged))
+    assert time.monotonic() - started < 1.5
+    assert caller.stats["hedges"] == 1
+    assert caller.stats["hedge_wins"] == 1
+
+
+def test_breaker_opens_half_opens_and_closes(server):
+    app, base_url = server
+    config = app.state.config
+    config.error_rate = 1.0
+    caller = _caller(max_retries=0, breaker_failure_threshold=2, breaker_reset_seconds=0.3)
+    call = _completion(base_url)
+
+    async def scenario():
+        for _ in range(2):
+            with pytest.raises(openai.InternalServerError):
+                await caller.call(call)
+        assert caller.breaker.state == CircuitBreaker.OPEN
+        requests = app.state.stats["requests"]
+        with pytest.raises(CircuitOpenError):
+            await caller.call(call)
+        assert app.state.stats["requests"] == requests  # 熔断期间不发出请求
+
+        # 半开探测失败：重新打开
+        await asyncio.sleep(0.35)
+        with pytest.raises(openai.InternalServerError):
+            await caller.call(call)
+        assert caller.breaker.state == CircuitBreaker.OPEN
+
+        # 半开探测成功：关闭
+        await asyncio.sleep(0.35)
+        config.error_rate = 0.0
+        assert await caller.call(call)
+        assert caller.breaker.state == CircuitBreaker.CLOSED
+        assert caller.breaker.consecutive_failures == 0
+
+    asyncio.run(scenario())
+    assert caller.stats["short_circuits"] == 1
+
+
+def test_half_open_allows_single_probe(server):
+    app, base_url = server
+    app.state.config.sample_latency = lambda: 0.3
+    caller = _caller(breaker_failure_threshold=1, breaker_reset_seconds=0.1)
+    caller.breaker.record_failure()
+    time.sleep(0.15)
+    call = _completion(base_url)
+
+    async def scenario():
+        probe = asyncio.ensure_future(caller.call(call))
+        await asyncio.sleep(0.05)
+        with pytest.raises(CircuitOpenError):
+            await caller.call(call)
+        assert await probe
+        assert caller.breaker.state == CircuitBreaker.CLOSED
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_probe_releases_half_open_slot(server):
+    app, base_url = server
+    app.state.config.hang_rate = 1.0
+    app.state.config.hang_seconds = 1.0
+    caller = _caller(breaker_failure_threshold=1, breaker_reset_seconds=0.1)
+    caller.breaker.record_failure()
+    time.sleep(0.15)
+    call = _completion(base_url)
+
+    async def scenario():
+        probe = asyncio.ensure_future(caller.call(call))
+        await asyncio.sleep(0.1)
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+
+        # 被取消的探测归还了名额：下一个请求成为新的探测，而不是永远 CircuitOpenError
+        app.state.config.hang_rate = 0.0
+        assert await caller.call(call)
+        assert caller.breaker.state == CircuitBreaker.CLOSED
+
+    asyncio.run(scenario())
+
+
+def test_lost_probe_expires_after_probe_timeout():
+    breaker = CircuitBreaker(failure_threshold=1, reset_seconds=0.05, probe_timeout=0.1)
+    breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.before_call() is True
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    time.sleep(0.11)
+    assert breaker.before_call() is True
@@ -0,0 +1,124 @@
+"""
+任务进度计数（task_progress.py）和 user_daily_stats 汇总（stats_rollup.py）经过 API 修改后的取值
+
+勾选 → 修改时间 → 删除计划项，以及 /calendar/clear 之后，/tasks 的 progress 和 /users/{user_id}/stats
+应与按计划项直接计算的结果一致。使用临时 SQLite 数据库和离线 LLM，通过 TestClient 调用真实的路由。
+"""
+import os
+from datetime import date
+
+import pytest
+from fastapi.testclient import TestClient
+
+STATS_RANGE = {"start_date": "2030-01-01", "end_date": "2030-01-31"}
+
+
+@pytest.fixture(scope="module")
+def client(tmp_path_factory):
+    # main 在导入时按 DATABASE_URL 创建引擎，必须先设置环境变量
+    os.environ["DATABASE_URL"] = f"sqlite:///{tmp_path_factory.mktemp('db') / 'progress.db'}"
+    os.environ["LLM_PROVIDER"] = "offline"
+    import main
+    with TestClient(main.app) as test_client:
+        yield test_client
+
+
+@pytest.fixture
+def user(client, request):
+    created = client.post("/users", json={"nickname": f"progress-{request.node.name}"}).json()
+    return {
+        "user_id": created["user_id"],
+        "headers": {"Authorization": f"Bearer {created['token']}"},
+    }
+
+
+def _add_items(task_id: int, hours_by_day: dict) -> list:
+    """直接写入计划项（与生成计划写入的方式相同，flush 时维护计数）"""
+    from database import SessionLocal
+    from models import DailyTaskItem
+
+    db = SessionLocal()
+    try:
+        items = [
+            DailyTaskItem(task_id=task_id, date=day, allocated_hours=hours)
+            for day, hours in hours_by_day.items()
+        ]
+        db.add_all(items)
+        db.commit()
+        return [item.id for item in items]
+    finally:
+        db.close()
+
+
+def _progress(client, user) -> dict:
+    tasks = client.get("/tasks", headers=user["headers"]).json()
+    assert len(tasks) == 1
+    return tasks[0]["progress"]
+
+
+def _totals(client, user) -> dict:
+    response = client.get(f"/users/{user['user_id']}/stats", params=STATS_RANGE, headers=user["headers"])
+    assert response.status_code == 200
+    return response.json()["totals"]
+
+
+def _create_task(client, user) -> int:
+    response = client.post(
+        "/tasks",
+        json={"task_name": "论文", "description": "写论文", "deadline": "2030-01-31"},
+        headers=user["headers"]
+    )
+    assert response.status_code == 200
+    return response.json()["id"]
+
+
+def test_toggle_edit_delete_keep_counters_consistent(client, user):
+    task_id = _create_task(client, user)
+    first, second = _add_items(task_id, {date(2030, 1, 5): 1.0, date(2030, 1, 6): 2.0})
+
+    progress = _progress(client, user)
+    assert (progress["total_hours"], progress["completed_hours"]) == (3.0, 0.0)
+    assert progress["next_date"] == "2030-01-05"
+    assert _totals(client, user) == {"allocated_hours": 3.0, "completed_hours": 0.0, "items": 2, "completed_items": 0}
+
+    # 勾选完成
+    assert client.put(f"/daily-items/{first}/toggle-complete", headers=user["headers"]).status_code == 200
+    progress = _progress(client, user)
+    assert (progress["total_hours"], progress["completed_hours"]) == (3.0, 1.0)
+    assert progress["next_date"] == "2030-01-06"
+    assert _totals(client, user) == {"allocated_hours": 3.0, "completed_hours": 1.0, "items": 2, "completed_items": 1}
+
+    # 修改已完成计划项的时间：总时间和完成时间同时变化
+    response = client.put(f"/daily-items/{first}", json={"allocated_hours": 3.0}, headers=user["headers"])
+    assert response.status_code == 200
+    progress = _progress(client, user)
+    assert (progress["total_hours"], progress["completed_hours"]) == (5.0, 3.0)
+    assert _totals(client, user) == {"allocated_hours": 5.0, "completed_hours": 3.0, "items": 2, "completed_items": 1}
+
+    # 删除已完成的计划项
+    assert client.delete(f"/daily-items/{first}", headers=user["headers"]).status_code == 200
+    progress = _progress(client, user)
+    assert (progress["total_hours"], progress["completed_hours"]) == (2.0, 0.0)
+    assert progress["next_date"] == "2030-01-06"
+    assert _totals(client, user) == {"allocated_hours": 2.0, "completed_hours": 0.0, "items": 1, "completed_items": 0}
+
+    # 取消勾选后恢复
+    assert client.put(f"/daily-items/{second}/toggle-complete", headers=user["headers"]).status_code == 200
+    assert client.put(f"/daily-items/{second}/toggle-complete", headers=user["headers"]).status_code == 200
+    progress = _progress(client, user)
+    assert (progress["total_hours"], progress["completed_hours"], progress["percent"]) == (2.0, 0.0, 0.0)
+    assert _totals(client, user)["completed_items"] == 0
+
+
+def test_clear_calendar_resets_counters(client, user):
+    task_id = _create_task(client, user)
+    first, _ = _add_items(task_id, {date(2030, 1, 10): 1.5, date(2030, 1, 11): 2.5})
+    assert client.put(f"/daily-items/{first}/toggle-complete", headers=user["headers"]).status_code == 200
+    assert _totals(client, user)["allocated_hours"] == 4.0
+
+    response = client.delete("/calendar/clear", headers=user["headers"])
+    assert response.status_code == 200
+
+    progress = _progress(client, user)
+    assert (progress["total_hours"], progress["completed_hours"], progress["next_date"]) == (0.0, 0.0, None)
+    assert _totals(client, user) == {"allocated_hours": 0.0, "completed_hours": 0.0, "items": 0, "completed_items": 0}
@@ -0,0 +1,88 @@
+"""
+singleflight.SingleFlight：并发合并、异常共享、调用者被取消时的行为
+"""
+import asyncio
+
+import pytest
+
+from singleflight import SingleFlight
+
+
+def test_concurrent_calls_share_one_execution():
+    flight = SingleFlight()
+    calls = []
+
+    async def fn():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return 42
+
+    async def scenario():
+        return await asyncio.gather(flight.do("k", fn), flight.do("k", fn), flight.do("k", fn))
+
+    results = asyncio.run(scenario())
+    assert [result for result, _ in results] == [42, 42, 42]
+    assert [shared for _, shared in results] == [False, True, True]
+    assert len(calls) == 1
+    assert not flight.is_inflight("k")
+
+
+def test_exception_is_shared_and_key_released():
+    flight = SingleFlight()
+
+    async def fn():
+        await asyncio.sleep(0.02)
+        raise ValueError("boom")
+
+    async def scenario():
+        results = await asyncio.gather(flight.do("k", fn), flight.do("k", fn), return_exceptions=True)
+        assert all(isinstance(result, ValueError) for result in results)
+        assert not flight.is_inflight("k")
+        # 之后的调用重新执行
+        async def ok():
+            return 1
+        assert await flight.do("k", ok) == (1, False)
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_leader_does_not_cancel_followers():
+    flight = SingleFlight()
+    calls = []
+
+    async def fn():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return 42
+
+    async def scenario():
+        leader = asyncio.ensure_future(flight.do("k", fn))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flight.do("k", fn))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        assert await follower == (42, True)
+        assert len(calls) == 1
+        assert not flight.is_inflight("k")
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_follower_does_not_cancel_leader():
+    flight = SingleFlight()
+
+    async def fn():
+        await asyncio.sleep(0.05)
+        return 42
+
+    async def scenario():
+        leader = asyncio.ensure_future(flight.do("k", fn))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flight.do("k", fn))
+        await asyncio.sleep(0.01)
+        follower.cancel()
+        assert await leader == (42, False)
+
+    asyncio.run(scenario())
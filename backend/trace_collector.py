@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+本地追踪收集器（OpenTelemetry Collector 的简易替身，只用标准库）
+
+接收 OTLP/HTTP JSON 格式的 POST /v1/traces，把 span 逐行写入 JSONL 文件，
+并在每个 trace 的根 span 到达后打印调用树（每个 span 的耗时和关键属性）。
+也可以直接汇总 TRACING_EXPORTER=file 导出的文件。
+
+用法：
+    python trace_collector.py --port 4318 --output collected_traces.jsonl
+
+然后让后端把追踪数据发给它：
+    TRACING_EXPORTER=otlp TRACING_OTLP_ENDPOINT=http://127.0.0.1:4318/v1/traces uvicorn main:app
+
+汇总文件（file 导出器或本收集器的输出）：
+    python trace_collector.py --summarize traces.jsonl --slowest 10
+"""
+import argparse
+import json
+import sys
+import threading
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+
+# 打印调用树时显示的属性
+TREE_ATTRIBUTES = (
+    "http.response.status_code", "enduser.id", "db.row_count",
+    "gen_ai.request.model", "gen_ai.usage.input_tokens", "gen_ai.usage.output_tokens", "llm.stream.chunks",
+)
+
+
+def _otlp_value(value: dict):
+    if "intValue" in value:
+        return int(value["intValue"])
+    for key in ("stringValue", "boolValue", "doubleValue"):
+        if key in value:
+            return value[key]
+    return None
+
+
+def _otlp_attributes(attributes: List[dict]) -> dict:
+    return {item["key"]: _otlp_value(item.get("value", {})) for item in attributes or []}
+
+
+_STATUS = {0: "UNSET", 1: "OK", 2: "ERROR"}
+
+
+def spans_from_otlp(payload: dict) -> List[dict]:
+    """OTLP JSON → 与 tracing.py file 导出器相同格式的 span 字典"""
+    spans = []
+    for resource_spans in payload.get("resourceSpans", []):
+        resource = _otlp_attributes(resource_spans.get("resource", {}).get("attributes"))
+        for scope_spans in resource_spans.get("scopeSpans", []):
+            for span in scope_spans.get("spans", []):
+                start, end = int(span["startTimeUnixNano"]), int(span["endTimeUnixNano"])
+                status = span.get("status", {})
+                spans.append({
+                    "service": resource.get("service.name"),
+                    "trace_id": span["traceId"],
+                    "span_id": span["spanId"],
+                    "parent_span_id": span.get("parentSpanId"),
+                    "name": span["name"],
+                    "start_time_unix_nano": start,
+                    "end_time_unix_nano": end,
+                    "duration_ms": round((end - start) / 1e6, 3),
+                    "attributes": _otlp_attributes(span.get("attributes")),
+                    "status": {"code": _STATUS.get(status.get("code", 0), "UNSET"), "message": status.get("message", "")},
+                })
+    return spans
+
+
+def format_tree(spans: List[dict]) -> str:
+    """把同一个 trace 的 span 排成调用树"""
+    by_parent: Dict[str, List[dict]] = defaultdict(list)
+    ids = {span["span_id"] for span in spans}
+    roots = []
+    for span in sorted(spans, key=lambda s: s["start_time_unix_nano"]):
+        if span.get("parent_span_id") in ids:
+            by_parent[span["parent_span_id"]].append(span)
+        else:
+            roots.append(span)
+    lines = []
+
+    def walk(span: dict, depth: int):
+        attributes = span.get("attributes", {})
+        details = " ".join(f"{key}={attributes[key]}" for key in TREE_ATTRIBUTES if attributes.get(key) is not None)
+        error = " ❌" if span.get("status", {}).get("code") == "ERROR" else ""
+        lines.append(f"{'  ' * depth}{span['duration_ms']:>9.2f} ms  {span['name']}{error}  {details}".rstrip())
+        for child in by_parent.get(span["span_id"], []):
+            walk(child, depth + 1)
+
+    for root in roots:
+        walk(root, 0)
+    return "\n".join(lines)
+
+
+class Collector:
+    """按 trace 缓存 span，根 span 到达时打印调用树"""
+
+    def __init__(self, output: str, quiet: bool):
+        self.output = open(output, "a", encoding="utf-8") if output else None
+        self.quiet = quiet
+        self.pending: Dict[str, List[dict]] = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def add(self, spans: List[dict]):
+        finished = []
+        with self.lock:
+            if self.output is not None:
+                self.output.write("".join(json.dumps(span, ensure_ascii=False) + "\n" for span in spans))
+                self.output.flush()
+            for span in spans:
+                self.pending[span["trace_id"]].append(span)
+                # 请求 span 最后结束；带 traceparent 的请求 span 有远端父 span，用 http.request.method 识别
+                if not span.get("parent_span_id") or span.get("attributes", {}).get("http.request.method"):
+                    finished.append(span["trace_id"])
+            trees = [(trace_id, self.pending.pop(trace_id, [])) for trace_id in finished]
+        if not self.quiet:
+            for trace_id, trace_spans in trees:
+                if trace_spans:
+                    print(f"🔹 trace {trace_id}（{len(trace_spans)} spans）\n{format_tree(trace_spans)}", flush=True)
+
+
+def make_handler(collector: Collector):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path.split("?")[0] != "/v1/traces":
+                self.send_error(404)
+                return
+            length = int(self.headers.get("Content-Length", "0"))
+            try:
+                spans = spans_from_otlp(json.loads(self.rfile.read(length) or b"{}"))
+            except (ValueError, KeyError) as e:
+                self.send_error(400, str(e))
+                return
+            collector.add(spans)
+            body = b"{}"
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def summarize(path: str, slowest: int):
+    """汇总 JSONL 文件：按 span 名称统计次数和耗时，打印最慢的几个请求的调用树"""
+    traces: Dict[str, List[dict]] = defaultdict(list)
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                span = json.loads(line)
+                traces[span["trace_id"]].append(span)
+
+    by_name: Dict[str, List[float]] = defaultdict(list)
+    tokens = 0
+    for trace_spans in traces.values():
+        for span in trace_spans:
+            by_name[span["name"]].append(span["duration_ms"])
+            tokens += span.get("attributes", {}).get("llm.usage.total_tokens") or 0
+    print(f"🔹 {len(traces)} 个 trace，{sum(len(v) for v in by_name.values())} 个 span，LLM token 合计 {tokens}")
+    print(f"{'span':<48}{'count':>8}{'total ms':>12}{'p50 ms':>10}{'max ms':>10}")
+    for name, durations in sorted(by_name.items(), key=lambda item: -sum(item[1]))[:30]:
+        durations.sort()
+        print(f"{name[:47]:<48}{len(durations):>8}{sum(durations):>12.1f}{durations[len(durations) // 2]:>10.2f}{durations[-1]:>10.2f}")
+
+    def root_duration(trace_spans: List[dict]) -> float:
+        return max(span["duration_ms"] for span in trace_spans)
+
+    for trace_id, trace_spans in sorted(traces.items(), key=lambda item: -root_duration(item[1]))[:slowest]:
+        print(f"\n🔹 trace {trace_id}\n{format_tree(trace_spans)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Minimal OTLP/HTTP JSON trace collector")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=4318)
+    parser.add_argument("--output", default="collected_traces.jsonl", help="写入收到的 span（空字符串表示不写文件）")
+    parser.add_argument("--quiet", action="store_true", help="不打印调用树")
+    parser.add_argument("--summarize", metavar="FILE", help="汇总 JSONL 文件后退出，不启动服务")
+    parser.add_argument("--slowest", type=int, default=5, help="汇总时打印最慢的几个 trace")
+    args = parser.parse_args()
+
+    if args.summarize:
+        summarize(args.summarize, args.slowest)
+        return 0
+
+    collector = Collector(args.output, args.quiet)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(collector))
+    print(f"✅ 追踪收集器已启动: http://{args.host}:{args.port}/v1/traces")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,512 @@
+"""
+分布式追踪（OpenTelemetry 风格，不依赖 opentelemetry SDK）
+
+- 每个 HTTP 请求一个根 span（支持 W3C traceparent 请求头，延续上游的 trace），
+  请求内的 SQL 语句、事务提交（db.commit，flush 产生的语句都在它下面）、LLM 调用是嵌套的子 span
+- span 属性沿用 OpenTelemetry 语义约定：http.*、db.*（含 db.row_count）、gen_ai.*（模型、token 用量）
+- 当前 span 保存在 contextvars 中，跨 await 和 run_in_threadpool 自动传递
+- 导出在后台线程中批量进行，不占用请求路径：
+    file   每行一个 span 的 JSON（TRACING_FILE），可用 trace_collector.py --summarize 查看调用树
+    otlp   OTLP/HTTP JSON（TRACING_OTLP_ENDPOINT），可以发给 OpenTelemetry Collector 或本地的 trace_collector.py
+- 日志关联：追踪开启时，请求内 print 的每一行带 [trace=... span=...] 前缀，logging 记录带 trace_id/span_id 属性；
+  响应头 X-Trace-Id 返回 trace ID
+- TRACING_EXPORTER=none（默认）时不注册任何事件和中间件，没有额外开销
+
+环境变量：
+    TRACING_EXPORTER         none / file / otlp，默认 none
+    TRACING_FILE             file 导出的文件路径，默认 traces.jsonl
+    TRACING_OTLP_ENDPOINT    otlp 导出地址，默认 http://127.0.0.1:4318/v1/traces
+    TRACING_SERVICE_NAME     service.name，默认 plan-backend
+    TRACING_SAMPLE_RATIO     新 trace 的采样比例（0-1），默认 1；带 traceparent 的请求沿用上游的采样决定
+    TRACING_SQL_MAX_LENGTH   db.statement 最多保留的字符数，默认 1000
+    TRACING_LOG_CORRELATION  是否给日志加 trace 前缀，默认 1
+"""
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+TRACING_EXPORTER = os.getenv("TRACING_EXPORTER", "none").lower()
+TRACING_FILE = os.getenv("TRACING_FILE", "traces.jsonl")
+TRACING_OTLP_ENDPOINT = os.getenv("TRACING_OTLP_ENDPOINT", "http://127.0.0.1:4318/v1/traces")
+TRACING_SERVICE_NAME = os.getenv("TRACING_SERVICE_NAME", "plan-backend")
+TRACING_SAMPLE_RATIO = float(os.getenv("TRACING_SAMPLE_RATIO", "1"))
+TRACING_SQL_MAX_LENGTH = int(os.getenv("TRACING_SQL_MAX_LENGTH", "1000"))
+TRACING_LOG_CORRELATION = os.getenv("TRACING_LOG_CORRELATION", "1").lower() in ("1", "true", "yes", "on")
+
+KIND_INTERNAL = "INTERNAL"
+KIND_SERVER = "SERVER"
+KIND_CLIENT = "CLIENT"
+
+
+class Span:
+    """一个计时区间；end() 后交给导出器"""
+
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "kind", "start_ns", "end_ns",
+                 "attributes", "events", "status", "status_message", "_token")
+
+    recording = True
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], kind: str, attributes: Optional[dict]):
+        self.trace_id = trace_id
+        self.span_id = "%016x" % random.getrandbits(64)
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.attributes: Dict[str, object] = dict(attributes) if attributes else {}
+        self.events: List[dict] = []
+        self.status = "UNSET"
+        self.status_message = ""
+        self._token = None
+
+    def set_attribute(self, key: str, value):
+        if value is not None:
+            self.attributes[key] = value
+
+    def set_error(self, message: str):
+        self.status = "ERROR"
+        self.status_message = message[:500]
+
+    def record_exception(self, exc: BaseException):
+        self.events.append({
+            "name": "exception",
+            "time_ns": time.time_ns(),
+            "attributes": {"exception.type": type(exc).__name__, "exception.message": str(exc)[:500]},
+        })
+        self.set_error(f"{type(exc).__name__}: {str(exc)}")
+
+    def end(self):
+        if self.end_ns is not None:
+            return
+        self.end_ns = time.time_ns()
+        if _exporter is not None:
+            _exporter.export(self)
+
+    def duration_ms(self) -> float:
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+
+class _NonRecordingSpan:
+    """未采样的请求：子操作看到它就不再创建 span"""
+
+    __slots__ = ("_token",)
+
+    recording = False
+    trace_id = None
+    span_id = None
+
+    def set_attribute(self, key, value):
+        pass
+
+    def set_error(self, message):
+        pass
+
+    def record_exception(self, exc):
+        pass
+
+    def end(self):
+        pass
+
+
+NON_RECORDING = _NonRecordingSpan()  # 远端 traceparent 未采样时作为父 span
+
+_current_span: contextvars.ContextVar = contextvars.ContextVar("current_span", default=None)
+_exporter = None
+_user_key = None  # 从请求中取用户 ID 的函数（enduser.id）
+
+
+def enabled() -> bool:
+    return _exporter is not None
+
+
+def current_span():
+    return _current_span.get()
+
+
+def current_trace_id() -> Optional[str]:
+    span = _current_span.get()
+    return span.trace_id if span is not None else None
+
+
+def start_span(name: str, kind: str = KIND_INTERNAL, attributes: Optional[dict] = None,
+               root_if_missing: bool = True, parent=None):
+    """
+    创建 span 并设为当前 span（调用方负责 end_span）
+    没有父 span 且 root_if_missing=False 时返回 None（例如请求之外的 SQL）
+    """
+    if _exporter is None:
+        return None
+    parent = parent if parent is not None else _current_span.get()
+    if parent is None:
+        if not root_if_missing:
+            return None
+        if random.random() >= TRACING_SAMPLE_RATIO:
+            span = _NonRecordingSpan()
+        else:
+            span = Span(name, "%032x" % random.getrandbits(128), None, kind, attributes)
+    elif not parent.recording:
+        span = _NonRecordingSpan()
+    else:
+        span = Span(name, parent.trace_id, parent.span_id, kind, attributes)
+    span._token = _current_span.set(span)
+    return span
+
+
+def end_span(span):
+    if span is None:
+        return
+    span.end()
+    token = span._token
+    if token is not None:
+        try:
+            _current_span.reset(token)
+        except ValueError:
+            # 在另一个上下文中结束（例如提交事件在不同的调用栈中触发），恢复为父 span 即可
+            pass
+        span._token = None
+
+
+@contextmanager
+def span(name: str, kind: str = KIND_INTERNAL, attributes: Optional[dict] = None, root_if_missing: bool = True):
+    """with span("name", attributes={...}) as s: ...（追踪关闭时 s 为 None）"""
+    current = start_span(name, kind, attributes, root_if_missing)
+    try:
+        yield current
+    except BaseException as e:
+        if current is not None:
+            current.record_exception(e)
+        raise
+    finally:
+        end_span(current)
+
+
+# ============================================================================
+# W3C traceparent
+# ============================================================================
+
+def parse_traceparent(header: Optional[str]):
+    """返回 (trace_id, parent_span_id, sampled)，格式不对时返回 None"""
+    if not header:
+        return None
+    parts = header.strip().split("-")
+    if len(parts) < 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        int(parts[1], 16), int(parts[2], 16)
+        flags = int(parts[3][:2], 16)
+    except ValueError:
+        return None
+    if parts[1] == "0" * 32 or parts[2] == "0" * 16:
+        return None
+    return parts[1], parts[2], bool(flags & 1)
+
+
+def _remote_parent(header: Optional[str]):
+    parsed = parse_traceparent(header)
+    if parsed is None:
+        return None
+    trace_id, parent_id, sampled = parsed
+    if not sampled:
+        return NON_RECORDING
+    parent = Span.__new__(Span)
+    parent.trace_id, parent.span_id = trace_id, parent_id
+    return parent
+
+
+# ============================================================================
+# 导出
+# ============================================================================
+
+def _span_dict(span: Span) -> dict:
+    return {
+        "trace_id": span.trace_id,
+        "span_id": span.span_id,
+        "parent_span_id": span.parent_id,
+        "name": span.name,
+        "kind": span.kind,
+        "start_time_unix_nano": span.start_ns,
+        "end_time_unix_nano": span.end_ns,
+        "duration_ms": round(span.duration_ms(), 3),
+        "attributes": span.attributes,
+        "events": span.events,
+        "status": {"code": span.status, "message": span.status_message},
+    }
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attributes: dict) -> List[dict]:
+    return [{"key": key, "value": _otlp_value(value)} for key, value in attributes.items()]
+
+
+_OTLP_KINDS = {KIND_INTERNAL: 1, KIND_SERVER: 2, KIND_CLIENT: 3}
+_OTLP_STATUS = {"UNSET": 0, "OK": 1, "ERROR": 2}
+
+
+def _otlp_span(span: Span) -> dict:
+    result = {
+        "traceId": span.trace_id,
+        "spanId": span.span_id,
+        "name": span.name,
+        "kind": _OTLP_KINDS.get(span.kind, 1),
+        "startTimeUnixNano": str(span.start_ns),
+        "endTimeUnixNano": str(span.end_ns),
+        "attributes": _otlp_attributes(span.attributes),
+        "events": [
+            {"name": event["name"], "timeUnixNano": str(event["time_ns"]), "attributes": _otlp_attributes(event["attributes"])}
+            for event in span.events
+        ],
+        "status": {"code": _OTLP_STATUS[span.status], "message": span.status_message},
+    }
+    if span.parent_id:
+        result["parentSpanId"] = span.parent_id
+    return result
+
+
+class BatchExporter:
+    """后台线程批量导出；队列满时丢弃 span（计入 stats），不阻塞请求"""
+
+    def __init__(self, kind: str, max_queue: int = 20000, batch_size: int = 512, interval: float = 1.0):
+        self.kind = kind
+        self.batch_size = batch_size
+        self.interval = interval
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max_queue)
+        self._file = None
+        self._last_error_at = 0.0
+        self.stats = {"exported": 0, "dropped": 0, "failed": 0}
+        self._thread = threading.Thread(target=self._run, name="trace-export", daemon=True)
+        self._thread.start()
+
+    def export(self, span: Span):
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.stats["dropped"] += 1
+
+    def _run(self):
+        while True:
+            try:
+                batch = [self._queue.get(timeout=self.interval)]
+            except queue.Empty:
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+                self.stats["exported"] += len(batch)
+            except Exception as e:
+                self.stats["failed"] += len(batch)
+                now = time.monotonic()
+                if now - self._last_error_at > 60:
+                    self._last_error_at = now
+                    print(f"⚠️  导出追踪数据失败: {str(e)}")
+
+    def _write(self, batch: List[Span]):
+        if self.kind == "file":
+            if self._file is None:
+                self._file = open(TRACING_FILE, "a", encoding="utf-8")
+            self._file.write("".join(json.dumps(_span_dict(span), ensure_ascii=False) + "\n" for span in batch))
+            self._file.flush()
+            return
+        body = json.dumps({"resourceSpans": [{
+            "resource": {"attributes": _otlp_attributes({"service.name": TRACING_SERVICE_NAME})},
+            "scopeSpans": [{"scope": {"name": "plan_project.tracing"}, "spans": [_otlp_span(span) for span in batch]}],
+        }]}).encode("utf-8")
+        request = urllib.request.Request(
+            TRACING_OTLP_ENDPOINT, data=body, headers={"Content-Type": "application/json"}, method="POST"
+        )
+        with urllib.request.urlopen(request, timeout=5) as response:
+            response.read()
+
+
+# ============================================================================
+# 日志关联
+# ============================================================================
+
+class _TraceLinePrefixer:
+    """包装 stdout/stderr：请求内输出的每一行前加 [trace=... span=...]"""
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._at_line_start = True
+
+    def write(self, text):
+        current = _current_span.get()
+        if current is None or not current.recording or not text:
+            self._at_line_start = text.endswith("\n") if text else self._at_line_start
+            return self._stream.write(text)
+        prefix = f"[trace={current.trace_id} span={current.span_id}] "
+        lines = text.split("\n")
+        out = []
+        for index, line in enumerate(lines):
+            if line and (index > 0 or self._at_line_start):
+                line = prefix + line
+            out.append(line)
+        self._at_line_start = text.endswith("\n")
+        return self._stream.write("\n".join(out))
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+def _install_log_correlation():
+    factory = logging.getLogRecordFactory()
+
+    def record_factory(*args, **kwargs):
+        record = factory(*args, **kwargs)
+        current = _current_span.get()
+        recording = current is not None and current.recording
+        record.trace_id = current.trace_id if recording else "-"
+        record.span_id = current.span_id if recording else "-"
+        return record
+
+    logging.setLogRecordFactory(record_factory)
+    sys.stdout = _TraceLinePrefixer(sys.stdout)
+    sys.stderr = _TraceLinePrefixer(sys.stderr)
+
+
+# ============================================================================
+# SQL
+# ============================================================================
+
+def _install_sql_hooks():
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    from sqlalchemy.orm import Session
+
+    @event.listens_for(Engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ""
+        current = start_span(f"db {operation}".strip(), KIND_CLIENT, {
+            "db.system": conn.dialect.name,
+            "db.operation": operation,
+            "db.statement": statement[:TRACING_SQL_MAX_LENGTH],
+            "db.executemany": executemany or None,
+        }, root_if_missing=False)
+        if current is not None:
+            conn.info.setdefault("trace_spans", []).append(current)
+
+    @event.listens_for(Engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        spans = conn.info.get("trace_spans")
+        if not spans:
+            return
+        current = spans.pop()
+        rowcount = getattr(cursor, "rowcount", -1)
+        if rowcount is not None and rowcount >= 0:
+            current.set_attribute("db.row_count", rowcount)
+        end_span(current)
+
+    @event.listens_for(Engine, "handle_error")
+    def _handle_error(context):
+        spans = context.connection.info.get("trace_spans") if context.connection is not None else None
+        if not spans:
+            return
+        current = spans.pop()
+        current.record_exception(context.original_exception)
+        end_span(current)
+
+    # 事务提交：flush 中各个维护事件的查询和写入语句都嵌套在 db.commit 下
+    @event.listens_for(Session, "before_commit")
+    def _before_commit(session):
+        if session.info.get("trace_commit_span") is None:
+            current = start_span("db.commit", KIND_INTERNAL, {
+                "db.new": len(session.new), "db.dirty": len(session.dirty), "db.deleted": len(session.deleted),
+            }, root_if_missing=False)
+            if current is not None:
+                session.info["trace_commit_span"] = current
+
+    @event.listens_for(Session, "after_commit")
+    def _after_commit(session):
+        end_span(session.info.pop("trace_commit_span", None))
+
+    @event.listens_for(Session, "after_rollback")
+    def _after_rollback(session):
+        current = session.info.pop("trace_commit_span", None)
+        if current is not None:
+            current.set_error("rolled back")
+            end_span(current)
+
+
+# ============================================================================
+# HTTP 中间件
+# ============================================================================
+
+async def trace_requests(request, call_next):
+    """HTTP 中间件：每个请求一个 SERVER span，响应头带 X-Trace-Id"""
+    if _exporter is None:
+        return await call_next(request)
+    parent = _remote_parent(request.headers.get("traceparent"))
+    root = start_span(f"{request.method} {request.url.path}", KIND_SERVER, {
+        "http.request.method": request.method,
+        "url.path": request.url.path,
+        "url.query": request.url.query or None,
+        "client.address": request.client.host if request.client else None,
+        "user_agent.original": request.headers.get("user-agent"),
+    }, parent=parent)
+    try:
+        response = await call_next(request)
+    except BaseException as e:
+        root.record_exception(e)
+        end_span(root)
+        raise
+    route = request.scope.get("route")
+    if route is not None and getattr(route, "path", None) and root.recording:
+        root.name = f"{request.method} {route.path}"
+        root.set_attribute("http.route", route.path)
+    root.set_attribute("http.response.status_code", response.status_code)
+    if _user_key is not None and root.recording:
+        root.set_attribute("enduser.id", _user_key(request))
+    if response.status_code >= 500:
+        root.set_error(f"HTTP {response.status_code}")
+    if root.recording:
+        response.headers["X-Trace-Id"] = root.trace_id
+    end_span(root)
+    return response
+
+
+def setup_tracing(user_key=None):
+    """
+    按环境变量开启追踪（应用启动时调用一次），返回是否已开启（开启时才需要注册 trace_requests 中间件）
+    user_key(request) 返回请求的用户 ID，记录为 enduser.id
+    """
+    global _exporter, _user_key
+    if _exporter is not None:
+        return True
+    if TRACING_EXPORTER in ("", "none", "off"):
+        return False
+    if TRACING_EXPORTER not in ("file", "otlp"):
+        raise ValueError(f"Unknown TRACING_EXPORTER: {TRACING_EXPORTER}")
+    _user_key = user_key
+    _exporter = BatchExporter(TRACING_EXPORTER)
+    _install_sql_hooks()
+    if TRACING_LOG_CORRELATION:
+        _install_log_correlation()
+    target = TRACING_FILE if TRACING_EXPORTER == "file" else TRACING_OTLP_ENDPOINT
+    print(f"✅ 追踪已启用（{TRACING_EXPORTER} → {target}，采样比例 {TRACING_SAMPLE_RATIO}）")
+    return True
+
+
+def exporter_stats() -> Optional[dict]:
+    return dict(_exporter.stats) if _exporter is not None else None
@@ -1,10 +1,11 @@
-import { useState, useEffect } from 'react'
+import { useState, useEffect, useRef } from 'react'
 import { Link } from 'react-router-dom'
 import { useUser } from './UserContext'
 import FullCalendar from '@fullcalendar/react'
 import dayGridPlugin from '@fullcalendar/daygrid'
 import axios from 'axios'
 import { API_BASE_URL } from './config'
+import { createCalendarStore, syncCalendar, calendarRows, localToday, applyChangeEvents, subscribeCalendarEvents } from './calendarSync'
 
 function CalendarPage() {
   const { user } = useUser()
@@ -25,11 +26,22 @@ function CalendarPage() {
   const [newTaskHours, setNewTaskHours] = useState(2)
   const [newTaskImportance, setNewTaskImportance] = useState('medium')
   const [creating, setCreating] = useState(false)
+  // 本地日历副本和 /sync 游标：首次加载取全量快照，之后的刷新只取变化的行
+  const storeRef = useRef(createCalendarStore())
 
   useEffect(() => {
-    if (user) {
-      fetchCalendarData()
-    }
+    if (!user) return
+    storeRef.current = createCalendarStore()
+    setLoading(true)
+    fetchCalendarData()
+    // 其他设备、后台生成计划的变化实时推送；重连或 resync 时用 /sync 补齐
+    return subscribeCalendarEvents(user, {
+      onChanges: (changes) => {
+        applyChangeEvents(storeRef.current, changes)
+        renderStore()
+      },
+      onResync: () => fetchCalendarData(),
+    })
   }, [user])
 
   const fetchCalendarData = async () => {
@@ -39,35 +51,8 @@ function CalendarPage() {
     }
 
     try {
-      setLoading(true)
-      // Get user timezone offset (hours)
-      const timezoneOffset = -new Date().getTimezoneOffset() / 60
-      const response = await axios.get(
-        `${API_BASE_URL}/calendar?user_id=${user.user_id}&timezone_offset=${timezoneOffset}`
-      )
-      
-      setItems(response.data)
-      
-      // Convert data to FullCalendar event format
-      const calendarEvents = response.data.map(item => {
-        // Long-term tasks may not have subtasks (subtask_id === 0), only show task name
-        const displayName = item.subtask_id === 0 || !item.subtask_id
-          ? `${item.task_name} (${item.allocated_hours}h)`
-          : `${item.task_name}: ${item.subtask_name} (${item.allocated_hours}h)`
-        
-        return {
-          id: item.id.toString(),
-          title: displayName,
-          date: item.date,
-          backgroundColor: getColorForImportance(item.importance),
-          borderColor: getColorForImportance(item.importance),
-          extendedProps: {
-            item: item
-          }
-        }
-      })
-      
-      setEvents(calendarEvents)
+      await syncCalendar(storeRef.current, user, localToday())
+      renderStore()
       setError('')
     } catch (err) {
       setError('Failed to load plans. Please check if the backend service is running')
@@ -77,6 +62,32 @@ function CalendarPage() {
     }
   }
 
+  const renderStore = () => {
+    const rows = calendarRows(storeRef.current, localToday())
+    setItems(rows)
+    
+    // Convert data to FullCalendar event format
+    const calendarEvents = rows.map(item => {
+      // Long-term tasks may not have subtasks (subtask_id === 0), only show task name
+      const displayName = item.subtask_id === 0 || !item.subtask_id
+        ? `${item.task_name} (${item.allocated_hours}h)`
+        : `${item.task_name}: ${item.subtask_name} (${item.allocated_hours}h)`
+      
+      return {
+        id: item.id.toString(),
+        title: displayName,
+        date: item.date,
+        backgroundColor: getColorForImportance(item.importance),
+        borderColor: getColorForImportance(item.importance),
+        extendedProps: {
+          item: item
+        }
+      }
+    })
+    
+    setEvents(calendarEvents)
+  }
+
   // Generate color based on importance
   const getColorForImportance = (importance) => {
     const colors = {
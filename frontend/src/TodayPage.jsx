@@ -3,6 +3,41 @@ import { Link } from 'react-router-dom'
 import { useUser } from './UserContext'
 import axios from 'axios'
 import { API_BASE_URL } from './config'
+import { localToday, subscribeCalendarEvents } from './calendarSync'
+
+// 新增到今天的计划项：本地没有它所属任务、子任务的名称，需要重新获取
+const isNewTodayItem = (event) => event.type === 'item.created' && event.data?.date === localToday()
+
+// 把推送的变更应用到今日计划列表（字段与 /today 的响应一致）
+const applyTodayChanges = (plans, events) => {
+  let result = plans
+  events.forEach((event) => {
+    const [entity, op] = event.type.split('.')
+    if (entity === 'item') {
+      result = op === 'deleted' || event.data?.date !== localToday()
+        ? result.filter((plan) => plan.id !== event.id)
+        : result.map((plan) => plan.id === event.id
+          ? { ...plan, allocated_hours: event.data.allocated_hours, is_completed: event.data.is_completed }
+          : plan)
+    } else if (entity === 'task') {
+      result = op === 'deleted'
+        ? result.filter((plan) => plan.task_id !== event.id)
+        : result.map((plan) => plan.task_id === event.id
+          ? {
+              ...plan,
+              task_name: event.data.task_name,
+              importance: event.data.importance,
+              subtask_name: plan.subtask_id === 0 ? event.data.task_name : plan.subtask_name,
+            }
+          : plan)
+    } else if (entity === 'subtask') {
+      result = op === 'deleted'
+        ? result.filter((plan) => plan.subtask_id !== event.id)
+        : result.map((plan) => plan.subtask_id === event.id ? { ...plan, subtask_name: event.data.subtask_name } : plan)
+    }
+  })
+  return result
+}
 
 function TodayPage() {
   const { user } = useUser()
@@ -12,19 +47,29 @@ function TodayPage() {
   const [toggling, setToggling] = useState(null)
 
   useEffect(() => {
-    if (user) {
-      fetchTodayPlans()
-    }
+    if (!user) return
+    fetchTodayPlans()
+    // 今日计划只有一天的数据：能直接应用的变更就地更新，其余（新增今天的计划项、resync）重新获取 /today
+    return subscribeCalendarEvents(user, {
+      onChanges: (changes) => {
+        if (changes.some(isNewTodayItem)) {
+          fetchTodayPlans(false)
+        } else {
+          setPlans((current) => applyTodayChanges(current, changes))
+        }
+      },
+      onResync: () => fetchTodayPlans(false),
+    })
   }, [user])
 
-  const fetchTodayPlans = async () => {
+  const fetchTodayPlans = async (showLoading = true) => {
     if (!user) {
       setError('Please create or select a user first')
       return
     }
 
     try {
-      setLoading(true)
+      if (showLoading) setLoading(true)
       // Get user timezone offset (hours)
       // getTimezoneOffset() returns minutes and is inverted (UTC+8 returns -480)
       // So we need to divide by -60 to convert to hours
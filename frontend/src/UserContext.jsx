@@ -4,6 +4,33 @@ import { API_BASE_URL } from './config'
 
 const UserContext = createContext()
 
+// 会话令牌：所有请求通过 Authorization 头携带，后端不再按 user_id 查询用户
+const setAuthToken = (token) => {
+  if (token) {
+    axios.defaults.headers.common['Authorization'] = `Bearer ${token}`
+  } else {
+    delete axios.defaults.headers.common['Authorization']
+  }
+}
+
+// 令牌缺失或一天内过期时重新登录获取
+const tokenNeedsRefresh = (userData) => {
+  if (!userData.token || !userData.token_expires_at) return true
+  return new Date(userData.token_expires_at).getTime() - Date.now() < 24 * 3600 * 1000
+}
+
+// 令牌被拒绝（服务端重启后换了密钥、已过期）时按昵称重新获取；并发的多个 401 共用同一次请求
+let refreshPromise = null
+const refreshToken = (nickname) => {
+  if (!refreshPromise) {
+    refreshPromise = axios
+      .get(`${API_BASE_URL}/users/by-nickname/${encodeURIComponent(nickname)}`, { _skipAuthRetry: true })
+      .then((response) => response.data)
+      .finally(() => { refreshPromise = null })
+  }
+  return refreshPromise
+}
+
 export const useUser = () => {
   const context = useContext(UserContext)
   if (!context) {
@@ -16,27 +43,68 @@ export const UserProvider = ({ children }) => {
   const [user, setUser] = useState(null)
   const [loading, setLoading] = useState(true)
 
-  // 从 localStorage 加载用户信息
+  const saveUser = (userData) => {
+    setAuthToken(userData.token)
+    setUser(userData)
+    localStorage.setItem('user', JSON.stringify(userData))
+  }
+
+  // 401 时重新获取令牌并重试一次原请求
   useEffect(() => {
-    const savedUser = localStorage.getItem('user')
-    if (savedUser) {
+    const interceptor = axios.interceptors.response.use(undefined, async (error) => {
+      const config = error.config
+      const savedUser = localStorage.getItem('user')
+      if (error.response?.status !== 401 || !config || config._skipAuthRetry || config._authRetried || !savedUser) {
+        throw error
+      }
+      let userData
       try {
-        const userData = JSON.parse(savedUser)
-        setUser(userData)
+        userData = await refreshToken(JSON.parse(savedUser).nickname)
       } catch (e) {
-        console.error('Failed to parse saved user:', e)
-        localStorage.removeItem('user')
+        console.error('Failed to refresh session token:', e)
+        throw error
+      }
+      saveUser(userData)
+      config._authRetried = true
+      config.headers['Authorization'] = `Bearer ${userData.token}`
+      return axios(config)
+    })
+    return () => axios.interceptors.response.eject(interceptor)
+  }, [])
+
+  // 从 localStorage 加载用户信息
+  useEffect(() => {
+    const loadSavedUser = async () => {
+      const savedUser = localStorage.getItem('user')
+      if (savedUser) {
+        try {
+          const userData = JSON.parse(savedUser)
+          setAuthToken(userData.token)
+          setUser(userData)
+          if (tokenNeedsRefresh(userData)) {
+            const response = await axios.get(`${API_BASE_URL}/users/by-nickname/${encodeURIComponent(userData.nickname)}`)
+            saveUser(response.data)
+          }
+        } catch (e) {
+          console.error('Failed to load saved user:', e)
+          // 本地数据无法解析或用户已不存在时清除；网络错误保留本地用户
+          if (e instanceof SyntaxError || e.response?.status === 404) {
+            setAuthToken(null)
+            setUser(null)
+            localStorage.removeItem('user')
+          }
+        }
       }
+      setLoading(false)
     }
-    setLoading(false)
+    loadSavedUser()
   }, [])
 
   const createUser = async (nickname) => {
     try {
       const response = await axios.post(`${API_BASE_URL}/users`, { nickname })
       const userData = response.data
-      setUser(userData)
-      localStorage.setItem('user', JSON.stringify(userData))
+      saveUser(userData)
       return userData
     } catch (error) {
       console.error('Failed to create user:', error)
@@ -48,8 +116,7 @@ export const UserProvider = ({ children }) => {
     try {
       const response = await axios.get(`${API_BASE_URL}/users/by-nickname/${encodeURIComponent(nickname)}`)
       const userData = response.data
-      setUser(userData)
-      localStorage.setItem('user', JSON.stringify(userData))
+      saveUser(userData)
       return userData
     } catch (error) {
       if (error.response?.status === 404) {
@@ -62,6 +129,7 @@ export const UserProvider = ({ children }) => {
   }
 
   const logout = () => {
+    setAuthToken(null)
     setUser(null)
     localStorage.removeItem('user')
   }
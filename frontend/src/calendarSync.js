@@ -0,0 +1,130 @@
+import axios from 'axios'
+import { API_BASE_URL } from './config'
+
+// 日历数据的本地副本：首次调用 /sync 取全量快照，之后带上次的 cursor 只取变化的行和删除的 ID
+export const createCalendarStore = () => ({
+  cursor: null,
+  tasks: new Map(),
+  subtasks: new Map(),
+  items: new Map(),
+  pending: Promise.resolve(),  // 同一时间只有一个 /sync 请求，后一个使用前一个返回的 cursor
+})
+
+// 本地日期（YYYY-MM-DD），与日历显示的"今天"一致
+export const localToday = () => {
+  const now = new Date()
+  const pad = (value) => String(value).padStart(2, '0')
+  return `${now.getFullYear()}-${pad(now.getMonth() + 1)}-${pad(now.getDate())}`
+}
+
+export const applySyncResponse = (store, data) => {
+  if (data.full) {
+    store.tasks.clear()
+    store.subtasks.clear()
+    store.items.clear()
+  }
+  data.tasks.forEach((task) => store.tasks.set(task.id, task))
+  data.subtasks.forEach((subtask) => store.subtasks.set(subtask.id, subtask))
+  data.items.forEach((item) => store.items.set(item.id, item))
+  data.deleted.tasks.forEach((id) => store.tasks.delete(id))
+  data.deleted.subtasks.forEach((id) => store.subtasks.delete(id))
+  data.deleted.items.forEach((id) => store.items.delete(id))
+  store.cursor = data.cursor
+}
+
+// 拉取 cursor 之后的变化；没有 cursor（第一次）时服务端返回从 startDate 开始的全量快照
+export const syncCalendar = (store, user, startDate) => {
+  const run = async () => {
+    const params = { user_id: user.user_id }
+    if (store.cursor) {
+      params.since = store.cursor
+    } else if (startDate) {
+      params.start_date = startDate
+    }
+    const response = await axios.get(`${API_BASE_URL}/sync`, { params })
+    applySyncResponse(store, response.data)
+    return response.data
+  }
+  const result = store.pending.catch(() => {}).then(run)
+  store.pending = result
+  return result
+}
+
+// 转成与 /calendar 相同字段的计划项列表（按日期、ID 排序），startDate 之前的行不返回
+export const calendarRows = (store, startDate) => {
+  const rows = []
+  store.items.forEach((item) => {
+    if (startDate && item.date < startDate) return
+    const task = store.tasks.get(item.task_id)
+    if (!task) return
+    const subtask = item.subtask_id ? store.subtasks.get(item.subtask_id) : null
+    rows.push({
+      ...item,
+      task_name: task.task_name,
+      subtask_name: subtask ? subtask.subtask_name : task.task_name,
+      importance: task.importance || 'medium',
+    })
+  })
+  return rows.sort((a, b) => (a.date < b.date ? -1 : a.date > b.date ? 1 : a.id - b.id))
+}
+
+const STORE_MAPS = { task: 'tasks', subtask: 'subtasks', item: 'items' }
+
+// 应用推送的行级变更事件（{"type": "item.updated", "id": 12, "data": {...}}，删除事件只有 id）
+export const applyChangeEvents = (store, events) => {
+  events.forEach((event) => {
+    const [entity, op] = event.type.split('.')
+    const rows = store[STORE_MAPS[entity]]
+    if (!rows) return
+    if (op === 'deleted') {
+      rows.delete(event.id)
+    } else {
+      rows.set(event.id, { ...rows.get(event.id), ...event.data, id: event.id })
+    }
+  })
+}
+
+const currentToken = (user) => {
+  try {
+    return JSON.parse(localStorage.getItem('user'))?.token || user.token
+  } catch (e) {
+    return user.token
+  }
+}
+
+// 订阅 /users/{user_id}/events：每次（重新）连接成功和收到 resync 时调用 onResync（调用方用 /sync 补齐），
+// 其余变更交给 onChanges。EventSource 不能设置请求头，令牌放在 access_token 参数中；
+// 连接被拒绝（例如令牌失效）时 EventSource 不会自动重连：先调用 onResync（/sync 的 401 会刷新令牌），
+// 隔几秒再用最新的令牌重新连接
+export const subscribeCalendarEvents = (user, { onChanges, onResync }) => {
+  let source = null
+  let retryTimer = null
+  let closed = false
+
+  const connect = () => {
+    const token = encodeURIComponent(currentToken(user) || '')
+    source = new EventSource(`${API_BASE_URL}/users/${encodeURIComponent(user.user_id)}/events?access_token=${token}`)
+    source.addEventListener('ready', () => onResync())
+    source.addEventListener('changes', (message) => {
+      const events = JSON.parse(message.data).events || []
+      if (events.some((event) => event.type === 'resync')) {
+        onResync()
+      } else if (events.length > 0) {
+        onChanges(events)
+      }
+    })
+    source.onerror = () => {
+      if (source.readyState === EventSource.CLOSED && !closed) {
+        onResync()
+        retryTimer = setTimeout(connect, 5000)
+      }
+    }
+  }
+
+  connect()
+  return () => {
+    closed = true
+    clearTimeout(retryTimer)
+    if (source) source.close()
+  }
+}